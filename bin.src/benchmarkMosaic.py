@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Time obs_mosaic on a synthetic repository and check the times against limits
+
+The exit status is 1 if any benchmark is slower than its limit.
+
+    benchmarkMosaic.py
+    benchmarkMosaic.py --root /tmp/synthetic -c numVisits=4 repeat=1 benchmarks="['mapperGet']"
+    benchmarkMosaic.py -C myLimits.py
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import sys
+
+import lsst.log
+from lsst.obs.mosaic.benchmark import MosaicBenchmarkConfig, runBenchmarks, formatBenchmarkResults
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", help="write the synthetic repository here and keep it")
+    parser.add_argument("-C", "--configfile", action="append", default=[], help="config override file")
+    parser.add_argument("-c", "--config", nargs="*", default=[], metavar="NAME=VALUE",
+                        help="config overrides, e.g. repeat=1")
+    args = parser.parse_args()
+
+    config = MosaicBenchmarkConfig()
+    for path in args.configfile:
+        config.load(path)
+    for item in args.config:
+        name, sep, value = item.partition("=")
+        if not sep:
+            parser.error("Invalid config override %r; expected NAME=VALUE" % (item,))
+        setattr(config, name, eval(value, {}))
+
+    results = runBenchmarks(config, root=args.root, log=lsst.log.Log.getLogger("benchmarkMosaic"))
+    print(formatBenchmarkResults(results))
+    sys.exit(0 if all(result.passed for result in results) else 1)
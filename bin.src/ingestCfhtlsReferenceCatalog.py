@@ -0,0 +1,3 @@
+#!/usr/bin/env python
+from lsst.obs.mosaic.ingestCfhtls import IngestCfhtlsReferenceTask
+IngestCfhtlsReferenceTask.parseAndRun()
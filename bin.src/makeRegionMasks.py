@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Build the "masked" dataset of a repository from ds9 region files
+
+The region file of each raw CCD is looked up in REGIONS as
+<field>/<subfield>/<filter>/<dateObs>/<objname>_<ccdnum>.reg; the pixels inside
+the regions are set to 0 in a copy of the bad pixel mask, which is written
+tile compressed as the "masked" dataset of the CCD.
+
+    makeRegionMasks.py DATA DATA/regions -j 8
+    makeRegionMasks.py DATA DATA/regions --id objname=obj330 --bpm bpm.fits --clobber
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+
+import lsst.log
+from lsst.obs.mosaic import MosaicMapper
+from lsst.obs.mosaic import regionMask
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", help="root of the repository of the raw data")
+    parser.add_argument("regions", help="directory of the region files")
+    parser.add_argument("--id", nargs="*", default=[], metavar="KEY=VALUE",
+                        help="restrict to the raw data with these values, e.g. objname=obj330 ccdnum=2")
+    parser.add_argument("--template", default=regionMask.REGION_TEMPLATE,
+                        help="path of a region file relative to REGIONS (default: %(default)s)")
+    parser.add_argument("--bpm", help="bad pixel mask to use for all CCDs, instead of the bpm dataset")
+    parser.add_argument("--observatory", default="kpno", help="observatory of the bpm dataset")
+    parser.add_argument("--clobber", action="store_true", help="replace existing masked images")
+    parser.add_argument("-j", "--processes", type=int, default=1, help="number of worker processes")
+    args = parser.parse_args()
+
+    dataId = {}
+    for item in args.id:
+        key, sep, value = item.partition("=")
+        if not sep:
+            parser.error("Invalid --id value %r; expected KEY=VALUE" % (item,))
+        dataId[key] = int(value) if key == "ccdnum" else value
+
+    log = lsst.log.Log.getLogger("makeRegionMasks")
+    mapper = MosaicMapper(root=args.root)
+    jobs = regionMask.findRegionMasks(mapper, args.regions, dataId=dataId, regionTemplate=args.template,
+                                      bpmPath=args.bpm, observatory=args.observatory, clobber=args.clobber)
+    log.info("Writing %d masked images with %d processes" % (len(jobs), args.processes))
+    regionMask.buildRegionMasks(jobs, processes=args.processes, log=log)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Concatenate the columnar source exports of many visits, e.g. of a field, into one file
+
+    mergeSourceExports.py F2_src.npz DATA/rerun/run/src/F2/*/*/*/*_src.npz
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+
+from lsst.obs.mosaic.sourceExport import mergeColumnFiles
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output", help="columnar file to write")
+    parser.add_argument("inputs", nargs="+", help="columnar files written by mosaicSourceExport.py")
+    args = parser.parse_args()
+
+    numRows = mergeColumnFiles(args.inputs, args.output)
+    print("Wrote %d rows of %d files to %s" % (numRows, len(args.inputs), args.output))
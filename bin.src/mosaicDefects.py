@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Export, import and index the defects of a Mosaic calibration repository
+
+    mosaicDefects.py export CALIB defects.fits      # all periods and CCDs, one pass
+    mosaicDefects.py export CALIB defectsDir --text # as text, one directory per period
+    mosaicDefects.py import defects.fits CALIB      # install as CALIB/defectIndex.fits
+    mosaicDefects.py index CALIB                    # export and install in one step
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import os
+
+import lsst.log
+from lsst.obs.mosaic import defects
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    exportParser = subparsers.add_parser("export", help="export the defects of a calibration repository")
+    exportParser.add_argument("calibRoot", help="root of the calibration repository")
+    exportParser.add_argument("output", help="output FITS file, or directory with --text")
+    exportParser.add_argument("--text", action="store_true", help="write text files instead of FITS")
+    importParser = subparsers.add_parser("import", help="install defects as the defect index")
+    importParser.add_argument("input", help="FITS file or text directory written by export")
+    importParser.add_argument("calibRoot", help="root of the calibration repository")
+    indexParser = subparsers.add_parser("index", help="index the bad pixel masks of a calibration repository")
+    indexParser.add_argument("calibRoot", help="root of the calibration repository")
+    args = parser.parse_args()
+
+    log = lsst.log.Log.getLogger("mosaicDefects")
+    if args.command in ("export", "index"):
+        defectTable, index = defects.exportDefects(args.calibRoot, log=log)
+        if args.command == "index":
+            output = os.path.join(args.calibRoot, defects.DEFECT_INDEX_NAME)
+            defects.writeDefectFile(output, defectTable, index)
+        elif args.text:
+            output = args.output
+            defects.writeDefectText(output, defectTable)
+        else:
+            output = args.output
+            defects.writeDefectFile(output, defectTable, index)
+        log.info("Wrote %d defects of %d registry entries to %s" % (len(defectTable), len(index), output))
+    elif args.command == "import":
+        output = defects.importDefects(args.input, args.calibRoot, log=log)
+        log.info("Installed %s" % (output,))
+    else:
+        parser.error("Specify a command: export, import or index")
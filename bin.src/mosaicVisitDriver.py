@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Run ISR and characterization on DLS preprocessed visits, reading each file once
+
+    mosaicVisitDriver.py DATA --rerun visits --id field=F2 filter=R \
+        --config numProcesses=8 maxVisitsInMemory=2
+"""
+from lsst.obs.mosaic.visitDriver import MosaicVisitDriverTask
+
+MosaicVisitDriverTask.parseAndRun()
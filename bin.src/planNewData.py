@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""List the CCDs whose outputs are missing or older than their inputs, as --id arguments
+
+The raw table of the registry of ROOT is read once, and the files of the
+input datasets (under ROOT) and output datasets (under OUTPUT) are listed
+with one directory walk each.
+
+    planNewData.py DATA DATA/rerun/nightly --ids plan.txt
+    processCcd.py DATA --rerun nightly @plan.txt
+    planNewData.py DATA DATA/rerun/nightly --input preprocessed --output postISRCCD --id filter=R
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+
+from lsst.obs.mosaic import MosaicMapper
+from lsst.obs.mosaic import planner
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", help="root of the input repository, with the registry")
+    parser.add_argument("output", help="root of the output repository (e.g. a rerun directory)")
+    parser.add_argument("--input", nargs="+", default=["preprocessed"], help="input datasets")
+    parser.add_argument("--output", nargs="+", default=["calexp", "src", "icSrc"], dest="outputs",
+                        help="output datasets")
+    parser.add_argument("--id", nargs="*", default=[], metavar="KEY=VALUE",
+                        help="restrict to the raw data with these values, e.g. dateObs=2003-01-04")
+    parser.add_argument("--ids", help="file to write the --id arguments to, instead of printing them")
+    args = parser.parse_args()
+
+    dataId = {}
+    for item in args.id:
+        key, sep, value = item.partition("=")
+        if not sep:
+            parser.error("Invalid --id value %r; expected KEY=VALUE" % (item,))
+        dataId[key] = int(value) if key in ("ccdnum", "visit") else value
+
+    mapper = MosaicMapper(root=args.root)
+    plan = planner.planNewData(args.root, args.output,
+                               inputTemplates=[mapper.mappings[name].template for name in args.input],
+                               outputTemplates=[mapper.mappings[name].template for name in args.outputs],
+                               dataId=dataId)
+    print("%d CCDs to process: %d new, %d stale; %d up to date, %d with missing inputs" %
+          (len(plan.dataIds), plan.numNew, plan.numStale, plan.numUpToDate, plan.numMissingInput))
+    if args.ids:
+        planner.writeIdFile(args.ids, plan.dataIds)
+    else:
+        for line in planner.formatIdArguments(plan.dataIds):
+            print(line)
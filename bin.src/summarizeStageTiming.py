@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Summarize the per-stage timing and memory use recorded in task metadata
+
+Reads the metadata dataset of every CCD of a processing run and prints, for
+each stage, the total wall and CPU time, the largest increase of the peak
+resident set size and the bytes read and written.
+
+    summarizeStageTiming.py DATA/rerun/isr                          # isr_metadata
+    summarizeStageTiming.py DATA/rerun/run --dataset processCcd_metadata --id filter=R
+
+With --store, read a metadata store written with processCcd.metadataStore
+instead, with one query:
+
+    summarizeStageTiming.py DATA/rerun/run --store metadata.sqlite3 --id filter=R
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import os
+
+from lsst.daf.persistence import Butler
+from lsst.obs.mosaic.metadataStore import MetadataStore
+from lsst.obs.mosaic.stageTimer import summarizeStages, formatStageSummary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", help="repository (or rerun) with the task metadata")
+    parser.add_argument("--dataset", default="isr_metadata", help="metadata dataset (default: %(default)s)")
+    parser.add_argument("--id", nargs="*", default=[], metavar="KEY=VALUE",
+                        help="restrict to the data with these values, e.g. dateObs=1999-11-11")
+    parser.add_argument("--store", help="metadata store, relative to root, to read instead of the datasets")
+    parser.add_argument("--task", default="processCcd",
+                        help="task whose metadata to read from --store (default: %(default)s)")
+    args = parser.parse_args()
+
+    dataId = {}
+    for item in args.id:
+        key, sep, value = item.partition("=")
+        if not sep:
+            parser.error("Invalid --id value %r; expected KEY=VALUE" % (item,))
+        dataId[key] = int(value) if key == "ccdnum" else value
+
+    if args.store is not None:
+        store = MetadataStore(os.path.join(args.root, args.store))
+        summary = store.summarizeStages(task=args.task, dataId=dataId)
+        print("%d %s records in %s" % (len(store.getDataIds(task=args.task, dataId=dataId)), args.task,
+                                        store.path))
+    else:
+        butler = Butler(args.root)
+        dataRefs = [dataRef for dataRef in butler.subset("raw", **dataId)
+                    if dataRef.datasetExists(args.dataset)]
+        summary = summarizeStages(dataRef.get(args.dataset) for dataRef in dataRefs)
+        print("%d %s datasets" % (len(dataRefs), args.dataset))
+    print(formatStageSummary(summary))
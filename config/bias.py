@@ -1,3 +1,6 @@
+from lsst.obs.mosaic.calibCombine import MosaicCalibCombineTask
+
 config.dateObs = "date"
 config.ccdKeys = ["ccdnum"]
 config.isr.assembleCcd.setGain = False
+config.combination.retarget(MosaicCalibCombineTask)
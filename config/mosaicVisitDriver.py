@@ -0,0 +1 @@
+config.charImage.repair.cosmicray.nCrPixelMax = 100000
@@ -1,3 +1,7 @@
 from lsst.obs.mosaic.isr import MosaicIsrTask
+from lsst.obs.mosaic.fringe import MosaicFringeTask
+from lsst.obs.mosaic.repair import MosaicRepairTask
 config.isr.retarget(MosaicIsrTask)
+config.isr.fringe.retarget(MosaicFringeTask)
+config.charImage.repair.retarget(MosaicRepairTask)
 config.charImage.repair.cosmicray.nCrPixelMax = 100000
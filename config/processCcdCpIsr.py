@@ -1,5 +1,7 @@
 from lsst.obs.decam.decamCpIsr import DecamCpIsrTask
+from lsst.obs.mosaic.fringe import MosaicFringeTask
 config.isr.retarget(DecamCpIsrTask)
+config.isr.fringe.retarget(MosaicFringeTask)
 
 config.isr.doDark = False
 config.isr.fringe.filters = ['z', 'y']
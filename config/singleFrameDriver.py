@@ -1,6 +1,8 @@
 import os
 
 from lsst.utils import getPackageDir
+from lsst.obs.mosaic.processCcd import MosaicProcessCcdTask
 
+config.processCcd.retarget(MosaicProcessCcdTask)
 config.processCcd.load(os.path.join(getPackageDir("obs_mosaic"), "config", "processCcd.py"))
 config.ccdKey = 'ccdnum'
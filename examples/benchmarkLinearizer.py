@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Compare the time to linearize a Mosaic CCD with LinearizeLookupTable and FastLinearizeLookupTable
+
+By default, synthetic tables like those written by mosaic/makeLinearizer.py
+(small integer offsets over the 16-bit ADU range) are used; use --butler to
+time the linearizers installed in mosaic/linearizer instead.
+
+python $OBS_MOSAIC_DIR/examples/benchmarkLinearizer.py --repeat 5
+"""
+from __future__ import absolute_import, division, print_function
+from builtins import range
+import argparse
+import time
+
+import numpy as np
+
+import lsst.afw.image as afwImage
+from lsst.daf.persistence import Butler
+from lsst.ip.isr import LinearizeLookupTable
+from lsst.obs.mosaic import MosaicMapper
+from lsst.obs.mosaic.linearize import FastLinearizeLookupTable, getFastLinearizer
+
+
+def makeImage(detector, rng):
+    """Make a float image of the size of the detector with values spread over the ADU range"""
+    image = afwImage.ImageF(detector.getBBox())
+    image.getArray()[:] = rng.uniform(0, 65535, size=image.getArray().shape).astype(np.float32)
+    return image
+
+
+def timeLinearizer(linearizer, image, detector, repeat):
+    """Return the best time to linearize a copy of image, and the result"""
+    best = None
+    for i in range(repeat):
+        work = image.Factory(image, True)
+        start = time.time()
+        linearizer(image=work, detector=detector)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, work
+
+
+def main(useButler, repeat, numThreads):
+    rng = np.random.RandomState(1)
+    camera = MosaicMapper().camera
+    butler = Butler(mapper=MosaicMapper) if useButler else None
+    totalSlow = totalFast = 0.0
+    print("%6s %10s %10s %8s %10s %10s" % ("ccdnum", "generic(s)", "fast(s)", "speedup", "table(kB)", "dtype"))
+    for detector in camera:
+        ccdnum = detector.getId()
+        if butler is not None:
+            slow = butler.get("linearizer", dataId=dict(ccdnum=ccdnum), immediate=True)
+            fast = getFastLinearizer(slow, detector, numThreads=numThreads)
+        else:
+            table = np.rint(rng.normal(0, 20, size=(2, 2**16))).astype(np.float32)
+            slow = LinearizeLookupTable(table=table, detector=detector)
+            fast = FastLinearizeLookupTable(table, detector, numThreads=numThreads)
+        image = makeImage(detector, rng)
+        slowTime, slowResult = timeLinearizer(slow, image, detector, repeat)
+        fastTime, fastResult = timeLinearizer(fast, image, detector, repeat)
+        if not np.array_equal(slowResult.getArray(), fastResult.getArray()):
+            raise RuntimeError("Linearized images differ for ccdnum=%s" % (ccdnum,))
+        totalSlow += slowTime
+        totalFast += fastTime
+        print("%6d %10.4f %10.4f %8.1f %10.1f %10s" % (ccdnum, slowTime, fastTime, slowTime/fastTime,
+                                                      fast.nbytes/1024.0, fast._table.dtype))
+    print("%6s %10.4f %10.4f %8.1f" % ("total", totalSlow, totalFast, totalSlow/totalFast))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the generic and fast Mosaic linearizers")
+    parser.add_argument("--butler", action="store_true", help="use the installed linearizers")
+    parser.add_argument("--repeat", type=int, default=3, help="number of repetitions per CCD")
+    parser.add_argument("-j", "--threads", type=int, default=2, help="number of threads for the fast path")
+    cmd = parser.parse_args()
+
+    main(useButler=cmd.butler, repeat=cmd.repeat, numThreads=cmd.threads)
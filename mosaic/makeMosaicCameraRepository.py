@@ -22,16 +22,28 @@
 #
 """Generate camera geometry for Mosaic
 
-Example of use (if mosaic/camGeom already exists, move it aside first):
+Example of use (if mosaic/camGeom already exists, use --clobber to replace it):
 
     python mosaic/makeMosaicCameraRepository.py mosaic/chipcenters.txt mosaic/segmentfile.txt mosaic/camGeom
+
+The repository is written together with a manifest of the SHA-1 of each file
+(see lsst.obs.mosaic.cameraManifest).  To check that the committed repository
+is what the current inputs produce, without modifying it:
+
+    python mosaic/makeMosaicCameraRepository.py mosaic/chipcenters.txt mosaic/segmentfile.txt \
+        --compare mosaic/camGeom
 """
 from __future__ import absolute_import
 from __future__ import print_function
 from builtins import range
 import argparse
+import collections
+import difflib
+import multiprocessing
 import os
 import shutil
+import sys
+import tempfile
 
 import lsst.utils
 import lsst.afw.geom as afwGeom
@@ -39,133 +51,154 @@ import lsst.afw.table as afwTable
 from lsst.afw.cameraGeom import DetectorConfig, CameraConfig, PUPIL, FOCAL_PLANE, PIXELS
 from lsst.ip.isr import LinearizeLookupTable
 from lsst.obs.mosaic import MosaicMapper
+from lsst.obs.mosaic import cameraManifest
 
 
-def makeAmpTables(segmentsFile):
-    """
-    Read the segments file from a PhoSim release and produce the appropriate AmpInfo
+def readSegments(segmentsFile):
+    """Read the amplifier segments file in one pass
+
     @param segmentsFile -- String indicating where the file is located
+    @return an OrderedDict of detector name: list of amplifier segments, each a tuple
+        (ampName, ndatax, ndatay, xoff, yoff, gain, saturation, readnoise)
     """
-    returnDict = {}
-    readoutMap = {'LL': afwTable.LL, 'LR': afwTable.LR, 'UR': afwTable.UR, 'UL': afwTable.UL}
-    detectorName = [] # set to a value that is an invalid dict key, to catch bugs
+    segments = collections.OrderedDict()
     with open(segmentsFile) as fh:
         fh.readline()
         for l in fh:
             els = l.rstrip().split()
+            if not els:
+                continue
             detectorName = els[1]
             #skip focus and guiding for now:
             if detectorName[0] in ('F', 'G'):
                 continue
-            if detectorName not in returnDict:
-                schema = afwTable.AmpInfoTable.makeMinimalSchema()
-                returnDict[detectorName] = afwTable.AmpInfoCatalog(schema)
-            record = returnDict[detectorName].addNew()
-            name = els[2]
-            gain = float(els[7])
-            saturation = int(els[8])
-            readnoise = float(els[9])
-            xoff = int(els[5])
-            yoff = int(els[6])
-            ndatax = int(els[3])
-            ndatay = int(els[4])
-
-            flipx = False
-            flipy = False
-
-            if detectorName.startswith("S") and name == "A":
-                readCorner = readoutMap['UR']
-            elif detectorName.startswith("W") and name == "B":
-                readCorner = readoutMap['UL']
-            elif detectorName.startswith("N") and name == "A":
-                readCorner = readoutMap['LL']
-            elif detectorName.startswith("E") and name == "B":
-                readCorner = readoutMap['LR']
-            else:
-                raise RuntimeError("Did not recognize detector name or amp name")
-
-            prescan = 24
-            hoverscan = 50
-            voverscan = 0
-            hjunk = 14
-            rawBBox = afwGeom.Box2I(afwGeom.Point2I(xoff, yoff),
-                                    afwGeom.Extent2I(ndatax + prescan + hjunk + hoverscan, ndatay + voverscan))
-            # Note: I'm not particularry happy with how the data origin is derived (it neglects [xy]off),
-            # but I don't see a better way.
-            if readCorner is afwTable.LL:
-                originRawData = afwGeom.Point2I(xoff + prescan + hoverscan, yoff)
-                originData = afwGeom.Point2I(0, 0)
-                originHOverscan = afwGeom.Point2I(xoff + prescan, yoff)
-                originVOverscan = afwGeom.Point2I(xoff + prescan + hoverscan, yoff + ndatay)
-                originPrescan = afwGeom.Point2I(xoff, yoff)
-            elif readCorner is afwTable.LR:
-                originRawData = afwGeom.Point2I(xoff, yoff)
-                originData = afwGeom.Point2I(0, 0)
-                originHOverscan = afwGeom.Point2I(xoff, yoff)
-                originVOverscan = afwGeom.Point2I(xoff, yoff + ndatay)
-                originPrescan = afwGeom.Point2I(xoff + ndatax + hoverscan + hjunk, yoff)
-            elif readCorner is afwTable.UL:
-                originRawData = afwGeom.Point2I(xoff, yoff)
-                originData = afwGeom.Point2I(0, 0)
-                originHOverscan = afwGeom.Point2I(xoff + prescan + ndatax + + hjunk, yoff)
-                originVOverscan = afwGeom.Point2I(xoff + prescan + hoverscan, yoff)
-                originPrescan = afwGeom.Point2I(xoff, yoff)
-            elif readCorner is afwTable.UR:
-                originRawData = afwGeom.Point2I(xoff, yoff + voverscan)
-                originData = afwGeom.Point2I(ndatax, 0)
-                originHOverscan = afwGeom.Point2I(xoff + ndatax, yoff + voverscan)
-                originVOverscan = afwGeom.Point2I(xoff, yoff)
-                originPrescan = afwGeom.Point2I(xoff + ndatax + hoverscan, yoff + voverscan)
-            else:
-                raise RuntimeError("Expected readout corner to be LL, LR, UL, or UR")
-
-            rawDataBBox = afwGeom.Box2I(originRawData, afwGeom.Extent2I(ndatax, ndatay))
-            dataBBox = afwGeom.Box2I(originData, afwGeom.Extent2I(ndatax, ndatay))
-            rawHorizontalOverscanBBox = afwGeom.Box2I(originHOverscan, afwGeom.Extent2I(hoverscan, ndatay))
-            rawVerticalOverscanBBox = afwGeom.Box2I(originVOverscan, afwGeom.Extent2I(ndatax, voverscan))
-            rawPrescanBBox = afwGeom.Box2I(originPrescan, afwGeom.Extent2I(prescan, ndatay))
+            segments.setdefault(detectorName, []).append(
+                (els[2], int(els[3]), int(els[4]), int(els[5]), int(els[6]),
+                 float(els[7]), int(els[8]), float(els[9])))
+    return segments
+
 
+def makeAmpTable(detectorName, ampSegments, verbose=False):
+    """
+    Make the AmpInfo table of one detector
+    @param detectorName -- name of the detector
+    @param ampSegments -- list of amplifier segments of the detector, as returned by readSegments
+    @param verbose -- print the bounding boxes of each amplifier?
+    """
+    readoutMap = {'LL': afwTable.LL, 'LR': afwTable.LR, 'UR': afwTable.UR, 'UL': afwTable.UL}
+    schema = afwTable.AmpInfoTable.makeMinimalSchema()
+    ampTable = afwTable.AmpInfoCatalog(schema)
+    for name, ndatax, ndatay, xoff, yoff, gain, saturation, readnoise in ampSegments:
+        record = ampTable.addNew()
+        flipx = False
+        flipy = False
+
+        if detectorName.startswith("S") and name == "A":
+            readCorner = readoutMap['UR']
+        elif detectorName.startswith("W") and name == "B":
+            readCorner = readoutMap['UL']
+        elif detectorName.startswith("N") and name == "A":
+            readCorner = readoutMap['LL']
+        elif detectorName.startswith("E") and name == "B":
+            readCorner = readoutMap['LR']
+        else:
+            raise RuntimeError("Did not recognize detector name or amp name")
+
+        prescan = 24
+        hoverscan = 50
+        voverscan = 0
+        hjunk = 14
+        rawBBox = afwGeom.Box2I(afwGeom.Point2I(xoff, yoff),
+                                afwGeom.Extent2I(ndatax + prescan + hjunk + hoverscan, ndatay + voverscan))
+        # Note: I'm not particularry happy with how the data origin is derived (it neglects [xy]off),
+        # but I don't see a better way.
+        if readCorner is afwTable.LL:
+            originRawData = afwGeom.Point2I(xoff + prescan + hoverscan, yoff)
+            originData = afwGeom.Point2I(0, 0)
+            originHOverscan = afwGeom.Point2I(xoff + prescan, yoff)
+            originVOverscan = afwGeom.Point2I(xoff + prescan + hoverscan, yoff + ndatay)
+            originPrescan = afwGeom.Point2I(xoff, yoff)
+        elif readCorner is afwTable.LR:
+            originRawData = afwGeom.Point2I(xoff, yoff)
+            originData = afwGeom.Point2I(0, 0)
+            originHOverscan = afwGeom.Point2I(xoff, yoff)
+            originVOverscan = afwGeom.Point2I(xoff, yoff + ndatay)
+            originPrescan = afwGeom.Point2I(xoff + ndatax + hoverscan + hjunk, yoff)
+        elif readCorner is afwTable.UL:
+            originRawData = afwGeom.Point2I(xoff, yoff)
+            originData = afwGeom.Point2I(0, 0)
+            originHOverscan = afwGeom.Point2I(xoff + prescan + ndatax + + hjunk, yoff)
+            originVOverscan = afwGeom.Point2I(xoff + prescan + hoverscan, yoff)
+            originPrescan = afwGeom.Point2I(xoff, yoff)
+        elif readCorner is afwTable.UR:
+            originRawData = afwGeom.Point2I(xoff, yoff + voverscan)
+            originData = afwGeom.Point2I(ndatax, 0)
+            originHOverscan = afwGeom.Point2I(xoff + ndatax, yoff + voverscan)
+            originVOverscan = afwGeom.Point2I(xoff, yoff)
+            originPrescan = afwGeom.Point2I(xoff + ndatax + hoverscan, yoff + voverscan)
+        else:
+            raise RuntimeError("Expected readout corner to be LL, LR, UL, or UR")
+
+        rawDataBBox = afwGeom.Box2I(originRawData, afwGeom.Extent2I(ndatax, ndatay))
+        dataBBox = afwGeom.Box2I(originData, afwGeom.Extent2I(ndatax, ndatay))
+        rawHorizontalOverscanBBox = afwGeom.Box2I(originHOverscan, afwGeom.Extent2I(hoverscan, ndatay))
+        rawVerticalOverscanBBox = afwGeom.Box2I(originVOverscan, afwGeom.Extent2I(ndatax, voverscan))
+        rawPrescanBBox = afwGeom.Box2I(originPrescan, afwGeom.Extent2I(prescan, ndatay))
+
+        if verbose:
             print("\nDetector=%s; Amp=%s" % (detectorName, name))
             print(rawHorizontalOverscanBBox)
             print(rawVerticalOverscanBBox)
             print(rawPrescanBBox)
             print(dataBBox)
             print(rawBBox)
-            #Set the elements of the record for this amp
-            record.setBBox(dataBBox) # This is the box for the amp in the assembled frame
-            record.setName(name)
-            record.setReadoutCorner(readCorner)
-            record.setGain(gain)
-            record.setSaturation(saturation)
-            record.setSuspectLevel(float("nan"))
-            record.setReadNoise(readnoise)
-            ampIndex = dict(A=0, B=1)[name]
-            record.setLinearityCoeffs([ampIndex, 0, 0, 0])
-            record.setLinearityType(LinearizeLookupTable.LinearityType)
+        #Set the elements of the record for this amp
+        record.setBBox(dataBBox) # This is the box for the amp in the assembled frame
+        record.setName(name)
+        record.setReadoutCorner(readCorner)
+        record.setGain(gain)
+        record.setSaturation(saturation)
+        record.setSuspectLevel(float("nan"))
+        record.setReadNoise(readnoise)
+        ampIndex = dict(A=0, B=1)[name]
+        record.setLinearityCoeffs([ampIndex, 0, 0, 0])
+        record.setLinearityType(LinearizeLookupTable.LinearityType)
+        if verbose:
             print("Linearity type=%r; coeffs=%s" % (record.getLinearityType(), record.getLinearityCoeffs()))
-            record.setHasRawInfo(True)
-            record.setRawFlipX(flipx)
-            record.setRawFlipY(flipy)
-            record.setRawBBox(rawBBox)
-            # I believe that xy offset is not needed if the raw data are pre-assembled
-            record.setRawXYOffset(afwGeom.Extent2I(0, 0))
-            """
-            if readCorner is afwTable.LL:
-                record.setRawXYOffset(afwGeom.Extent2I(xoff + prescan + hoverscan, yoff))
-            elif readCorner is afwTable.LR:
-                record.setRawXYOffset(afwGeom.Extent2I(xoff, yoff))
-            elif readCorner is afwTable.UL:
-                record.setRawXYOffset(afwGeom.Extent2I(xoff + prescan + hoverscan, yoff + voverscan))
-            elif readCorner is afwTable.UR:
-                record.setRawXYOffset(afwGeom.Extent2I(xoff, yoff + voverscan))
-            """
-            record.setRawDataBBox(rawDataBBox)
-            record.setRawHorizontalOverscanBBox(rawHorizontalOverscanBBox)
-            record.setRawVerticalOverscanBBox(rawVerticalOverscanBBox)
-            # I think of prescan as being along the bottom of the raw data.  I actually
-            # don't know how you would do a prescan in the serial direction.
-            record.setRawPrescanBBox(afwGeom.Box2I())
-    return returnDict
+        record.setHasRawInfo(True)
+        record.setRawFlipX(flipx)
+        record.setRawFlipY(flipy)
+        record.setRawBBox(rawBBox)
+        # I believe that xy offset is not needed if the raw data are pre-assembled
+        record.setRawXYOffset(afwGeom.Extent2I(0, 0))
+        """
+        if readCorner is afwTable.LL:
+            record.setRawXYOffset(afwGeom.Extent2I(xoff + prescan + hoverscan, yoff))
+        elif readCorner is afwTable.LR:
+            record.setRawXYOffset(afwGeom.Extent2I(xoff, yoff))
+        elif readCorner is afwTable.UL:
+            record.setRawXYOffset(afwGeom.Extent2I(xoff + prescan + hoverscan, yoff + voverscan))
+        elif readCorner is afwTable.UR:
+            record.setRawXYOffset(afwGeom.Extent2I(xoff, yoff + voverscan))
+        """
+        record.setRawDataBBox(rawDataBBox)
+        record.setRawHorizontalOverscanBBox(rawHorizontalOverscanBBox)
+        record.setRawVerticalOverscanBBox(rawVerticalOverscanBBox)
+        # I think of prescan as being along the bottom of the raw data.  I actually
+        # don't know how you would do a prescan in the serial direction.
+        record.setRawPrescanBBox(afwGeom.Box2I())
+    return ampTable
+
+
+def makeAmpTables(segmentsFile, verbose=False):
+    """
+    Read the segments file from a PhoSim release and produce the appropriate AmpInfo
+    @param segmentsFile -- String indicating where the file is located
+    @param verbose -- print the bounding boxes of each amplifier?
+    @return a dict of detector name: AmpInfo table
+    """
+    return dict((detectorName, makeAmpTable(detectorName, ampSegments, verbose=verbose))
+                for detectorName, ampSegments in readSegments(segmentsFile).items())
 
 
 def makeDetectorConfigs(detectorLayoutFile):
@@ -219,28 +252,11 @@ def makeDetectorConfigs(detectorLayoutFile):
             detectorConfigs.append(detConfig)
     return detectorConfigs
 
-if __name__ == "__main__":
+def makeCameraConfig(detectorConfigList):
     """
-    Create the configs for building a camera.
+    Build the camera config
+    @param detectorConfigList -- list of DetectorConfig, as returned by makeDetectorConfigs
     """
-    baseDir = lsst.utils.getPackageDir("obs_mosaic")
-    defaultOutDir = os.path.join(os.path.normpath(baseDir), "description", "camera")
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("DetectorLayoutFile", help="Path to detector layout file")
-    parser.add_argument("SegmentsFile", help="Path to amp segments file")
-    parser.add_argument("OutputDir",
-                        help="Path to dump configs and AmpInfo Tables; defaults to %r" % (defaultOutDir,),
-                        nargs="?",
-                        default=defaultOutDir,
-                        )
-    parser.add_argument("--clobber", action="store_true", dest="clobber", default=False,
-                        help=("remove and re-create the output directory if it already exists?"))
-    args = parser.parse_args()
-    ampTableDict = makeAmpTables(args.SegmentsFile)
-    detectorConfigList = makeDetectorConfigs(args.DetectorLayoutFile)
-
-    #Build the camera config.
     camConfig = CameraConfig()
     camConfig.detectorList = dict([(i, detectorConfigList[i]) for i in range(len(detectorConfigList))])
     camConfig.name = 'MOSAIC1'
@@ -260,32 +276,142 @@ if __name__ == "__main__":
     tmc.nativeSys = FOCAL_PLANE.getSysName()
     tmc.transforms = {PUPIL.getSysName(): tConfig}
     camConfig.transformDict = tmc
+    return camConfig
 
-    def makeDir(dirPath, doClobber=False):
-        """Make a directory; if it exists then clobber or fail, depending on doClobber
 
-        @param[in] dirPath: path of directory to create
-        @param[in] doClobber: what to do if dirPath already exists:
-            if True and dirPath is a dir, then delete it and recreate it, else raise an exception
-        @throw RuntimeError if dirPath exists and doClobber False
-        """
-        if os.path.exists(dirPath):
-            if doClobber and os.path.isdir(dirPath):
-                print("Clobbering directory %r" % (dirPath,))
-                shutil.rmtree(dirPath)
-            else:
-                raise RuntimeError("Directory %r exists" % (dirPath,))
-        print("Creating directory %r" % (dirPath,))
-        os.makedirs(dirPath)
-
-    # write data products
-    outDir = args.OutputDir
-    makeDir(dirPath=outDir, doClobber=args.clobber)
-
-    camConfigPath = os.path.join(outDir, "camera.py")
-    camConfig.save(camConfigPath)
-
-    for detectorName, ampTable in ampTableDict.items():
-        shortDetectorName = MosaicMapper.getShortCcdName(detectorName)
-        ampInfoPath = os.path.join(outDir, shortDetectorName + ".fits")
-        ampTable.writeFits(ampInfoPath)
+def writeAmpTable(args):
+    """
+    Make and write the AmpInfo table of one detector; run by the worker pool
+    @param args -- tuple (detectorName, ampSegments, outDir, verbose)
+    @return the name of the file written
+    """
+    detectorName, ampSegments, outDir, verbose = args
+    ampTable = makeAmpTable(detectorName, ampSegments, verbose=verbose)
+    fileName = MosaicMapper.getShortCcdName(detectorName) + ".fits"
+    ampTable.writeFits(os.path.join(outDir, fileName))
+    return fileName
+
+
+def buildRepository(detectorLayoutFile, segmentsFile, outDir, processes=1, verbose=False):
+    """
+    Build a camera repository, including its manifest
+    @param detectorLayoutFile -- path of the detector layout file
+    @param segmentsFile -- path of the amp segments file
+    @param outDir -- directory in which to write the repository; must exist
+    @param processes -- number of detectors to build in parallel
+    @param verbose -- print the bounding boxes of each amplifier?
+    @return the manifest of the repository
+    """
+    segments = readSegments(segmentsFile)
+    jobs = [(detectorName, ampSegments, outDir, verbose) for detectorName, ampSegments in segments.items()]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(writeAmpTable, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            writeAmpTable(job)
+
+    camConfig = makeCameraConfig(makeDetectorConfigs(detectorLayoutFile))
+    camConfig.save(os.path.join(outDir, "camera.py"))
+    return cameraManifest.writeManifest(outDir)
+
+
+def compareRepositories(newDir, oldDir):
+    """
+    Print the differences between two camera repositories
+    @param newDir -- directory of the new repository
+    @param oldDir -- directory of the existing repository
+    @return True if the repositories are identical
+    """
+    newManifest = cameraManifest.makeManifest(newDir)
+    oldManifest = cameraManifest.makeManifest(oldDir)
+    differences = cameraManifest.compareManifests(newManifest, oldManifest)
+    for name in differences.added:
+        print("Only in %s: %s" % (newDir, name))
+    for name in differences.removed:
+        print("Only in %s: %s" % (oldDir, name))
+    for name in differences.changed:
+        newPath = os.path.join(newDir, name)
+        oldPath = os.path.join(oldDir, name)
+        if name.endswith(".fits"):
+            newTable = afwTable.AmpInfoCatalog.readFits(newPath)
+            oldTable = afwTable.AmpInfoCatalog.readFits(oldPath)
+            if len(newTable) != len(oldTable):
+                print("%s: %d amplifiers != %d" % (name, len(newTable), len(oldTable)))
+                continue
+            for newRecord, oldRecord in zip(newTable, oldTable):
+                for key in ("Name", "BBox", "Gain", "Saturation", "ReadNoise", "ReadoutCorner",
+                            "LinearityType", "LinearityCoeffs", "RawBBox", "RawDataBBox",
+                            "RawHorizontalOverscanBBox", "RawVerticalOverscanBBox", "RawPrescanBBox",
+                            "RawFlipX", "RawFlipY", "RawXYOffset"):
+                    newValue = getattr(newRecord, "get" + key)()
+                    oldValue = getattr(oldRecord, "get" + key)()
+                    if str(newValue) != str(oldValue):
+                        print("%s amp %s %s: %s != %s" % (name, oldRecord.getName(), key, newValue, oldValue))
+        else:
+            with open(newPath) as newFile, open(oldPath) as oldFile:
+                for line in difflib.unified_diff(oldFile.readlines(), newFile.readlines(), oldPath, newPath):
+                    print(line, end="")
+    return not (differences.added or differences.removed or differences.changed)
+
+
+if __name__ == "__main__":
+    """
+    Create the configs for building a camera.
+    """
+    baseDir = lsst.utils.getPackageDir("obs_mosaic")
+    defaultOutDir = os.path.join(os.path.normpath(baseDir), "description", "camera")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("DetectorLayoutFile", help="Path to detector layout file")
+    parser.add_argument("SegmentsFile", help="Path to amp segments file")
+    parser.add_argument("OutputDir",
+                        help="Path to dump configs and AmpInfo Tables; defaults to %r" % (defaultOutDir,),
+                        nargs="?",
+                        default=defaultOutDir,
+                        )
+    parser.add_argument("--clobber", action="store_true", dest="clobber", default=False,
+                        help=("remove and re-create the output directory if it already exists?"))
+    parser.add_argument("--compare", metavar="DIR",
+                        help="build the repository in a temporary directory and report the differences "
+                             "with the existing repository DIR, instead of writing OutputDir; "
+                             "exits with status 1 if there are differences")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of detectors to build in parallel")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False,
+                        help="print the bounding boxes of each amplifier")
+    args = parser.parse_args()
+
+    if args.compare:
+        tempDir = tempfile.mkdtemp()
+        try:
+            buildRepository(args.DetectorLayoutFile, args.SegmentsFile, tempDir,
+                            processes=args.processes, verbose=args.verbose)
+            identical = compareRepositories(tempDir, args.compare)
+        finally:
+            shutil.rmtree(tempDir)
+        print("Repository %r is %s" % (args.compare, "up to date" if identical else "out of date"))
+        sys.exit(0 if identical else 1)
+
+    # write data products; build next to the output directory, so a failure leaves it untouched
+    outDir = os.path.abspath(args.OutputDir)
+    if os.path.exists(outDir) and not (args.clobber and os.path.isdir(outDir)):
+        raise RuntimeError("Directory %r exists" % (outDir,))
+    tempDir = tempfile.mkdtemp(dir=os.path.dirname(outDir))
+    try:
+        manifest = buildRepository(args.DetectorLayoutFile, args.SegmentsFile, tempDir,
+                                   processes=args.processes, verbose=args.verbose)
+    except Exception:
+        shutil.rmtree(tempDir, ignore_errors=True)
+        raise
+    if os.path.exists(outDir):
+        print("Clobbering directory %r" % (outDir,))
+        shutil.rmtree(outDir)
+    os.rename(tempDir, outDir)
+    os.chmod(outDir, 0o755)
+    print("Wrote %d files to %r; repository hash %s" %
+          (len(manifest), outDir, cameraManifest.repositoryHash(manifest)))
@@ -1,4 +1,68 @@
+"""Mosaic camera support, with the submodules loaded on first use
+
+Importing lsst.obs.mosaic loads nothing else: MosaicMapper,
+MakeMosaicRawVisitInfo and the submodules (e.g. lsst.obs.mosaic.synthetic)
+are imported the first time they are accessed as attributes of the package,
+so a command or pool worker that needs only one submodule does not pay for
+the mapper and its dependencies (afw, ip_isr, meas_algorithms, astropy).
+
+Python 3.7 calls a module __getattr__ itself; older versions need the package
+to be a module subclass, so the package replaces itself in sys.modules with
+one, keeping a reference to the original module so that its globals, used by
+__getattr__, are not cleared.
+"""
 from __future__ import absolute_import
-from .mosaicMapper import *
-from . import makeCamera
-from .makeMosaicRawVisitInfo import *
+
+import importlib
+import pkgutil
+import sys
+import types
+
+__all__ = ["MosaicMapper", "MakeMosaicRawVisitInfo"]
+
+# Attributes of the package, and the submodules that define them
+_LAZY_ATTRIBUTES = {
+    "MosaicMapper": "mosaicMapper",
+    "MakeMosaicRawVisitInfo": "makeMosaicRawVisitInfo",
+}
+
+
+def _getSubmoduleNames(module):
+    """Return the names of the submodules of the package"""
+    return set(name for _, name, _ in pkgutil.iter_modules(module.__path__))
+
+
+def _getLazyAttribute(module, name):
+    """Import a name of _LAZY_ATTRIBUTES or a submodule, and cache it in the package"""
+    if name.startswith("__"):
+        raise AttributeError("module %r has no attribute %r" % (module.__name__, name))
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module("." + _LAZY_ATTRIBUTES[name], module.__name__), name)
+    elif name in _getSubmoduleNames(module):
+        value = importlib.import_module("." + name, module.__name__)
+    else:
+        raise AttributeError("module %r has no attribute %r" % (module.__name__, name))
+    setattr(module, name, value)
+    return value
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        return _getLazyAttribute(sys.modules[__name__], name)
+
+    def __dir__():
+        return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+else:
+    class _LazyModule(types.ModuleType):
+        """The lsst.obs.mosaic package, importing its attributes on first access"""
+
+        def __getattr__(self, name):
+            return _getLazyAttribute(self, name)
+
+        def __dir__(self):
+            return sorted(set(self.__dict__) | set(_LAZY_ATTRIBUTES))
+
+    _module = _LazyModule(__name__, __doc__)
+    _module.__dict__.update(sys.modules[__name__].__dict__)
+    _module._originalModule = sys.modules[__name__]
+    sys.modules[__name__] = _module
@@ -0,0 +1,228 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Throughput benchmarks of obs_mosaic on a synthetic repository
+
+Each benchmark times one operation over all the CCD exposures of a repository
+written by synthetic.makeSyntheticRepository, keeps the best of
+config.repeat runs, and compares the time per CCD exposure (per call for
+ccdExposureId) with config.maxSeconds, so that performance regressions show
+up without testdata_mosaic or a network.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import shutil
+import tempfile
+import time
+
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+from lsst.daf.persistence import Butler
+from lsst.utils import getPackageDir
+
+from . import synthetic
+
+__all__ = ["BENCHMARKS", "MosaicBenchmarkConfig", "runBenchmarks", "formatBenchmarkResults"]
+
+
+def _ingest(root, rows, config):
+    """Ingest the raw files into a new repository"""
+    from .ingest import MosaicIngestTask
+    rawFiles = sorted(set(os.path.join(root, synthetic.RAW_TEMPLATE % row) for row in rows))
+    extnames = ["im%d" % (ccdnum,) for ccdnum in synthetic.CCDNUMS]
+
+    def run():
+        output = tempfile.mkdtemp(prefix="benchmarkIngest")
+        try:
+            with open(os.path.join(output, "_mapper"), "w") as outfile:
+                outfile.write("lsst.obs.mosaic.MosaicMapper\n")
+            MosaicIngestTask.parseAndRun(args=[output] + rawFiles + [
+                "--mode", "link", "--filetype", "raw",
+                "-C", os.path.join(getPackageDir("obs_mosaic"), "config", "ingest.py"),
+                "--config", "parse.extnames=%r" % (extnames,)])
+        finally:
+            shutil.rmtree(output, ignore_errors=True)
+    return len(rows), run
+
+
+def _mapperGet(root, rows, config):
+    """Read and standardize the preprocessed exposures with a new butler"""
+    def run():
+        butler = Butler(root)
+        for row in rows:
+            butler.get("preprocessed", dataId=_dataId(row), immediate=True)
+    return len(rows), run
+
+
+def _preprocessedIsr(root, rows, config):
+    """Run MosaicPreprocessedIsrTask on the preprocessed exposures"""
+    from .mosaicPreprocessedIsr import MosaicPreprocessedIsrTask
+    isrConfig = MosaicPreprocessedIsrTask.ConfigClass()
+    isrConfig.doWrite = False
+    task = MosaicPreprocessedIsrTask(config=isrConfig)
+    butler = Butler(root)
+
+    def run():
+        for row in rows:
+            task.runDataRef(butler.dataRef("preprocessed", dataId=_dataId(row)))
+    return len(rows), run
+
+
+def _mosaicIsr(root, rows, config):
+    """Run MosaicIsrTask on the raw exposures, without calibration frames"""
+    from .isr import MosaicIsrTask
+    isrConfig = MosaicIsrTask.ConfigClass()
+    for name in ("doBias", "doDark", "doFlat", "doFringe", "doLinearize", "doWrite"):
+        setattr(isrConfig, name, False)
+    task = MosaicIsrTask(config=isrConfig)
+    butler = Butler(root)
+    exposures = [butler.get("raw", dataId=dict(visit=row["visit"], ccdnum=row["ccdnum"]), immediate=True)
+                 for row in rows]
+
+    def run():
+        for exposure in exposures:
+            task.run(exposure.clone(), defects=[])
+    return len(rows), run
+
+
+def _ccdExposureId(root, rows, config):
+    """Compute the exposure ids of the CCD exposures, through the butler"""
+    butler = Butler(root)
+    dataIds = [_dataId(row) for row in rows]
+    numCalls = 100
+
+    def run():
+        for i in range(numCalls):
+            for dataId in dataIds:
+                butler.get("ccdExposureId", dataId=dataId)
+    return numCalls*len(rows), run
+
+
+def _dataId(row):
+    return dict((key, row[key]) for key in ("field", "subfield", "filter", "dateObs", "objname", "ccdnum"))
+
+
+BENCHMARKS = collections.OrderedDict([
+    ("ingest", _ingest),
+    ("mapperGet", _mapperGet),
+    ("preprocessedIsr", _preprocessedIsr),
+    ("mosaicIsr", _mosaicIsr),
+    ("ccdExposureId", _ccdExposureId),
+])
+
+
+class MosaicBenchmarkConfig(pexConfig.Config):
+    numVisits = pexConfig.Field(
+        dtype=int,
+        doc="Number of synthetic exposures",
+        default=2,
+    )
+    ccdnums = pexConfig.ListField(
+        dtype=int,
+        doc="CCDs of the synthetic exposures",
+        default=list(synthetic.CCDNUMS),
+    )
+    repeat = pexConfig.Field(
+        dtype=int,
+        doc="Number of times to run each benchmark; the best time is used",
+        default=3,
+    )
+    benchmarks = pexConfig.ListField(
+        dtype=str,
+        doc="Benchmarks to run, in %s" % (list(BENCHMARKS),),
+        default=list(BENCHMARKS),
+    )
+    maxSeconds = pexConfig.DictField(
+        keytype=str,
+        itemtype=float,
+        doc="Maximum time per CCD exposure (per call for ccdExposureId) for each benchmark to pass",
+        default={
+            "ingest": 0.5,
+            "mapperGet": 2.0,
+            "preprocessedIsr": 5.0,
+            "mosaicIsr": 10.0,
+            "ccdExposureId": 0.002,
+        },
+    )
+    seed = pexConfig.Field(
+        dtype=int,
+        doc="Random number seed of the synthetic data",
+        default=1,
+    )
+
+    def validate(self):
+        pexConfig.Config.validate(self)
+        unknown = set(self.benchmarks) - set(BENCHMARKS)
+        if unknown:
+            raise ValueError("Unknown benchmarks %s; must be in %s" % (sorted(unknown), list(BENCHMARKS)))
+
+
+def runBenchmarks(config, root=None, log=None):
+    """Run the benchmarks on a synthetic repository
+
+    @param[in] config  a MosaicBenchmarkConfig
+    @param[in] root  repository to write and keep; if None, use a temporary directory
+    @param[in] log  logger or None
+    @return a list of pipeBase.Struct, one per benchmark, with fields
+        name, units, seconds (best time), perUnit, maxSeconds and passed
+    """
+    config.validate()
+    tempRoot = None
+    if root is None:
+        root = tempRoot = tempfile.mkdtemp(prefix="benchmarkMosaic")
+    try:
+        rows = synthetic.makeSyntheticRepository(root, numVisits=config.numVisits, ccdnums=config.ccdnums,
+                                                 seed=config.seed)
+        results = []
+        for name in config.benchmarks:
+            units, run = BENCHMARKS[name](root, rows, config)
+            best = None
+            for i in range(config.repeat):
+                start = time.time()
+                run()
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            perUnit = best/units
+            maxSeconds = config.maxSeconds.get(name)
+            result = pipeBase.Struct(name=name, units=units, seconds=best, perUnit=perUnit,
+                                     maxSeconds=maxSeconds, passed=maxSeconds is None or perUnit <= maxSeconds)
+            if log is not None:
+                log.info("%s: %.4f s per unit (limit %s)" % (name, perUnit, maxSeconds))
+            results.append(result)
+        return results
+    finally:
+        if tempRoot is not None:
+            shutil.rmtree(tempRoot, ignore_errors=True)
+
+
+def formatBenchmarkResults(results):
+    """Format the result of runBenchmarks as a table"""
+    lines = ["%-16s %6s %10s %12s %12s %6s" % ("benchmark", "units", "best(s)", "per unit(s)", "limit(s)", "")]
+    for result in results:
+        lines.append("%-16s %6d %10.3f %12.5f %12s %6s" %
+                     (result.name, result.units, result.seconds, result.perUnit,
+                      "-" if result.maxSeconds is None else "%.5f" % (result.maxSeconds,),
+                      "ok" if result.passed else "FAIL"))
+    return "\n".join(lines)
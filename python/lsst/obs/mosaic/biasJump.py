@@ -0,0 +1,155 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Find the row of the bias jump of a Mosaic CCD from its overscan
+
+The CCDs on some readout backplanes show a jump of the bias level where the
+readout of the smaller ancillary CCDs ends.  findBiasJump collapses the
+overscan to one value per row and finds the single step that best splits
+the rows into two levels, with cumulative sums over all the candidate rows
+at once: the statistic of a split at row k is the difference of the means
+of the rows below and above k, in units of its noise.  The noise is measured
+from the differences of adjacent rows, so it is not inflated by the jump.
+
+A ramp or a transient of the bias also splits the rows into two levels, with
+a large statistic, so the best split is a jump only if it is localized: the
+difference of the means of the minRows rows on each side of it, and of the
+minRows/2 rows on each side of it, must both be significant, and agree.
+
+The location is the same for all the CCDs of a backplane during a night, so
+BiasJumpCache keeps it, or the absence of a jump, per (night, backplane):
+only the first frame of each night and backplane processed by a process
+pays for the detection.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+
+import collections
+import math
+import threading
+
+import numpy as np
+
+__all__ = ["BiasJump", "collapseOverscan", "findBiasJump", "getNight", "BiasJumpCache"]
+
+BiasJump = collections.namedtuple("BiasJump", ["location", "step", "significance"])
+BiasJump.__doc__ = """A bias jump found by findBiasJump
+
+location: number of rows before the jump, from the readout corner; step: level
+above the jump minus level below it; significance: step in units of its noise
+"""
+
+
+def collapseOverscan(overscan, flip=False):
+    """Collapse an overscan array to its median in each row
+
+    @param[in] overscan  2-d overscan array (rows, columns)
+    @param[in] flip  reverse the rows, for an amplifier read out from the top
+    @return a float64 array of one value per row, in readout order
+    """
+    profile = np.median(np.asarray(overscan, dtype=np.float64), axis=1)
+    return profile[::-1] if flip else profile
+
+
+def findBiasJump(profile, minRows=50, minSignificance=10.0, minStep=1.0):
+    """Find the single step in a collapsed overscan profile
+
+    @param[in] profile  1-d array of one overscan value per row, in readout order
+    @param[in] minRows  minimum number of rows on each side of the jump, and number of rows on each
+        side of it in which the step must be seen
+    @param[in] minSignificance  minimum step, in units of its noise, of a jump
+    @param[in] minStep  minimum absolute step of a jump (ADU)
+    @return a BiasJump, or None if there is no significant jump
+    """
+    profile = np.asarray(profile, dtype=np.float64)
+    num = len(profile)
+    if num < 2*minRows or minRows < 1:
+        return None
+    # Noise of a row from the differences of adjacent rows, robust to the jump itself
+    diffs = np.diff(profile)
+    sigma = 1.4826*np.median(np.abs(diffs - np.median(diffs)))/math.sqrt(2.0)
+    if not sigma > 0:
+        sigma = np.std(diffs)/math.sqrt(2.0)
+    if not sigma > 0:
+        return None
+
+    cumsum = np.concatenate([[0.0], np.cumsum(profile)])
+    rows = np.arange(minRows, num - minRows + 1)
+    below = cumsum[rows]/rows
+    above = (cumsum[-1] - cumsum[rows])/(num - rows)
+    steps = above - below
+    significance = np.abs(steps)/(sigma*np.sqrt(1.0/rows + 1.0/(num - rows)))
+    best = int(np.argmax(significance))
+    if significance[best] < minSignificance or abs(steps[best]) < minStep:
+        return None
+
+    # The steps between the rows next to the split, which are small for a ramp, and differ for a transient
+    location = int(rows[best])
+    localSteps = []
+    for window in (max(minRows//2, 1), minRows):
+        localStep = ((cumsum[location + window] - cumsum[location]) -
+                     (cumsum[location] - cumsum[location - window]))/window
+        localSigma = sigma*math.sqrt(2.0/window)
+        if abs(localStep) < max(minSignificance*localSigma, minStep):
+            return None
+        localSteps.append(localStep)
+    if abs(localSteps[0] - localSteps[1]) > max(3.0*localSigma*math.sqrt(2.0), 0.2*abs(localSteps[1])):
+        return None
+    return BiasJump(location=location, step=float(steps[best]), significance=float(significance[best]))
+
+
+def getNight(mjd, nightBoundaryUT=19.0):
+    """Return the integer MJD of the night of an observation
+
+    @param[in] mjd  modified Julian date of the observation
+    @param[in] nightBoundaryUT  UT hour at which a night starts (local noon)
+    """
+    return int(math.floor(mjd - nightBoundaryUT/24.0))
+
+
+class BiasJumpCache(object):
+    """Bias jumps of the backplanes, or None for no jump, per (night, backplane), shared by the process"""
+
+    _results = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, night, backplane, detect):
+        """Return the cached result for a night and backplane, calling detect() to make it if needed
+
+        @param[in] detect  function with no arguments returning a BiasJump or None
+        @return (BiasJump or None, was the result cached?)
+        """
+        key = (night, backplane)
+        with cls._lock:
+            if key in cls._results:
+                return cls._results[key], True
+        result = detect()
+        with cls._lock:
+            result = cls._results.setdefault(key, result)
+        return result, False
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._results.clear()
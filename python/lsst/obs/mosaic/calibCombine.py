@@ -0,0 +1,290 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Combine the frames of a bias, dark, flat or fringe in row bands read straight from the files
+
+CalibCombineTask from pipe_drivers reads `rows` rows of every input through
+the butler for each band, and combines the bands one after the other.
+MosaicCalibCombineTask reads each band with astropy sections, which read
+only the rows of the band from memory-mapped files, or decompress only its
+tiles, and combines the bands on threads.  The height of the bands is chosen
+so that the bands being combined fit in maxMemoryMBytes.
+
+The combine is computed with numpy, pixel by pixel along the stack, so the
+result does not depend on the height of the bands: combineArrays, which
+combines whole frames in memory, gives the same result.  MEANCLIP is the
+mean after nIter rounds of clipping at clip sigma, starting from the median
+and the interquartile range; MEDIAN and MEAN are also supported, and other
+statistics fall back to CalibCombineTask.  The streaming combine is enabled
+with doStream; by default the afw combine of CalibCombineTask is used.
+testCalibCombine compares the two on the same inputs.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+from builtins import range
+
+import re
+import threading
+import warnings
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.afw.image as afwImage
+import lsst.pex.config as pexConfig
+from lsst.pipe.drivers.constructCalibs import CalibCombineConfig, CalibCombineTask
+
+__all__ = ["STATISTICS", "BYTES_PER_PIXEL", "combineStack", "combineArrays", "getBandRows",
+           "streamCombine", "MosaicCalibCombineConfig", "MosaicCalibCombineTask"]
+
+STATISTICS = ("MEANCLIP", "MEDIAN", "MEAN")
+
+# Memory used by the combine for each pixel of each input: the stack and the temporaries of combineStack
+BYTES_PER_PIXEL = 40
+
+
+def combineStack(stack, statistic="MEANCLIP", clip=3.0, nIter=3):
+    """Combine a stack of frames pixel by pixel
+
+    @param[in] stack  float32 array of shape (number of frames, rows, columns); NaN pixels are ignored
+    @param[in] statistic  one of STATISTICS
+    @param[in] clip  clipping threshold, in sigma, for MEANCLIP
+    @param[in] nIter  number of clipping iterations for MEANCLIP
+    @return the combined float32 array of shape (rows, columns); NaN where all pixels are ignored
+    """
+    if statistic not in STATISTICS:
+        raise RuntimeError("Unsupported statistic %s: not one of %s" % (statistic, STATISTICS))
+    with warnings.catch_warnings(), np.errstate(invalid="ignore", divide="ignore"):
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN pixels
+        if statistic == "MEDIAN":
+            return np.nanmedian(stack, axis=0).astype(np.float32)
+        if statistic == "MEAN":
+            return np.nanmean(stack, axis=0, dtype=np.float64).astype(np.float32)
+        lower, center, upper = np.nanpercentile(stack, [25, 50, 75], axis=0)
+        sigma = 0.741*(upper - lower)
+        for i in range(nIter):
+            valid = np.abs(stack - center) <= clip*sigma
+            num = valid.sum(axis=0)
+            center = np.where(valid, stack, 0.0).sum(axis=0, dtype=np.float64)/num
+            sumSq = (np.where(valid, stack - center, 0.0)**2).sum(axis=0)
+            # A single pixel left keeps itself
+            sigma = np.where(num > 1, np.sqrt(sumSq/(num - 1)), 0.0)
+        return center.astype(np.float32)
+
+
+def _maskStack(stack, masks, badMask):
+    """Set the pixels of a stack with any of the badMask bits set in masks to NaN"""
+    if masks is not None and badMask:
+        for image, mask in zip(stack, masks):
+            if mask is not None:
+                image[(mask.astype(np.int64, copy=False) & badMask) != 0] = np.nan
+
+
+def combineArrays(images, masks=None, badMask=0, scales=None, statistic="MEANCLIP", clip=3.0, nIter=3):
+    """Combine whole frames in memory, as streamCombine does band by band
+
+    @param[in] images  list of 2-d arrays
+    @param[in] masks  list of 2-d integer arrays (or None) matching images, or None
+    @param[in] badMask  pixels with any of these mask bits set are ignored
+    @param[in] scales  list of numbers (or None) by which to divide the images, or None
+    @return the combined float32 array; see combineStack for the other parameters
+    """
+    stack = np.array(images, dtype=np.float32)
+    if scales is not None:
+        for image, scale in zip(stack, scales):
+            if scale is not None:
+                image /= scale
+    _maskStack(stack, masks, badMask)
+    return combineStack(stack, statistic, clip, nIter)
+
+
+def getBandRows(numInputs, width, height, maxBytes, numThreads=1):
+    """Return the height of the bands for which numThreads bands of numInputs frames fit in maxBytes"""
+    rows = maxBytes//(max(numThreads, 1)*numInputs*width*BYTES_PER_PIXEL)
+    return int(min(max(rows, 1), height))
+
+
+def _splitPath(path):
+    """Split a butler path into the path of the file and the HDU (None if there is no suffix)"""
+    match = re.match(r"^(.*)\[(\d+)\]$", path)
+    if match is None:
+        return path, None
+    return match.group(1), int(match.group(2))
+
+
+class _BandReader(object):
+    """Read row bands of the image and mask of a list of files, with one set of open files per thread
+
+    @param[in] inputs  list of (path, image HDU, mask HDU or None); None for a missing input
+    """
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self._local = threading.local()
+        self._hduLists = []
+        self._lock = threading.Lock()
+
+    def _getHdus(self):
+        hdus = getattr(self._local, "hdus", None)
+        if hdus is None:
+            hdus = []
+            for item in self.inputs:
+                if item is None:
+                    hdus.append(None)
+                    continue
+                path, imageHdu, maskHdu = item
+                hduList = fits.open(path, memmap=True)
+                with self._lock:
+                    self._hduLists.append(hduList)
+                hdus.append((hduList[imageHdu], hduList[maskHdu] if maskHdu is not None else None))
+            self._local.hdus = hdus
+        return hdus
+
+    def read(self, y0, y1, width):
+        """Return the image stack (NaN for missing inputs) and the list of masks of rows [y0, y1)"""
+        hdus = self._getHdus()
+        stack = np.empty((len(hdus), y1 - y0, width), dtype=np.float32)
+        masks = []
+        for image, item in zip(stack, hdus):
+            if item is None:
+                image[:] = np.nan
+                masks.append(None)
+                continue
+            imageHdu, maskHdu = item
+            image[:] = imageHdu.section[y0:y1, :]
+            masks.append(maskHdu.section[y0:y1, :] if maskHdu is not None else None)
+        return stack, masks
+
+    def close(self):
+        with self._lock:
+            for hduList in self._hduLists:
+                hduList.close()
+            self._hduLists = []
+
+
+def streamCombine(inputs, width, height, badMask=0, scales=None, statistic="MEANCLIP", clip=3.0, nIter=3,
+                  maxBytes=1 << 30, numThreads=1, log=None):
+    """Combine frames band by band, reading only the rows of each band from the files
+
+    @param[in] inputs  list of (path, image HDU, mask HDU or None); None for a missing input
+    @param[in] width, height  dimensions of the frames
+    @param[in] maxBytes  memory for the bands being combined
+    @param[in] numThreads  number of bands combined at once
+    @param[in] log  logger or None
+    @return the combined float32 array; see combineArrays for the other parameters
+    """
+    rows = getBandRows(len(inputs), width, height, maxBytes, numThreads)
+    bands = [(y0, min(y0 + rows, height)) for y0 in range(0, height, rows)]
+    if log is not None:
+        log.info("Combining %d inputs in %d bands of %d rows on %d threads" %
+                 (len(inputs), len(bands), rows, numThreads))
+    combined = np.empty((height, width), dtype=np.float32)
+    reader = _BandReader(inputs)
+
+    def combineBand(band):
+        y0, y1 = band
+        stack, masks = reader.read(y0, y1, width)
+        if scales is not None:
+            for image, scale in zip(stack, scales):
+                if scale is not None:
+                    image /= scale
+        _maskStack(stack, masks, badMask)
+        combined[y0:y1] = combineStack(stack, statistic, clip, nIter)
+
+    try:
+        if numThreads > 1 and len(bands) > 1:
+            pool = ThreadPool(min(numThreads, len(bands)))
+            try:
+                pool.map(combineBand, bands, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for band in bands:
+                combineBand(band)
+    finally:
+        reader.close()
+    return combined
+
+
+class MosaicCalibCombineConfig(CalibCombineConfig):
+    doStream = pexConfig.Field(dtype=bool, default=False,
+                               doc="Read and combine the inputs in bands straight from the files, "
+                                   "with numpy instead of afw?")
+    maxMemoryMBytes = pexConfig.Field(dtype=int, default=1024,
+                                      doc="Memory for the bands being combined (MB), if doStream")
+    numThreads = pexConfig.Field(dtype=int, default=4, doc="Number of bands combined at once, if doStream")
+
+
+class MosaicCalibCombineTask(CalibCombineTask):
+    """CalibCombineTask that streams the inputs in bands and combines the bands on threads
+
+    See the documentation of lsst.obs.mosaic.calibCombine.
+    """
+    ConfigClass = MosaicCalibCombineConfig
+
+    def run(self, sensorRefList, expScales=None, finalScale=None, inputName="postISRCCD"):
+        """Combine the inputs of a CCD
+
+        @param[in] sensorRefList  data references of the inputs; None for a missing input
+        @param[in] expScales  numbers by which to divide the inputs, or None
+        @param[in] finalScale  background of the combined image, or None
+        @param[in] inputName  dataset of the inputs
+        @return (lsst.afw.image.DecoratedImageF) the combined image
+        """
+        if not self.config.doStream or self.config.combine not in STATISTICS:
+            if self.config.doStream:
+                self.log.warn("Cannot stream the %s statistic; combining with afw" % (self.config.combine,))
+            return CalibCombineTask.run(self, sensorRefList, expScales=expScales, finalScale=finalScale,
+                                        inputName=inputName)
+        width, height = self.getDimensions(sensorRefList)
+        inputs = [None if sensorRef is None else self.getInput(sensorRef, inputName)
+                  for sensorRef in sensorRefList]
+        numImages = len([item for item in inputs if item is not None])
+        if numImages < 1:
+            raise RuntimeError("No valid input data")
+        if numImages < self.config.stats.minimum:
+            self.log.warn("Number of good input images (%d) is less than the minimum (%d)" %
+                          (numImages, self.config.stats.minimum))
+        scales = None
+        if expScales is not None:
+            scales = [None if scale is None else float(scale) for scale in expScales]
+        array = streamCombine(inputs, width, height, badMask=afwImage.MaskU.getPlaneBitMask(self.config.mask),
+                              scales=scales, statistic=self.config.combine, clip=self.config.clip,
+                              nIter=self.config.nIter, maxBytes=self.config.maxMemoryMBytes << 20,
+                              numThreads=self.config.numThreads, log=self.log)
+        combined = afwImage.MaskedImageF(afwImage.ImageF(array, False))
+        if finalScale is not None:
+            background = self.stats.run(combined)
+            self.log.info("Measured background of stack is %f; adjusting to %f" % (background, finalScale))
+            combined *= finalScale/background
+        return afwImage.DecoratedImageF(combined.getImage())
+
+    def getInput(self, sensorRef, inputName):
+        """Return (path, image HDU, mask HDU) of an input Exposure"""
+        path, hdu = _splitPath(sensorRef.get(inputName + "_filename")[0])
+        if hdu is not None:
+            return path, hdu, None
+        # An Exposure written by afw: image, mask and variance in HDUs 1, 2 and 3
+        return path, 1, 2
@@ -0,0 +1,172 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Content hashes of a camera geometry repository
+
+A camera repository (e.g. mosaic/camGeom) is a camera.py config and one
+AmpInfo FITS table per detector.  Its manifest lists the SHA-1 of each file,
+in the format of sha1sum, so it can also be checked with `sha1sum -c manifest`.
+The hash of the whole repository is the SHA-1 of the manifest text.
+
+getCurrentManifest describes the files as they are without reading those
+that have not changed: a file listed in the repository's manifest and not
+modified since the manifest was written has the digest of the manifest, and
+other files are hashed once per process for each size and modification time.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import glob
+import hashlib
+import os
+import threading
+
+__all__ = ["MANIFEST_NAME", "listRepository", "hashFile", "makeManifest", "formatManifest",
+           "repositoryHash", "readManifest", "writeManifest", "verifyManifest", "compareManifests",
+           "getCurrentManifest"]
+
+MANIFEST_NAME = "manifest"
+
+# SHA-1 of the files hashed by getCurrentManifest, keyed by (path, size, mtime)
+_hashCache = {}
+_hashLock = threading.Lock()
+
+ManifestDifferences = collections.namedtuple("ManifestDifferences", ["added", "removed", "changed"])
+
+
+def listRepository(cameraDir):
+    """Return the sorted names of the files that make up a camera repository"""
+    paths = [os.path.join(cameraDir, "camera.py")] + glob.glob(os.path.join(cameraDir, "*.fits"))
+    return sorted(os.path.basename(path) for path in paths if os.path.isfile(path))
+
+
+def hashFile(path, blockSize=1 << 20):
+    """Return the SHA-1 hex digest of a file"""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(blockSize), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def makeManifest(cameraDir):
+    """Hash the files of a camera repository
+
+    @param[in] cameraDir  directory of the camera repository
+    @return an OrderedDict of file name: SHA-1, sorted by name
+    """
+    return collections.OrderedDict((name, hashFile(os.path.join(cameraDir, name)))
+                                   for name in listRepository(cameraDir))
+
+
+def formatManifest(manifest):
+    """Return the text of a manifest, in the format of sha1sum"""
+    return "".join("%s  %s\n" % (digest, name) for name, digest in sorted(manifest.items()))
+
+
+def repositoryHash(manifest):
+    """Return a single SHA-1 for the whole repository described by a manifest"""
+    return hashlib.sha1(formatManifest(manifest).encode("ascii")).hexdigest()
+
+
+def readManifest(cameraDir):
+    """Read the manifest of a camera repository
+
+    @return an OrderedDict of file name: SHA-1, or None if there is no manifest
+    """
+    path = os.path.join(cameraDir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    manifest = collections.OrderedDict()
+    with open(path) as infile:
+        for line in infile:
+            if line.strip():
+                digest, name = line.split(None, 1)
+                manifest[name.strip()] = digest
+    return manifest
+
+
+def writeManifest(cameraDir, manifest=None):
+    """Write the manifest of a camera repository
+
+    @param[in] cameraDir  directory of the camera repository
+    @param[in] manifest  manifest to write; if None, hash the files in cameraDir
+    @return the manifest
+    """
+    if manifest is None:
+        manifest = makeManifest(cameraDir)
+    with open(os.path.join(cameraDir, MANIFEST_NAME), "w") as outfile:
+        outfile.write(formatManifest(manifest))
+    return manifest
+
+
+def compareManifests(newManifest, oldManifest):
+    """Compare two manifests
+
+    @return a ManifestDifferences of sorted lists of file names: added, removed, changed
+    """
+    return ManifestDifferences(
+        added=sorted(set(newManifest) - set(oldManifest)),
+        removed=sorted(set(oldManifest) - set(newManifest)),
+        changed=sorted(name for name in set(newManifest) & set(oldManifest)
+                       if newManifest[name] != oldManifest[name]),
+    )
+
+
+def verifyManifest(cameraDir):
+    """Check the files of a camera repository against its manifest
+
+    @return the differences between the files and the manifest, as returned
+        by compareManifests
+    @throw RuntimeError if there is no manifest
+    """
+    manifest = readManifest(cameraDir)
+    if manifest is None:
+        raise RuntimeError("No %s in camera repository %r" % (MANIFEST_NAME, cameraDir))
+    return compareManifests(makeManifest(cameraDir), manifest)
+
+
+def getCurrentManifest(cameraDir):
+    """Return the manifest of the files of a camera repository, hashing only the files that changed
+
+    @param[in] cameraDir  directory of the camera repository
+    @return an OrderedDict of file name: SHA-1, sorted by name, as makeManifest
+    """
+    stored = readManifest(cameraDir) or {}
+    manifestTime = os.stat(os.path.join(cameraDir, MANIFEST_NAME)).st_mtime if stored else None
+    manifest = collections.OrderedDict()
+    for name in listRepository(cameraDir):
+        path = os.path.join(cameraDir, name)
+        stat = os.stat(path)
+        if name in stored and stat.st_mtime <= manifestTime:
+            manifest[name] = stored[name]
+            continue
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+        with _hashLock:
+            digest = _hashCache.get(key)
+        if digest is None:
+            digest = hashFile(path)
+            with _hashLock:
+                _hashCache[key] = digest
+        manifest[name] = digest
+    return manifest
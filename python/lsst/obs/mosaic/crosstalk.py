@@ -0,0 +1,178 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Remove the crosstalk between the CCDs of a visit read out by the same backplane
+
+The CCDs of a readout backplane (the FPA header keyword, MOSAIC_BKP*) are
+read at the same time, and a bright pixel of one CCD leaks into the pixel
+read at the same time on the others: victim -= coefficient*source, for the
+source pixels above a threshold.  Each task of processCcd sees one CCD, so
+the correction is a visit-level stage: MosaicCrosstalkTask.run takes the raw
+exposures of all the CCDs of a visit, and correctArrays their image arrays,
+as MosaicVisitDriverTask does with the CCDs of a visit in its buffer.
+
+correctCrosstalk groups the CCDs by backplane.  For each group it finds the
+pixels bright in any CCD, gathers the values of all the CCDs of the group at
+those pixels (zero below the threshold), computes the corrections of all
+the victims with one matrix product, and subtracts them; the corrections
+are computed from the uncorrected values.  The subtraction is done in
+floating point, and rounded and clipped to the range of integer arrays.
+Arrays are put in readout order with views, so CCDs read from different
+corners line up.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import range
+
+import collections
+
+import numpy as np
+
+import lsst.afw.table as afwTable
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+
+__all__ = ["parseCoefficients", "getReadoutFlip", "correctCrosstalk", "MosaicCrosstalkConfig",
+           "MosaicCrosstalkTask"]
+
+
+def parseCoefficients(coefficients):
+    """Convert a dict of "victim,source" ccdnum: coefficient to a dict of (victim, source): coefficient"""
+    result = {}
+    for key, value in coefficients.items():
+        victim, source = [int(item) for item in key.split(",")]
+        result[(victim, source)] = float(value)
+    return result
+
+
+def getReadoutFlip(detector):
+    """Return (flip rows?, flip columns?) to put the image of a detector in readout order"""
+    corner = detector[0].getReadoutCorner()
+    return (corner in (afwTable.UL, afwTable.UR), corner in (afwTable.LR, afwTable.UR))
+
+
+def _readoutView(array, flip):
+    """Return a view of an array in readout order; flip is (flip rows?, flip columns?)"""
+    flipRows, flipColumns = flip
+    return array[::-1 if flipRows else 1, ::-1 if flipColumns else 1]
+
+
+def correctCrosstalk(arrays, backplanes, coefficients, threshold, flips=None):
+    """Remove the crosstalk between the CCDs of each backplane, in place
+
+    @param[in,out] arrays  dict of ccdnum: 2-d image array
+    @param[in] backplanes  dict of ccdnum: backplane name; CCDs without one are not corrected
+    @param[in] coefficients  dict of (victim ccdnum, source ccdnum): crosstalk coefficient
+    @param[in] threshold  only the source pixels above this value are corrected
+    @param[in] flips  dict of ccdnum: (flip rows?, flip columns?) to put the array in readout order,
+        or None if all the CCDs are read from the same corner
+    @return dict of ccdnum: number of pixels corrected
+    """
+    groups = collections.defaultdict(list)
+    for ccdnum in sorted(arrays):
+        if backplanes.get(ccdnum) is not None:
+            groups[backplanes[ccdnum]].append(ccdnum)
+    numCorrected = dict((ccdnum, 0) for ccdnum in arrays)
+    for backplane, ccdnums in groups.items():
+        matrix = np.array([[coefficients.get((victim, source), 0.0) for source in ccdnums]
+                           for victim in ccdnums])
+        if len(ccdnums) < 2 or not matrix.any():
+            continue
+        views = [_readoutView(arrays[ccdnum], flips[ccdnum] if flips else (False, False))
+                 for ccdnum in ccdnums]
+        shape = views[0].shape
+        if any(view.shape != shape for view in views):
+            raise RuntimeError("CCDs %s of backplane %s differ in shape" % (ccdnums, backplane))
+        # Only the CCDs that are the source of some crosstalk need to be searched for bright pixels
+        sources = [i for i in range(len(ccdnums)) if matrix[:, i].any()]
+        bright = np.zeros(shape, dtype=bool)
+        for i in sources:
+            bright |= views[i] > threshold
+        rows, columns = np.nonzero(bright)
+        if len(rows) == 0:
+            continue
+        values = np.zeros((len(ccdnums), len(rows)))
+        for i in sources:
+            pixels = views[i][rows, columns]
+            values[i] = np.where(pixels > threshold, pixels, 0.0)
+        corrections = matrix.dot(values)
+        for i, ccdnum in enumerate(ccdnums):
+            if matrix[i].any():
+                pixels = views[i][rows, columns] - corrections[i]
+                if np.issubdtype(views[i].dtype, np.integer):
+                    limits = np.iinfo(views[i].dtype)
+                    pixels = np.clip(np.rint(pixels), limits.min, limits.max)
+                views[i][rows, columns] = pixels
+                numCorrected[ccdnum] = int(np.count_nonzero(corrections[i]))
+    return numCorrected
+
+
+class MosaicCrosstalkConfig(pexConfig.Config):
+    coefficients = pexConfig.DictField(
+        keytype=str,
+        itemtype=float,
+        default={},
+        doc="Crosstalk coefficients, keyed by \"victim ccdnum,source ccdnum\"; "
+            "pairs not listed have no crosstalk",
+    )
+    minPixelToCorrect = pexConfig.Field(
+        dtype=float,
+        default=45000.0,
+        doc="Only source pixels above this value (ADU) are corrected",
+    )
+
+
+class MosaicCrosstalkTask(pipeBase.Task):
+    """Remove the crosstalk between the CCDs of a visit; see lsst.obs.mosaic.crosstalk"""
+    ConfigClass = MosaicCrosstalkConfig
+    _DefaultName = "crosstalk"
+
+    @pipeBase.timeMethod
+    def run(self, exposures):
+        """Remove the crosstalk between the raw exposures of the CCDs of a visit, in place
+
+        @param[in,out] exposures  dict of ccdnum: raw exposure, with the FPA metadata keyword
+        @return a pipeBase.Struct with numCorrected, a dict of ccdnum: number of pixels corrected
+        """
+        arrays = {}
+        backplanes = {}
+        flips = {}
+        for ccdnum, exposure in exposures.items():
+            arrays[ccdnum] = exposure.getMaskedImage().getImage().getArray()
+            metadata = exposure.getMetadata()
+            backplanes[ccdnum] = metadata.get('FPA') if metadata.exists('FPA') else None
+            flips[ccdnum] = getReadoutFlip(exposure.getDetector())
+        return self.correctArrays(arrays, backplanes, flips)
+
+    def correctArrays(self, arrays, backplanes, flips=None):
+        """Remove the crosstalk between the image arrays of the CCDs of a visit, in place
+
+        @param[in,out] arrays  dict of ccdnum: 2-d image array
+        @param[in] backplanes  dict of ccdnum: backplane name (FPA), or None
+        @param[in] flips  dict of ccdnum: (flip rows?, flip columns?), as returned by getReadoutFlip
+        @return a pipeBase.Struct with numCorrected, a dict of ccdnum: number of pixels corrected
+        """
+        numCorrected = correctCrosstalk(arrays, backplanes, parseCoefficients(self.config.coefficients),
+                                        self.config.minPixelToCorrect, flips)
+        self.log.info("Corrected crosstalk in %d pixels of %d CCDs" %
+                      (sum(numCorrected.values()), len([n for n in numCorrected.values() if n > 0])))
+        return pipeBase.Struct(numCorrected=numCorrected)
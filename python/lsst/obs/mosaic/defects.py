@@ -0,0 +1,347 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Bulk export and import of Mosaic defects, and a compact defect index
+
+Mosaic defects are bad pixel masks registered in the "defect" table of the
+calibration registry, one per CCD and validity period.  They are
+community pipeline masks, nonzero for bad pixels (unlike the DLS bpm dataset
+read by mosaicPreprocessedIsr, which is 0 for bad pixels).  Reading them through
+the butler means one registry lookup and one file read per CCD per period,
+and turning the mask into a defect list each time.
+
+Here all the defects of a calibration repository are exported in one pass
+(one registry query, each bad pixel mask file read once) into a columnar FITS
+file with two binary tables:
+- DEFECTS: one row per defect (ccdnum, validStart, x0, y0, width, height),
+  sorted by validStart and ccdnum, so the defects of a validity period are
+  contiguous rows;
+- INDEX: one row per registry entry (validStart, validEnd, ccdnum, path,
+  row, nrows) giving the rows of the defects of each CCD.
+Installed in the calibration repository as DEFECT_INDEX_NAME, it is used by
+MosaicMapper.bypass_defects to read the defects of all the CCDs of a validity
+period at once.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+
+import collections
+import glob
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+import astropy.io.fits as fits
+
+__all__ = ["DEFECT_INDEX_NAME", "DEFECT_DTYPE", "INDEX_DTYPE", "maskToBoxes", "readRegistry",
+           "exportDefects", "importDefects", "makeIndex", "readDefectText", "writeDefectText",
+           "writeDefectFile", "readDefectFile", "DefectIndex"]
+
+DEFECT_INDEX_NAME = "defectIndex.fits"
+
+DEFECT_DTYPE = np.dtype([("ccdnum", np.int16), ("validStart", "S10"), ("x0", np.int32), ("y0", np.int32),
+                         ("width", np.int32), ("height", np.int32)])
+INDEX_DTYPE = np.dtype([("validStart", "S10"), ("validEnd", "S10"), ("ccdnum", np.int16), ("path", "S256"),
+                        ("row", np.int64), ("nrows", np.int32)])
+
+
+def maskToBoxes(mask):
+    """Decompose the nonzero pixels of a mask into non-overlapping rectangles
+
+    Runs of bad pixels along each row are merged with identical runs in the
+    following rows, so bad columns and blocks become single rectangles.
+
+    @param[in] mask  2-d array; nonzero pixels are bad
+    @return structured array with fields x0, y0, width, height
+    """
+    bad = np.asarray(mask) != 0
+    padded = np.zeros((bad.shape[0], bad.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = bad
+    edges = np.diff(padded, axis=1)
+    # both lists are in row-major order, so the i-th start matches the i-th end
+    runY, runX0 = np.nonzero(edges == 1)
+    runX1 = np.nonzero(edges == -1)[1]
+
+    boxes = np.zeros(len(runY), dtype=[("x0", np.int32), ("y0", np.int32),
+                                       ("width", np.int32), ("height", np.int32)])
+    if len(runY) == 0:
+        return boxes
+    order = np.lexsort((runY, runX1, runX0))
+    runY, runX0, runX1 = runY[order], runX0[order], runX1[order]
+    newBox = np.ones(len(runY), dtype=bool)
+    newBox[1:] = (runX0[1:] != runX0[:-1]) | (runX1[1:] != runX1[:-1]) | (runY[1:] != runY[:-1] + 1)
+    starts = np.flatnonzero(newBox)
+    boxes = boxes[:len(starts)]
+    boxes["x0"] = runX0[starts]
+    boxes["y0"] = runY[starts]
+    boxes["width"] = runX1[starts] - runX0[starts]
+    boxes["height"] = np.diff(np.append(starts, len(runY)))
+    return boxes
+
+
+def readRegistry(calibRoot, registryName="calibRegistry.sqlite3"):
+    """Read all the entries of the defect table of a calibration registry in one query
+
+    @return a list of (validStart, validEnd, ccdnum, path), sorted by validStart and ccdnum
+    """
+    conn = sqlite3.connect(os.path.join(calibRoot, registryName))
+    conn.text_factory = str
+    try:
+        cursor = conn.cursor()
+        cursor.execute("select validStart, validEnd, ccdnum, path from defect order by validStart, ccdnum")
+        return [(str(validStart), str(validEnd), int(ccdnum), str(path))
+                for validStart, validEnd, ccdnum, path in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def _splitPath(path):
+    """Split a path with an optional [hdu] suffix into (filename, hdu or None)"""
+    match = re.match(r"(.*)\[(\d+)\]$", path)
+    if match:
+        return match.group(1), int(match.group(2))
+    return path, None
+
+
+def _findMask(hduList, hdu, ccdnum):
+    """Return the bad pixel mask array of ccdnum from an open FITS file"""
+    if hdu is not None:
+        return hduList[hdu].data
+    images = [h for h in hduList if h.data is not None and h.data.ndim == 2]
+    for h in images:
+        if h.header.get("CCDNUM") == ccdnum:
+            return h.data
+    if len(images) == 1:
+        return images[0].data
+    raise RuntimeError("Cannot find the bad pixel mask of ccdnum=%d in %s" % (ccdnum, hduList.filename()))
+
+
+def exportDefects(calibRoot, registryName="calibRegistry.sqlite3", log=None):
+    """Export the defects of all validity periods and CCDs of a calibration repository
+
+    @param[in] calibRoot  root of the calibration repository
+    @param[in] registryName  name of the calibration registry in calibRoot
+    @param[in] log  logger or None
+    @return (defects, index): structured arrays of dtype DEFECT_DTYPE and INDEX_DTYPE
+    """
+    entries = readRegistry(calibRoot, registryName)
+    byFile = collections.defaultdict(list)
+    for i, (validStart, validEnd, ccdnum, path) in enumerate(entries):
+        filename, hdu = _splitPath(path)
+        byFile[filename].append((i, hdu))
+
+    boxesList = [None]*len(entries)
+    for filename, items in byFile.items():
+        if log is not None:
+            log.info("Reading %s" % (filename,))
+        with fits.open(os.path.join(calibRoot, filename), memmap=False) as hduList:
+            for i, hdu in items:
+                boxesList[i] = maskToBoxes(_findMask(hduList, hdu, entries[i][2]))
+
+    index = np.zeros(len(entries), dtype=INDEX_DTYPE)
+    numDefects = sum(len(boxes) for boxes in boxesList)
+    defects = np.zeros(numDefects, dtype=DEFECT_DTYPE)
+    row = 0
+    for i, ((validStart, validEnd, ccdnum, path), boxes) in enumerate(zip(entries, boxesList)):
+        index[i] = (validStart, validEnd, ccdnum, path, row, len(boxes))
+        rows = defects[row:row + len(boxes)]
+        rows["ccdnum"] = ccdnum
+        rows["validStart"] = validStart
+        for name in ("x0", "y0", "width", "height"):
+            rows[name] = boxes[name]
+        row += len(boxes)
+    return defects, index
+
+
+def writeDefectFile(path, defects, index):
+    """Write defects and their index as a FITS file with DEFECTS and INDEX binary tables"""
+    hduList = fits.HDUList([fits.PrimaryHDU(),
+                            fits.BinTableHDU(defects, name="DEFECTS"),
+                            fits.BinTableHDU(index, name="INDEX")])
+    tempPath = path + ".tmp"
+    hduList.writeto(tempPath, overwrite=True)
+    os.rename(tempPath, path)
+
+
+def readDefectFile(path):
+    """Read a file written by writeDefectFile
+
+    @return (defects, index): structured arrays of dtype DEFECT_DTYPE and INDEX_DTYPE
+    """
+    with fits.open(path) as hduList:
+        defects = np.array(hduList["DEFECTS"].data, dtype=DEFECT_DTYPE)
+        index = np.array(hduList["INDEX"].data, dtype=INDEX_DTYPE)
+    return defects, index
+
+
+def writeDefectText(outputDir, defects):
+    """Write defects as text, one directory per validity period
+
+    The format is that of the former examples/genDefectText.py:
+    outputDir/<validStart>/defects.dat with columns ccdnum x0 y0 width height.
+    """
+    for validStart in np.unique(defects["validStart"]):
+        rows = defects[defects["validStart"] == validStart]
+        dirPath = os.path.join(outputDir, validStart.decode())
+        if not os.path.isdir(dirPath):
+            os.makedirs(dirPath)
+        table = np.array([rows[name] for name in ("ccdnum", "x0", "y0", "width", "height")]).T
+        np.savetxt(os.path.join(dirPath, "defects.dat"), table, fmt="%-4d %-5d %-5d %-5d %d",
+                   header="CCD x0    y0    width height", comments="#")
+
+
+def readDefectText(inputDir):
+    """Read defects written by writeDefectText
+
+    @return a structured array of dtype DEFECT_DTYPE
+    """
+    pieces = []
+    for path in sorted(glob.glob(os.path.join(inputDir, "*", "defects.dat"))):
+        validStart = os.path.basename(os.path.dirname(path))
+        table = np.loadtxt(path, dtype=np.int64, ndmin=2).reshape(-1, 5)
+        rows = np.zeros(len(table), dtype=DEFECT_DTYPE)
+        rows["validStart"] = validStart
+        for i, name in enumerate(("ccdnum", "x0", "y0", "width", "height")):
+            rows[name] = table[:, i]
+        pieces.append(rows)
+    if not pieces:
+        return np.zeros(0, dtype=DEFECT_DTYPE)
+    return np.concatenate(pieces)
+
+
+def makeIndex(defects, entries):
+    """Sort defects and index them against calibration registry entries
+
+    @param[in] defects  structured array of dtype DEFECT_DTYPE
+    @param[in] entries  list of (validStart, validEnd, ccdnum, path), as returned by readRegistry
+    @return (defects, index, unmatched): the sorted defects, the index, and the
+        number of defects whose (validStart, ccdnum) is not in the registry
+    """
+    defects = defects[np.lexsort((defects["ccdnum"], defects["validStart"]))]
+    groups = {}
+    if len(defects) > 0:
+        newGroup = np.ones(len(defects), dtype=bool)
+        newGroup[1:] = (defects["validStart"][1:] != defects["validStart"][:-1]) | \
+            (defects["ccdnum"][1:] != defects["ccdnum"][:-1])
+        starts = np.flatnonzero(newGroup)
+        counts = np.diff(np.append(starts, len(defects)))
+        for start, count in zip(starts, counts):
+            groups[(defects["validStart"][start].decode(), int(defects["ccdnum"][start]))] = (start, count)
+
+    index = np.zeros(len(entries), dtype=INDEX_DTYPE)
+    matched = 0
+    for i, (validStart, validEnd, ccdnum, path) in enumerate(sorted(entries)):
+        key = (validStart, ccdnum)
+        if key in groups:
+            row, nrows = groups[key]
+            matched += nrows
+        else:
+            row = np.searchsorted(defects["validStart"], validStart.encode())
+            nrows = 0
+        index[i] = (validStart, validEnd, ccdnum, path, row, nrows)
+    return defects, index, len(defects) - matched
+
+
+def importDefects(inputPath, calibRoot, registryName="calibRegistry.sqlite3", log=None):
+    """Install defects as the defect index of a calibration repository
+
+    @param[in] inputPath  a file written by writeDefectFile, or a directory written by writeDefectText
+    @param[in] calibRoot  root of the calibration repository
+    @param[in] registryName  name of the calibration registry in calibRoot
+    @param[in] log  logger or None
+    @return the path of the defect index
+    """
+    if os.path.isdir(inputPath):
+        defects = readDefectText(inputPath)
+    else:
+        defects = readDefectFile(inputPath)[0]
+    defects, index, unmatched = makeIndex(defects, readRegistry(calibRoot, registryName))
+    if unmatched > 0 and log is not None:
+        log.warn("%d defects of %s have no (validStart, ccdnum) entry in the registry" %
+                 (unmatched, inputPath))
+    indexPath = os.path.join(calibRoot, DEFECT_INDEX_NAME)
+    writeDefectFile(indexPath, defects, index)
+    return indexPath
+
+
+class DefectIndex(object):
+    """Defects of a calibration repository, read one validity period at a time
+
+    @param[in] path  path of a file written by writeDefectFile
+    """
+    _cache = {}
+    _cacheLock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        with fits.open(path) as hduList:
+            self._index = np.array(hduList["INDEX"].data, dtype=INDEX_DTYPE)
+        self._periodByPath = dict(((entry["path"].decode(), int(entry["ccdnum"])), entry["validStart"])
+                                  for entry in self._index)
+        self._periods = {}
+
+    @classmethod
+    def get(cls, path):
+        """Return the DefectIndex for path, shared within the process and reloaded if the file changes
+
+        @return a DefectIndex, or None if path does not exist
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        with cls._cacheLock:
+            entry = cls._cache.get(path)
+            if entry is None or entry[0] != mtime:
+                entry = (mtime, cls(path))
+                cls._cache[path] = entry
+            return entry[1]
+
+    def findPeriod(self, path, ccdnum):
+        """Return the validStart of the registry entry (path, ccdnum), or None if not indexed"""
+        return self._periodByPath.get((path, ccdnum))
+
+    def getPeriod(self, validStart):
+        """Return the defects of all CCDs for a validity period, reading them at once
+
+        @return a dict of ccdnum: structured array with fields x0, y0, width, height
+        """
+        if validStart not in self._periods:
+            entries = self._index[self._index["validStart"] == validStart]
+            start = int(entries["row"].min())
+            end = int((entries["row"] + entries["nrows"]).max())
+            with fits.open(self.path, memmap=True) as hduList:
+                rows = np.array(hduList["DEFECTS"].data[start:end], dtype=DEFECT_DTYPE)
+            self._periods[validStart] = dict(
+                (int(entry["ccdnum"]), rows[int(entry["row"]) - start:int(entry["row"] + entry["nrows"]) - start])
+                for entry in entries)
+        return self._periods[validStart]
+
+    def getDefects(self, path, ccdnum):
+        """Return the defects of the registry entry (path, ccdnum), or None if not indexed"""
+        validStart = self.findPeriod(path, ccdnum)
+        if validStart is None:
+            return None
+        return self.getPeriod(validStart).get(ccdnum)
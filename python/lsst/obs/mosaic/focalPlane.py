@@ -0,0 +1,328 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Vectorized pixel <-> focal plane <-> pupil <-> sky transforms for the Mosaic camera
+
+The Mosaic camera description in mosaic/camGeom/camera.py is simple: eight
+detectors placed with an offset and a yaw, and a radial polynomial from the
+focal plane (mm) to the pupil (radians on the sky).  Going through
+Detector.transform one point at a time is very slow for large numbers of
+points, so this module precomputes the per-detector affine transforms and the
+radial polynomial once and applies them to whole NumPy arrays.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+from builtins import range
+
+import math
+import os
+
+import numpy as np
+
+__all__ = ["MosaicFocalPlaneTransform"]
+
+
+class MosaicFocalPlaneTransform(object):
+    """Whole-focal-plane pixel <-> sky transform for the Mosaic camera
+
+    Each detector is modelled by an affine transform from pixels to the
+    focal plane (mm), which is exact for a detector described by an offset,
+    a reference position, a pixel size, a yaw and an optional transposition.
+    The focal plane is mapped to the pupil (field angle in radians) with the
+    camera radial polynomial, and the pupil is mapped to the sky with a
+    zenithal equidistant projection about the boresight.
+
+    All methods take and return NumPy arrays; ccdnum may be a scalar or an
+    array broadcastable against the positions.
+
+    The sky orientation convention is that, for a rotation angle of zero,
+    pupil +y points north and pupil +x points west (east is left, as on an
+    image displayed with north up).  The rotation angle is the position angle
+    of pupil +y, measured from north through east, in degrees.
+    """
+
+    def __init__(self, ccdnums, offsets, refPositions, pixelSizes, yaws, bboxes, radialCoeffs,
+                 transposes=None):
+        """Construct a MosaicFocalPlaneTransform
+
+        @param[in] ccdnums  sequence of detector ids (ccdnum)
+        @param[in] offsets  sequence of (x, y) detector offsets in the focal plane (mm)
+        @param[in] refPositions  sequence of (x, y) reference positions in pixels
+        @param[in] pixelSizes  sequence of (x, y) pixel sizes (mm)
+        @param[in] yaws  sequence of detector yaws (degrees)
+        @param[in] bboxes  sequence of (x0, y0, x1, y1) inclusive pixel bounding boxes
+        @param[in] radialCoeffs  coefficients of the focal plane -> pupil radial polynomial;
+                                 coeffs[0] must be 0
+        @param[in] transposes  sequence of booleans: transpose the pixel grid first?
+        """
+        ccdnums = np.asarray(ccdnums, dtype=int)
+        if transposes is None:
+            transposes = [False]*len(ccdnums)
+        if len(radialCoeffs) < 2 or radialCoeffs[0] != 0:
+            raise RuntimeError("Radial coefficients must have at least 2 terms and coeffs[0] must be 0")
+        self.ccdnums = ccdnums
+        self.radialCoeffs = np.array(radialCoeffs, dtype=float)
+        self._radialDerivCoeffs = self.radialCoeffs[1:]*np.arange(1, len(self.radialCoeffs))
+
+        # Per-detector affine transforms, indexed directly by ccdnum so that
+        # lookups are a single fancy-indexing operation.  Unused slots are NaN.
+        size = ccdnums.max() + 1
+        self._forward = np.full((size, 2, 3), np.nan)
+        self._inverse = np.full((size, 2, 3), np.nan)
+        self._bboxes = np.full((size, 4), np.nan)
+        for i, ccdnum in enumerate(ccdnums):
+            forward = self._makeAffine(offsets[i], refPositions[i], pixelSizes[i], yaws[i], transposes[i])
+            self._forward[ccdnum] = forward
+            linearInverse = np.linalg.inv(forward[:, :2])
+            self._inverse[ccdnum, :, :2] = linearInverse
+            self._inverse[ccdnum, :, 2] = -linearInverse.dot(forward[:, 2])
+            self._bboxes[ccdnum] = bboxes[i]
+
+    @staticmethod
+    def _makeAffine(offset, refPosition, pixelSize, yaw, transpose):
+        """Return the 2x3 pixels -> focal plane affine matrix for one detector
+
+        This mirrors lsst.afw.cameraGeom.Orientation for zero pitch and roll:
+            fp = offset + R(yaw) S (T pix - refPosition)
+        where S scales by the pixel size and T optionally swaps x and y.
+        """
+        cosYaw = math.cos(math.radians(yaw))
+        sinYaw = math.sin(math.radians(yaw))
+        rotation = np.array([[cosYaw, -sinYaw], [sinYaw, cosYaw]])
+        linear = rotation.dot(np.diag([pixelSize[0], pixelSize[1]]))
+        if transpose:
+            linear = linear.dot(np.array([[0., 1.], [1., 0.]]))
+        # refPosition is given in transposed coordinates, so subtract it after T
+        refFp = rotation.dot(np.array([refPosition[0]*pixelSize[0], refPosition[1]*pixelSize[1]]))
+        affine = np.empty((2, 3))
+        affine[:, :2] = linear
+        affine[:, 2] = np.asarray(offset, dtype=float) - refFp
+        return affine
+
+    @classmethod
+    def fromCameraConfig(cls, cameraConfig):
+        """Construct from an lsst.afw.cameraGeom.CameraConfig
+
+        @param[in] cameraConfig  camera config, e.g. as loaded from mosaic/camGeom/camera.py
+        """
+        pupilName = "Pupil"
+        transforms = cameraConfig.transformDict.transforms
+        if pupilName not in transforms or transforms[pupilName].transform.name != "radial":
+            raise RuntimeError("Camera config does not have a radial %s transform" % (pupilName,))
+        radialCoeffs = list(transforms[pupilName].transform["radial"].coeffs)
+
+        detectorConfigs = [cameraConfig.detectorList[i] for i in sorted(cameraConfig.detectorList)]
+        for det in detectorConfigs:
+            if det.pitchDeg != 0 or det.rollDeg != 0:
+                raise RuntimeError("Detector %s has non-zero pitch or roll" % (det.name,))
+        return cls(
+            ccdnums=[det.id for det in detectorConfigs],
+            offsets=[(det.offset_x, det.offset_y) for det in detectorConfigs],
+            refPositions=[(det.refpos_x, det.refpos_y) for det in detectorConfigs],
+            pixelSizes=[(det.pixelSize_x, det.pixelSize_y) for det in detectorConfigs],
+            yaws=[det.yawDeg for det in detectorConfigs],
+            bboxes=[(det.bbox_x0, det.bbox_y0, det.bbox_x1, det.bbox_y1) for det in detectorConfigs],
+            radialCoeffs=radialCoeffs,
+            transposes=[det.transposeDetector for det in detectorConfigs],
+        )
+
+    @classmethod
+    def fromCameraRepository(cls, cameraDir=None):
+        """Construct from a camera repository, by default the one in obs_mosaic
+
+        @param[in] cameraDir  directory containing camera.py; defaults to mosaic/camGeom
+        """
+        from lsst.afw.cameraGeom import CameraConfig
+        if cameraDir is None:
+            from lsst.utils import getPackageDir
+            cameraDir = os.path.join(getPackageDir("obs_mosaic"), "mosaic", "camGeom")
+        cameraConfig = CameraConfig()
+        cameraConfig.load(os.path.join(cameraDir, "camera.py"))
+        return cls.fromCameraConfig(cameraConfig)
+
+    def _checkCcdnum(self, ccdnum):
+        ccdnum = np.asarray(ccdnum, dtype=int)
+        if np.any(ccdnum < 0) or np.any(ccdnum >= len(self._forward)) or \
+                np.any(np.isnan(self._forward[ccdnum, 0, 0])):
+            raise RuntimeError("Unknown ccdnum in %s" % (np.unique(ccdnum),))
+        return ccdnum
+
+    def pixelsToFocalPlane(self, ccdnum, x, y):
+        """Transform pixel positions to focal plane positions (mm)
+
+        @param[in] ccdnum  detector id(s)
+        @param[in] x, y  pixel positions
+        @return xFp, yFp  focal plane positions (mm)
+        """
+        affine = self._forward[self._checkCcdnum(ccdnum)]
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        xFp = affine[..., 0, 0]*x + affine[..., 0, 1]*y + affine[..., 0, 2]
+        yFp = affine[..., 1, 0]*x + affine[..., 1, 1]*y + affine[..., 1, 2]
+        return xFp, yFp
+
+    def focalPlaneToPixels(self, xFp, yFp, ccdnum=None):
+        """Transform focal plane positions (mm) to pixel positions
+
+        @param[in] xFp, yFp  focal plane positions (mm)
+        @param[in] ccdnum  detector id(s) to use; if None, use the detector
+                           containing each point (0 if there is none)
+        @return ccdnum, x, y  detector id and pixel positions; NaN off-detector
+        """
+        xFp = np.asarray(xFp, dtype=float)
+        yFp = np.asarray(yFp, dtype=float)
+        if ccdnum is not None:
+            affine = self._inverse[self._checkCcdnum(ccdnum)]
+            x = affine[..., 0, 0]*xFp + affine[..., 0, 1]*yFp + affine[..., 0, 2]
+            y = affine[..., 1, 0]*xFp + affine[..., 1, 1]*yFp + affine[..., 1, 2]
+            return np.broadcast_to(ccdnum, x.shape).astype(int), x, y
+
+        xFp, yFp = np.broadcast_arrays(xFp, yFp)
+        ccdOut = np.zeros(xFp.shape, dtype=int)
+        xOut = np.full(xFp.shape, np.nan)
+        yOut = np.full(xFp.shape, np.nan)
+        for det in self.ccdnums:
+            affine = self._inverse[det]
+            x = affine[0, 0]*xFp + affine[0, 1]*yFp + affine[0, 2]
+            y = affine[1, 0]*xFp + affine[1, 1]*yFp + affine[1, 2]
+            x0, y0, x1, y1 = self._bboxes[det]
+            inside = (x >= x0 - 0.5) & (x < x1 + 0.5) & (y >= y0 - 0.5) & (y < y1 + 0.5) & (ccdOut == 0)
+            ccdOut[inside] = det
+            xOut[inside] = x[inside]
+            yOut[inside] = y[inside]
+        return ccdOut, xOut, yOut
+
+    def focalPlaneToPupil(self, xFp, yFp):
+        """Transform focal plane positions (mm) to pupil positions (radians)"""
+        xFp = np.asarray(xFp, dtype=float)
+        yFp = np.asarray(yFp, dtype=float)
+        radius = np.hypot(xFp, yFp)
+        scale = self._radialScale(radius)
+        return xFp*scale, yFp*scale
+
+    def _radialScale(self, radius):
+        """Return radialPolynomial(radius)/radius, with the limit at radius = 0"""
+        # coeffs[0] is 0, so poly(r)/r = coeffs[1] + coeffs[2] r + ...
+        return np.polynomial.polynomial.polyval(radius, self.radialCoeffs[1:])
+
+    def pupilToFocalPlane(self, xPupil, yPupil, maxIter=20, tolerance=1e-12):
+        """Transform pupil positions (radians) to focal plane positions (mm)
+
+        The radial polynomial is inverted with vectorized Newton iterations.
+        """
+        xPupil = np.asarray(xPupil, dtype=float)
+        yPupil = np.asarray(yPupil, dtype=float)
+        rPupil = np.hypot(xPupil, yPupil)
+        radius = rPupil/self.radialCoeffs[1]
+        for i in range(maxIter):
+            value = np.polynomial.polynomial.polyval(radius, self.radialCoeffs) - rPupil
+            deriv = np.polynomial.polynomial.polyval(radius, self._radialDerivCoeffs)
+            step = value/deriv
+            radius -= step
+            if np.all(np.abs(step) <= tolerance*np.maximum(radius, 1.0)):
+                break
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scale = np.where(rPupil > 0, radius/rPupil, 1.0/self.radialCoeffs[1])
+        return xPupil*scale, yPupil*scale
+
+    @staticmethod
+    def pupilToSky(xPupil, yPupil, boresightRa, boresightDec, rotAngle=0.0):
+        """Transform pupil positions (radians) to sky positions (degrees)
+
+        @param[in] xPupil, yPupil  pupil positions (radians)
+        @param[in] boresightRa, boresightDec  boresight position (degrees)
+        @param[in] rotAngle  position angle of pupil +y, east of north (degrees)
+        @return ra, dec  (degrees)
+        """
+        ra0 = math.radians(boresightRa)
+        dec0 = math.radians(boresightDec)
+        rho = np.hypot(xPupil, yPupil)
+        # position angle east of north; +x is west so it enters negated
+        theta = np.arctan2(-np.asarray(xPupil, dtype=float), yPupil) + math.radians(rotAngle)
+        sinDec = math.sin(dec0)*np.cos(rho) + math.cos(dec0)*np.sin(rho)*np.cos(theta)
+        dec = np.arcsin(np.clip(sinDec, -1.0, 1.0))
+        ra = ra0 + np.arctan2(np.sin(theta)*np.sin(rho)*math.cos(dec0),
+                              np.cos(rho) - math.sin(dec0)*sinDec)
+        return np.degrees(ra) % 360.0, np.degrees(dec)
+
+    @staticmethod
+    def skyToPupil(ra, dec, boresightRa, boresightDec, rotAngle=0.0):
+        """Transform sky positions (degrees) to pupil positions (radians)
+
+        This is the inverse of pupilToSky.
+        """
+        ra0 = math.radians(boresightRa)
+        dec0 = math.radians(boresightDec)
+        ra = np.radians(ra)
+        dec = np.radians(dec)
+        dRa = ra - ra0
+        # east and north components of the direction from the boresight; using atan2
+        # rather than arccos keeps full precision at small separations
+        east = np.sin(dRa)*np.cos(dec)
+        north = math.cos(dec0)*np.sin(dec) - math.sin(dec0)*np.cos(dec)*np.cos(dRa)
+        cosRho = math.sin(dec0)*np.sin(dec) + math.cos(dec0)*np.cos(dec)*np.cos(dRa)
+        rho = np.arctan2(np.hypot(east, north), cosRho)
+        theta = np.arctan2(east, north)
+        theta = theta - math.radians(rotAngle)
+        return -rho*np.sin(theta), rho*np.cos(theta)
+
+    def pixelsToSky(self, ccdnum, x, y, boresightRa, boresightDec, rotAngle=0.0):
+        """Transform pixel positions to sky positions (degrees)"""
+        xFp, yFp = self.pixelsToFocalPlane(ccdnum, x, y)
+        xPupil, yPupil = self.focalPlaneToPupil(xFp, yFp)
+        return self.pupilToSky(xPupil, yPupil, boresightRa, boresightDec, rotAngle)
+
+    def skyToPixels(self, ra, dec, boresightRa, boresightDec, rotAngle=0.0, ccdnum=None):
+        """Transform sky positions (degrees) to pixel positions
+
+        @return ccdnum, x, y  see focalPlaneToPixels
+        """
+        xPupil, yPupil = self.skyToPupil(ra, dec, boresightRa, boresightDec, rotAngle)
+        xFp, yFp = self.pupilToFocalPlane(xPupil, yPupil)
+        return self.focalPlaneToPixels(xFp, yFp, ccdnum=ccdnum)
+
+    def transformPixels(self, ccdnum, x, y, boresight=None, rotAngle=0.0):
+        """Transform pixel positions to every supported coordinate system in one call
+
+        @param[in] ccdnum  detector id(s)
+        @param[in] x, y  pixel positions
+        @param[in] boresight  (ra, dec) of the boresight in degrees, or None
+        @param[in] rotAngle  see pupilToSky
+        @return a dict with keys xFp, yFp, xPupil, yPupil and, if boresight is
+            given, ra and dec
+        """
+        xFp, yFp = self.pixelsToFocalPlane(ccdnum, x, y)
+        xPupil, yPupil = self.focalPlaneToPupil(xFp, yFp)
+        result = dict(xFp=xFp, yFp=yFp, xPupil=xPupil, yPupil=yPupil)
+        if boresight is not None:
+            result["ra"], result["dec"] = self.pupilToSky(xPupil, yPupil, boresight[0], boresight[1],
+                                                          rotAngle)
+        return result
+
+    def getCorners(self, ccdnum):
+        """Return the pixel positions of the four corners of a detector's bounding box
+
+        @return x, y  arrays of length 4, in order (x0, y0), (x1, y0), (x1, y1), (x0, y1)
+        """
+        x0, y0, x1, y1 = self._bboxes[self._checkCcdnum(ccdnum)]
+        return np.array([x0, x1, x1, x0]), np.array([y0, y0, y1, y1])
@@ -0,0 +1,304 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Fit one smooth background model across all the CCDs of a visit, in focal plane coordinates
+
+The sky of a Mosaic visit varies smoothly across the focal plane, but a
+background fitted to each CCD alone has to find its large-scale shape from
+one eighth of the field, and follows the light of large galaxies and bright
+stars near the CCD edges.  MosaicFocalPlaneBackgroundTask bins each CCD,
+taking the median of the good pixels of each bin with one numpy reduction
+over all the bins, maps the bin centers to the focal plane with the
+vectorized MosaicFocalPlaneTransform, and fits a single two-dimensional
+Chebyshev polynomial to the bins of all the CCDs, clipping outlying bins.
+The model is evaluated at the centers of the bins, of about nodeSpacing
+pixels, of an afw.math.BackgroundMI on each CCD, and returned as an
+afw.math.BackgroundList, which interpolates it linearly to every pixel and
+which CharacterizeImageTask persists with its own background, so the work
+per visit is one small linear least-squares fit and a few array operations
+per CCD.
+
+The stage works on a visit: run takes the exposures of the CCDs of a visit.
+MosaicVisitDriverTask does as run with the CCDs on worker processes:
+measureExposure on each CCD, fitMeasurements on the measurements of the
+visit, and makeBackground for each CCD.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+from builtins import range
+
+import warnings
+
+import numpy as np
+from numpy.polynomial import chebyshev
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+
+__all__ = ["binImage", "FocalPlaneBackground", "fitFocalPlaneBackground", "getBinCenters",
+           "MosaicFocalPlaneBackgroundConfig", "MosaicFocalPlaneBackgroundTask"]
+
+
+def binImage(image, bad, binSize, minFraction=0.5):
+    """Measure the median of the good pixels of each bin of an image
+
+    @param[in] image  2-d image array
+    @param[in] bad  2-d boolean array of the pixels to ignore, or None
+    @param[in] binSize  size of the bins (pixels); the bins at the top and right may be smaller
+    @param[in] minFraction  minimum fraction of good pixels in a bin
+    @return x, y, values: the 1-d arrays of the pixel positions of the centers of the columns
+        and rows of bins, and the 2-d array of the medians, NaN for bins with too few good pixels
+    """
+    height, width = image.shape
+    ny = (height + binSize - 1)//binSize
+    nx = (width + binSize - 1)//binSize
+    padded = np.full((ny*binSize, nx*binSize), np.nan, dtype=np.float32)
+    padded[:height, :width] = image
+    if bad is not None:
+        padded[:height, :width][bad] = np.nan
+    blocks = padded.reshape(ny, binSize, nx, binSize).swapaxes(1, 2).reshape(ny, nx, binSize*binSize)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN bins
+        values = np.nanmedian(blocks, axis=2).astype(np.float64)
+    xEdges = np.minimum(np.arange(nx + 1)*binSize, width)
+    yEdges = np.minimum(np.arange(ny + 1)*binSize, height)
+    numPixels = np.outer(np.diff(yEdges), np.diff(xEdges))
+    numGood = np.isfinite(blocks).sum(axis=2)
+    values[(numGood == 0) | (numGood < minFraction*numPixels)] = np.nan
+    # Pixel centers are at integer positions
+    x = 0.5*(xEdges[:-1] + xEdges[1:]) - 0.5
+    y = 0.5*(yEdges[:-1] + yEdges[1:]) - 0.5
+    return x, y, values
+
+
+def _chebyshevTerms(order):
+    """Return the (x, y) degrees of the terms of a Chebyshev polynomial of maximum total order"""
+    return [(i, j) for i in range(order + 1) for j in range(order + 1 - i)]
+
+
+class FocalPlaneBackground(object):
+    """A Chebyshev polynomial background model in focal plane coordinates
+
+    @param[in] bounds  (xMin, yMin, xMax, yMax) of the focal plane (mm), mapped to [-1, 1]
+    @param[in] order  maximum total order of the polynomial
+    @param[in] coefficients  coefficients of the terms, in the order of _chebyshevTerms(order)
+    """
+
+    def __init__(self, bounds, order, coefficients):
+        self.bounds = tuple(float(value) for value in bounds)
+        self.order = order
+        self.coefficients = np.asarray(coefficients, dtype=float)
+
+    def _normalize(self, xFp, yFp):
+        xMin, yMin, xMax, yMax = self.bounds
+        u = (2.0*np.asarray(xFp, dtype=float) - (xMin + xMax))/(xMax - xMin)
+        v = (2.0*np.asarray(yFp, dtype=float) - (yMin + yMax))/(yMax - yMin)
+        return u, v
+
+    def getDesignMatrix(self, xFp, yFp):
+        """Return the values of the terms of the polynomial at 1-d arrays of focal plane positions"""
+        u, v = self._normalize(xFp, yFp)
+        full = chebyshev.chebvander2d(u, v, [self.order, self.order])
+        return full[:, [i*(self.order + 1) + j for i, j in _chebyshevTerms(self.order)]]
+
+    def __call__(self, xFp, yFp):
+        """Evaluate the model at focal plane positions (mm), arrays of any shape"""
+        xFp, yFp = np.broadcast_arrays(np.asarray(xFp, dtype=float), np.asarray(yFp, dtype=float))
+        design = self.getDesignMatrix(xFp.ravel(), yFp.ravel())
+        return design.dot(self.coefficients).reshape(xFp.shape)
+
+
+def fitFocalPlaneBackground(xFp, yFp, values, bounds, order=4, clip=3.0, nIter=3):
+    """Fit a FocalPlaneBackground to binned measurements, clipping outlying bins
+
+    @param[in] xFp, yFp  1-d arrays of the focal plane positions of the bins (mm)
+    @param[in] values  1-d array of the measurements of the bins; non-finite values are ignored
+    @param[in] bounds  (xMin, yMin, xMax, yMax) of the focal plane (mm)
+    @param[in] order  maximum total order of the polynomial
+    @param[in] clip  rejection threshold, in units of the robust scatter of the residuals
+    @param[in] nIter  number of rejection iterations
+    @return a pipeBase.Struct with model (the FocalPlaneBackground), used (boolean array of the bins
+        used in the final fit) and rms (robust scatter of the residuals of the used bins)
+    """
+    xFp = np.asarray(xFp, dtype=float)
+    yFp = np.asarray(yFp, dtype=float)
+    values = np.asarray(values, dtype=float)
+    model = FocalPlaneBackground(bounds, order, np.zeros(len(_chebyshevTerms(order))))
+    design = model.getDesignMatrix(xFp, yFp)
+    used = np.isfinite(values)
+    if used.sum() < design.shape[1]:
+        raise RuntimeError("Too few good bins (%d) to fit a background of order %d" % (used.sum(), order))
+    rms = 0.0
+    for i in range(nIter + 1):
+        model.coefficients = np.linalg.lstsq(design[used], values[used], rcond=-1)[0]
+        residuals = values - design.dot(model.coefficients)
+        rms = 1.4826*np.median(np.abs(residuals[used]))
+        if i == nIter or not rms > 0:
+            break
+        keep = np.isfinite(values) & (np.abs(residuals) <= clip*rms)
+        if keep.sum() < design.shape[1] or np.all(keep == used):
+            break
+        used = keep
+    return pipeBase.Struct(model=model, used=used, rms=rms)
+
+
+def getBinCenters(size, numBins):
+    """Return the pixel positions of the centers of the bins of an afw.math.BackgroundMI along one axis
+
+    The bins are laid out as by afw.math.BackgroundMI, to whose statistics
+    image the values at these positions are given.
+
+    @param[in] size  width or height of the image
+    @param[in] numBins  number of bins along the axis
+    @return a 1-d float array of numBins positions
+    """
+    ends = np.minimum(((np.arange(numBins) + 1)*size + numBins//2)//numBins, size)
+    origins = np.concatenate([[0], ends[:-1]])
+    return origins + 0.5*(ends - origins) - 0.5
+
+
+class MosaicFocalPlaneBackgroundConfig(pexConfig.Config):
+    binSize = pexConfig.Field(dtype=int, default=256, doc="Size of the bins (pixels)")
+    minFraction = pexConfig.Field(dtype=float, default=0.5, doc="Minimum fraction of good pixels in a bin")
+    order = pexConfig.Field(dtype=int, default=4,
+                            doc="Maximum total order of the Chebyshev polynomial across the focal plane")
+    clip = pexConfig.Field(dtype=float, default=3.0,
+                           doc="Rejection threshold for bins, in units of the robust scatter of the residuals")
+    nIter = pexConfig.Field(dtype=int, default=3, doc="Number of rejection iterations")
+    nodeSpacing = pexConfig.Field(dtype=int, default=128,
+                                  doc="Approximate size (pixels) of the bins of the afw background at whose "
+                                      "centers the model is evaluated, before it is interpolated to every "
+                                      "pixel")
+    badMaskPlanes = pexConfig.ListField(
+        dtype=str,
+        default=["BAD", "SAT", "EDGE", "SUSPECT", "NO_DATA", "CR", "INTRP", "DETECTED"],
+        doc="Mask planes of the pixels ignored when binning; planes that an exposure lacks are skipped",
+    )
+
+
+class MosaicFocalPlaneBackgroundTask(pipeBase.Task):
+    """Fit and subtract one background model across the CCDs of a visit
+
+    See the documentation of lsst.obs.mosaic.focalPlaneBackground.
+    """
+    ConfigClass = MosaicFocalPlaneBackgroundConfig
+    _DefaultName = "focalPlaneBackground"
+
+    def __init__(self, transform=None, *args, **kwargs):
+        """Construct a MosaicFocalPlaneBackgroundTask
+
+        @param[in] transform  MosaicFocalPlaneTransform of the camera, or None to use
+            MosaicMapper.getFocalPlaneTransform()
+        """
+        pipeBase.Task.__init__(self, *args, **kwargs)
+        self.transform = transform
+
+    def getTransform(self):
+        if self.transform is None:
+            from .mosaicMapper import MosaicMapper
+            self.transform = MosaicMapper.getFocalPlaneTransform()
+        return self.transform
+
+    def getBounds(self, ccdnums):
+        """Return (xMin, yMin, xMax, yMax) of the focal plane positions (mm) of the corners of the CCDs"""
+        transform = self.getTransform()
+        corners = [transform.pixelsToFocalPlane(ccdnum, *transform.getCorners(ccdnum))
+                   for ccdnum in ccdnums]
+        xFp = np.concatenate([xCorners for xCorners, yCorners in corners])
+        yFp = np.concatenate([yCorners for xCorners, yCorners in corners])
+        return xFp.min(), yFp.min(), xFp.max(), yFp.max()
+
+    def binExposure(self, exposure):
+        """Bin the good pixels of an exposure; see binImage"""
+        maskedImage = exposure.getMaskedImage()
+        mask = maskedImage.getMask()
+        planes = [plane for plane in self.config.badMaskPlanes if plane in mask.getMaskPlaneDict()]
+        bad = (mask.getArray() & mask.getPlaneBitMask(planes)) != 0 if planes else None
+        return binImage(maskedImage.getImage().getArray(), bad, self.config.binSize, self.config.minFraction)
+
+    def measureExposure(self, ccdnum, exposure):
+        """Bin the good pixels of the exposure of a CCD, with the bin centers in focal plane coordinates
+
+        @return (xFp, yFp, values), 1-d arrays of the focal plane positions (mm) and medians of the bins
+        """
+        x, y, values = self.binExposure(exposure)
+        xFp, yFp = self.getTransform().pixelsToFocalPlane(ccdnum, *np.meshgrid(x, y))
+        return xFp.ravel(), yFp.ravel(), values.ravel()
+
+    def fitMeasurements(self, measurements):
+        """Fit one background model to the binned measurements of the CCDs of a visit
+
+        @param[in] measurements  dict of ccdnum: (xFp, yFp, values), as returned by measureExposure
+        @return the pipeBase.Struct returned by fitFocalPlaneBackground
+        """
+        ccdnums = sorted(measurements)
+        xFp, yFp, values = [np.concatenate([measurements[ccdnum][i] for ccdnum in ccdnums]) for i in range(3)]
+        fit = fitFocalPlaneBackground(xFp, yFp, values, self.getBounds(ccdnums), order=self.config.order,
+                                      clip=self.config.clip, nIter=self.config.nIter)
+        self.log.info("Fitted a focal plane background of order %d to %d bins of %d CCDs; rms %g" %
+                      (self.config.order, fit.used.sum(), len(ccdnums), fit.rms))
+        return fit
+
+    def makeBackground(self, ccdnum, model, bbox):
+        """Return the background model of a CCD as an afw background
+
+        @param[in] ccdnum  CCD number
+        @param[in] model  FocalPlaneBackground
+        @param[in] bbox  lsst.afw.geom.Box2I of the exposure of the CCD
+        @return an lsst.afw.math.BackgroundList with one linearly interpolated BackgroundMI
+        """
+        width, height = bbox.getWidth(), bbox.getHeight()
+        x = getBinCenters(width, max(int(round(width/self.config.nodeSpacing)), 1))
+        y = getBinCenters(height, max(int(round(height/self.config.nodeSpacing)), 1))
+        statsImage = afwImage.MaskedImageF(afwGeom.Extent2I(len(x), len(y)))
+        xFp, yFp = self.getTransform().pixelsToFocalPlane(ccdnum, *np.meshgrid(x, y))
+        statsImage.getImage().getArray()[:] = model(xFp, yFp)
+        background = afwMath.BackgroundList()
+        background.append((afwMath.BackgroundMI(bbox, statsImage), afwMath.Interpolate.LINEAR,
+                           afwMath.REDUCE_INTERP_ORDER, afwMath.ApproximateControl.UNKNOWN, 0, 0, False))
+        return background
+
+    @pipeBase.timeMethod
+    def run(self, exposures, doSubtract=True):
+        """Fit one background model to the CCDs of a visit, and subtract it from each
+
+        @param[in,out] exposures  dict of ccdnum: exposure of the CCDs of a visit
+        @param[in] doSubtract  subtract the model from the exposures?
+        @return a pipeBase.Struct with model (the FocalPlaneBackground), backgrounds (dict of
+            ccdnum: lsst.afw.math.BackgroundList of the model), numBins (number of bins used) and rms
+            (robust scatter of the binned measurements about the model)
+        """
+        measurements = dict((ccdnum, self.measureExposure(ccdnum, exposure))
+                            for ccdnum, exposure in exposures.items())
+        fit = self.fitMeasurements(measurements)
+        backgrounds = {}
+        for ccdnum, exposure in exposures.items():
+            backgrounds[ccdnum] = self.makeBackground(ccdnum, fit.model, exposure.getBBox())
+            if doSubtract:
+                image = exposure.getMaskedImage().getImage()
+                image.getArray()[:] -= backgrounds[ccdnum].getImage().getArray()
+        return pipeBase.Struct(model=fit.model, backgrounds=backgrounds, numBins=int(fit.used.sum()),
+                               rms=fit.rms)
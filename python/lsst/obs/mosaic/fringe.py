@@ -0,0 +1,277 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Vectorized fringe measurement, with the fringe frames and sample regions cached per detector
+
+FringeTask from ip_isr measures the fringe frame and the science exposure in
+config.num pairs of small and large boxes, one afw statistic per box in a
+Python loop.  MosaicFringeTask places the boxes once per detector: a
+FringeRegions holds the flat index of the center of each box and the flat
+offsets of the pixels of a small and of a large box, from which the pixel
+indices of any number of boxes are formed with one broadcast addition.  The
+boxes are measured in chunks of chunkSize boxes, each with one numpy
+reduction over the gathered pixels (NaN for the pixels with a bad mask bit
+in the science or fringe mask).  The fringe frames are read once per
+process, their pedestal removed (if config.pedestal), and kept, with their
+regions, for fringeCacheSize detectors; measure and run do not modify them.
+
+runVisit fits one set of fringe amplitudes to the measurements of all the
+CCDs of a visit, whose fringes share the sky spectrum, and subtracts them
+from each CCD; run fits each CCD alone, as FringeTask does.
+MosaicVisitDriverTask does as runVisit with the CCDs on worker processes:
+measure on each CCD, solveFinite on the measurements of the visit, and
+subtract from each CCD.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+from builtins import range
+
+import collections
+import os
+import threading
+
+import numpy as np
+
+import lsst.afw.math as afwMath
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+from lsst.ip.isr.fringe import FringeConfig, FringeTask
+
+from .calibCombine import combineStack
+
+__all__ = ["FringeRegions", "getFringeRegions", "measureRegions", "MosaicFringeConfig", "MosaicFringeTask"]
+
+# afw statistics that measureRegions computes, and their combineStack names
+_STATISTICS = {afwMath.MEDIAN: "MEDIAN", afwMath.MEAN: "MEAN", afwMath.MEANCLIP: "MEANCLIP"}
+
+# FringeRegions keyed by (detector name, width, height, num, small, large, seed)
+_regionCache = {}
+# Results of MosaicFringeTask._readFringes, keyed by (path, size, mtime, pedestal), least recently used first
+_fringeCache = collections.OrderedDict()
+_cacheLock = threading.Lock()
+
+
+def _boxOffsets(size, width):
+    """Return the flat offsets of the pixels of a box of half-size size from its central pixel"""
+    dy, dx = np.mgrid[-size:size, -size:size]
+    return (dy*width + dx).ravel()
+
+
+class FringeRegions(object):
+    """Positions of the fringe measurement boxes of a detector, as flat pixel indices
+
+    @param[in] width, height  dimensions of the detector
+    @param[in] num  number of boxes
+    @param[in] small, large  half-sizes of the small (fringe) and large (background) boxes
+    @param[in] seed  seed of the random positions, as for FringeTask.generatePositions
+    """
+
+    def __init__(self, width, height, num, small, large, seed=None):
+        self.width = width
+        self.height = height
+        rng = np.random.RandomState(seed)
+        self.positions = np.array([rng.randint(large, width - large, size=num),
+                                   rng.randint(large, height - large, size=num)]).swapaxes(0, 1)
+        self.centers = self.positions[:, 1]*width + self.positions[:, 0]
+        self.smallOffsets = _boxOffsets(small, width)
+        self.largeOffsets = _boxOffsets(large, width)
+
+    def __len__(self):
+        return len(self.centers)
+
+    def getIndices(self, start, stop, offsets):
+        """Return the flat indices of the pixels of boxes [start, stop), shape (stop - start, box pixels)"""
+        return self.centers[start:stop, np.newaxis] + offsets[np.newaxis, :]
+
+
+def getFringeRegions(detectorName, width, height, num, small, large, seed=None):
+    """Return the FringeRegions of a detector, made once per process unless seed is None"""
+    if seed is None:
+        return FringeRegions(width, height, num, small, large)
+    key = (detectorName, width, height, num, small, large, seed)
+    with _cacheLock:
+        regions = _regionCache.get(key)
+        if regions is None:
+            regions = FringeRegions(width, height, num, small, large, seed)
+            _regionCache[key] = regions
+    return regions
+
+
+def measureRegions(image, bad, regions, offsets, statistic="MEDIAN", clip=3.0, nIter=3, chunkSize=2000):
+    """Measure a statistic of the pixels of boxes of an image, many boxes at a time
+
+    @param[in] image  2-d image array
+    @param[in] bad  2-d boolean array of the pixels to ignore, or None
+    @param[in] regions  a FringeRegions
+    @param[in] offsets  regions.smallOffsets or regions.largeOffsets
+    @param[in] statistic  a statistic of calibCombine.STATISTICS
+    @param[in] clip, nIter  clipping parameters for MEANCLIP
+    @param[in] chunkSize  number of boxes measured at once
+    @return an array of the statistic of each box (NaN if all its pixels are bad)
+    """
+    flatImage = np.ascontiguousarray(image, dtype=np.float32).ravel()
+    flatBad = np.ascontiguousarray(bad).ravel() if bad is not None else None
+    values = np.empty(len(regions))
+    for start in range(0, len(regions), chunkSize):
+        stop = min(start + chunkSize, len(regions))
+        indices = regions.getIndices(start, stop, offsets)
+        pixels = flatImage[indices]
+        if flatBad is not None:
+            pixels[flatBad[indices]] = np.nan
+        # combineStack reduces along the first axis
+        values[start:stop] = combineStack(pixels.T[:, :, np.newaxis], statistic, clip, nIter)[:, 0]
+    return values
+
+
+class MosaicFringeConfig(FringeConfig):
+    chunkSize = pexConfig.Field(dtype=int, default=2000, doc="Number of boxes measured at once")
+    fringeCacheSize = pexConfig.Field(dtype=int, default=8,
+                                      doc="Number of fringe frames kept in memory; 0 to read each every time")
+    seed = pexConfig.Field(dtype=int, default=1, optional=True,
+                           doc="Seed of the box positions, which are then the same for all the visits "
+                               "of a detector; None for new positions every time, as FringeTask")
+
+
+class MosaicFringeTask(FringeTask):
+    """FringeTask with vectorized measurements and fringe frames cached per detector
+
+    See the documentation of lsst.obs.mosaic.fringe.
+    """
+    ConfigClass = MosaicFringeConfig
+
+    def readFringes(self, dataRef, assembler=None):
+        """Read the fringe frame of a CCD, or return it from the cache
+
+        The pedestal of the fringe frames is removed once, when they are read, if config.pedestal.
+
+        @return a pipeBase.Struct as FringeTask.readFringes; do not modify its fringes
+        """
+        if self.config.fringeCacheSize <= 0:
+            return self._readFringes(dataRef, assembler)
+        path = dataRef.get("fringe_filename")[0]
+        stat = os.stat(path.split("[")[0])
+        key = (path, stat.st_size, stat.st_mtime, self.config.pedestal)
+        with _cacheLock:
+            result = _fringeCache.pop(key, None)
+        if result is None:
+            result = self._readFringes(dataRef, assembler)
+        with _cacheLock:
+            _fringeCache[key] = result
+            while len(_fringeCache) > self.config.fringeCacheSize:
+                _fringeCache.popitem(last=False)
+        return result
+
+    def _readFringes(self, dataRef, assembler):
+        """Read the fringe frames of a CCD with FringeTask.readFringes, and remove their pedestal"""
+        result = FringeTask.readFringes(self, dataRef, assembler=assembler)
+        if self.config.pedestal:
+            fringes = result.fringes if hasattr(result.fringes, '__iter__') else [result.fringes]
+            for fringe in fringes:
+                self.removePedestal(fringe)
+        return result
+
+    def _getStatistic(self):
+        return _STATISTICS.get(self.config.stats.stat)
+
+    def measure(self, exposure, fringes):
+        """Measure the science exposure and fringe frames in the boxes of the detector
+
+        @param[in] exposure  science exposure
+        @param[in] fringes  fringe exposure, or list of fringe exposures, as returned by readFringes
+            (with the pedestal removed); they are not modified
+        @return a pipeBase.Struct with science (array of num measurements) and fluxes
+            (array of shape (num, number of fringe frames))
+        """
+        if not hasattr(fringes, '__iter__'):
+            fringes = [fringes]
+        statistic = self._getStatistic()
+        if statistic is None:
+            raise RuntimeError("Unsupported fringe statistic %s" % (self.config.stats.stat,))
+        maskedImage = exposure.getMaskedImage()
+        badBits = maskedImage.getMask().getPlaneBitMask(self.config.stats.badMaskPlanes)
+        scienceMask = maskedImage.getMask().getArray()
+        detector = exposure.getDetector()
+        regions = getFringeRegions(detector.getName() if detector is not None else None,
+                                   exposure.getWidth(), exposure.getHeight(), self.config.num,
+                                   self.config.small, self.config.large, self.config.seed)
+
+        def measureImage(image, bad):
+            kwargs = dict(statistic=statistic, clip=self.config.stats.clip,
+                          nIter=self.config.stats.iterations, chunkSize=self.config.chunkSize)
+            small = measureRegions(image, bad, regions, regions.smallOffsets, **kwargs)
+            large = measureRegions(image, bad, regions, regions.largeOffsets, **kwargs)
+            return small - large
+
+        fluxes = np.ndarray([len(regions), len(fringes)])
+        for i, fringe in enumerate(fringes):
+            # As FringeTask, which ORs the science mask into the fringe masks
+            fringeMaskedImage = fringe.getMaskedImage()
+            bad = ((scienceMask | fringeMaskedImage.getMask().getArray()) & badBits) != 0
+            fluxes[:, i] = measureImage(fringeMaskedImage.getImage().getArray(), bad)
+        science = measureImage(maskedImage.getImage().getArray(), (scienceMask & badBits) != 0)
+        return pipeBase.Struct(science=science, fluxes=fluxes)
+
+    @pipeBase.timeMethod
+    def run(self, exposure, fringes, seed=None):
+        """Remove fringes from a CCD, fitting its amplitudes alone
+
+        @param[in,out] exposure  science exposure
+        @param[in] fringes  fringe exposure, or list of fringe exposures
+        @param[in] seed  ignored; the boxes are placed with config.seed
+        """
+        if not self.checkFilter(exposure):
+            return
+        if not hasattr(fringes, '__iter__'):
+            fringes = [fringes]
+        if self._getStatistic() is None:
+            # FringeTask.run ORs the science mask into the fringe frames: give it copies
+            return FringeTask.run(self, exposure, [fringe.Factory(fringe, True) for fringe in fringes])
+        measurement = self.measure(exposure, fringes)
+        solution = self.solveFinite([measurement])
+        self.subtract(exposure, fringes, solution)
+        self.log.info("Fringe amplitudes: %s" % (solution,))
+        return solution
+
+    def runVisit(self, exposures, fringesList):
+        """Remove fringes from the CCDs of a visit, fitting one set of amplitudes to all of them
+
+        @param[in,out] exposures  science exposures of the CCDs
+        @param[in] fringesList  fringe exposure, or list of fringe exposures, of each CCD
+        @return the amplitudes, or None if the filter is not fringe-corrected
+        """
+        if not exposures or not self.checkFilter(exposures[0]):
+            return None
+        fringesList = [fringes if hasattr(fringes, '__iter__') else [fringes] for fringes in fringesList]
+        measurements = [self.measure(exposure, fringes) for exposure, fringes in zip(exposures, fringesList)]
+        solution = self.solveFinite(measurements)
+        for exposure, fringes in zip(exposures, fringesList):
+            self.subtract(exposure, fringes, solution)
+        self.log.info("Fringe amplitudes of %d CCDs: %s" % (len(exposures), solution))
+        return solution
+
+    def solveFinite(self, measurements):
+        """Fit fringe amplitudes to the finite measurements of one or more CCDs with FringeTask.solve"""
+        science = np.concatenate([measurement.science for measurement in measurements])
+        fluxes = np.concatenate([measurement.fluxes for measurement in measurements])
+        good = np.isfinite(science) & np.all(np.isfinite(fluxes), axis=1)
+        return self.solve(science[good], fluxes[good])
@@ -0,0 +1,273 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Ingest CFHTLS Wide catalogs as an HTM-indexed reference catalog
+
+The CFHTLS catalogs are large whitespace-separated text files, one per tile.
+Each file is read in chunks of lines and the star, saturation and magnitude
+cuts are applied to whole chunks.  The files are processed in parallel; each
+worker writes the selected stars of its file as one partial shard per HTM
+pixel, and the partial shards are then merged and written as the ref_cat
+dataset (ref_cats/<name>/<pixel_id>.fits), with the ref_cat_config that
+LoadIndexedReferenceObjectsTask needs to read them.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import itertools
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import lsst.pex.config as pexConfig
+from lsst.meas.algorithms import IngestIndexedReferenceTask, IndexerRegistry
+from lsst.meas.algorithms.ingestIndexReferenceTask import IngestIndexedReferenceConfig
+
+__all__ = ["readCfhtlsCatalog", "IngestCfhtlsReferenceConfig", "IngestCfhtlsReferenceTask"]
+
+FILTERS = ("u", "g", "r", "i", "z")
+
+# Columns of the CFHTLS Wide catalogs:
+# id       x          y        ra        dec         r2   flag    u
+# g        r        i         z       uerr     gerr     rerr     ierr
+# zerr   e(b-v) u(SExflag) g(SExflag) r(SExflag) i(SExflag)   z(SExflag)
+# dk
+RA_COLUMN = 3
+DEC_COLUMN = 4
+FLAG_COLUMN = 6
+MAG_COLUMNS = dict((f, 7 + i) for i, f in enumerate(FILTERS))
+MAG_ERR_COLUMNS = dict((f, 12 + i) for i, f in enumerate(FILTERS))
+
+STAR_FLAG = 1  # star galaxy separation: 0/1 galaxy/star
+SATURATED_FLAG = 2  # saturated star in one of the filters
+
+STAR_DTYPE = np.dtype([("ra", np.float64), ("dec", np.float64)] +
+                      [(f, np.float64) for f in FILTERS] +
+                      [(f + "_err", np.float64) for f in FILTERS] +
+                      [("starnotgal", np.bool_), ("resolved", np.bool_), ("variable", np.bool_)])
+
+
+def readCfhtlsCatalog(filename, chunkSize=100000, magLimit=23.0, magLimitFilter="r", minMagErr=0.001):
+    """Read the unsaturated stars of a CFHTLS Wide catalog, in chunks
+
+    @param[in] filename  path of the catalog
+    @param[in] chunkSize  number of lines to read at a time
+    @param[in] magLimit  keep stars brighter than this
+    @param[in] magLimitFilter  filter of the magnitude limit
+    @param[in] minMagErr  added in quadrature to the magnitude errors
+    @return an iterator over structured arrays of dtype STAR_DTYPE
+    """
+    with open(filename) as infile:
+        lines = (line for line in infile if line.strip() and not line.lstrip().startswith("#"))
+        while True:
+            chunk = list(itertools.islice(lines, chunkSize))
+            if not chunk:
+                break
+            data = np.loadtxt(chunk, ndmin=2)
+            flags = data[:, FLAG_COLUMN].astype(np.int64)
+            good = ((flags & STAR_FLAG) != 0) & ((flags & SATURATED_FLAG) == 0) & \
+                (data[:, MAG_COLUMNS[magLimitFilter]] < magLimit)
+            data = data[good]
+            stars = np.zeros(len(data), dtype=STAR_DTYPE)
+            stars["ra"] = data[:, RA_COLUMN]
+            stars["dec"] = data[:, DEC_COLUMN]
+            for f in FILTERS:
+                stars[f] = data[:, MAG_COLUMNS[f]]
+                stars[f + "_err"] = np.hypot(minMagErr, data[:, MAG_ERR_COLUMNS[f]])
+            stars["starnotgal"] = True
+            yield stars
+
+
+def _indexFile(args):
+    """Select and HTM-index the stars of one file, writing one partial shard per pixel
+
+    Run by the worker pool of IngestCfhtlsReferenceTask.
+
+    @param[in] args  tuple (filename, fileIndex, indexerName, indexerConfig, tempDir,
+                     chunkSize, magLimit, magLimitFilter)
+    @return (fileIndex, number of stars, list of (pixel_id, partial shard path))
+    """
+    filename, fileIndex, indexerName, indexerConfig, tempDir, chunkSize, magLimit, magLimitFilter = args
+    indexer = IndexerRegistry[indexerName](indexerConfig)
+    partials = collections.defaultdict(list)
+    numStars = 0
+    for stars in readCfhtlsCatalog(filename, chunkSize=chunkSize, magLimit=magLimit,
+                                   magLimitFilter=magLimitFilter):
+        if len(stars) == 0:
+            continue
+        pixelIds = np.asarray(indexer.index_points(stars["ra"], stars["dec"]))
+        # remember the position of each star in the file, to number them in file order
+        index = np.arange(numStars, numStars + len(stars))
+        order = np.argsort(pixelIds, kind="mergesort")
+        uniqueIds, starts = np.unique(pixelIds[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for pixelId, start, end in zip(uniqueIds, starts, ends):
+            rows = order[start:end]
+            partials[int(pixelId)].append((index[rows], stars[rows]))
+        numStars += len(stars)
+
+    shards = []
+    for pixelId, pieces in partials.items():
+        path = os.path.join(tempDir, "%d_%d.npz" % (pixelId, fileIndex))
+        np.savez(path, index=np.concatenate([p[0] for p in pieces]),
+                 stars=np.concatenate([p[1] for p in pieces]))
+        shards.append((pixelId, path))
+    return fileIndex, numStars, shards
+
+
+class IngestCfhtlsReferenceConfig(IngestIndexedReferenceConfig):
+    chunkSize = pexConfig.Field(
+        dtype=int,
+        doc="Number of catalog lines to read at a time",
+        default=100000,
+    )
+    magLimit = pexConfig.Field(
+        dtype=float,
+        doc="Keep stars brighter than this magnitude in magLimitFilter",
+        default=23.0,
+    )
+    magLimitFilter = pexConfig.ChoiceField(
+        dtype=str,
+        doc="Filter of magLimit",
+        default="r",
+        allowed=dict((f, "CFHTLS %s" % (f,)) for f in FILTERS),
+    )
+    numProcesses = pexConfig.Field(
+        dtype=int,
+        doc="Number of catalog files to read in parallel",
+        default=1,
+    )
+
+    def setDefaults(self):
+        IngestIndexedReferenceConfig.setDefaults(self)
+        self.dataset_config.ref_dataset_name = "cfhtls"
+        self.ra_name = "ra"
+        self.dec_name = "dec"
+        self.mag_column_list = list(FILTERS)
+        self.mag_err_column_map = dict((f, f + "_err") for f in FILTERS)
+        self.is_resolved_name = "resolved"
+        self.is_variable_name = "variable"
+
+
+class IngestCfhtlsReferenceTask(IngestIndexedReferenceTask):
+    """Ingest CFHTLS Wide catalogs into sharded reference catalog files
+
+    To ingest the CFHTLS Wide catalogs into the repository DATA, use 8 processes:
+
+        ingestCfhtlsReferenceCatalog.py DATA CFHTLS_W_ugriz_*.cat -c numProcesses=8
+    """
+    ConfigClass = IngestCfhtlsReferenceConfig
+    _DefaultName = "ingestCfhtlsReference"
+
+    def create_indexed_catalog(self, files):
+        """Index the stars of a list of CFHTLS catalogs and write them as ref_cat shards
+
+        @param[in] files  a list of paths of CFHTLS catalogs
+        """
+        datasetName = self.config.dataset_config.ref_dataset_name
+        schema, keyMap = self.make_schema(STAR_DTYPE)
+        dataId = self.indexer.make_data_id('master_schema', datasetName)
+        self.butler.put(self.get_catalogs(dataId, schema), 'ref_cat', dataId=dataId)
+
+        tempDir = tempfile.mkdtemp(prefix="ingestCfhtls")
+        try:
+            indexerConfig = self.config.dataset_config.indexer
+            jobs = [(filename, fileIndex, indexerConfig.name, indexerConfig.active, tempDir,
+                     self.config.chunkSize, self.config.magLimit, self.config.magLimitFilter)
+                    for fileIndex, filename in enumerate(files)]
+            if self.config.numProcesses > 1 and len(jobs) > 1:
+                pool = multiprocessing.Pool(min(self.config.numProcesses, len(jobs)))
+                try:
+                    results = pool.map(_indexFile, jobs, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [_indexFile(job) for job in jobs]
+
+            # number the stars consecutively, in the order of the input files
+            firstId = {}
+            numStars = 0
+            shardsByPixel = collections.defaultdict(list)
+            for fileIndex, fileNumStars, shards in sorted(results):
+                self.log.info("Selected %d stars from %s" % (fileNumStars, files[fileIndex]))
+                firstId[fileIndex] = numStars + 1
+                numStars += fileNumStars
+                for pixelId, path in shards:
+                    shardsByPixel[pixelId].append((fileIndex, path))
+
+            for pixelId in sorted(shardsByPixel):
+                ids = []
+                stars = []
+                for fileIndex, path in sorted(shardsByPixel[pixelId]):
+                    with np.load(path) as partial:
+                        ids.append(partial["index"] + firstId[fileIndex])
+                        stars.append(partial["stars"])
+                dataId = self.indexer.make_data_id(pixelId, datasetName)
+                catalog = self._appendStars(self.get_catalogs(dataId, schema), schema, keyMap,
+                                            np.concatenate(ids), np.concatenate(stars))
+                self.butler.put(catalog, 'ref_cat', dataId=dataId)
+        finally:
+            shutil.rmtree(tempDir, ignore_errors=True)
+
+        self.log.info("Wrote %d stars in %d shards" % (numStars, len(shardsByPixel)))
+        dataId = self.indexer.make_data_id(None, datasetName)
+        self.butler.put(self.config.dataset_config, 'ref_cat_config', dataId=dataId)
+
+    def _appendStars(self, catalog, schema, keyMap, ids, stars):
+        """Append stars to a reference catalog, setting whole columns at a time
+
+        @param[in] catalog  reference catalog to extend (possibly empty)
+        @param[in] schema  schema of the reference catalog
+        @param[in] keyMap  map of field name to key, as returned by make_schema
+        @param[in] ids  ids of the stars
+        @param[in] stars  structured array of dtype STAR_DTYPE
+        @return the extended catalog, which is contiguous
+        """
+        start = len(catalog)
+        # resize allocates all the new records in one block of the table
+        catalog.resize(start + len(stars))
+        if not catalog.isContiguous():
+            catalog = catalog.copy(deep=True)
+        columns = catalog.columns
+        columns[schema.find("id").key][start:] = ids
+        columns[schema.find("coord_ra").key][start:] = np.radians(stars["ra"])
+        columns[schema.find("coord_dec").key][start:] = np.radians(stars["dec"])
+        for f in self.config.mag_column_list:
+            # AB magnitudes to fluxes in erg/s/cm^2/Hz, as afwImage.fluxFromABMag
+            flux = 10.0**(-0.4*(stars[f] + 48.6))
+            columns[keyMap[f + "_flux"]][start:] = flux
+            errName = self.config.mag_err_column_map.get(f)
+            if errName is not None:
+                columns[keyMap[f + "_fluxSigma"]][start:] = 0.4*math.log(10.0)*flux*stars[errName]
+        # Flag columns are bits of a shared field, which column views can only read; set only the
+        # true values, which are few since only stars are ingested
+        for flag in ("resolved", "variable"):
+            if flag in keyMap:
+                for i in np.flatnonzero(stars[flag]):
+                    catalog[start + int(i)].set(keyMap[flag], True)
+        return catalog
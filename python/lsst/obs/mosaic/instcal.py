@@ -0,0 +1,153 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Read a community pipeline instcal CCD and its dqmask and wtmap as one MaskedImage
+
+The community pipeline writes the image, data quality mask and weight map
+of an exposure as three files, registered by MosaicParseTask in the
+instcal, dqmask and wtmap columns of the registry.  readInstcal reads the
+HDU of a CCD from each file on its own thread, memory-mapping the files
+that are not tile compressed, and converts each to its final array there:
+the image to native float32, the dqmask bits to mask planes through a
+lookup table of all 16-bit values, and the weights to variance in place.
+The arrays are then used without copies as the planes of the MaskedImage.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.afw.image as afwImage
+
+__all__ = ["DQMASK_PLANES", "MIN_WEIGHT", "makeDqmaskLut", "dqmaskToMask", "weightToVariance",
+           "readInstcal", "makeInstcalMaskedImage"]
+
+# Community pipeline data quality bits and the mask planes they set
+DQMASK_PLANES = collections.OrderedDict([
+    (1, "BAD"),  # bad pixel
+    (2, "SAT"),  # saturated
+    (4, "INTRP"),  # interpolated
+    (16, "CR"),  # cosmic ray
+    (64, "SAT"),  # bleed trail
+    (512, "EDGE"),  # edge
+])
+
+# Weight given to pixels with no valid weight, i.e. a large variance
+MIN_WEIGHT = 1e-14
+
+_lutCache = {}
+_lutLock = threading.Lock()
+
+
+def makeDqmaskLut(planeBits):
+    """Return the lookup table from 16-bit dqmask values to mask values
+
+    @param[in] planeBits  dict of dqmask bit: mask plane bit value
+    @return a uint16 array of 2**16 elements, cached by planeBits
+    """
+    key = tuple(sorted(planeBits.items()))
+    with _lutLock:
+        lut = _lutCache.get(key)
+        if lut is None:
+            values = np.arange(1 << 16, dtype=np.uint32)
+            lut = np.zeros(1 << 16, dtype=np.uint16)
+            for dqBit, maskBit in key:
+                lut[(values & dqBit) != 0] |= maskBit
+            _lutCache[key] = lut
+    return lut
+
+
+def _getPlaneBits():
+    """Return the dict of dqmask bit: mask plane bit value for DQMASK_PLANES"""
+    return dict((dqBit, afwImage.MaskU.getPlaneBitMask(plane)) for dqBit, plane in DQMASK_PLANES.items())
+
+
+def dqmaskToMask(dqmask, lut):
+    """Convert a dqmask array to a mask array with a table from makeDqmaskLut"""
+    return lut[np.asarray(dqmask).astype(np.uint16, copy=False)]
+
+
+def weightToVariance(weight):
+    """Convert a weight map to variance
+
+    Pixels with a weight that is not positive and finite get the variance of
+    the smaller of MIN_WEIGHT and the smallest valid weight.
+
+    @param[in,out] weight  native float32 array; it becomes the variance
+    @return weight
+    """
+    bad = ~(np.isfinite(weight) & (weight > 0))
+    if bad.any():
+        good = weight[~bad]
+        weight[bad] = min(MIN_WEIGHT, good.min()) if good.size else MIN_WEIGHT
+    np.reciprocal(weight, out=weight)
+    return weight
+
+
+def _readHdu(path, hdu, convert):
+    """Read the primary header and the header of an HDU and convert its data, memory-mapped
+    if not compressed"""
+    with fits.open(path, memmap=True) as hduList:
+        return hduList[0].header.copy(), hduList[hdu].header.copy(), convert(hduList[hdu].data)
+
+
+def readInstcal(instcalPath, dqmaskPath, wtmapPath, hdu, numThreads=3):
+    """Read the image, mask and variance arrays of a CCD, concurrently
+
+    @param[in] instcalPath, dqmaskPath, wtmapPath  paths of the three files (without HDU suffixes)
+    @param[in] hdu  HDU of the CCD in each file
+    @param[in] numThreads  number of threads; 1 to read the files one after the other
+    @return (primary header, header of the HDU, image, mask, variance) with the headers of the
+        instcal file; the arrays are native and writable
+    """
+    lut = makeDqmaskLut(_getPlaneBits())
+    jobs = [
+        (instcalPath, lambda data: np.array(data, dtype=np.float32)),
+        (dqmaskPath, lambda data: dqmaskToMask(data, lut)),
+        (wtmapPath, lambda data: weightToVariance(np.array(data, dtype=np.float32))),
+    ]
+    if numThreads > 1:
+        pool = ThreadPool(min(numThreads, len(jobs)))
+        try:
+            results = pool.map(lambda job: _readHdu(job[0], hdu, job[1]), jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_readHdu(path, hdu, convert) for path, convert in jobs]
+    (primaryHeader, header, image), (_, _, mask), (_, _, variance) = results
+    if not (image.shape == mask.shape == variance.shape):
+        raise RuntimeError("Shapes of %s, %s and %s HDU %d differ: %s, %s, %s" %
+                           (instcalPath, dqmaskPath, wtmapPath, hdu, image.shape, mask.shape, variance.shape))
+    return primaryHeader, header, image, mask, variance
+
+
+def makeInstcalMaskedImage(image, mask, variance):
+    """Make a MaskedImageF whose planes share the memory of the arrays from readInstcal"""
+    # deep=False: use the arrays, do not copy them
+    return afwImage.MaskedImageF(afwImage.ImageF(image, False), afwImage.MaskU(mask, False),
+                                 afwImage.ImageF(variance, False))
@@ -22,16 +22,22 @@
 
 import lsst.afw.geom as afwGeom
 import lsst.afw.table as afwTable
+import lsst.daf.base as dafBase
 import lsst.pex.config as pexConfig
 from lsst.ip.isr import IsrTask, overscanCorrection
 from lsst.meas.algorithms.detection import SourceDetectionTask
+from .biasJump import BiasJumpCache, collapseOverscan, findBiasJump, getNight
+from .linearize import getFastLinearizer
+from .quicklook import writeCcdQuicklook
+from .stageTimer import timeStage, timeStageMethod
 
 
 class MosaicIsrConfig(IsrTask.ConfigClass):
     overscanBiasJumpBKP = pexConfig.ListField(
         dtype=str,
         doc="Names of the backplanes for CCDs showing bias jump due to " +
-        "the simultaneous readout of the smaller ancillary CCDs.",
+        "the simultaneous readout of the smaller ancillary CCDs; they are cut " +
+        "at overscanBiasJumpLocation when no jump is found.",
         default=['MOSAIC_BKP3', 'MOSAIC_BKP5', 'MOSAIC_BKP1', 'MOSAIC_BKP4'],
     )
     overscanBiasJumpLocation = pexConfig.Field(
@@ -41,20 +47,97 @@ class MosaicIsrConfig(IsrTask.ConfigClass):
         "dimension of the smaller ancillary CCDs.",
         default=2098,
     )
+    doDetectBiasJump = pexConfig.Field(
+        dtype=bool,
+        doc="Find the bias jump location from the overscan, once per night and " +
+        "backplane, for every backplane (FPA)?  If False, or no jump is found, " +
+        "only the backplanes of overscanBiasJumpBKP are cut, at overscanBiasJumpLocation.",
+        default=True,
+    )
+    nightBoundaryUT = pexConfig.Field(
+        dtype=float,
+        doc="UT hour at which a night starts, for caching the bias jump location.",
+        default=19.0,
+    )
+    biasJumpMinRows = pexConfig.Field(
+        dtype=int,
+        doc="Minimum number of rows on each side of a detected bias jump.",
+        default=50,
+    )
+    biasJumpMinSignificance = pexConfig.Field(
+        dtype=float,
+        doc="Minimum step, in units of its noise, of a detected bias jump.",
+        default=10.0,
+    )
+    biasJumpMinStep = pexConfig.Field(
+        dtype=float,
+        doc="Minimum step (ADU) of a detected bias jump.",
+        default=1.0,
+    )
     numEdgeSuspect = pexConfig.Field(
         dtype=int,
         doc="Number of edge pixels to be flagged as untrustworthy.",
         default=35,
     )
+    doFastLinearize = pexConfig.Field(
+        dtype=bool,
+        doc="Apply the linearization lookup table with the vectorized Mosaic " +
+        "implementation, converting each table only once per process?",
+        default=True,
+    )
+    fastLinearizeNumThreads = pexConfig.Field(
+        dtype=int,
+        doc="Number of amplifiers to linearize in parallel with doFastLinearize.",
+        default=2,
+    )
+    doWriteQuicklook = pexConfig.Field(
+        dtype=bool,
+        doc="Write the ISR-corrected exposure, block-averaged by quicklookBinSize, " +
+        "as quicklookCcd for mosaicQuicklook.py?",
+        default=False,
+    )
+    quicklookBinSize = pexConfig.Field(
+        dtype=int,
+        doc="Number of pixels across a block of quicklookCcd.",
+        default=8,
+    )
 
 
 class MosaicIsrTask(IsrTask):
     ConfigClass = MosaicIsrConfig
 
+    def runDataRef(self, sensorRef):
+        """Perform instrument signature removal on a CCD, as IsrTask.runDataRef
+
+        Write the binned exposure as quicklookCcd if config.doWriteQuicklook.
+        """
+        result = IsrTask.runDataRef(self, sensorRef)
+        if self.config.doWriteQuicklook:
+            with timeStage(self.metadata, "writeQuicklook", self.log):
+                writeCcdQuicklook(sensorRef, result.exposure, self.config.quicklookBinSize)
+        return result
+
     def convertIntToFloat(self, exp):
         """No conversion necessary."""
         return exp
 
+    def readIsrData(self, dataRef, rawExposure):
+        """Retrieve necessary frames for instrument signature removal
+
+        Replace the linearizer by its fast equivalent if config.doFastLinearize.
+
+        @param[in] dataRef: a daf.persistence.butlerSubset.ButlerDataRef
+                            of the detector data to be processed
+        @param[in] rawExposure: a reference raw exposure that will later be
+                                corrected with the retrieved calibration data
+        @return a pipeBase.Struct with the calibration frames, as IsrTask.readIsrData
+        """
+        isrData = IsrTask.readIsrData(self, dataRef, rawExposure)
+        if self.config.doFastLinearize and isrData.linearizer is not None:
+            isrData.linearizer = getFastLinearizer(isrData.linearizer, rawExposure.getDetector(),
+                                                   numThreads=self.config.fastLinearizeNumThreads)
+        return isrData
+
     def maskAndInterpDefect(self, ccdExposure, defectBaseList):
         """Mask defects and edges, interpolate over defects in place
 
@@ -64,42 +147,113 @@ class MosaicIsrTask(IsrTask):
         @param[in,out] ccdExposure: exposure to process
         @param[in] defectBaseList: a list of defects to mask and interpolate
         """
-        IsrTask.maskAndInterpDefect(self, ccdExposure, defectBaseList)
-        maskedImage = ccdExposure.getMaskedImage()
-        goodBBox = maskedImage.getBBox()
-        # This makes a bbox numEdgeSuspect pixels smaller than the image on each side
-        goodBBox.grow(-self.config.numEdgeSuspect)
-        # Mask pixels outside goodBBox as SUSPECT
-        SourceDetectionTask.setEdgeBits(
-            maskedImage,
-            goodBBox,
-            maskedImage.getMask().getPlaneBitMask("SUSPECT")
-        )
+        with timeStage(self.metadata, "maskAndInterpDefect", self.log):
+            IsrTask.maskAndInterpDefect(self, ccdExposure, defectBaseList)
+        with timeStage(self.metadata, "maskEdges", self.log):
+            maskedImage = ccdExposure.getMaskedImage()
+            goodBBox = maskedImage.getBBox()
+            # This makes a bbox numEdgeSuspect pixels smaller than the image on each side
+            goodBBox.grow(-self.config.numEdgeSuspect)
+            # Mask pixels outside goodBBox as SUSPECT
+            SourceDetectionTask.setEdgeBits(
+                maskedImage,
+                goodBBox,
+                maskedImage.getMask().getPlaneBitMask("SUSPECT")
+            )
 
     def overscanCorrection(self, exposure, amp):
         """Apply overscan correction in place
 
-        If the input exposure is on the readout backplanes listed in
-        config.overscanBiasJumpBKP, cut the amplifier in two vertically
-        and correct each piece separately.
+        If config.doDetectBiasJump, look for a bias jump in the overscan of
+        any exposure whose readout backplane (FPA) is known, and if one is
+        found, cut the amplifier in two vertically at the jump and correct each
+        piece separately.  If none is found, exposures on the backplanes listed
+        in config.overscanBiasJumpBKP are cut at config.overscanBiasJumpLocation,
+        and others are corrected as a whole.
 
         @param[in,out] exposure: exposure to process; must include both
                                  DataSec and BiasSec pixels
         @param[in] amp: amplifier device data
         """
-        if not (exposure.getMetadata().exists('FPA') and
-                exposure.getMetadata().get('FPA') in self.config.overscanBiasJumpBKP):
-            IsrTask.overscanCorrection(self, exposure, amp)
+        metadata = exposure.getMetadata()
+        backplane = metadata.get('FPA') if metadata.exists('FPA') else None
+        if backplane is not None and self.config.doDetectBiasJump:
+            biasJump = self.getBiasJump(exposure, amp, backplane)
+            if biasJump is not None:
+                self.biasJumpOverscanCorrection(exposure, amp, biasJump.location)
+                return
+        if backplane in self.config.overscanBiasJumpBKP:
+            self.biasJumpOverscanCorrection(exposure, amp)
             return
+        with timeStage(self.metadata, "overscanCorrection"):
+            IsrTask.overscanCorrection(self, exposure, amp)
+
+    def getBiasJump(self, exposure, amp, backplane):
+        """Return the bias jump of the backplane of an exposure, found once per night
+
+        The jump is found in the overscan of amp the first time a night and
+        backplane are seen, and cached; see lsst.obs.mosaic.biasJump.
+
+        @param[in] exposure: exposure to process; must include BiasSec pixels
+        @param[in] amp: amplifier device data
+        @param[in] backplane: name of the readout backplane of the CCD (FPA)
+        @return a BiasJump, or None if there is no jump
+        """
+        flip = amp.getReadoutCorner() not in (afwTable.LL, afwTable.LR)
 
+        def detect():
+            with timeStage(self.metadata, "detectBiasJump"):
+                image = exposure.getMaskedImage().getImage()
+                overscan = image.Factory(image, amp.getRawHorizontalOverscanBBox()).getArray()
+                return findBiasJump(collapseOverscan(overscan, flip=flip),
+                                    minRows=self.config.biasJumpMinRows,
+                                    minSignificance=self.config.biasJumpMinSignificance,
+                                    minStep=self.config.biasJumpMinStep)
+
+        mjd = self.getMjd(exposure)
+        if mjd is None:
+            return detect()
+        night = getNight(mjd, self.config.nightBoundaryUT)
+        biasJump, cached = BiasJumpCache.get(night, backplane, detect)
+        if not cached:
+            if biasJump is None:
+                self.log.info("No bias jump on %s for night %d" % (backplane, night))
+            else:
+                self.log.info("Bias jump on %s for night %d: %.1f ADU at row %d (%.1f sigma)" %
+                              (backplane, night, biasJump.step, biasJump.location, biasJump.significance))
+        return biasJump
+
+    @staticmethod
+    def getMjd(exposure):
+        """Return the MJD of an exposure, from MJD-OBS or its visitInfo, or None if unknown"""
+        metadata = exposure.getMetadata()
+        if metadata.exists('MJD-OBS'):
+            return metadata.get('MJD-OBS')
+        date = exposure.getInfo().getVisitInfo().getDate()
+        if not date.isValid():
+            return None
+        return date.get(dafBase.DateTime.MJD)
+
+    @timeStageMethod("biasJumpOverscan")
+    def biasJumpOverscanCorrection(self, exposure, amp, location=None):
+        """Apply overscan correction in place, separately above and below the bias jump
+
+        @param[in,out] exposure: exposure to process; must include both
+                                 DataSec and BiasSec pixels
+        @param[in] amp: amplifier device data
+        @param[in] location: rows before the jump, from the readout corner;
+                             config.overscanBiasJumpLocation if None
+        """
+        if location is None:
+            location = self.config.overscanBiasJumpLocation
         dataBox = amp.getRawDataBBox()
         overscanBox = amp.getRawHorizontalOverscanBBox()
 
         if amp.getReadoutCorner() in (afwTable.LL, afwTable.LR):
-            yLower = self.config.overscanBiasJumpLocation
+            yLower = location
             yUpper = dataBox.getHeight() - yLower
         else:
-            yUpper = self.config.overscanBiasJumpLocation
+            yUpper = location
             yLower = dataBox.getHeight() - yUpper
 
         lowerDataBBox = afwGeom.Box2I(dataBox.getBegin(),
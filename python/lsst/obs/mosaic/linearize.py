@@ -0,0 +1,271 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Fast application of the Mosaic linearization lookup tables
+
+mosaic/makeLinearizer.py writes one LinearizeLookupTable per CCD: a float32
+table of shape (num amps, num ADU) of offsets to add to each pixel, indexed by
+its rounded value.  LinearizeLookupTable reads the table from disk for every
+frame and applies it one pixel at a time.
+
+Here the tables are read once per process, stored as int16 or float16 when
+that is exact (the Mosaic tables are small integer offsets), and applied to
+the whole amplifier at once with np.take, with the amplifiers processed in
+parallel threads (NumPy releases the GIL for the array operations).  The
+result is identical to LinearizeLookupTable, including the treatment of
+out-of-range pixels, which are corrected using the nearest table entry.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+from builtins import range
+
+import copy
+import pickle
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import lsst.pipe.base as pipeBase
+from lsst.ip.isr import LinearizeLookupTable
+
+__all__ = ["FastLinearizeLookupTable", "compactTable", "readLinearizer", "getFastLinearizer", "preload"]
+
+# Linearizers read from disk, keyed by path
+_linearizerCache = {}
+# FastLinearizeLookupTable, keyed by (detector name, detector serial)
+_fastLinearizerCache = {}
+_cacheLock = threading.Lock()
+
+# Process-wide ThreadPools, keyed by number of threads; never closed, as other threads may be using them
+_threadPools = {}
+
+
+def _getThreadPool(numThreads):
+    """Return the process-wide pool of numThreads threads, made on first use"""
+    with _cacheLock:
+        pool = _threadPools.get(numThreads)
+        if pool is None:
+            pool = ThreadPool(numThreads)
+            _threadPools[numThreads] = pool
+    return pool
+
+
+def compactTable(table):
+    """Return the table in the smallest of int16, float16 and float32 that holds it exactly
+
+    @param[in] table  linearization table (numpy array)
+    @return the table, possibly converted to a smaller dtype
+    """
+    table = np.asarray(table, dtype=np.float32)
+    if np.all(np.isfinite(table)):
+        with np.errstate(invalid="ignore", over="ignore"):
+            if np.all(np.abs(table) <= np.iinfo(np.int16).max):
+                compact = table.astype(np.int16)
+                if np.array_equal(compact.astype(np.float32), table):
+                    return compact
+            compact = table.astype(np.float16)
+            if np.array_equal(compact.astype(np.float32), table):
+                return compact
+    return np.ascontiguousarray(table)
+
+
+class FastLinearizeLookupTable(object):
+    """A drop-in replacement for LinearizeLookupTable that applies the table with NumPy
+
+    Like LinearizeLookupTable, the amplifier linearity coefficients are
+    [row index in the table, offset to add to the rounded pixel value].
+    """
+    LinearityType = LinearizeLookupTable.LinearityType
+
+    def __init__(self, table, detector, numThreads=2):
+        """Construct a FastLinearizeLookupTable
+
+        @param[in] table  lookup table; a 2-dimensional array of offsets,
+            one row per amplifier
+        @param[in] detector  detector information (lsst.afw.cameraGeom.Detector)
+        @param[in] numThreads  number of amplifiers to linearize in parallel
+        """
+        table = np.asarray(table)
+        if len(table.shape) != 2:
+            raise RuntimeError("table shape = %s; must have two dimensions" % (table.shape,))
+        if table.shape[1] < 1:
+            raise RuntimeError("table shape = %s; must have at least one column" % (table.shape,))
+        self._table = compactTable(table)
+        self._detectorName = detector.getName()
+        self._detectorSerial = detector.getSerial()
+        self._rowInds = []
+        self._colIndOffsets = []
+        for ampInfo in detector.getAmpInfoCatalog():
+            coeffs = ampInfo.getLinearityCoeffs()
+            rowInd = int(coeffs[0])
+            if not 0 <= rowInd < table.shape[0]:
+                raise RuntimeError("Amplifier %s has rowInd=%s; must be in range [0, %s)" %
+                                   (ampInfo.getName(), rowInd, table.shape[0]))
+            self._rowInds.append(rowInd)
+            self._colIndOffsets.append(int(coeffs[1]))
+        self.numThreads = numThreads
+
+    @classmethod
+    def fromLinearizer(cls, linearizer, detector, numThreads=2):
+        """Construct from a LinearizeLookupTable, which keeps its table in _table"""
+        return cls(linearizer._table, detector, numThreads=numThreads)
+
+    @property
+    def nbytes(self):
+        """Memory used by the table, in bytes"""
+        return self._table.nbytes
+
+    def checkDetector(self, detector):
+        """Check detector name and serial number
+
+        @throw RuntimeError if the name or serial number of the detector does not match
+        """
+        if detector.getName() != self._detectorName:
+            raise RuntimeError("Detector names don't match: %s != %s" %
+                               (detector.getName(), self._detectorName))
+        if detector.getSerial() != self._detectorSerial:
+            raise RuntimeError("Detector serial numbers don't match: %s != %s" %
+                               (detector.getSerial(), self._detectorSerial))
+
+    def _linearizeArray(self, array, rowInd, colIndOffset):
+        """Linearize a float array in place
+
+        @return the number of pixels outside the table
+        """
+        table = self._table[rowInd]
+        with np.errstate(invalid="ignore"):
+            # Round halves away from zero, as std::lround in LinearizeLookupTable (np.rint rounds
+            # them to even), in double precision, in which adding 0.5 to a float is exact;
+            # NaN pixels get an arbitrary index, and stay NaN
+            rounded = np.copysign(0.5, array, dtype=np.float64)
+            rounded += array
+            indices = np.trunc(rounded, out=rounded).astype(np.int32)
+        if colIndOffset != 0:
+            indices += colIndOffset
+        numOutOfRange = int(np.count_nonzero((indices < 0) | (indices >= len(table))))
+        np.clip(indices, 0, len(table) - 1, out=indices)
+        array += np.take(table, indices)
+        return numOutOfRange
+
+    def __call__(self, image, detector, log=None):
+        """Correct for non-linearity
+
+        @param[in,out] image  image to correct in place (an lsst.afw.image.Image
+                              of some type)
+        @param[in] detector  detector info (an lsst.afw.cameraGeom.Detector)
+        @param[in] log  logger or None
+
+        @return an lsst.pipe.base.Struct containing:
+        - numAmps  number of amplifiers found
+        - numLinearized  number of amplifiers linearized
+        - numOutOfRange  number of pixels out of range of the table
+        """
+        self.checkDetector(detector)
+        ampInfoCat = detector.getAmpInfoCatalog()
+        array = image.getArray()
+        x0, y0 = image.getX0(), image.getY0()
+        jobs = []
+        for ampInfo, rowInd, colIndOffset in zip(ampInfoCat, self._rowInds, self._colIndOffsets):
+            bbox = ampInfo.getBBox()
+            ampArray = array[bbox.getMinY() - y0:bbox.getMaxY() + 1 - y0,
+                             bbox.getMinX() - x0:bbox.getMaxX() + 1 - x0]
+            jobs.append((ampArray, rowInd, colIndOffset))
+
+        if self.numThreads > 1 and len(jobs) > 1:
+            pool = _getThreadPool(self.numThreads)
+            numOutOfRangeList = pool.map(lambda job: self._linearizeArray(*job), jobs)
+        else:
+            numOutOfRangeList = [self._linearizeArray(*job) for job in jobs]
+        numOutOfRange = sum(numOutOfRangeList)
+
+        if numOutOfRange > 0 and log is not None:
+            log.warn("%s pixels of detector \"%s\" were out of range of the linearization table" %
+                     (numOutOfRange, detector.getName()))
+        numAmps = len(ampInfoCat)
+        return pipeBase.Struct(
+            numAmps=numAmps,
+            numLinearized=numAmps,
+            numOutOfRange=numOutOfRange,
+        )
+
+
+def readLinearizer(path):
+    """Read a pickled linearizer, once per process
+
+    @param[in] path  path of the pickle file
+    @return the linearizer
+    """
+    with _cacheLock:
+        linearizer = _linearizerCache.get(path)
+    if linearizer is None:
+        with open(path, "rb") as infile:
+            linearizer = pickle.load(infile)
+        with _cacheLock:
+            linearizer = _linearizerCache.setdefault(path, linearizer)
+    return linearizer
+
+
+def getFastLinearizer(linearizer, detector, numThreads=2):
+    """Return the FastLinearizeLookupTable equivalent to a LinearizeLookupTable
+
+    The conversion is done once per process for each detector, as long as the
+    same linearizer is passed in (MosaicMapper caches the linearizers it reads).
+    The cached instance is shared, so a caller asking for another number of
+    threads gets a shallow copy of it, which shares its table.
+
+    @param[in] linearizer  a LinearizeLookupTable
+    @param[in] detector  detector info (an lsst.afw.cameraGeom.Detector)
+    @param[in] numThreads  number of amplifiers to linearize in parallel
+    @return a FastLinearizeLookupTable
+    """
+    key = (detector.getName(), detector.getSerial())
+    with _cacheLock:
+        entry = _fastLinearizerCache.get(key)
+    if entry is None or entry[0] is not linearizer:
+        entry = (linearizer, FastLinearizeLookupTable.fromLinearizer(linearizer, detector,
+                                                                     numThreads=numThreads))
+        with _cacheLock:
+            _fastLinearizerCache[key] = entry
+    fastLinearizer = entry[1]
+    if fastLinearizer.numThreads != numThreads:
+        fastLinearizer = copy.copy(fastLinearizer)
+        fastLinearizer.numThreads = numThreads
+    return fastLinearizer
+
+
+def preload(butler, ccdnums=None, numThreads=2):
+    """Read and convert the linearizers of all CCDs, e.g. before forking workers
+
+    @param[in] butler  data butler
+    @param[in] ccdnums  CCD numbers to load; all CCDs in the camera if None
+    @return a dict of ccdnum: FastLinearizeLookupTable
+    """
+    camera = butler.get("camera", immediate=True)
+    if ccdnums is None:
+        ccdnums = [detector.getId() for detector in camera]
+    linearizers = {}
+    for ccdnum in ccdnums:
+        linearizer = butler.get("linearizer", dataId=dict(ccdnum=ccdnum), immediate=True)
+        linearizers[ccdnum] = getFastLinearizer(linearizer, camera[ccdnum], numThreads=numThreads)
+    return linearizers
@@ -0,0 +1,226 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Task metadata of a whole processing run in one SQLite file
+
+The policy persists the metadata of each task run (processCcd_metadata,
+isr_metadata, ...) as one small .boost file per data reference, and
+summarizeStageTiming.py reads them all back.  A MetadataStore keeps them in a
+single SQLite file per run instead: put appends one record per task run,
+with its data ID, every metadata value, and the stage measurements of
+stageTimer in a table of their own, so that summarizeStages aggregates a
+whole run with one GROUP BY query.
+
+Records are only appended: a data reference processed again gets a new
+record, and the queries use the latest record of each task and data ID.
+Writers from many processes, possibly on different nodes, are serialized by
+an fcntl lock on <path>.lock, taken around each put; each put is one
+transaction on its own connection, so a store may be shared by forked
+workers.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+from past.builtins import basestring
+
+import collections
+import contextlib
+import fcntl
+import json
+import numbers
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from .stageTimer import getStageValues
+
+__all__ = ["MetadataStore"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT NOT NULL,
+    dataId TEXT NOT NULL, time REAL NOT NULL, host TEXT, pid INTEGER);
+CREATE TABLE IF NOT EXISTS dataIds (record INTEGER NOT NULL, key TEXT NOT NULL, value);
+CREATE TABLE IF NOT EXISTS metadata (record INTEGER NOT NULL, name TEXT NOT NULL, position INTEGER NOT NULL,
+    value);
+CREATE TABLE IF NOT EXISTS stages (record INTEGER NOT NULL, stage TEXT NOT NULL, quantity TEXT NOT NULL,
+    value REAL);
+CREATE INDEX IF NOT EXISTS recordsTaskDataId ON records (task, dataId);
+CREATE INDEX IF NOT EXISTS dataIdsKeyValue ON dataIds (key, value);
+CREATE INDEX IF NOT EXISTS metadataRecord ON metadata (record);
+CREATE INDEX IF NOT EXISTS stagesRecord ON stages (record);
+"""
+
+
+def _toSql(value):
+    """Convert a metadata value to a type that SQLite stores; other types are stored as strings"""
+    if value is None or isinstance(value, (bool, float, basestring)):
+        return value
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    return str(value)
+
+
+class MetadataStore(object):
+    """Append-only store of task metadata in an SQLite file
+
+    @param[in] path  path of the SQLite file; it is created if needed
+    @param[in] timeout  time (s) to wait for the lock of another writer
+    """
+    _threadLock = threading.Lock()
+
+    def __init__(self, path, timeout=600.0):
+        self.path = path
+        self.timeout = timeout
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Open a connection, and close it after committing or rolling back"""
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """Serialize the writers of all the threads and processes using the store"""
+        with self._threadLock:
+            with open(self.path + ".lock", "a") as lockFile:
+                fcntl.lockf(lockFile, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.lockf(lockFile, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _dataIdKey(dataId):
+        return json.dumps(dict(dataId), sort_keys=True)
+
+    def put(self, task, dataId, metadata):
+        """Append the metadata of a task run
+
+        @param[in] task  name of the task, e.g. "processCcd"
+        @param[in] dataId  data ID of the task run (a dict)
+        @param[in] metadata  task metadata (an lsst.daf.base.PropertySet), e.g. from getFullMetadata
+        @return the id of the new record
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):  # made by another process
+                    raise
+        values = []
+        for name in metadata.paramNames(False):
+            values.extend((name, position, _toSql(value))
+                          for position, value in enumerate(metadata.getArray(name)))
+        stages = [(stage, quantity, value)
+                  for (stage, quantity), stageValues in getStageValues(metadata).items()
+                  for value in stageValues]
+        with self._lock(), self._connect() as conn:
+            conn.executescript(_SCHEMA)
+            cursor = conn.execute("INSERT INTO records (task, dataId, time, host, pid) "
+                                  "VALUES (?, ?, ?, ?, ?)",
+                                  (task, self._dataIdKey(dataId), time.time(), socket.gethostname(),
+                                   os.getpid()))
+            record = cursor.lastrowid
+            conn.executemany("INSERT INTO dataIds (record, key, value) VALUES (?, ?, ?)",
+                             [(record, key, _toSql(value)) for key, value in dataId.items()])
+            conn.executemany("INSERT INTO metadata (record, name, position, value) VALUES (?, ?, ?, ?)",
+                             [(record,) + item for item in values])
+            conn.executemany("INSERT INTO stages (record, stage, quantity, value) VALUES (?, ?, ?, ?)",
+                             [(record,) + item for item in stages])
+        return record
+
+    def _selectRecords(self, task=None, dataId=None):
+        """Return the SQL and parameters selecting the latest records of a task matching a partial data ID"""
+        sql = "SELECT MAX(id) FROM records"
+        conditions = []
+        params = []
+        if task is not None:
+            conditions.append("task = ?")
+            params.append(task)
+        for key, value in sorted((dataId or {}).items()):
+            conditions.append("id IN (SELECT record FROM dataIds WHERE key = ? AND value = ?)")
+            params.extend([key, _toSql(value)])
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return sql + " GROUP BY task, dataId", params
+
+    def getDataIds(self, task=None, dataId=None):
+        """Return the data IDs of the latest records of a task matching a partial data ID"""
+        select, params = self._selectRecords(task, dataId)
+        if not os.path.exists(self.path):
+            return []
+        with self._connect() as conn:
+            rows = conn.execute("SELECT dataId FROM records WHERE id IN (%s) ORDER BY id" % (select,), params)
+            return [json.loads(row[0]) for row in rows]
+
+    def get(self, task, dataId):
+        """Return the latest metadata of a task run
+
+        @return an OrderedDict of name: list of values, or None if there is no record
+        """
+        if not os.path.exists(self.path):
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT MAX(id) FROM records WHERE task = ? AND dataId = ?",
+                               (task, self._dataIdKey(dataId))).fetchone()
+            if row is None or row[0] is None:
+                return None
+            metadata = collections.OrderedDict()
+            for name, value in conn.execute("SELECT name, value FROM metadata WHERE record = ? "
+                                            "ORDER BY rowid", (row[0],)):
+                metadata.setdefault(name, []).append(value)
+        return metadata
+
+    def summarizeStages(self, task=None, dataId=None):
+        """Aggregate the stage measurements of the latest records of a task, as stageTimer.summarizeStages
+
+        @param[in] task  name of the task, or None for all tasks
+        @param[in] dataId  partial data ID the records must match, or None
+        @return an OrderedDict as returned by stageTimer.summarizeStages
+        """
+        summary = collections.defaultdict(lambda: collections.defaultdict(float))
+        if not os.path.exists(self.path):
+            return collections.OrderedDict()
+        select, params = self._selectRecords(task, dataId)
+        with self._connect() as conn:
+            rows = conn.execute("SELECT stage, quantity, COUNT(DISTINCT record), COUNT(*), SUM(value), "
+                                "MAX(value) FROM stages WHERE record IN (%s) GROUP BY stage, quantity" %
+                                (select,), params).fetchall()
+        for stage, quantity, runs, calls, total, maximum in rows:
+            entry = summary[stage]
+            if quantity == "MaxRssDelta":
+                entry[quantity] = max(maximum, 0.0)
+            else:
+                entry[quantity] = total
+            if quantity == "WallTime":
+                entry["runs"] = runs
+                entry["calls"] = calls
+        return collections.OrderedDict(sorted(summary.items(), key=lambda item: -item[1]["WallTime"]))
@@ -23,15 +23,23 @@ from builtins import map
 import os
 import re
 import numpy as np
-import pyfits
 from lsst.utils import getPackageDir
+import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
 import lsst.afw.image.utils as afwImageUtils
 from lsst.obs.base import CameraMapper, exposureFromImage
-from lsst.daf.persistence import ButlerLocation
-from lsst.ip.isr import isr
+from lsst.daf.persistence import ButlerLocation, Storage
+import lsst.daf.base as dafBase
+import lsst.daf.persistence as dafPersist
 import lsst.pex.policy as pexPolicy
 from .makeMosaicRawVisitInfo import MakeMosaicRawVisitInfo
+from .focalPlane import MosaicFocalPlaneTransform
+from .zpxWcs import ZpxDistortion
+from . import cameraManifest
+from .registryMirror import RegistryMirror, MirroredLookup, getRegistryPath
+# pyfits, ip_isr, meas_algorithms and the defects, instcal and linearize modules are imported where
+# they are used, so that commands that only need the mapper class (e.g. ingestImagesDecam.py, to find
+# the package of the repository) and the pool workers start quickly
 
 np.seterr(divide="ignore")
 
@@ -42,12 +50,29 @@ class MosaicMapper(CameraMapper):
 
     detectorNames = {1:'E1', 2:'E2', 3:'E3', 4:'E4', 5:'W5', 6:'W6', 7:'W7', 8:'W8'}
 
+    _focalPlaneTransform = None
+
+    # Cameras built by _makeCamera, keyed by the content hash of the camera repository
+    _cameraCache = {}
+
+    # Order and sampling of the TAN-SIP approximation to the DLS ZPX Wcs of
+    # preprocessed images; set preprocessedSipOrder to 0 to use a plain TAN Wcs
+    preprocessedSipOrder = 4
+    preprocessedSipSpacing = 64
+    preprocessedSipMaxResidual = 0.01  # arcsec; warn if the fit is worse than this
+
+    # Answer registry lookups on the raw table from memory; see registryMirror
+    useRegistryMirror = True
+
     def __init__(self, inputPolicy=None, **kwargs):
         policyFile = pexPolicy.DefaultPolicyFile(self.packageName, "MosaicMapper.paf", "policy")
         policy = pexPolicy.Policy(policyFile)
 
         super(MosaicMapper, self).__init__(policy, policyFile.getRepositoryPath(), **kwargs)
 
+        # TAN-SIP cards fit to the ZPX Wcs, keyed by (objname, ccdnum)
+        self._sipCache = {}
+
         #I found these values in the mosaic 1 manual from september 2004. lambda is in nm
         afwImageUtils.defineFilter('B', lambdaEff=436, alias=['B'])
         afwImageUtils.defineFilter('V', lambdaEff=537, alias=['V'])
@@ -59,6 +84,11 @@ class MosaicMapper(CameraMapper):
         # Add it so raw dataset know about the data ID key ccdnum.
         self.mappings["raw"].keyDict.update({'ccdnum': int})
 
+        # Complete data IDs from an in-memory copy of the raw table of the registry
+        self._registryPath = None
+        if self.useRegistryMirror:
+            self._installRegistryMirror()
+
         # The number of bits allocated for fields in object IDs
         # TODO: This needs to be updated; also see Trac #2797
         MosaicMapper._nbit_tract = 10
@@ -68,6 +98,66 @@ class MosaicMapper(CameraMapper):
                                      2*MosaicMapper._nbit_patch +
                                      MosaicMapper._nbit_filter)
 
+    def _installRegistryMirror(self):
+        """Make the mappings that look up keys in the raw table use a RegistryMirror"""
+        self._registryPath = getRegistryPath(self.registry)
+        if self._registryPath is None:
+            return
+        for mapping in self.mappings.values():
+            tables = mapping.tables
+            if isinstance(tables, str):
+                tables = [tables]
+            if mapping.registry is self.registry and tables is not None and list(tables) == ["raw"] and \
+                    not getattr(mapping, "range", None):
+                mapping.lookup = MirroredLookup(mapping, self._registryPath)
+
+    def getRegistryMirrorStats(self):
+        """Return the number of registry mirror loads, lookups and fallbacks to SQL
+
+        @return a dict with keys loads, lookups and fallbacks (all 0 without a mirror)
+        """
+        stats = RegistryMirror.stats.get((self._registryPath, "raw"), {})
+        return dict((key, stats.get(key, 0)) for key in ("loads", "lookups", "fallbacks"))
+
+    @classmethod
+    def getFocalPlaneTransform(cls):
+        """Return the vectorized whole-focal-plane transform for the camera
+
+        The transform is built from mosaic/camGeom the first time it is needed
+        and shared by all mappers in the process.
+
+        @return (MosaicFocalPlaneTransform)
+        """
+        if cls._focalPlaneTransform is None:
+            cameraDir = os.path.join(getPackageDir(cls.packageName), "mosaic", "camGeom")
+            cls._focalPlaneTransform = MosaicFocalPlaneTransform.fromCameraRepository(cameraDir)
+        return cls._focalPlaneTransform
+
+    def _makeCamera(self, policy, repositoryDir):
+        """Make the camera, or reuse the one already made from an identical camera repository
+
+        The content hash of the camera repository is found from its committed
+        manifest, rehashing only the files modified since it was written (see
+        cameraManifest.getCurrentManifest), which is much cheaper than executing
+        camera.py and reading the AmpInfo tables, and detects any change.
+        """
+        if isinstance(policy, pexPolicy.Policy):
+            policy = dafPersist.Policy(pexPolicy=policy)
+        cameraDir = os.path.normpath(os.path.join(repositoryDir, policy['camera']))
+        key = cameraManifest.repositoryHash(cameraManifest.getCurrentManifest(cameraDir))
+        camera = MosaicMapper._cameraCache.get(key)
+        if camera is None:
+            camera = CameraMapper._makeCamera(self, policy, repositoryDir)
+            MosaicMapper._cameraCache[key] = camera
+        else:
+            self.cameraDataLocation = os.path.join(cameraDir, "camera.py")
+        return camera
+
+    @classmethod
+    def getLinearizerDir(cls):
+        """Directory containing linearizers"""
+        return os.path.join(getPackageDir(cls.packageName), "mosaic", "linearizer")
+
     def _extractDetectorName(self, dataId):
         copyId = self._transformId(dataId)
         try:
@@ -133,6 +223,89 @@ class MosaicMapper(CameraMapper):
     def bypass_deepMergedCoaddId_bits(self, *args, **kwargs):
         return 64 - MosaicMapper._nbit_id
 
+    def map_linearizer(self, dataId, write=False):
+        """Map a linearizer"""
+        actualId = self._transformId(dataId)
+        return ButlerLocation(
+            pythonType="lsst.ip.isr.LinearizeLookupTable",
+            cppType="Config",
+            storageName="PickleStorage",
+            locationList=["%02d.fits" % (actualId["ccdnum"],)],
+            dataId=actualId,
+            mapper=self,
+            storage=Storage.makeFromURI(self.getLinearizerDir())
+        )
+
+    def bypass_linearizer(self, datasetType, pythonType, location, dataId):
+        """Read a linearizer, only once per process for each CCD"""
+        from .linearize import readLinearizer
+        return readLinearizer(location.getLocationsWithRoot()[0])
+
+    def map_defects(self, dataId, write=False):
+        """Map defects dataset with the calibration registry.
+
+        Overriding the method so to use CalibrationMapping policy,
+        instead of looking up the path in defectRegistry as currently
+        implemented in CameraMapper.
+        """
+        return self.mappings["defects"].map(self, dataId=dataId, write=write)
+
+    def bypass_defects(self, datasetType, pythonType, butlerLocation, dataId):
+        """Return a defect list based on butlerLocation returned by map_defects.
+
+        If the calibration repository has a defect index (see lsst.obs.mosaic.defects),
+        read the defects from it; the defects of all CCDs of a validity period are
+        read at once.  Otherwise use all nonzero pixels in the bad pixel mask (a community
+        pipeline mask, nonzero for bad pixels).
+        """
+        import lsst.meas.algorithms as measAlg
+        from lsst.ip.isr import isr
+        from .defects import DEFECT_INDEX_NAME, DefectIndex
+
+        path = butlerLocation.getLocations()[0]
+        bpmFitsPath = butlerLocation.getLocationsWithRoot()[0]
+        calibRoot = bpmFitsPath[:len(bpmFitsPath) - len(path)]
+        defectIndex = DefectIndex.get(os.path.join(calibRoot, DEFECT_INDEX_NAME))
+        if defectIndex is not None:
+            boxes = defectIndex.getDefects(path, self._transformId(dataId)["ccdnum"])
+            if boxes is not None:
+                return [measAlg.Defect(afwGeom.Box2I(afwGeom.Point2I(int(box["x0"]), int(box["y0"])),
+                                                     afwGeom.Extent2I(int(box["width"]), int(box["height"]))))
+                        for box in boxes]
+        bpmImg = afwImage.ImageU(bpmFitsPath)
+        idxBad = np.nonzero(bpmImg.getArray())
+        mim = afwImage.MaskedImageU(bpmImg.getDimensions())
+        mim.getMask().getArray()[idxBad] |= mim.getMask().getPlaneBitMask("BAD")
+        return isr.getDefectListFromMask(mim, "BAD", growFootprints=0)
+
+    def _getPreprocessedSip(self, md, dataId, dimensions):
+        """Return TAN-SIP cards approximating the ZPX Wcs of a preprocessed image
+
+        The fit is done once per (objname, ccdnum) and cached.
+
+        @param md: metadata of the preprocessed HDU
+        @param dataId: Data identifier
+        @param dimensions: (lsst.afw.geom.Extent2I) dimensions of the image
+        @return a dict of FITS cards, or None if there is no usable ZPX Wcs
+        """
+        if self.preprocessedSipOrder <= 0:
+            return None
+        key = (dataId.get('objname'), self._transformId(dataId).get('ccdnum'))
+        if key not in self._sipCache:
+            try:
+                distortion = ZpxDistortion.fromMetadata(md)
+                cards, maxResidual = distortion.fitSip(dimensions.getX(), dimensions.getY(),
+                                                       order=self.preprocessedSipOrder,
+                                                       spacing=self.preprocessedSipSpacing)
+                if maxResidual > self.preprocessedSipMaxResidual:
+                    self.log.warn("TAN-SIP fit to the ZPX Wcs of %s is off by up to %.3f arcsec" %
+                                  (dataId, maxResidual))
+            except Exception as e:
+                self.log.warn("Cannot fit a TAN-SIP Wcs for %s; using TAN: %s" % (dataId, e))
+                cards = None
+            self._sipCache[key] = cards
+        return self._sipCache[key]
+
     def std_preprocessed(self, item, dataId):
         """Standardize a preprocess dataset by converting it to an Exposure.
 
@@ -144,32 +317,71 @@ class MosaicMapper(CameraMapper):
         @param dataId: Data identifier
         @return (lsst.afw.image.Exposure) the standardized Exposure
         """
+        return self.standardizePreprocessed(item, dataId, self.readPreprocessedPrimaryHeader(dataId))
+
+    def readPreprocessedPrimaryHeader(self, dataId):
+        """Read the primary header of the MEF file of a preprocessed dataset
+
+        @param dataId: Data identifier
+        @return the header of HDU 0 (a pyfits.Header)
+        """
+        import pyfits
+        path = self.map_preprocessed(dataId).getLocationsWithRoot()[0]
+        headerPath = re.sub(r'[\[](\d+)[\]]$', "", path)
+        return pyfits.getheader(headerPath, 0)
+
+    def standardizePreprocessed(self, item, dataId, primaryHeader):
+        """Standardize a preprocessed CCD image, given the primary header of its MEF file
+
+        This is std_preprocessed for callers that have already read the file,
+        e.g. the visit driver, which reads all the CCDs of a visit at once.
+
+        @param item: (lsst.afw.image.DecoratedImageF) the image and header of the CCD HDU
+        @param dataId: Data identifier
+        @param primaryHeader: header of HDU 0 (a pyfits.Header or a dict of keyword: value)
+        @return (lsst.afw.image.Exposure) the standardized Exposure
+        """
         # Convert the raw DecoratedImage to an Exposure, set metadata and wcs.
         md = item.getMetadata()
 
-        # Convert wcs to a TAN by removing the higher order corrections which
-        # were put by the DLS pipeline into the image Wcs.  The Wcs which results
-        # is now only approximate
-        md.set('CTYPE1', 'RA---TAN')
-        md.set('CTYPE2', 'DEC--TAN')
+        # afw cannot read the ZPX Wcs written by the DLS pipeline, so replace it
+        # with a TAN-SIP fit to it (or, failing that, its linear TAN part).
+        sipCards = self._getPreprocessedSip(md, dataId, item.getImage().getDimensions())
         for kw in md.paramNames():
             if kw.startswith('WAT1') or kw.startswith('WAT2'):
                 md.remove(kw)
+        if sipCards is None:
+            md.set('CTYPE1', 'RA---TAN')
+            md.set('CTYPE2', 'DEC--TAN')
+        else:
+            for kw, value in sipCards.items():
+                md.set(kw, value)
         exp = exposureFromImage(item)
+        self._setVisitInfo(exp, md, primaryHeader, dataId)
+        # Standardize an Exposure, including setting the calib object
+        result = self._standardizeExposure(self.exposures['preprocessed'], exp, dataId,
+                                         trimmed=False)
+        return result
 
-        #   convert the hdu0 header to visitInfo using pyfits to read it
-        path = self.map_preprocessed(dataId).getLocationsWithRoot()[0]
-        headerPath = re.sub(r'[\[](\d+)[\]]$', "", path)
-        header = pyfits.open(headerPath)[0].header
-        #  We don't actually use all of thes values in the header, but put this
-        #  list here for later reference
+    # Keywords of the primary header used for the visitInfo.  We don't actually
+    # use all of these values, but put this list here for later reference
+    primaryHeaderKeys = ('DATE', 'FILENAME', 'EXPTIME', 'DARKTIME', 'RA', 'DEC', 'DATE-OBS',
+                         'TIME-OBS', 'MJD-OBS', 'OBSERVAT', 'TELESCOP', 'TELRADEC', 'TELRA',
+                         'TELDEC', 'ZD', 'AIRMASS', 'DETECTOR', 'FILTER', 'READTIME', 'OBSID')
+
+    def _setVisitInfo(self, exp, md, primaryHeader, dataId):
+        """Set the visitInfo of an Exposure from the primary header of its MEF file
+
+        @param exp: (lsst.afw.image.Exposure) the Exposure
+        @param md: metadata of the Exposure; EXPTIME, MJD-OBS and OBSERVAT are copied to it
+        @param primaryHeader: header of HDU 0 (a pyfits.Header or a dict of keyword: value)
+        @param dataId: Data identifier
+        """
+        #   convert the hdu0 header to visitInfo
         md0 = type(md)()
-        extractKeys = ('DATE', 'FILENAME', 'EXPTIME', 'DARKTIME', 'RA', 'DEC', 'DATE-OBS',
-                       'TIME-OBS', 'MJD-OBS', 'OBSERVAT', 'TELESCOP', 'TELRADEC', 'TELRA',
-                       'TELDEC', 'ZD', 'AIRMASS', 'DETECTOR', 'FILTER', 'READTIME', 'OBSID')
-        for key in extractKeys:
-            if key in header.keys():
-                md0.add(key, header[key])
+        for key in self.primaryHeaderKeys:
+            if key in primaryHeader:
+                md0.add(key, primaryHeader[key])
         #   TIMESYS is utc approximate in the header, so we need to replace it
         md0.add('TIMESYS', 'utc')
         exposureId = self._computeCcdExposureId(dataId)
@@ -179,7 +391,32 @@ class MosaicMapper(CameraMapper):
         for kw in ('MJD-OBS', 'EXPTIME', 'OBSERVAT'):
             if kw in md0.paramNames():
                 md.add(kw, md0.get(kw))
-        # Standardize an Exposure, including setting the calib object
-        result = self._standardizeExposure(self.exposures['preprocessed'], exp, dataId,
-                                         trimmed=False)
-        return result
+
+    def bypass_instcal(self, datasetType, pythonType, butlerLocation, dataId):
+        """Read a community pipeline instcal CCD with its dqmask and wtmap as an Exposure
+
+        The three HDUs are read concurrently and their arrays become the image,
+        mask and variance planes without further copies; see lsst.obs.mosaic.instcal.
+
+        @return (lsst.afw.image.ExposureF) the standardized Exposure
+        """
+        from .instcal import readInstcal, makeInstcalMaskedImage
+
+        paths = {}
+        for name, location in [("instcal", butlerLocation), ("dqmask", self.map_dqmask(dataId)),
+                               ("wtmap", self.map_wtmap(dataId))]:
+            match = re.match(r'^(.*)[\[](\d+)[\]]$', location.getLocationsWithRoot()[0])
+            paths[name], hdu = match.group(1), int(match.group(2))
+        primaryHeader, header, image, mask, variance = readInstcal(paths["instcal"], paths["dqmask"],
+                                                                   paths["wtmap"], hdu)
+
+        md = dafBase.PropertyList()
+        for key, value in header.items():
+            if key not in ('COMMENT', 'HISTORY', ''):
+                md.set(key, value)
+        exp = afwImage.makeExposure(makeInstcalMaskedImage(image, mask, variance))
+        # makeWcs strips the Wcs keywords from the metadata
+        exp.setWcs(afwImage.makeWcs(md, True))
+        exp.setMetadata(md)
+        self._setVisitInfo(exp, md, primaryHeader, dataId)
+        return self._standardizeExposure(self.exposures['instcal'], exp, dataId, trimmed=False)
@@ -22,6 +22,7 @@
 #
 import lsst.pipe.base as pipeBase
 import lsst.pex.config as pexConfig
+from .stageTimer import timeStage
 
 
 class MosaicNullIsrConfig(pexConfig.Config):
@@ -91,11 +92,11 @@ class MosaicNullIsrTask(pipeBase.Task):
         """
         self.log.info("Loading Mosaic community pipeline file %s" % (sensorRef.dataId))
 
-        exposure = sensorRef.get("preprocessed", immediate=True)
-        import pdb
-        pdb.set_trace()
+        with timeStage(self.metadata, "getPreprocessed", self.log):
+            exposure = sensorRef.get("preprocessed", immediate=True)
         if self.config.doWrite:
-            sensorRef.put("postISRCCD", exposure)
+            with timeStage(self.metadata, "putPostIsr", self.log):
+                sensorRef.put(exposure, "postISRCCD")
 
         return pipeBase.Struct(
             exposure=exposure,
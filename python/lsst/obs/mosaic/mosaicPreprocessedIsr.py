@@ -27,6 +27,9 @@ import lsst.pipe.base as pipeBase
 import lsst.pex.config as pexConfig
 from lsst.pipe.tasks.characterizeImage import CharacterizeImageTask
 from lsst.ip.isr.isrFunctions import updateVariance, makeThresholdMask, maskPixelsFromDefectList, interpolateFromMask
+from .stageTimer import timeStage
+from .prefetch import getPrefetched
+from .quicklook import writeCcdQuicklook
 
 #  Use the header from the preprocessed mosaic image to set the wcs of the exposure.
 #  The wcs is centered on the central pixel, using the coordinate
@@ -55,6 +58,28 @@ def makeWcs(metadata, dimensions):
 
 #   Set the mask plane for the "BAD" pixels using the BPM supplied by the observatory
 def setMask(butler, dataId, exp):
+    bpm, masked = readMasks(butler, dataId, exp)
+    applyMask(dataId, exp, bpm, masked)
+
+#   Use the butler to fetch the DLS bpm and masked region images of a CCD, as arrays
+#   (None if the dataset does not exist)
+def readMasks(butler, dataId, exp):
+    #   First get the bpm for that date, ccd, and telescope
+    dI2 = dict(dataId)
+    dI2['observatory'] = exp.getMetadata().get('OBSERVAT').lower()
+    dI2['year'] = dI2['dateObs'][0:4]
+    bpm = None
+    if butler.datasetExists('bpm', dI2):
+        bpm = butler.get('bpm', dI2).getArray()
+
+    #    Next get the exclusion regions for each exposure
+    masked = None
+    if butler.datasetExists('masked', dI2):
+        masked = butler.get('masked', dI2).getArray()
+    return bpm, masked
+
+#   Set the SAT bit for saturated pixels, BAD where bpm is 0 and SUSPECT where masked is 0
+def applyMask(dataId, exp, bpm=None, masked=None):
     mi = exp.getMaskedImage()
     mask = mi.getMask()
     #   First set the saturated pixels with the SAT bit
@@ -63,24 +88,18 @@ def setMask(butler, dataId, exp):
     #satlevel = exp.getDetector()[0].getSaturation() * .85
     satlevel = satlevels[dataId['ccdnum'] - 1] * .85
     satmask = (exp.getMaskedImage().getImage().getArray() >= satlevel)
-    maskarray = mask.getArray()
     mask.getArray()[satmask] |= satbitm
 
-    #   First get the bpm for that date, ccd, and telescope
-    dI2 = dict(dataId)
-    dI2['observatory'] = exp.getMetadata().get('OBSERVAT').lower()
-    dI2['year'] = dI2['dateObs'][0:4]
-    if butler.datasetExists('bpm', dI2):
-        img = butler.get('bpm', dI2)
+    if bpm is not None:
         badbitm = mask.getPlaneBitMask('BAD')
-        badmask = (img.getArray() == 0)
+        # The DLS bad pixel masks are 0 for bad pixels
+        badmask = (bpm == 0)
         mask.getArray()[badmask] |= badbitm
 
-    #    Next get the exclusion regions for each exposure, mark as "SUSPECT"
-    if butler.datasetExists('masked', dI2):
-        regimg = butler.get('masked', dI2)
+    #    Mark the exclusion regions as "SUSPECT"
+    if masked is not None:
         badbitm = mask.getPlaneBitMask('SUSPECT')
-        badmask = (regimg.getArray() == 0)
+        badmask = (masked == 0)
         mask.getArray()[badmask] |= badbitm
 
 def updateVar(exp, metadata):
@@ -107,6 +126,16 @@ class MosaicPreprocessedIsrConfig(pexConfig.Config):
         doc="Dataset type for input data; read by ProcessCcdTask; users will typically leave this alone",
         default="preprocessed",
     )
+    doWriteQuicklook = pexConfig.Field(
+        dtype=bool,
+        doc="Write the exposure, block-averaged by quicklookBinSize, as quicklookCcd for mosaicQuicklook.py?",
+        default=False,
+    )
+    quicklookBinSize = pexConfig.Field(
+        dtype=int,
+        doc="Number of pixels across a block of quicklookCcd",
+        default=8,
+    )
 
 ## \addtogroup LSST_task_documentation
 ## \{
@@ -164,18 +193,49 @@ class MosaicPreprocessedIsrTask(pipeBase.Task):
         self.log.info("Loading Mosaic community pipeline file %s" % (sensorRef.dataId))
         butler = sensorRef.getButler()
         dataId = sensorRef.dataId
-        exp = butler.get('preprocessed', dataId)
+        #   Inputs read ahead by the active prefetcher, if any
+        with timeStage(self.metadata, "waitPrefetch", self.log):
+            prefetched = getPrefetched(dataId)
+        with timeStage(self.metadata, "getPreprocessed", self.log):
+            exp = butler.get('preprocessed', dataId)
 
         #   Use the butler to fetch info needed to use the DLS bpm and masked region files
-        setMask(butler, dataId, exp)
-        interpolateFromMask(exp.getMaskedImage(), 1.0,  growFootprints=1, maskName='BAD')
-        #   Update the variance plane using the image prior to background subtraction
-        updateVar(exp, exp.getMetadata())
+        with timeStage(self.metadata, "readMasks", self.log):
+            if prefetched is not None and prefetched.masksRead:
+                bpm, masked = prefetched.bpm, prefetched.masked
+            else:
+                bpm, masked = readMasks(butler, dataId, exp)
+        self.run(exp, dataId, bpm=bpm, masked=masked)
 
         #interpolateFromMask(exp.getMaskedImage(), 1.0,  growFootprints=1, maskName='SAT')
         if self.config.doWrite:
-            sensorRef.put(exp, "postISRCCD")
+            with timeStage(self.metadata, "putPostIsr", self.log):
+                sensorRef.put(exp, "postISRCCD")
+        if self.config.doWriteQuicklook:
+            with timeStage(self.metadata, "writeQuicklook", self.log):
+                writeCcdQuicklook(sensorRef, exp, self.config.quicklookBinSize)
 
         return pipeBase.Struct(
             exposure=exp,
         )
+
+    def run(self, exp, dataId, bpm=None, masked=None):
+        """!Mask, interpolate and set the variance of a preprocessed exposure, in place
+
+        @param[in,out] exp  the standardized "preprocessed" exposure
+        @param[in] dataId  data ID of the exposure (ccdnum selects the saturation level)
+        @param[in] bpm  array of the bad pixel mask (0 for bad pixels), or None
+        @param[in] masked  array of the masked regions (0 inside a region), or None
+
+        @return a pipeBase.Struct with field exposure: exp
+        """
+        with timeStage(self.metadata, "setMask", self.log):
+            applyMask(dataId, exp, bpm, masked)
+        with timeStage(self.metadata, "interpolateFromMask", self.log):
+            interpolateFromMask(exp.getMaskedImage(), 1.0,  growFootprints=1, maskName='BAD')
+        #   Update the variance plane using the image prior to background subtraction
+        with timeStage(self.metadata, "updateVar", self.log):
+            updateVar(exp, exp.getMetadata())
+        return pipeBase.Struct(
+            exposure=exp,
+        )
@@ -0,0 +1,181 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Find the CCDs whose outputs are missing or older than their inputs
+
+Finding the new data of a growing repository with the butler takes a
+registry query per subset and a datasetExists call (a stat) per data ID
+and dataset.  planNewData reads the raw table of the registry once, lists
+the files under the fixed leading directory of each template with one
+os.scandir walk, and compares the modification times of the input and
+output files of each CCD in memory.  The result is written as --id
+arguments for processCcd.py and similar tasks:
+
+    processCcd.py DATA --rerun nightly @plan.txt
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import re
+
+from .registryMirror import RegistryMirror
+
+__all__ = ["Plan", "getTemplateKeys", "expandTemplate", "scanFiles", "planNewData", "formatIdArguments",
+           "writeIdFile"]
+
+Plan = collections.namedtuple("Plan", ["dataIds", "numNew", "numStale", "numUpToDate", "numMissingInput"])
+Plan.__doc__ = """Result of planNewData
+
+dataIds: data IDs to process, in registry order; numNew: CCDs with a missing
+output; numStale: CCDs with an output older than an input; numUpToDate: CCDs
+left out; numMissingInput: CCDs of the registry with a missing input, left out
+"""
+
+_templateKeyRe = re.compile(r"%\((\w+)\)")
+
+
+def getTemplateKeys(template):
+    """Return the data ID keys of a butler path template, in order"""
+    return list(collections.OrderedDict.fromkeys(_templateKeyRe.findall(template)))
+
+
+def expandTemplate(template, dataId):
+    """Return the path of a data ID, without an HDU suffix"""
+    return re.sub(r"\[\d+\]$", "", template % dataId)
+
+
+def _getTop(template):
+    """Return the fixed leading directory of a template ("" if there is none)"""
+    return os.path.dirname(template.split("%", 1)[0])
+
+
+def scanFiles(root, top=""):
+    """List the files under a directory with os.scandir
+
+    @param[in] root  root of the repository
+    @param[in] top  directory relative to root
+    @return a dict of path relative to root: modification time, empty if top does not exist
+    """
+    files = {}
+    stack = [top]
+    while stack:
+        relDir = stack.pop()
+        absDir = os.path.join(root, relDir)
+        try:
+            if hasattr(os, "scandir"):
+                entries = [(entry.name, entry.is_dir(), entry) for entry in os.scandir(absDir)]
+            else:
+                entries = [(name, os.path.isdir(os.path.join(absDir, name)), None)
+                           for name in os.listdir(absDir)]
+        except OSError:
+            continue
+        for name, isDir, entry in entries:
+            relPath = os.path.join(relDir, name)
+            if isDir:
+                stack.append(relPath)
+            else:
+                stat = entry.stat() if entry is not None else os.stat(os.path.join(root, relPath))
+                files[relPath] = stat.st_mtime
+    return files
+
+
+def _scanTemplates(root, templates):
+    """Scan the top directories of templates, each once"""
+    tops = set(_getTop(template) for template in templates)
+    files = {}
+    for top in sorted(tops):
+        if not any(other != top and (other == "" or top.startswith(other + os.sep)) for other in tops):
+            files.update(scanFiles(root, top))
+    return files
+
+
+def planNewData(inputRoot, outputRoot, inputTemplates, outputTemplates, registryPath=None, dataId=None):
+    """Find the CCDs of a registry whose outputs are missing or older than their inputs
+
+    @param[in] inputRoot  root of the input repository
+    @param[in] outputRoot  root of the output repository (e.g. a rerun)
+    @param[in] inputTemplates  path templates of the inputs, relative to inputRoot
+    @param[in] outputTemplates  path templates of the outputs, relative to outputRoot
+    @param[in] registryPath  registry with a raw table; inputRoot/registry.sqlite3 if None
+    @param[in] dataId  dict restricting the rows of the registry, or None
+    @return a Plan; its data IDs have the keys of the templates
+    """
+    if registryPath is None:
+        registryPath = os.path.join(inputRoot, "registry.sqlite3")
+    mirror = RegistryMirror.get(registryPath, "raw")
+    if mirror is None:
+        raise RuntimeError("Cannot read the raw table of registry %s" % (registryPath,))
+    keys = getTemplateKeys("".join(list(inputTemplates) + list(outputTemplates)))
+    missing = [key for key in keys if key not in mirror.columns]
+    if missing:
+        raise RuntimeError("Template keys %s are not columns of the raw table" % (missing,))
+    rows = [collections.OrderedDict(zip(keys, values)) for values in mirror.lookup(keys, dataId or {})]
+
+    inputFiles = _scanTemplates(inputRoot, inputTemplates)
+    outputFiles = _scanTemplates(outputRoot, outputTemplates)
+
+    dataIds = []
+    counts = collections.Counter()
+    for row in rows:
+        inputTimes = [inputFiles.get(expandTemplate(template, row)) for template in inputTemplates]
+        if None in inputTimes:
+            counts["missingInput"] += 1
+            continue
+        outputTimes = [outputFiles.get(expandTemplate(template, row)) for template in outputTemplates]
+        if None in outputTimes:
+            counts["new"] += 1
+        elif min(outputTimes) < max(inputTimes):
+            counts["stale"] += 1
+        else:
+            counts["upToDate"] += 1
+            continue
+        dataIds.append(row)
+    return Plan(dataIds=dataIds, numNew=counts["new"], numStale=counts["stale"],
+                numUpToDate=counts["upToDate"], numMissingInput=counts["missingInput"])
+
+
+def formatIdArguments(dataIds, groupKey="ccdnum"):
+    """Format data IDs as --id arguments, one per set of data IDs that differ only in groupKey
+
+    @return a list of strings, e.g. "--id field=F2 ... objname=obj330 ccdnum=1^2^5"
+    """
+    groups = collections.OrderedDict()
+    for dataId in dataIds:
+        others = tuple((key, value) for key, value in dataId.items() if key != groupKey)
+        groups.setdefault(others, []).append(dataId.get(groupKey))
+    lines = []
+    for others, values in groups.items():
+        items = ["%s=%s" % (key, value) for key, value in others]
+        values = [value for value in values if value is not None]
+        if values:
+            items.append("%s=%s" % (groupKey, "^".join(str(value) for value in values)))
+        lines.append("--id " + " ".join(items))
+    return lines
+
+
+def writeIdFile(path, dataIds, groupKey="ccdnum"):
+    """Write data IDs as a file of --id arguments, for @path on a task command line"""
+    with open(path, "w") as outfile:
+        for line in formatIdArguments(dataIds, groupKey):
+            outfile.write(line + "\n")
@@ -0,0 +1,333 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Read the inputs of the next CCDs on I/O threads while the current CCD is processed
+
+A Prefetcher is given the ordered list of data references a process will
+handle and a function that loads the inputs of one of them.  I/O threads
+load up to `depth` data references ahead of the one being processed, as long
+as the loaded inputs not yet used fit in `maxBytes`.  Prefetcher.get returns
+the inputs of a data reference: at once if they are loaded (a hit), after
+waiting if they are being loaded (a stall), or by loading them itself if
+they were not started (a miss).
+
+loadCcdInputs is the loader for Mosaic CCDs.  The butler reads exposures
+with cfitsio, which does not release the GIL, so it cannot run on a thread
+while the current CCD computes.  Instead the loader reads the bytes of the
+HDU of each input dataset (preprocessed, raw, calibs), so that the butler
+finds them in the page cache, and it reads the bpm and masked images used by
+MosaicPreprocessedIsrTask as arrays.  A Prefetcher used as a context manager
+is the active prefetcher of the process, which the tasks query with
+getPrefetched.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+
+import collections
+import os
+import re
+import threading
+import time
+
+import astropy.io.fits as fits
+
+__all__ = ["Prefetcher", "CcdInputs", "loadCcdInputs", "getPrefetched", "dataIdKey"]
+
+# The Prefetcher of the current `with` block, if any
+_active = None
+_activeLock = threading.Lock()
+
+
+def dataIdKey(dataId):
+    """Return a hashable key for a data ID"""
+    return tuple(sorted(dataId.items()))
+
+
+def getPrefetched(dataId):
+    """Return the prefetched inputs of a data ID, or None if there is no active prefetcher for it"""
+    prefetcher = _active
+    if prefetcher is None or not prefetcher.has(dataId):
+        return None
+    return prefetcher.get(dataId)
+
+
+class Prefetcher(object):
+    """Load the inputs of an ordered list of items on I/O threads, ahead of their use
+
+    @param[in] items  items in the order they will be used, e.g. data references
+    @param[in] load  function of an item returning (inputs, size of the inputs in bytes)
+    @param[in] depth  maximum number of items loaded or being loaded ahead of the current one
+    @param[in] numThreads  number of I/O threads
+    @param[in] maxBytes  maximum size of the loaded inputs not yet used; an item is
+        loaded anyway if nothing else is loaded
+    @param[in] key  function of an item, or of the argument of get, returning the key of the item
+        (by default the data ID key of a data reference or data ID)
+    @param[in] log  logger or None; load failures are logged at debug level and the inputs
+        are then loaded again by get
+    """
+
+    def __init__(self, items, load, depth=2, numThreads=2, maxBytes=1 << 30, key=None, log=None):
+        self.items = list(items)
+        self.load = load
+        self.depth = depth
+        self.numThreads = numThreads
+        self.maxBytes = maxBytes
+        self.key = key if key is not None else _defaultKey
+        self.log = log
+        self._indices = dict((self.key(item), i) for i, item in enumerate(self.items))
+        self._cond = threading.Condition()
+        self._next = 0  # next item to start loading
+        self._position = 0  # items before this are used or skipped
+        self._started = set()
+        self._loaded = {}  # index: (inputs, nbytes)
+        self._bytes = 0
+        self._current = None  # (key, inputs) of the last item returned by get
+        self._closed = False
+        self._threads = []
+        self.counters = collections.Counter()
+        self.stallTime = 0.0
+        self.loadTime = 0.0
+
+    def start(self):
+        """Start the I/O threads"""
+        for i in range(self.numThreads):
+            thread = threading.Thread(target=self._run, name="prefetch%d" % (i,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        """Stop the I/O threads, after the loads in progress, and release the loaded inputs"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._loaded.clear()
+        self._bytes = 0
+        self._current = None
+
+    def __enter__(self):
+        global _active
+        self.start()
+        with _activeLock:
+            self._previous, _active = _active, self
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        with _activeLock:
+            _active = self._previous
+        self.close()
+
+    def has(self, item):
+        """Is an item in the list?"""
+        return self.key(item) in self._indices
+
+    def _canStart(self):
+        return self._next < len(self.items) and self._next < self._position + self.depth and \
+            (self._bytes < self.maxBytes or not self._loaded)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._canStart():
+                    self._cond.wait()
+                if self._closed:
+                    return
+                index = self._next
+                self._next += 1
+                if index in self._started:
+                    continue
+                self._started.add(index)
+            start = time.time()
+            try:
+                result = self.load(self.items[index])
+            except Exception as e:
+                if self.log is not None:
+                    self.log.debug("Prefetch of %s failed: %s" % (self.items[index], e))
+                result = None
+            with self._cond:
+                self.loadTime += time.time() - start
+                if result is None:
+                    self._started.discard(index)
+                elif index >= self._position - 1:  # not skipped by get
+                    self._loaded[index] = result
+                    self._bytes += result[1]
+                    self.counters["bytes"] += result[1]
+                self._cond.notify_all()
+
+    def _skipTo(self, index):
+        """Release the inputs of the items before index, which will not be used"""
+        for i in range(self._position, index):
+            if i in self._loaded:
+                self._bytes -= self._loaded.pop(i)[1]
+        self._position = max(self._position, index + 1)
+        self._next = max(self._next, self._position)
+        self._cond.notify_all()
+
+    def get(self, item):
+        """Return the inputs of an item, loading them if they were not prefetched
+
+        The items are expected in order; the inputs of the items skipped are
+        released.  The inputs of the last item are kept until the next call,
+        so that the code processing an item may get them again at no cost.
+        """
+        key = self.key(item)
+        with self._cond:
+            if self._current is not None and self._current[0] == key:
+                return self._current[1]
+            self.counters["gets"] += 1
+            index = self._indices.get(key)
+            if index is not None:
+                self._skipTo(index)
+                if index in self._started and index not in self._loaded:
+                    start = time.time()
+                    while index in self._started and index not in self._loaded:
+                        self._cond.wait()
+                    self.stallTime += time.time() - start
+                    self.counters["stalls"] += 1
+                if index in self._loaded:
+                    inputs, nbytes = self._loaded.pop(index)
+                    self._bytes -= nbytes
+                    self._cond.notify_all()
+                    self.counters["hits"] += 1
+                    self._current = (key, inputs)
+                    return inputs
+                # Not started, or the prefetch failed
+                self._started.add(index)
+                item = self.items[index]
+            self.counters["misses"] += 1
+        inputs = self.load(item)[0]
+        with self._cond:
+            self._current = (key, inputs)
+        return inputs
+
+    def getStats(self):
+        """Return a dict of counters: gets, hits (including stalls), stalls, misses, hitRate,
+        stallTime and loadTime (s), and bytes loaded"""
+        with self._cond:
+            stats = dict((name, self.counters[name]) for name in ("gets", "hits", "stalls", "misses", "bytes"))
+            stats["hitRate"] = stats["hits"]/stats["gets"] if stats["gets"] else 0.0
+            stats["stallTime"] = self.stallTime
+            stats["loadTime"] = self.loadTime
+        return stats
+
+
+def _defaultKey(item):
+    dataId = getattr(item, "dataId", item)
+    return dataIdKey(dataId) if isinstance(dataId, dict) else item
+
+
+CcdInputs = collections.namedtuple("CcdInputs", ["dataId", "paths", "masksRead", "bpm", "masked"])
+CcdInputs.__doc__ = """Inputs of a CCD read by loadCcdInputs
+
+dataId: the data ID; paths: the files whose HDU was read into the page cache;
+masksRead: were the bpm and masked datasets looked up?  bpm, masked: arrays
+of the bpm and masked images, or None if they do not exist or were not looked up
+"""
+
+
+def _splitPath(path):
+    """Split a butler path into the path of the file and the HDU (None if there is no suffix)"""
+    match = re.match(r"^(.*)\[(\d+)\]$", path)
+    if match is None:
+        return path, None
+    return match.group(1), int(match.group(2))
+
+
+def _readRange(path, start, size, blockSize=8 << 20):
+    """Read a range of a file, to bring it into the page cache; return the number of bytes read"""
+    total = 0
+    with open(path, "rb") as infile:
+        infile.seek(start)
+        while total < size:
+            block = infile.read(min(blockSize, size - total))
+            if not block:
+                break
+            total += len(block)
+    return total
+
+
+def _warm(path):
+    """Read the header and data of the HDU of a butler path; return (bytes read, primary header)"""
+    filename, hdu = _splitPath(path)
+    with fits.open(filename, memmap=False, lazy_load_hdus=True) as hduList:
+        primaryHeader = hduList[0].header
+        if hdu is None:
+            start, size = 0, os.path.getsize(filename)
+        else:
+            info = hduList[hdu].fileinfo()
+            start, size = info["hdrLoc"], info["datLoc"] + info["datSpan"] - info["hdrLoc"]
+    return _readRange(filename, start, size), primaryHeader
+
+
+def _readArray(path):
+    filename, hdu = _splitPath(path)
+    with fits.open(filename, memmap=False) as hduList:
+        if hdu is None:
+            hdu = 0 if hduList[0].data is not None else 1
+        return hduList[hdu].data
+
+
+def loadCcdInputs(dataRef, datasetTypes=("preprocessed", "raw", "bias", "flat", "fringe"), doMasks=True,
+                  log=None):
+    """Read the inputs of a Mosaic CCD; see the module documentation
+
+    @param[in] dataRef  data reference of the CCD
+    @param[in] datasetTypes  datasets whose HDU is read into the page cache, if they exist
+    @param[in] doMasks  read the bpm and masked arrays used with a preprocessed dataset?
+    @param[in] log  logger or None; missing datasets are logged at debug level
+    @return (a CcdInputs, number of bytes read)
+    """
+    butler = dataRef.getButler()
+    dataId = dict(dataRef.dataId)
+    paths = []
+    nbytes = 0
+    primaryHeaders = {}
+    for datasetType in datasetTypes:
+        try:
+            if not butler.datasetExists(datasetType, dataId):
+                continue
+            path = butler.get(datasetType + "_filename", dataId)[0]
+            size, primaryHeaders[datasetType] = _warm(path)
+        except Exception as e:
+            if log is not None:
+                log.debug("Not prefetching %s for %s: %s" % (datasetType, dataId, e))
+            continue
+        paths.append(path)
+        nbytes += size
+
+    arrays = dict(bpm=None, masked=None)
+    masksRead = doMasks and "preprocessed" in primaryHeaders
+    if masksRead:
+        # Same data ID as mosaicPreprocessedIsr.readMasks
+        maskId = dict(dataId)
+        maskId["observatory"] = primaryHeaders["preprocessed"]["OBSERVAT"].lower()
+        maskId["year"] = maskId["dateObs"][0:4]
+        for datasetType in arrays:
+            if butler.datasetExists(datasetType, maskId):
+                arrays[datasetType] = _readArray(butler.get(datasetType + "_filename", maskId)[0])
+                nbytes += arrays[datasetType].nbytes
+    return CcdInputs(dataId=dataId, paths=paths, masksRead=masksRead, **arrays), nbytes
@@ -0,0 +1,397 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""ProcessCcdTask that can skip the CCDs it has already processed, and read inputs ahead
+
+After processing a CCD, MosaicProcessCcdTask writes a fingerprint next to the
+calexp (<objname>_<ccdnum>.fingerprint.json).  It holds a hash of the config
+and the size, modification time and SHA-1 checksum of each input file.  With
+doSkipDone=True, a CCD is skipped if all of config.fingerprintOutputs exist
+and its fingerprint matches: the same config hash, and the same input files,
+each with either the same size and modification time or, failing that, the
+same checksum.  The inputs are, by default, the raw file and the
+calibrations the configured ISR applies to it (see getFingerprintInputs), so
+a new bias, dark, flat, fringe or defects file makes the CCD stale; a CCD
+none of whose inputs is found is always stale.
+A rerun after a node failure then only processes the CCDs that were not
+finished.
+
+With prefetchDepth > 0, each process is given a contiguous list of CCDs, and
+the inputs of the next prefetchDepth CCDs are read on I/O threads while the
+current one is processed; see prefetch.py.  The hit rate and stall time of
+the prefetcher are logged at the end of each list.
+
+With metadataStore set, the task metadata of each CCD are appended to one
+SQLite file for the run (see metadataStore.py) instead of being written as a
+processCcd_metadata file per CCD.
+
+processCcd.py from pipe_tasks runs ProcessCcdTask; use mosaicProcessCcd.py,
+whose task runner skips and prefetches.  singleFrameDriver.py, whose
+processCcd subtask is retargeted by config/singleFrameDriver.py, skips CCDs
+one at a time and does not prefetch.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import functools
+import hashlib
+import json
+import os
+import re
+
+import lsst.log
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+from lsst.pipe.tasks.processCcd import ProcessCcdConfig, ProcessCcdTask
+
+from .metadataStore import MetadataStore
+from .prefetch import Prefetcher, loadCcdInputs
+
+__all__ = ["FINGERPRINT_VERSION", "computeConfigHash", "getFingerprintInputs", "makeFingerprint",
+           "writeFingerprint", "readFingerprint", "isUpToDate", "MosaicProcessCcdConfig",
+           "MosaicProcessCcdTaskRunner", "MosaicProcessCcdTask"]
+
+FINGERPRINT_VERSION = 1
+
+# Fields of MosaicProcessCcdConfig that do not change the outputs, so are not in the config hash
+SKIP_DONE_FIELDS = ("doSkipDone", "doWriteFingerprint", "fingerprintInputs", "fingerprintOutputs",
+                    "prefetchDepth", "prefetchThreads", "prefetchMaxMBytes", "prefetchDatasets",
+                    "metadataStore")
+
+# Checksums of input files, keyed by (path, size, mtime)
+_checksumCache = {}
+
+
+def _checksum(path, blockSize=1 << 20):
+    """Return the SHA-1 checksum of a file, cached while its size and modification time are unchanged"""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    checksum = _checksumCache.get(key)
+    if checksum is None:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as infile:
+            for block in iter(lambda: infile.read(blockSize), b""):
+                sha1.update(block)
+        checksum = _checksumCache[key] = sha1.hexdigest()
+    return checksum
+
+
+def _getPath(dataRef, datasetType):
+    """Return the path of the file of a dataset, without an HDU suffix, or None if it does not exist
+
+    A dataset that cannot be looked up for the data ID (e.g. one whose data ID
+    needs keys the CCD's does not have, for which the registry query fails)
+    does not exist.
+    """
+    try:
+        if not dataRef.datasetExists(datasetType):
+            return None
+    except Exception:
+        return None
+    return re.sub(r"\[\d+\]$", "", dataRef.get(datasetType + "_filename")[0])
+
+
+def _getFingerprintPath(dataRef, datasetType):
+    path = _getPath(dataRef, datasetType)
+    if path is None:
+        return None
+    return os.path.splitext(path)[0] + ".fingerprint.json"
+
+
+def computeConfigHash(config):
+    """Return the SHA-1 hash of a config, without the fields of SKIP_DONE_FIELDS"""
+    values = config.toDict()
+    for name in SKIP_DONE_FIELDS:
+        values.pop(name, None)
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+
+
+# Calibration datasets read by IsrTask, keyed by the ISR config field that enables them
+ISR_CALIBRATIONS = (("doBias", "bias"), ("doDark", "dark"), ("doFlat", "flat"), ("doFringe", "fringe"),
+                    ("doDefect", "defects"))
+
+
+def getFingerprintInputs(config):
+    """Return the input datasets in the fingerprint of a CCD
+
+    These are config.fingerprintInputs if set; otherwise raw and the
+    calibrations that config.isr applies.
+
+    @param[in] config  a MosaicProcessCcdConfig
+    """
+    if config.fingerprintInputs is not None:
+        return list(config.fingerprintInputs)
+    return ["raw"] + [datasetType for field, datasetType in ISR_CALIBRATIONS
+                      if getattr(config.isr, field, False)]
+
+
+def makeFingerprint(dataRef, config):
+    """Return the fingerprint of the config and input files of a data reference
+
+    @param[in] dataRef  data reference of a CCD
+    @param[in] config  a MosaicProcessCcdConfig
+    @return a dict with the format version, the config hash, and a dict of
+        input path: dict with size, mtime and sha1
+    """
+    inputs = {}
+    for datasetType in getFingerprintInputs(config):
+        path = _getPath(dataRef, datasetType)
+        if path is not None:
+            stat = os.stat(path)
+            inputs[path] = dict(size=stat.st_size, mtime=stat.st_mtime, sha1=_checksum(path))
+    return dict(version=FINGERPRINT_VERSION, config=computeConfigHash(config), inputs=inputs)
+
+
+def writeFingerprint(dataRef, config):
+    """Write the fingerprint of a data reference next to its first output
+
+    @return the path of the fingerprint, or None if the first output does not exist
+    """
+    path = _getFingerprintPath(dataRef, config.fingerprintOutputs[0])
+    if path is None:
+        return None
+    tempPath = path + ".tmp"
+    with open(tempPath, "w") as outfile:
+        json.dump(makeFingerprint(dataRef, config), outfile, indent=1, sort_keys=True)
+    os.rename(tempPath, path)
+    return path
+
+
+def readFingerprint(dataRef, config):
+    """Read the fingerprint of a data reference
+
+    @return the fingerprint, or None if there is no readable fingerprint
+    """
+    path = _getFingerprintPath(dataRef, config.fingerprintOutputs[0])
+    if path is None:
+        return None
+    try:
+        with open(path) as infile:
+            return json.load(infile)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def isUpToDate(dataRef, config):
+    """Are the outputs of a data reference up to date?
+
+    True if all of config.fingerprintOutputs exist and the fingerprint written
+    with them matches the config and the inputs.  An input file whose size and
+    modification time are unchanged is not read; one whose modification time
+    changed is up to date if its checksum is unchanged.  Outputs are never up
+    to date if none of the inputs of getFingerprintInputs exists, now or when
+    the fingerprint was written.
+
+    @param[in] dataRef  data reference of a CCD
+    @param[in] config  a MosaicProcessCcdConfig
+    """
+    if not all(dataRef.datasetExists(datasetType) for datasetType in config.fingerprintOutputs):
+        return False
+    fingerprint = readFingerprint(dataRef, config)
+    if fingerprint is None or fingerprint.get("version") != FINGERPRINT_VERSION or \
+            fingerprint.get("config") != computeConfigHash(config):
+        return False
+    paths = set(_getPath(dataRef, datasetType) for datasetType in getFingerprintInputs(config))
+    paths.discard(None)
+    if not paths or paths != set(fingerprint["inputs"]):
+        return False
+    for path, record in fingerprint["inputs"].items():
+        stat = os.stat(path)
+        if stat.st_size != record["size"]:
+            return False
+        if stat.st_mtime != record["mtime"] and _checksum(path) != record["sha1"]:
+            return False
+    return True
+
+
+class MosaicProcessCcdConfig(ProcessCcdConfig):
+    doSkipDone = pexConfig.Field(
+        dtype=bool,
+        doc="Skip CCDs whose outputs exist and whose fingerprint matches the config and inputs?",
+        default=False,
+    )
+    doWriteFingerprint = pexConfig.Field(
+        dtype=bool,
+        doc="Write the fingerprint of the config and inputs next to the outputs of each CCD?",
+        default=True,
+    )
+    fingerprintInputs = pexConfig.ListField(
+        dtype=str,
+        doc="Input datasets whose files are in the fingerprint, if they exist; a CCD is reprocessed "
+            "when any of them changes, and always if none of them exists.  If None, raw and the "
+            "calibrations enabled in isr (bias, dark, flat, fringe, defects)",
+        default=None,
+        optional=True,
+    )
+    fingerprintOutputs = pexConfig.ListField(
+        dtype=str,
+        doc="Output datasets that must exist for a CCD to be skipped; "
+            "the fingerprint is written next to the first",
+        default=["calexp", "src", "icSrc"],
+    )
+
+    prefetchDepth = pexConfig.Field(
+        dtype=int,
+        doc="Number of CCDs whose inputs are read ahead on I/O threads; 0 to disable",
+        default=0,
+    )
+    prefetchThreads = pexConfig.Field(
+        dtype=int,
+        doc="Number of I/O threads per process reading ahead",
+        default=2,
+    )
+    prefetchMaxMBytes = pexConfig.Field(
+        dtype=float,
+        doc="Maximum size of the inputs read ahead and not yet used, per process (MB)",
+        default=1024.0,
+    )
+    prefetchDatasets = pexConfig.ListField(
+        dtype=str,
+        doc="Datasets whose HDU is read ahead, if they exist; the bpm and masked arrays are also "
+            "read ahead if preprocessed is included",
+        default=["preprocessed", "raw", "bias", "flat", "fringe"],
+    )
+    metadataStore = pexConfig.Field(
+        dtype=str,
+        doc="SQLite file to which the task metadata of each CCD are appended, instead of writing "
+            "processCcd_metadata; a relative path is relative to the output repository",
+        default=None,
+        optional=True,
+    )
+
+    def validate(self):
+        ProcessCcdConfig.validate(self)
+        if not self.fingerprintOutputs:
+            raise ValueError("fingerprintOutputs must not be empty")
+
+
+class MosaicProcessCcdTaskRunner(pipeBase.TaskRunner):
+    """TaskRunner for MosaicProcessCcdTask
+
+    With doSkipDone, leave out the CCDs that are up to date, and report how
+    many there are.  With prefetchDepth > 0, give each process a contiguous
+    list of CCDs, whose inputs are read ahead by a prefetch.Prefetcher.
+    """
+
+    def __init__(self, TaskClass, parsedCmd, doReturnResults=False):
+        pipeBase.TaskRunner.__init__(self, TaskClass, parsedCmd, doReturnResults=doReturnResults)
+        # For a relative config.metadataStore
+        self.outputRoot = getattr(parsedCmd, "output", None)
+
+    def makeTask(self, parsedCmd=None, args=None):
+        task = pipeBase.TaskRunner.makeTask(self, parsedCmd=parsedCmd, args=args)
+        task.outputRoot = self.outputRoot
+        return task
+
+    @staticmethod
+    def getTargetList(parsedCmd, **kwargs):
+        config = parsedCmd.config
+        targetList = pipeBase.TaskRunner.getTargetList(parsedCmd, **kwargs)
+        if config.doSkipDone:
+            todo = [target for target in targetList if not isUpToDate(target[0], config)]
+            log = lsst.log.Log.getLogger(MosaicProcessCcdTask._DefaultName)
+            log.info("Skipping %d CCDs with up-to-date outputs; running %d" %
+                     (len(targetList) - len(todo), len(todo)))
+            targetList = todo
+        if config.prefetchDepth > 0 and targetList:
+            numChunks = min(max(getattr(parsedCmd, "processes", 1), 1), len(targetList))
+            dataRefs = [dataRef for dataRef, targetKwargs in targetList]
+            bounds = [len(dataRefs)*i//numChunks for i in range(numChunks + 1)]
+            targetList = [(dataRefs[start:end], kwargs) for start, end in zip(bounds[:-1], bounds[1:])]
+        return targetList
+
+    def __call__(self, args):
+        """Run the task on a data reference, or on a list of data references with prefetching"""
+        dataRefList, kwargs = args
+        if not isinstance(dataRefList, list):
+            return pipeBase.TaskRunner.__call__(self, args)
+        config = self.config
+        log = lsst.log.Log.getLogger(MosaicProcessCcdTask._DefaultName)
+        load = functools.partial(loadCcdInputs, datasetTypes=config.prefetchDatasets, log=log)
+        results = []
+        with Prefetcher(dataRefList, load, depth=config.prefetchDepth, numThreads=config.prefetchThreads,
+                        maxBytes=int(config.prefetchMaxMBytes*2**20), log=log) as prefetcher:
+            for dataRef in dataRefList:
+                prefetcher.get(dataRef)
+                results.append(pipeBase.TaskRunner.__call__(self, (dataRef, kwargs)))
+            stats = prefetcher.getStats()
+        log.info("Prefetch: %d CCDs, hit rate %.2f, %d stalls (%.1f s), %d misses, %.1f MB read in %.1f s" %
+                 (stats["gets"], stats["hitRate"], stats["stalls"], stats["stallTime"], stats["misses"],
+                  stats["bytes"]/2.0**20, stats["loadTime"]))
+        return results
+
+    def run(self, parsedCmd):
+        resultList = pipeBase.TaskRunner.run(self, parsedCmd)
+        flattened = []
+        for result in resultList:
+            flattened.extend(result if isinstance(result, list) else [result])
+        return flattened
+
+
+class MosaicProcessCcdTask(ProcessCcdTask):
+    """ProcessCcdTask that writes fingerprints of its outputs, and skips up-to-date CCDs if doSkipDone
+
+    The task metadata have skipped=True for a skipped CCD and False otherwise.
+    """
+    ConfigClass = MosaicProcessCcdConfig
+    RunnerClass = MosaicProcessCcdTaskRunner
+    _DefaultName = "processCcd"
+    # Root of the output repository, set by MosaicProcessCcdTaskRunner
+    outputRoot = None
+
+    def run(self, sensorRef):
+        """Process a CCD, unless doSkipDone is set and its outputs are up to date
+
+        @param[in] sensorRef  butler data reference for raw data
+        @return the result of ProcessCcdTask.run, with skipped=False, or
+            pipeBase.Struct(skipped=True)
+        """
+        if self.config.doSkipDone and isUpToDate(sensorRef, self.config):
+            self.log.info("Skipping %s: outputs are up to date" % (sensorRef.dataId,))
+            self.metadata.set("skipped", True)
+            return pipeBase.Struct(skipped=True)
+        result = ProcessCcdTask.run(self, sensorRef)
+        if self.config.doWriteFingerprint:
+            writeFingerprint(sensorRef, self.config)
+        self.metadata.set("skipped", False)
+        result.skipped = False
+        return result
+
+    def getMetadataStore(self):
+        """Return the MetadataStore of config.metadataStore, or None if it is not set"""
+        path = self.config.metadataStore
+        if path is None:
+            return None
+        if not os.path.isabs(path) and self.outputRoot is not None:
+            path = os.path.join(self.outputRoot, path)
+        return MetadataStore(path)
+
+    def writeMetadata(self, dataRef):
+        """Write the metadata of the task and its subtasks to config.metadataStore, if set"""
+        store = self.getMetadataStore()
+        if store is None:
+            return ProcessCcdTask.writeMetadata(self, dataRef)
+        try:
+            store.put(self._DefaultName, dataRef.dataId, self.getFullMetadata())
+        except Exception as e:
+            self.log.warn("Could not store metadata for dataId=%s in %s: %s" %
+                          (dataRef.dataId, store.path, e))
@@ -0,0 +1,283 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Binned quicklook images of whole visits, placed in focal plane coordinates
+
+A quicklook image of a visit shows all its CCDs, block-averaged by binSize
+pixels, at their places in the focal plane.  readBinnedHdu reads a CCD HDU
+once, in bands of a multiple of binSize rows read with astropy sections, and
+block-averages each band as it is read, ignoring the pixels with a bad mask
+bit; the whole CCD is never held in memory.  placeCcds maps the centers of
+the binned pixels of each CCD to the focal plane with the camGeom offsets
+and yaw, through MosaicFocalPlaneTransform, and puts each at the nearest
+pixel of the quicklook grid, whose pixels are binSize CCD pixels across:
+CCDs rotated by multiples of 90 degrees are placed exactly, with one
+fancy-indexing assignment per CCD.
+
+MosaicQuicklookTask makes the quicklook image of each visit of a night, one
+visit per process with -j, and writes it as the quicklook dataset.  The ISR
+tasks can write the binned CCD as the quicklookCcd dataset from the exposure
+already in memory (doWriteQuicklook); MosaicQuicklookTask then uses those
+instead of reading the CCDs again, when they were binned by its binSize from
+its dataset (the BINSIZE and DATASET header cards; ISR writes postISRCCD).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import range
+
+import re
+import warnings
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+
+__all__ = ["BAD_MASK_PLANES", "binArray", "getMaskBits", "readBinnedHdu", "placeCcds", "makeCcdQuicklook",
+           "writeCcdQuicklook", "MosaicQuicklookConfig", "MosaicQuicklookTaskRunner", "MosaicQuicklookTask"]
+
+# Mask planes of the pixels left out of the binned images
+BAD_MASK_PLANES = ("BAD", "SAT", "NO_DATA")
+
+
+def binArray(array, binSize, bad=None):
+    """Block-average an image, ignoring bad and NaN pixels
+
+    @param[in] array  2-d image array
+    @param[in] binSize  size of the blocks; the blocks at the top and right may be smaller
+    @param[in] bad  2-d boolean array of the pixels to ignore, or None
+    @return the float32 array of the means of the blocks; NaN for blocks with no good pixel
+    """
+    height, width = array.shape
+    ny = (height + binSize - 1)//binSize
+    nx = (width + binSize - 1)//binSize
+    padded = np.full((ny*binSize, nx*binSize), np.nan, dtype=np.float32)
+    padded[:height, :width] = array
+    if bad is not None:
+        padded[:height, :width][bad] = np.nan
+    blocks = padded.reshape(ny, binSize, nx, binSize).swapaxes(1, 2).reshape(ny, nx, binSize*binSize)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # blocks with no good pixel
+        return np.nanmean(blocks, axis=2, dtype=np.float64).astype(np.float32)
+
+
+def getMaskBits(header, planes):
+    """Return the bit mask of mask planes from the MP_ keywords of a mask HDU written by afw
+
+    Planes without a keyword are ignored.
+    """
+    bits = 0
+    for plane in planes:
+        key = "MP_" + plane
+        if key in header:
+            bits |= 1 << int(header[key])
+    return bits
+
+
+def readBinnedHdu(path, hdu, binSize, maskHdu=None, badMaskPlanes=BAD_MASK_PLANES, bandBins=64):
+    """Read and block-average an image HDU, a band of rows at a time
+
+    @param[in] path  path of the FITS file, without an HDU suffix
+    @param[in] hdu  index of the image HDU
+    @param[in] binSize  size of the blocks
+    @param[in] maskHdu  index of an afw mask HDU, or None
+    @param[in] badMaskPlanes  mask planes of the pixels to ignore, if maskHdu is not None
+    @param[in] bandBins  number of rows of blocks read at once
+    @return the float32 array of the means of the blocks, as binArray
+    """
+    with fits.open(path) as hduList:
+        imageHdu = hduList[hdu]
+        height = imageHdu.shape[0]
+        badMask = 0
+        if maskHdu is not None:
+            maskHdu = hduList[maskHdu]
+            badMask = getMaskBits(maskHdu.header, badMaskPlanes)
+        bandRows = binSize*bandBins
+        bands = []
+        for y0 in range(0, height, bandRows):
+            y1 = min(y0 + bandRows, height)
+            image = np.asarray(imageHdu.section[y0:y1, :], dtype=np.float32)
+            bad = None
+            if badMask:
+                bad = (np.asarray(maskHdu.section[y0:y1, :]).astype(np.int64) & badMask) != 0
+            bands.append(binArray(image, binSize, bad))
+    return np.concatenate(bands)
+
+
+def placeCcds(binnedImages, transform, binSize):
+    """Put binned CCD images at their places in the focal plane
+
+    The quicklook pixels are binSize times the pixels of the CCDs, all of
+    which must have the same pixel size; the binned pixels are put at the
+    nearest quicklook pixel.
+
+    @param[in] binnedImages  dict of ccdnum: binned image array, as made by binArray
+    @param[in] transform  MosaicFocalPlaneTransform of the camera
+    @param[in] binSize  size of the blocks of the binned images
+    @return a pipeBase.Struct with image (the float32 quicklook array, NaN between the
+        CCDs), xFp0, yFp0 (focal plane position, in mm, of the center of pixel (0, 0))
+        and scale (size of the pixels, in mm)
+    """
+    if not binnedImages:
+        raise RuntimeError("No CCDs to place")
+    positions = {}
+    for ccdnum, binned in binnedImages.items():
+        # Center of each block, in CCD pixels
+        y, x = np.indices(binned.shape, dtype=float)
+        positions[ccdnum] = transform.pixelsToFocalPlane(ccdnum, (x + 0.5)*binSize - 0.5,
+                                                         (y + 0.5)*binSize - 0.5)
+    ccdnum = min(binnedImages)
+    xStep, yStep = transform.pixelsToFocalPlane(ccdnum, [0.0, 1.0], [0.0, 0.0])
+    scale = binSize*np.hypot(xStep[1] - xStep[0], yStep[1] - yStep[0])
+    xFp0 = min(xFp.min() for xFp, yFp in positions.values())
+    yFp0 = min(yFp.min() for xFp, yFp in positions.values())
+    indices = {}
+    for ccdnum, (xFp, yFp) in positions.items():
+        indices[ccdnum] = (np.rint((yFp - yFp0)/scale).astype(int), np.rint((xFp - xFp0)/scale).astype(int))
+    height = max(rows.max() for rows, columns in indices.values()) + 1
+    width = max(columns.max() for rows, columns in indices.values()) + 1
+    image = np.full((height, width), np.nan, dtype=np.float32)
+    for ccdnum, (rows, columns) in indices.items():
+        image[rows, columns] = binnedImages[ccdnum]
+    return pipeBase.Struct(image=image, xFp0=xFp0, yFp0=yFp0, scale=scale)
+
+
+def makeCcdQuicklook(exposure, binSize, badMaskPlanes=BAD_MASK_PLANES, dataset="postISRCCD"):
+    """Block-average an exposure in memory
+
+    @param[in] dataset  dataset of the exposure, recorded in the header
+    @return an lsst.afw.image.DecoratedImageF of the binned image, with binSize in BINSIZE
+        and dataset in DATASET
+    """
+    maskedImage = exposure.getMaskedImage()
+    mask = maskedImage.getMask()
+    planes = [plane for plane in badMaskPlanes if plane in mask.getMaskPlaneDict()]
+    bad = (mask.getArray() & mask.getPlaneBitMask(planes)) != 0 if planes else None
+    binned = binArray(maskedImage.getImage().getArray(), binSize, bad)
+    quicklook = afwImage.DecoratedImageF(afwImage.ImageF(binned, False))
+    metadata = dafBase.PropertyList()
+    metadata.set("BINSIZE", binSize)
+    metadata.set("DATASET", dataset)
+    quicklook.setMetadata(metadata)
+    return quicklook
+
+
+def writeCcdQuicklook(sensorRef, exposure, binSize, badMaskPlanes=BAD_MASK_PLANES, dataset="postISRCCD"):
+    """Block-average an exposure in memory and write it as the quicklookCcd dataset"""
+    sensorRef.put(makeCcdQuicklook(exposure, binSize, badMaskPlanes, dataset), "quicklookCcd")
+
+
+class MosaicQuicklookConfig(pexConfig.Config):
+    binSize = pexConfig.Field(dtype=int, default=8, doc="Number of CCD pixels across a quicklook pixel")
+    dataset = pexConfig.Field(dtype=str, default="calexp",
+                              doc="Dataset of the CCDs: an afw exposure (e.g. calexp, postISRCCD) or a "
+                                  "CCD HDU of a multi-extension file (e.g. preprocessed)")
+    badMaskPlanes = pexConfig.ListField(dtype=str, default=list(BAD_MASK_PLANES),
+                                        doc="Mask planes of the pixels left out of the blocks, for an "
+                                            "afw exposure")
+    useCcdQuicklook = pexConfig.Field(dtype=bool, default=True,
+                                      doc="Use the quicklookCcd written by ISR, when it exists with binSize "
+                                          "and was binned from dataset?")
+    bandBins = pexConfig.Field(dtype=int, default=64, doc="Number of rows of blocks read at once")
+
+
+class MosaicQuicklookTaskRunner(pipeBase.TaskRunner):
+    """Run MosaicQuicklookTask once per visit, so that -j processes visits in parallel"""
+
+    @staticmethod
+    def getTargetList(parsedCmd, **kwargs):
+        from .visitDriver import groupByVisit
+        return [(dataRefs, kwargs) for key, dataRefs in groupByVisit(parsedCmd.id.refList)]
+
+
+class MosaicQuicklookTask(pipeBase.CmdLineTask):
+    """Make binned quicklook images of visits; see lsst.obs.mosaic.quicklook"""
+    ConfigClass = MosaicQuicklookConfig
+    RunnerClass = MosaicQuicklookTaskRunner
+    _DefaultName = "mosaicQuicklook"
+
+    def __init__(self, transform=None, *args, **kwargs):
+        """Construct a MosaicQuicklookTask
+
+        @param[in] transform  MosaicFocalPlaneTransform of the camera, or None to use
+            MosaicMapper.getFocalPlaneTransform()
+        """
+        pipeBase.CmdLineTask.__init__(self, *args, **kwargs)
+        self.transform = transform
+
+    @classmethod
+    def _makeArgumentParser(cls):
+        parser = pipeBase.ArgumentParser(name=cls._DefaultName)
+        parser.add_id_argument("--id", "preprocessed", help="data ID, e.g. --id dateObs=2000-10-01")
+        return parser
+
+    def getTransform(self):
+        if self.transform is None:
+            from .mosaicMapper import MosaicMapper
+            self.transform = MosaicMapper.getFocalPlaneTransform()
+        return self.transform
+
+    def readCcd(self, dataRef):
+        """Return the binned image array of a CCD, from its quicklookCcd or its config.dataset"""
+        if self.config.useCcdQuicklook and dataRef.datasetExists("quicklookCcd"):
+            quicklook = dataRef.get("quicklookCcd")
+            metadata = quicklook.getMetadata()
+            if (metadata.exists("BINSIZE") and metadata.get("BINSIZE") == self.config.binSize and
+                    metadata.exists("DATASET") and metadata.get("DATASET") == self.config.dataset):
+                return quicklook.getImage().getArray()
+        path = dataRef.get(self.config.dataset + "_filename")[0]
+        match = re.match(r"^(.*)\[(\d+)\]$", path)
+        if match is not None:
+            path, hdu, maskHdu = match.group(1), int(match.group(2)), None
+        else:
+            # An Exposure written by afw: image and mask in HDUs 1 and 2
+            hdu, maskHdu = 1, 2
+        return readBinnedHdu(path, hdu, self.config.binSize, maskHdu=maskHdu,
+                             badMaskPlanes=self.config.badMaskPlanes, bandBins=self.config.bandBins)
+
+    @pipeBase.timeMethod
+    def run(self, dataRefList):
+        """Make and write the quicklook image of a visit
+
+        @param[in] dataRefList  data references of the CCDs of a visit
+        @return a pipeBase.Struct as placeCcds
+        """
+        binnedImages = dict((dataRef.dataId["ccdnum"], self.readCcd(dataRef)) for dataRef in dataRefList)
+        result = placeCcds(binnedImages, self.getTransform(), self.config.binSize)
+        quicklook = afwImage.DecoratedImageF(afwImage.ImageF(result.image, False))
+        metadata = dafBase.PropertyList()
+        metadata.set("BINSIZE", self.config.binSize)
+        metadata.set("FPX0", result.xFp0)
+        metadata.set("FPY0", result.yFp0)
+        metadata.set("FPSCALE", result.scale)
+        quicklook.setMetadata(metadata)
+        dataRefList[0].put(quicklook, "quicklook")
+        self.log.info("Wrote a %dx%d quicklook of %d CCDs of %s" %
+                      (result.image.shape[1], result.image.shape[0], len(binnedImages),
+                       dataRefList[0].dataId))
+        return result
+
+    def _getMetadataName(self):
+        return None
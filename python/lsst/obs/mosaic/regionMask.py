@@ -0,0 +1,292 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Build the "masked" dataset from ds9 region files
+
+The manually drawn exclusion regions of an exposure (satellite trails, ghosts,
+bright star halos) are ds9 region files in image coordinates, one per CCD,
+stored under a regions directory with the same layout as the raw data.  The
+"masked" dataset of a CCD is a copy of the bad pixel mask of the CCD with the
+pixels inside the regions set to 0; setMask in mosaicPreprocessedIsr marks
+those pixels SUSPECT.
+
+Polygons, boxes and circles are rasterized by scan conversion, all rows of a
+shape at once: a pixel is inside a shape if its center is.  The output is
+written tile compressed (as fpack does), and the CCDs are processed in a pool
+of worker processes.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import multiprocessing
+import os
+import re
+
+import numpy as np
+import astropy.io.fits as fits
+
+__all__ = ["REGION_TEMPLATE", "readRegions", "parseRegions", "rasterizePolygon", "rasterizeCircle",
+           "makeRegionMask", "writeRegionMask", "findRegionMasks", "buildRegionMasks"]
+
+# Region files, relative to the regions directory, in the layout of the "masked" dataset
+REGION_TEMPLATE = "%(field)s/%(subfield)s/%(filter)s/%(dateObs)s/%(objname)s_%(ccdnum)d.reg"
+
+# Keys of the "masked" and "bpm" templates
+MASKED_KEYS = ("field", "subfield", "filter", "dateObs", "objname", "ccdnum")
+
+_shapeRe = re.compile(r"^\s*([-+]?)\s*(polygon|box|circle)\s*\(([^)]*)\)", re.IGNORECASE)
+_coordSystems = ("image", "physical", "fk4", "fk5", "icrs", "galactic", "ecliptic", "wcs", "linear",
+                 "amplifier", "detector")
+
+
+def parseRegions(text):
+    """Parse the polygons, boxes and circles of a ds9 region file
+
+    Only image (or physical, which is the same for Mosaic CCDs) coordinates
+    are supported.  Shapes preceded by "-" are exclusions, which are removed
+    from the mask.
+
+    @param[in] text  contents of the region file
+    @return a list of (shape, parameters, exclude), where shape is "polygon",
+        "box" or "circle" and parameters a list of floats, in 1-based pixels
+    @throw RuntimeError if the file uses sky coordinates
+    """
+    regions = []
+    system = "physical"
+    for line in text.splitlines():
+        line = line.split("#", 1)[0]
+        for item in line.split(";"):
+            item = item.strip()
+            if not item:
+                continue
+            if item.lower() in _coordSystems:
+                system = item.lower()
+                continue
+            match = _shapeRe.match(item)
+            if match is None:
+                continue
+            if system not in ("image", "physical"):
+                raise RuntimeError("Region %r is in %s coordinates; only image coordinates are supported" %
+                                   (item, system))
+            sign, shape, args = match.groups()
+            params = [float(arg) for arg in args.replace(",", " ").split()]
+            regions.append((shape.lower(), params, sign == "-"))
+    return regions
+
+
+def readRegions(path):
+    """Read the polygons, boxes and circles of a ds9 region file; see parseRegions"""
+    with open(path) as infile:
+        return parseRegions(infile.read())
+
+
+def _fillSpans(mask, rows, starts, ends, value=True):
+    """Set the pixels of rows whose centers are in [start, end)
+
+    @param[in,out] mask  2-d bool array
+    @param[in] rows  0-based row of each span
+    @param[in] starts, ends  limits of each span, in 1-based pixel coordinates
+    @param[in] value  value to set
+    """
+    width = mask.shape[1]
+    # the center of 0-based pixel i is at i + 1
+    first = np.clip(np.ceil(np.asarray(starts) - 1).astype(np.int64), 0, width)
+    last = np.clip(np.ceil(np.asarray(ends) - 1).astype(np.int64), 0, width)
+    good = last > first
+    rows, first, last = np.asarray(rows)[good], first[good], last[good]
+    if len(rows) == 0:
+        return
+    counts = np.zeros((mask.shape[0], width + 1), dtype=np.int32)
+    np.add.at(counts, (rows, first), 1)
+    np.add.at(counts, (rows, last), -1)
+    mask[np.cumsum(counts[:, :-1], axis=1) > 0] = value
+
+
+def rasterizePolygon(mask, vertices, value=True):
+    """Set the pixels of a mask whose centers are inside a polygon (even-odd rule)
+
+    @param[in,out] mask  2-d bool array
+    @param[in] vertices  sequence of (x, y), in 1-based pixel coordinates
+    @param[in] value  value to set
+    """
+    vertices = np.asarray(vertices, dtype=float).reshape(-1, 2)
+    if len(vertices) < 3:
+        return
+    x0, y0 = vertices[:, 0], vertices[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    # row centers that the polygon spans; 0-based row j has its center at y = j + 1
+    rowMin = max(int(math.ceil(y0.min() - 1)), 0)
+    rowMax = min(int(math.floor(y0.max() - 1)), mask.shape[0] - 1)
+    if rowMax < rowMin:
+        return
+    rows = np.arange(rowMin, rowMax + 1)
+    y = (rows + 1.0)[:, np.newaxis]
+    # an edge crosses a row if the row center is in [lower end, upper end)
+    crosses = ((y0 <= y) & (y < y1)) | ((y1 <= y) & (y < y0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = np.where(crosses, x0 + (y - y0)*(x1 - x0)/(y1 - y0), np.nan)
+    # sorted crossings of each row; NaN sort last, and there is an even number of crossings
+    x.sort(axis=1)
+    ends = x[:, 1::2]
+    starts = x[:, 0::2][:, :ends.shape[1]]
+    good = np.isfinite(starts) & np.isfinite(ends)
+    spanRows = np.broadcast_to(rows[:, np.newaxis], good.shape)[good]
+    _fillSpans(mask, spanRows, starts[good], ends[good], value)
+
+
+def rasterizeCircle(mask, xc, yc, radius, value=True):
+    """Set the pixels of a mask whose centers are inside a circle
+
+    @param[in,out] mask  2-d bool array
+    @param[in] xc, yc  center of the circle, in 1-based pixel coordinates
+    @param[in] radius  radius of the circle, in pixels
+    @param[in] value  value to set
+    """
+    rowMin = max(int(math.ceil(yc - radius - 1)), 0)
+    rowMax = min(int(math.floor(yc + radius - 1)), mask.shape[0] - 1)
+    if rowMax < rowMin:
+        return
+    rows = np.arange(rowMin, rowMax + 1)
+    halfWidth = np.sqrt(np.maximum(radius**2 - (rows + 1.0 - yc)**2, 0.0))
+    # include the pixels whose centers are on the circle
+    _fillSpans(mask, rows, xc - halfWidth, np.nextafter(xc + halfWidth, np.inf), value)
+
+
+def _boxVertices(xc, yc, width, height, angle=0.0):
+    """Return the corners of a ds9 box, rotated by angle degrees about its center"""
+    c, s = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    corners = np.array([(-0.5, -0.5), (0.5, -0.5), (0.5, 0.5), (-0.5, 0.5)])*(width, height)
+    return np.column_stack([xc + c*corners[:, 0] - s*corners[:, 1], yc + s*corners[:, 0] + c*corners[:, 1]])
+
+
+def makeRegionMask(regions, shape):
+    """Rasterize regions
+
+    @param[in] regions  list of regions, as returned by parseRegions
+    @param[in] shape  shape of the mask (rows, columns)
+    @return a bool array of the given shape, True inside the regions
+    """
+    mask = np.zeros(shape, dtype=bool)
+    for region, params, exclude in regions:
+        value = not exclude
+        if region == "polygon":
+            rasterizePolygon(mask, params, value)
+        elif region == "box":
+            rasterizePolygon(mask, _boxVertices(*params[:5]), value)
+        elif region == "circle":
+            rasterizeCircle(mask, params[0], params[1], params[2], value)
+    return mask
+
+
+def writeRegionMask(job):
+    """Write the "masked" image of one CCD
+
+    Run by the worker pool of buildRegionMasks.
+
+    @param[in] job  tuple (regionPath, bpmPath, shape, outputPath):
+        - regionPath  ds9 region file
+        - bpmPath  bad pixel mask to start from, or None for an image of 1s
+        - shape  shape of the image (rows, columns) when bpmPath is None
+        - outputPath  tile-compressed image to write
+    @return (outputPath, number of pixels inside the regions)
+    """
+    regionPath, bpmPath, shape, outputPath = job
+    if bpmPath is not None:
+        with fits.open(bpmPath, memmap=False) as hduList:
+            hdu = next(hdu for hdu in hduList if hdu.data is not None)
+            image = np.asarray(hdu.data, dtype=np.uint16)
+    else:
+        image = np.ones(shape, dtype=np.uint16)
+    mask = makeRegionMask(readRegions(regionPath), image.shape)
+    image[mask] = 0
+
+    outputDir = os.path.dirname(outputPath)
+    if outputDir and not os.path.isdir(outputDir):
+        try:
+            os.makedirs(outputDir)
+        except OSError:
+            if not os.path.isdir(outputDir):  # another worker may have made it
+                raise
+    tempPath = outputPath + ".tmp%d" % (os.getpid(),)
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(image, compression_type="RICE_1")]).writeto(tempPath)
+    os.rename(tempPath, outputPath)
+    return outputPath, int(np.count_nonzero(mask))
+
+
+def findRegionMasks(mapper, regionDir, dataId=None, regionTemplate=REGION_TEMPLATE, bpmPath=None,
+                    observatory="kpno", clobber=False):
+    """List the CCDs that have a region file
+
+    @param[in] mapper  MosaicMapper of the repository the raw data are registered in
+    @param[in] regionDir  directory of the region files
+    @param[in] dataId  dict restricting the raw data considered (e.g. dict(objname="obj330"))
+    @param[in] regionTemplate  path of the region file of a CCD relative to regionDir,
+        with the keys of the "masked" dataset
+    @param[in] bpmPath  bad pixel mask used for all CCDs; if None, use the "bpm" dataset of
+        each CCD, or an image of 1s if there is none
+    @param[in] observatory  observatory of the "bpm" dataset
+    @param[in] clobber  replace existing "masked" images?
+    @return a list of jobs for writeRegionMask
+    """
+    camera = mapper.camera
+    jobs = []
+    for values in mapper.queryMetadata("raw", MASKED_KEYS, dataId or {}):
+        ccdId = dict(zip(MASKED_KEYS, values))
+        regionPath = os.path.join(regionDir, regionTemplate % ccdId)
+        if not os.path.exists(regionPath):
+            continue
+        outputPath = mapper.map("masked", ccdId, write=True).getLocationsWithRoot()[0]
+        if os.path.exists(outputPath) and not clobber:
+            continue
+        ccdBpmPath = bpmPath
+        if ccdBpmPath is None:
+            bpmId = dict(ccdId, observatory=observatory, year=ccdId["dateObs"][0:4])
+            ccdBpmPath = mapper.map("bpm", bpmId).getLocationsWithRoot()[0]
+            if not os.path.exists(ccdBpmPath):
+                ccdBpmPath = None
+        bbox = camera[ccdId["ccdnum"]].getBBox()
+        jobs.append((regionPath, ccdBpmPath, (bbox.getHeight(), bbox.getWidth()), outputPath))
+    return jobs
+
+
+def buildRegionMasks(jobs, processes=1, log=None):
+    """Write the "masked" images listed by findRegionMasks
+
+    @param[in] jobs  list of jobs, as returned by findRegionMasks
+    @param[in] processes  number of worker processes
+    @param[in] log  logger or None
+    @return a list of (path, number of pixels inside the regions) of the images written
+    """
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            results = pool.map(writeRegionMask, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [writeRegionMask(job) for job in jobs]
+    if log is not None:
+        for path, numMasked in results:
+            log.info("Masked %d pixels in %s" % (numMasked, path))
+    return results
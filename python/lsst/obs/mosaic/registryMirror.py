@@ -0,0 +1,208 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""An in-memory copy of the raw table of a registry, to complete data IDs
+
+Most Mosaic templates need field, subfield, filter, dateObs, objname and
+ccdnum.  When a data ID has only visit and ccdnum, the butler looks up the
+missing keys in the raw table of the registry, with one SQL query for each
+get or put.  RegistryMirror reads the table once per process (again if the
+file changes) into one array per column, with an index of the rows for each
+value of a column, and answers the same lookups with dictionary and array
+operations.  MosaicMapper installs a MirroredLookup in each mapping that uses
+the raw table.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+from past.builtins import basestring
+
+import collections
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+__all__ = ["RegistryMirror", "MirroredLookup", "getRegistryPath"]
+
+# Keys that Mapping.lookup takes from the data ID instead of the registry
+SKYMAP_KEYS = ("tract", "patch")
+
+
+def getRegistryPath(registry):
+    """Return the path of the file of a sqlite registry, or None for other registries"""
+    conn = getattr(registry, "conn", None)
+    if not isinstance(conn, sqlite3.Connection):
+        return None
+    for seq, name, path in conn.execute("PRAGMA database_list"):
+        if name == "main" and path:
+            return path
+    return None
+
+
+class RegistryMirror(object):
+    """The rows of a registry table, stored by column
+
+    @param[in] path  path of the sqlite registry
+    @param[in] table  name of the table
+    """
+    _cache = {}
+    _cacheLock = threading.Lock()
+    # Number of loads and lookups, by (path, table); kept across reloads
+    stats = collections.defaultdict(collections.Counter)
+
+    def __init__(self, path, table="raw"):
+        self.path = path
+        self.table = table
+        conn = sqlite3.connect(path)
+        try:
+            cursor = conn.execute("SELECT * FROM %s" % (table,))
+            names = [description[0] for description in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+        self.numRows = len(rows)
+        self._columns = {}
+        for i, name in enumerate(names):
+            column = np.empty(self.numRows, dtype=object)
+            column[:] = [row[i] for row in rows]
+            self._columns[name] = column
+        self._types = dict((name, type(next((v for v in column if v is not None), None)))
+                           for name, column in self._columns.items())
+        self._indices = {}
+        self._lock = threading.Lock()
+        RegistryMirror.stats[(path, table)]["loads"] += 1
+
+    @classmethod
+    def get(cls, path, table="raw"):
+        """Return the mirror of a registry table, shared within the process and reloaded if the file changes
+
+        @return a RegistryMirror, or None if path does not exist or has no such table
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        key = (path, table)
+        with cls._cacheLock:
+            entry = cls._cache.get(key)
+            if entry is None or entry[0] != mtime:
+                try:
+                    entry = (mtime, cls(path, table))
+                except sqlite3.Error:
+                    entry = (mtime, None)
+                cls._cache[key] = entry
+            return entry[1]
+
+    @property
+    def columns(self):
+        """Names of the columns"""
+        return list(self._columns)
+
+    def _getIndex(self, name):
+        """Return a dict of value: array of the rows with that value in a column"""
+        with self._lock:
+            index = self._indices.get(name)
+            if index is None:
+                rows = collections.defaultdict(list)
+                for i, value in enumerate(self._columns[name]):
+                    rows[value].append(i)
+                index = dict((value, np.array(indices, dtype=np.int64)) for value, indices in rows.items())
+                self._indices[name] = index
+            return index
+
+    def _coerce(self, name, value):
+        """Convert a data ID value to the type of a column, as sqlite would compare them"""
+        columnType = self._types[name]
+        if columnType in (int, float) and not isinstance(value, (int, float)):
+            try:
+                return columnType(value)
+            except (TypeError, ValueError):
+                return value
+        if columnType is str and not isinstance(value, str):
+            return str(value)
+        return value
+
+    def lookup(self, properties, dataId):
+        """Return the distinct values of properties in the rows matching dataId
+
+        This is the equivalent of
+            SELECT DISTINCT <properties> FROM <table> WHERE <key>=<value> AND ...
+
+        @param[in] properties  list of column names
+        @param[in] dataId  dict of column name: value
+        @return a list of tuples, in the order of the rows, or None if a
+            property or data ID key is not a column of the table
+        """
+        if any(name not in self._columns for name in properties) or \
+                any(name not in self._columns for name in dataId):
+            return None
+        rows = None
+        for name, value in dataId.items():
+            matches = self._getIndex(name).get(self._coerce(name, value))
+            if matches is None:
+                rows = np.empty(0, dtype=np.int64)
+                break
+            rows = matches if rows is None else np.intersect1d(rows, matches, assume_unique=True)
+            if len(rows) == 0:
+                break
+        if rows is None:
+            rows = np.arange(self.numRows)
+        values = [self._columns[name][rows].tolist() for name in properties]
+        RegistryMirror.stats[(self.path, self.table)]["lookups"] += 1
+        return list(collections.OrderedDict.fromkeys(zip(*values)))
+
+
+class MirroredLookup(object):
+    """A replacement for the lookup method of a Mapping that uses a RegistryMirror
+
+    Lookups the mirror cannot answer (unknown columns, sky map keys) are
+    passed to the original method.
+
+    @param[in] mapping  an lsst.obs.base.Mapping whose tables are [table]
+    @param[in] path  path of the sqlite registry of the mapping
+    @param[in] table  registry table of the mapping
+    """
+
+    def __init__(self, mapping, path, table="raw"):
+        self.lookup = mapping.lookup
+        self.columns = getattr(mapping, "columns", None)
+        self.obsTimeName = getattr(mapping, "obsTimeName", None)
+        self.path = path
+        self.table = table
+
+    def __call__(self, properties, dataId):
+        if isinstance(properties, basestring):
+            properties = [properties]
+        properties = list(properties)
+        if not any(name in SKYMAP_KEYS for name in properties):
+            mirror = RegistryMirror.get(self.path, self.table)
+            if mirror is not None:
+                lookupId = dict((name, value) for name, value in dataId.items()
+                                if (not self.columns or name in self.columns) and
+                                name != self.obsTimeName and name not in SKYMAP_KEYS)
+                result = mirror.lookup(properties, lookupId)
+                if result is not None:
+                    return result
+        RegistryMirror.stats[(self.path, self.table)]["fallbacks"] += 1
+        return self.lookup(properties, dataId)
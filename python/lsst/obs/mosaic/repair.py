@@ -0,0 +1,214 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""RepairTask that finds cosmic rays in overlapping tiles, on a process pool
+
+RepairTask.cosmicRay runs measAlg.findCosmicRays on the whole CCD in one
+thread.  MosaicRepairTask splits the CCD into a grid of tiles of tileSize
+pixels, the cores, and runs findCosmicRays on each core grown by tileOverlap
+pixels, so that a cosmic ray crossing a seam is seen whole by the tiles on
+both sides.  Each tile returns the CR mask and the repaired pixels of its
+core only; the cores partition the CCD, so the stitched CR mask has each
+pixel from exactly one tile, and a cosmic ray split by a seam becomes one
+footprint again when the cosmic rays are counted from the stitched mask.
+
+Tiling is off unless doTile is set.  The tiles are then processed by
+numProcesses forked processes, which read the exposure from the parent's
+memory, and return only their cores.  A process that is already a pool worker
+(e.g. of mosaicVisitDriver.py), or that runs other threads (e.g. the prefetch
+I/O threads of MosaicProcessCcdTask), which a fork would copy in whatever
+state they are in, processes the tiles itself.  config.cosmicray.nCrPixelMax
+applies to each tile, and to the stitched CR mask of the CCD.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import range
+
+import multiprocessing
+import threading
+
+import numpy as np
+
+import lsst.afw.detection as afwDet
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.meas.algorithms as measAlg
+import lsst.pex.config as pexConfig
+import lsst.pex.exceptions as pexExcept
+from lsst.pipe.tasks.repair import RepairConfig, RepairTask
+
+__all__ = ["makeTiles", "mergeTile", "MosaicRepairConfig", "MosaicRepairTask"]
+
+
+def makeTiles(width, height, tileSize, overlap):
+    """Split an image into tiles
+
+    @param[in] width, height  dimensions of the image
+    @param[in] tileSize  size of the cores of the tiles, which partition the image
+    @param[in] overlap  number of pixels by which the cores are grown, within the image
+    @return a list of (core, tile), each a tuple (x0, y0, x1, y1) of the pixels [x0, x1) x [y0, y1)
+    """
+    tiles = []
+    for y0 in range(0, height, tileSize):
+        for x0 in range(0, width, tileSize):
+            x1, y1 = min(x0 + tileSize, width), min(y0 + tileSize, height)
+            core = (x0, y0, x1, y1)
+            tile = (max(x0 - overlap, 0), max(y0 - overlap, 0), min(x1 + overlap, width),
+                    min(y1 + overlap, height))
+            tiles.append((core, tile))
+    return tiles
+
+
+def _coreSlices(core, tile):
+    """Return the slices of the core of a tile in the tile arrays"""
+    x0, y0, x1, y1 = core
+    return slice(y0 - tile[1], y1 - tile[1]), slice(x0 - tile[0], x1 - tile[0])
+
+
+def mergeTile(image, mask, core, crMask, crImage, maskBits):
+    """Copy the cosmic rays found in a tile to its core in the image and mask arrays
+
+    @param[in,out] image, mask  image and mask arrays of the whole CCD
+    @param[in] core  (x0, y0, x1, y1) of the core
+    @param[in] crMask  boolean array of the CR pixels of the core
+    @param[in] crImage  repaired values of the CR pixels, in the order of np.nonzero(crMask)
+    @param[in] maskBits  mask bits to set on the CR pixels
+    """
+    x0, y0, x1, y1 = core
+    rows, columns = np.nonzero(crMask)
+    image[rows + y0, columns + x0] = crImage
+    mask[rows + y0, columns + x0] |= maskBits
+
+
+# State shared with the forked tile workers, set by MosaicRepairTask.findCosmicRaysTiled
+_tileState = None
+
+
+def _findTileCosmicRays(item):
+    """Find the cosmic rays of a tile; return (core, CR mask of the core, repaired values of its CR pixels)"""
+    core, tile = item
+    maskedImage, psf, background, policy, keepCRs = _tileState
+    x0, y0, x1, y1 = tile
+    xy0 = maskedImage.getXY0()
+    bbox = afwGeom.Box2I(afwGeom.Point2I(xy0.getX() + x0, xy0.getY() + y0),
+                         afwGeom.Extent2I(x1 - x0, y1 - y0))
+    # A deep copy: findCosmicRays repairs the pixels, and the tiles overlap
+    tileImage = maskedImage.Factory(maskedImage, bbox, afwImage.PARENT, True)
+    crs = measAlg.findCosmicRays(tileImage, psf, background, policy, keepCRs)
+    mask = tileImage.getMask()
+    crBit = mask.getPlaneBitMask("CR")
+    if crs:
+        afwDet.setMaskFromFootprintList(mask, crs, crBit)
+    coreSlices = _coreSlices(core, tile)
+    crMask = (mask.getArray()[coreSlices] & crBit) != 0
+    return core, crMask, tileImage.getImage().getArray()[coreSlices][crMask]
+
+
+class MosaicRepairConfig(RepairConfig):
+    doTile = pexConfig.Field(dtype=bool, default=False, doc="Find cosmic rays in tiles?")
+    tileSize = pexConfig.Field(dtype=int, default=1024, doc="Size of the cores of the tiles (pixels)")
+    tileOverlap = pexConfig.Field(dtype=int, default=64,
+                                  doc="Number of pixels by which the tiles overlap their neighbours; "
+                                      "more than half the length of the longest cosmic rays")
+    numProcesses = pexConfig.Field(dtype=int, default=4, doc="Number of processes finding cosmic rays")
+
+
+class MosaicRepairTask(RepairTask):
+    """RepairTask that finds cosmic rays in tiles; see lsst.obs.mosaic.repair"""
+    ConfigClass = MosaicRepairConfig
+
+    def cosmicRay(self, exposure, keepCRs=None):
+        """Mask cosmic rays, and repair them unless keepCRs, as RepairTask.cosmicRay
+
+        @param[in,out] exposure  exposure to process; it must have a PSF
+        @param[in] keepCRs  don't interpolate over the CR pixels (defer to config if None)
+        """
+        if not self.config.doTile:
+            return RepairTask.cosmicRay(self, exposure, keepCRs=keepCRs)
+        assert exposure, "No exposure provided"
+        psf = exposure.getPsf()
+        assert psf, "No psf provided"
+
+        mask = exposure.getMaskedImage().getMask()
+        mask.clearMaskPlane(mask.getMaskPlane("CR"))
+
+        exposure0 = exposure
+        binSize = self.config.cosmicray.background.binSize
+        nx, ny = exposure.getWidth()/binSize, exposure.getHeight()/binSize
+        if nx*ny <= 1:
+            medianBg = afwMath.makeStatistics(exposure.getMaskedImage(), afwMath.MEDIAN).getValue()
+            modelBg = None
+        else:
+            # As RepairTask, subtract the background from a copy, and add it back at the end
+            exposure = exposure.Factory(exposure, True)
+            subtractBackgroundTask = measAlg.SubtractBackgroundTask(config=self.config.cosmicray.background)
+            modelBg = subtractBackgroundTask.run(exposure).background
+            medianBg = 0.0
+        if keepCRs is None:
+            keepCRs = self.config.cosmicray.keepCRs
+
+        self.findCosmicRaysTiled(exposure.getMaskedImage(), psf, medianBg, keepCRs)
+        if modelBg:
+            maskedImage = exposure.getMaskedImage()
+            maskedImage += modelBg.getImageF()
+            exposure0.setMaskedImage(maskedImage)
+
+        mask = exposure0.getMaskedImage().getMask()
+        crBit = mask.getPlaneBitMask("CR")
+        # Cosmic rays split by a seam are one footprint in the stitched mask
+        crs = afwDet.FootprintSet(mask, afwDet.Threshold(crBit, afwDet.Threshold.BITMASK))
+        num = len(crs.getFootprints())
+        self.log.info("Identified %s cosmic rays." % (num,))
+
+    def findCosmicRaysTiled(self, maskedImage, psf, background, keepCRs):
+        """Find, mask and repair the cosmic rays of a MaskedImage in tiles, in place"""
+        global _tileState
+        tiles = makeTiles(maskedImage.getWidth(), maskedImage.getHeight(), self.config.tileSize,
+                          self.config.tileOverlap)
+        policy = pexConfig.makePolicy(self.config.cosmicray)
+        _tileState = (maskedImage, psf, background, policy, keepCRs)
+        try:
+            numProcesses = min(self.config.numProcesses, len(tiles))
+            # Don't fork a pool worker, or a process whose other threads might hold locks
+            if numProcesses > 1 and not multiprocessing.current_process().daemon and \
+                    threading.active_count() == 1:
+                pool = multiprocessing.Pool(numProcesses)
+                try:
+                    results = pool.map(_findTileCosmicRays, tiles, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [_findTileCosmicRays(item) for item in tiles]
+        finally:
+            _tileState = None
+        # Merge once all the tiles are done, so that no tile sees the pixels repaired by another
+        image = maskedImage.getImage().getArray()
+        mask = maskedImage.getMask().getArray()
+        crBit = maskedImage.getMask().getPlaneBitMask("CR")
+        numCrPixels = sum(crMask.sum() for core, crMask, crImage in results)
+        if numCrPixels > self.config.cosmicray.nCrPixelMax:
+            raise pexExcept.LengthError("Too many CR pixels (max %d)" % (self.config.cosmicray.nCrPixelMax,))
+        for core, crMask, crImage in results:
+            mergeTile(image, mask, core, crMask, crImage, crBit)
+        self.log.debug("Found cosmic rays in %d tiles" % (len(tiles),))
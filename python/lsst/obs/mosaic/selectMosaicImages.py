@@ -22,7 +22,6 @@
 #
 from __future__ import print_function
 from builtins import range
-import MySQLdb
 import os
 import re
 
@@ -138,6 +137,9 @@ class SelectMosaicImagesTask(BaseSelectImagesTask):
         if filter not in set(("g", "r", "i", "z", "Y")):
             raise RuntimeError("filter=%r is an invalid name" % (filter,))
 
+        # Imported here, so that loading the configuration of a task does not need MySQLdb
+        import MySQLdb
+
         read_default_file = os.path.expanduser("~/.my.cnf")
 
         try:
@@ -0,0 +1,265 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Export the source catalogs of the CCDs of a visit to one columnar file
+
+src, icSrc, icMatch and srcMatch are written as one FITS table per CCD, so a
+query over a field opens thousands of files.  MosaicSourceExportTask gathers
+the catalogs of the CCDs of a visit into one file, with only the selected
+columns (config.columns for source catalogs, config.matchColumns for the
+packed match catalogs) and a ccdExposureId column, one visit per process
+with -j.
+
+The file is an uncompressed NumPy .npz archive with one array per column:
+np.load reads a column only when it is asked for, so readColumns reads only
+the columns it needs.  The rows of each CCD are contiguous, a row group;
+the _rowGroupIds and _rowGroupOffsets arrays give the ccdExposureId and the
+first row of each group, so readColumns can also read the rows of some CCDs
+only.  mergeColumnFiles concatenates the files of many visits, e.g. of a
+field, keeping their row groups.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import zip
+
+import os
+
+import numpy as np
+
+import lsst.afw.table as afwTable
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+
+__all__ = ["ROW_GROUP_IDS", "ROW_GROUP_OFFSETS", "catalogToColumns", "writeColumns", "getColumnNames",
+           "readColumns", "mergeColumnFiles", "MosaicSourceExportConfig", "MosaicSourceExportTaskRunner",
+           "MosaicSourceExportTask"]
+
+# Names of the arrays with the ccdExposureId and the first row of each row group
+ROW_GROUP_IDS = "_rowGroupIds"
+ROW_GROUP_OFFSETS = "_rowGroupOffsets"
+
+# Types of afw table fields with one value per row
+_SCALAR_TYPES = ("Flag", "B", "U", "I", "L", "F", "D", "Angle")
+
+
+def catalogToColumns(catalog, columns=None):
+    """Return columns of an afw catalog as NumPy arrays
+
+    @param[in] catalog  an lsst.afw.table catalog
+    @param[in] columns  names of the columns, or None for all the fields with one value per row;
+        Angle fields are in radians
+    @return a dict of name: array
+    """
+    if not catalog.isContiguous():
+        catalog = catalog.copy(deep=True)
+    if columns is None:
+        columns = [item.field.getName() for item in catalog.schema
+                   if item.field.getTypeString() in _SCALAR_TYPES]
+    return dict((name, np.array(catalog.get(name))) for name in columns)
+
+
+def _writeNpz(path, arrays):
+    """Write arrays to an uncompressed .npz file, atomically"""
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tempPath = path + ".tmp%d" % (os.getpid(),)
+    with open(tempPath, "wb") as outfile:
+        np.savez(outfile, **arrays)
+    os.rename(tempPath, path)
+
+
+def writeColumns(path, rowGroups):
+    """Write row groups of columns to a columnar file
+
+    @param[in] path  path of the file, ending in .npz
+    @param[in] rowGroups  list of (ccdExposureId, dict of name: array); all the dicts must have the
+        same names
+    @return the number of rows written
+    """
+    if not rowGroups:
+        raise RuntimeError("No row groups to write to %s" % (path,))
+    names = sorted(rowGroups[0][1])
+    for ccdExposureId, columns in rowGroups:
+        if sorted(columns) != names:
+            raise RuntimeError("Columns of row group %s differ: %s != %s" %
+                               (ccdExposureId, sorted(columns), names))
+    numRows = [len(columns[names[0]]) if names else 0 for ccdExposureId, columns in rowGroups]
+    arrays = dict((name, np.concatenate([columns[name] for ccdExposureId, columns in rowGroups]))
+                  for name in names)
+    ids = np.array([ccdExposureId for ccdExposureId, columns in rowGroups], dtype=np.int64)
+    arrays["ccdExposureId"] = np.repeat(ids, numRows)
+    arrays[ROW_GROUP_IDS] = ids
+    arrays[ROW_GROUP_OFFSETS] = np.concatenate([[0], np.cumsum(numRows)]).astype(np.int64)
+    _writeNpz(path, arrays)
+    return int(sum(numRows))
+
+
+def getColumnNames(path):
+    """Return the names of the columns of a columnar file"""
+    with np.load(path) as npz:
+        return [name for name in npz.files if name not in (ROW_GROUP_IDS, ROW_GROUP_OFFSETS)]
+
+
+def readColumns(path, columns=None, ccdExposureIds=None):
+    """Read columns of a columnar file, reading only the arrays of those columns
+
+    @param[in] path  path of the file
+    @param[in] columns  names of the columns, or None for all
+    @param[in] ccdExposureIds  read only the row groups of these CCDs, or None for all
+    @return a dict of name: array
+    """
+    with np.load(path) as npz:
+        if columns is None:
+            columns = [name for name in npz.files if name not in (ROW_GROUP_IDS, ROW_GROUP_OFFSETS)]
+        missing = [name for name in columns if name not in npz.files]
+        if missing:
+            raise RuntimeError("No columns %s in %s" % (missing, path))
+        if ccdExposureIds is None:
+            return dict((name, npz[name]) for name in columns)
+        wanted = set(ccdExposureIds)
+        offsets = npz[ROW_GROUP_OFFSETS]
+        slices = [slice(start, stop)
+                  for ccdExposureId, start, stop in zip(npz[ROW_GROUP_IDS], offsets[:-1], offsets[1:])
+                  if ccdExposureId in wanted]
+        result = {}
+        for name in columns:
+            array = npz[name]
+            result[name] = np.concatenate([array[s] for s in slices]) if slices else array[:0]
+        return result
+
+
+def mergeColumnFiles(paths, outputPath):
+    """Concatenate columnar files with the same columns, e.g. the visits of a field, keeping their row groups
+
+    @return the number of rows written
+    """
+    if not paths:
+        raise RuntimeError("No files to merge into %s" % (outputPath,))
+    names = None
+    arrays = {}
+    ids = []
+    numRows = []
+    for path in paths:
+        with np.load(path) as npz:
+            fileNames = sorted(npz.files)
+            if names is None:
+                names = fileNames
+            elif fileNames != names:
+                raise RuntimeError("Columns of %s differ from those of %s" % (path, paths[0]))
+            for name in names:
+                if name not in (ROW_GROUP_IDS, ROW_GROUP_OFFSETS):
+                    arrays.setdefault(name, []).append(npz[name])
+            ids.append(npz[ROW_GROUP_IDS])
+            numRows.append(np.diff(npz[ROW_GROUP_OFFSETS]))
+    merged = dict((name, np.concatenate(parts)) for name, parts in arrays.items())
+    merged[ROW_GROUP_IDS] = np.concatenate(ids)
+    numRows = np.concatenate(numRows)
+    merged[ROW_GROUP_OFFSETS] = np.concatenate([[0], np.cumsum(numRows)]).astype(np.int64)
+    _writeNpz(outputPath, merged)
+    return int(numRows.sum())
+
+
+class MosaicSourceExportConfig(pexConfig.Config):
+    dataset = pexConfig.Field(dtype=str, default="src",
+                              doc="Catalog dataset to export, e.g. src, icSrc, srcMatch or icMatch")
+    columns = pexConfig.ListField(
+        dtype=str,
+        default=["id", "parent", "coord_ra", "coord_dec", "base_SdssCentroid_x", "base_SdssCentroid_y",
+                 "base_PsfFlux_flux", "base_PsfFlux_fluxSigma", "base_GaussianFlux_flux",
+                 "base_GaussianFlux_fluxSigma", "base_SdssShape_xx", "base_SdssShape_yy", "base_SdssShape_xy",
+                 "base_ClassificationExtendedness_value", "deblend_nChild", "calib_psfUsed",
+                 "base_PixelFlags_flag_saturatedCenter", "base_PixelFlags_flag_interpolatedCenter"],
+        doc="Columns of a source catalog (src, icSrc) to export; empty for all the fields with one "
+            "value per row",
+    )
+    matchColumns = pexConfig.ListField(
+        dtype=str,
+        default=["first", "second", "distance"],
+        doc="Columns of a packed match catalog (a dataset whose name ends with Match, e.g. srcMatch) "
+            "to export: the reference and source IDs and the distance; empty for all the fields with "
+            "one value per row",
+    )
+
+
+class MosaicSourceExportTaskRunner(pipeBase.TaskRunner):
+    """Run MosaicSourceExportTask once per visit, so that -j processes visits in parallel"""
+
+    @staticmethod
+    def getTargetList(parsedCmd, **kwargs):
+        from .visitDriver import groupByVisit
+        return [(dataRefs, kwargs) for key, dataRefs in groupByVisit(parsedCmd.id.refList)]
+
+
+class MosaicSourceExportTask(pipeBase.CmdLineTask):
+    """Export the catalogs of the CCDs of visits to columnar files; see lsst.obs.mosaic.sourceExport
+
+    The file of a visit is written next to the catalog of its first CCD, as
+    <objname>_<dataset>.npz.
+    """
+    ConfigClass = MosaicSourceExportConfig
+    RunnerClass = MosaicSourceExportTaskRunner
+    _DefaultName = "mosaicSourceExport"
+
+    @classmethod
+    def _makeArgumentParser(cls):
+        parser = pipeBase.ArgumentParser(name=cls._DefaultName)
+        parser.add_id_argument("--id", "preprocessed", help="data ID, e.g. --id field=F2 filter=R")
+        return parser
+
+    def getColumns(self):
+        """Return the names of the columns to export from config.dataset, or None for all"""
+        columns = self.config.matchColumns if self.config.dataset.endswith("Match") else self.config.columns
+        return list(columns) or None
+
+    def getOutputPath(self, dataRef):
+        """Return the path of the columnar file of the visit of a data reference"""
+        path = dataRef.get(self.config.dataset + "_filename")[0]
+        return os.path.join(os.path.dirname(path), "%s_%s.npz" % (dataRef.dataId["objname"],
+                                                                  self.config.dataset))
+
+    @pipeBase.timeMethod
+    def run(self, dataRefList):
+        """Export the catalogs of the CCDs of a visit
+
+        @param[in] dataRefList  data references of the CCDs of a visit
+        @return a pipeBase.Struct with path (None if no CCD has a catalog), numCcds and numRows
+        """
+        columns = self.getColumns()
+        rowGroups = []
+        path = None
+        for dataRef in dataRefList:
+            if not dataRef.datasetExists(self.config.dataset):
+                self.log.warn("No %s for %s" % (self.config.dataset, dataRef.dataId))
+                continue
+            if path is None:
+                path = self.getOutputPath(dataRef)
+            catalog = dataRef.get(self.config.dataset, flags=afwTable.SOURCE_IO_NO_FOOTPRINTS, immediate=True)
+            rowGroups.append((dataRef.get("ccdExposureId"), catalogToColumns(catalog, columns)))
+        if not rowGroups:
+            return pipeBase.Struct(path=None, numCcds=0, numRows=0)
+        numRows = writeColumns(path, rowGroups)
+        self.log.info("Wrote %d rows of %d CCDs to %s" % (numRows, len(rowGroups), path))
+        return pipeBase.Struct(path=path, numCcds=len(rowGroups), numRows=numRows)
+
+    def _getMetadataName(self):
+        return None
@@ -0,0 +1,167 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Timing and resource usage of the steps of a task
+
+pipe.base.timeMethod records the resources used by a whole task method.  Here
+each step of a method (reading the input, masking, interpolation, writing the
+output, ...) is measured, and the measurements are added to the task metadata
+under the names <stage>StageWallTime (s), <stage>StageCpuTime (s),
+<stage>StageMaxRssDelta (bytes; the increase of the peak resident set size
+during the stage), and, where /proc/self/io exists, <stage>StageReadBytes and
+<stage>StageWriteBytes (bytes read and written by the process, including
+cached I/O).  A stage run several times for a data reference (e.g. once per
+amplifier) has one value per run.
+
+The metadata are persisted with the task (e.g. as isr_metadata or
+processCcd_metadata), and summarizeStages aggregates them over many data
+references.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import functools
+import re
+import resource
+import sys
+import time
+
+__all__ = ["STAGE_QUANTITIES", "timeStage", "timeStageMethod", "getStageValues", "summarizeStages",
+           "formatStageSummary"]
+
+STAGE_QUANTITIES = ("WallTime", "CpuTime", "MaxRssDelta", "ReadBytes", "WriteBytes")
+
+_stageNameRe = re.compile(r"^(?:.*\.)?(\w+)Stage(%s)$" % ("|".join(STAGE_QUANTITIES),))
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_maxRssUnit = 1 if sys.platform == "darwin" else 1024
+
+
+def _readProcIo():
+    """Return (bytes read, bytes written) by this process, or None if unknown"""
+    try:
+        with open("/proc/self/io") as infile:
+            counters = dict(line.split(":", 1) for line in infile if ":" in line)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def _getUsage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return time.time(), usage.ru_utime + usage.ru_stime, usage.ru_maxrss*_maxRssUnit, _readProcIo()
+
+
+@contextlib.contextmanager
+def timeStage(metadata, stage, log=None):
+    """Measure a stage of a task and add the results to its metadata
+
+    @param[in,out] metadata  task metadata (an lsst.daf.base.PropertySet)
+    @param[in] stage  name of the stage, e.g. "setMask"
+    @param[in] log  if not None, log the wall and CPU time at debug level
+    """
+    startWall, startCpu, startRss, startIo = _getUsage()
+    try:
+        yield
+    finally:
+        endWall, endCpu, endRss, endIo = _getUsage()
+        metadata.add(stage + "StageWallTime", endWall - startWall)
+        metadata.add(stage + "StageCpuTime", endCpu - startCpu)
+        metadata.add(stage + "StageMaxRssDelta", endRss - startRss)
+        if startIo is not None and endIo is not None:
+            metadata.add(stage + "StageReadBytes", endIo[0] - startIo[0])
+            metadata.add(stage + "StageWriteBytes", endIo[1] - startIo[1])
+        if log is not None:
+            log.debug("Stage %s: %.3f s wall, %.3f s CPU" % (stage, endWall - startWall, endCpu - startCpu))
+
+
+def timeStageMethod(stage=None):
+    """Decorator to measure a task method as a stage; see timeStage
+
+    @param[in] stage  name of the stage; the name of the method if None
+    """
+    def decorator(func):
+        name = stage if stage is not None else func.__name__
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with timeStage(self.metadata, name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def getStageValues(metadata):
+    """Extract the stage measurements from task metadata
+
+    @param[in] metadata  metadata of a task or of a task and its subtasks
+        (an lsst.daf.base.PropertySet)
+    @return a dict of (stage, quantity): list of values
+    """
+    values = collections.defaultdict(list)
+    for name in metadata.paramNames(False):
+        match = _stageNameRe.match(name)
+        if match is not None:
+            values[match.groups()].extend(metadata.getArray(name))
+    return values
+
+
+def summarizeStages(metadataList):
+    """Aggregate the stage measurements of many task runs
+
+    @param[in] metadataList  iterable of task metadata
+    @return an OrderedDict of stage: dict with
+        - runs: number of task runs that included the stage
+        - calls: number of times the stage was run
+        - WallTime, CpuTime, ReadBytes, WriteBytes: totals over all calls
+        - MaxRssDelta: the largest increase of peak RSS in a call
+        ordered by decreasing total wall time
+    """
+    summary = collections.defaultdict(lambda: collections.defaultdict(float))
+    for metadata in metadataList:
+        stages = set()
+        for (stage, quantity), values in getStageValues(metadata).items():
+            entry = summary[stage]
+            if quantity == "MaxRssDelta":
+                entry[quantity] = max([entry[quantity]] + list(values))
+            else:
+                entry[quantity] += sum(values)
+            if quantity == "WallTime":
+                entry["calls"] += len(values)
+            stages.add(stage)
+        for stage in stages:
+            summary[stage]["runs"] += 1
+    return collections.OrderedDict(sorted(summary.items(), key=lambda item: -item[1]["WallTime"]))
+
+
+def formatStageSummary(summary):
+    """Format the result of summarizeStages as a table"""
+    lines = ["%-24s %6s %7s %10s %10s %10s %10s %10s %10s" %
+             ("stage", "runs", "calls", "wall(s)", "cpu(s)", "wall/run", "maxRSS(MB)", "read(MB)", "write(MB)")]
+    for stage, entry in summary.items():
+        lines.append("%-24s %6d %7d %10.2f %10.2f %10.4f %10.1f %10.1f %10.1f" %
+                     (stage, entry["runs"], entry["calls"], entry["WallTime"], entry["CpuTime"],
+                      entry["WallTime"]/max(entry["runs"], 1), entry["MaxRssDelta"]/2.0**20,
+                      entry["ReadBytes"]/2.0**20, entry["WriteBytes"]/2.0**20))
+    return "\n".join(lines)
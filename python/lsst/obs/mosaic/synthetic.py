@@ -0,0 +1,402 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Write synthetic Mosaic data repositories
+
+The repositories have the layout of the MosaicMapper policy, so that the
+mapper, the ISR tasks and the ingest code can be exercised (and timed)
+without testdata_mosaic:
+- DLS preprocessed MEFs (one HDU per CCD) with a ZPX Wcs in WAT cards;
+- community pipeline instcal, dqmask and wtmap files sharing an EXPNUM;
+- raw MEFs with overscan columns, and a bias jump on the CCDs whose readout
+  backplane is listed in MosaicIsrConfig.overscanBiasJumpBKP;
+- bad pixel masks ("bpm"), ds9 region files and the matching "masked" images;
+- a registry (registry.sqlite3) with the raw and raw_visit tables.
+
+The images are a flat sky with Gaussian stars and noise; the values only have
+to be plausible, not physical.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import os
+import sqlite3
+
+import numpy as np
+import astropy.io.fits as fits
+
+from . import regionMask
+
+__all__ = ["DATASETS", "CCDNUMS", "BIAS_JUMP_BACKPLANES", "makeVisits", "makeImage", "makePrimaryHeader",
+           "makeCcdHeader", "writePreprocessed", "writeInstcal", "writeRaw", "writeBpm", "writeRegionMask",
+           "writeRegistry", "makeSyntheticRepository"]
+
+DATASETS = ("preprocessed", "instcal", "raw", "bpm", "masked")
+CCDNUMS = tuple(range(1, 9))
+CCD_SHAPE = (4096, 2048)
+PIXEL_SCALE = 0.258/3600.0  # degrees
+RAW_OVERSCAN = 88  # overscan columns at the right of the data section
+
+GAIN = 3.0
+READ_NOISE = 6.3
+SKY_LEVEL = 1000.0
+BIAS_LEVEL = 1500.0
+BIAS_JUMP = 8.0  # ADU, above overscanBiasJumpLocation
+BIAS_JUMP_LOCATION = 2098
+# default of MosaicIsrConfig.overscanBiasJumpBKP; CCD n is read out by backplane MOSAIC_BKP<n>
+BIAS_JUMP_BACKPLANES = ("MOSAIC_BKP3", "MOSAIC_BKP5", "MOSAIC_BKP1", "MOSAIC_BKP4")
+
+RAW_TEMPLATE = "%(date)s/%(filter)s/decam%(visit)07d.fits.fz"
+PREPROCESSED_TEMPLATE = "preprocessed/%(field)s/%(subfield)s/%(filter)s/%(dateObs)s/%(objname)s.fits"
+BPM_TEMPLATE = "masks/%(observatory)s/%(year)s/bpm_%(ccdnum)d.fits"
+MASKED_TEMPLATE = ("masks/manual/%(field)s/%(subfield)s/%(filter)s/%(dateObs)s/"
+                   "%(objname)s_%(ccdnum)d.bpm.fits.fz")
+
+
+def makeVisits(numVisits, field="F2", subfield="p11", filters=("B", "V", "R", "z"), dateObs="2003-01-04",
+               firstVisit=100001, ra=139.04807, dec=30.03947, exposureTime=600.0):
+    """Describe a night of synthetic exposures, cycling through the filters
+
+    @return a list of dicts with the keys of the registry and of the headers
+    """
+    visits = []
+    for i in range(numVisits):
+        mjd = 52643.0 + 0.1 + i*(exposureTime + 60.0)/86400.0
+        seconds = int(round((mjd % 1)*86400))
+        visits.append(dict(
+            visit=firstVisit + i,
+            objname="obj%03d" % (100 + i,),
+            field=field,
+            subfield=subfield,
+            filter=filters[i % len(filters)],
+            dateObs=dateObs,
+            date=dateObs,
+            timeObs="%02d:%02d:%02d" % (seconds//3600, seconds//60 % 60, seconds % 60),
+            mjd=mjd,
+            expTime=exposureTime,
+            ra=ra + 0.01*i,
+            dec=dec + 0.01*i,
+        ))
+    return visits
+
+
+def _sexagesimal(value):
+    sign = "-" if value < 0 else ""
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees)*60)
+    seconds = (value - degrees - minutes/60.0)*3600
+    return "%s%02d:%02d:%05.2f" % (sign, degrees, minutes, seconds)
+
+
+def makePrimaryHeader(visit):
+    """Return the primary header of an exposure, with the cards read by std_preprocessed"""
+    header = fits.Header()
+    header["OBSERVAT"] = "KPNO"
+    header["TELESCOP"] = "KPNO 4.0 meter telescope"
+    header["DETECTOR"] = "Mosaic1.1"
+    header["OBSID"] = "kp4m.%s.%s" % (visit["dateObs"].replace("-", ""), visit["objname"])
+    header["OBJECT"] = visit["objname"]
+    header["EXPNUM"] = visit["visit"]
+    header["FILTER"] = visit["filter"]
+    header["EXPTIME"] = visit["expTime"]
+    header["DARKTIME"] = visit["expTime"] + 1.2
+    header["DATE-OBS"] = "%sT%s" % (visit["dateObs"], visit["timeObs"])
+    header["TIME-OBS"] = visit["timeObs"]
+    header["MJD-OBS"] = visit["mjd"]
+    header["DATE"] = visit["dateObs"]
+    header["RA"] = _sexagesimal(visit["ra"]/15.0)
+    header["DEC"] = _sexagesimal(visit["dec"])
+    header["TELRA"] = header["RA"]
+    header["TELDEC"] = header["DEC"]
+    header["ZD"] = 30.0
+    header["AIRMASS"] = 1.155
+    header["READTIME"] = 100.0
+    header["NEXTEND"] = len(CCDNUMS)
+    return header
+
+
+def _ccdPosition(ccdnum):
+    """Column and row of a CCD in the 4x2 mosaic; E1-E4 on the first row"""
+    return (ccdnum - 1) % 4, (ccdnum - 1)//4
+
+
+def makeCcdHeader(visit, ccdnum, shape=CCD_SHAPE):
+    """Return the header of the HDU of one CCD, with a DLS-like ZPX Wcs
+
+    The reference pixel is the center of the mosaic, so the CCDs tile the sky.
+    """
+    height, width = shape
+    column, row = _ccdPosition(ccdnum)
+    header = fits.Header()
+    header["EXTNAME"] = "im%d" % (ccdnum,)
+    header["CCDNUM"] = ccdnum
+    header["CCDNAME"] = ("E%d" if ccdnum <= 4 else "W%d") % (ccdnum,)
+    header["FPA"] = "MOSAIC_BKP%d" % (ccdnum,)
+    header["GAIN"] = GAIN
+    header["RDNOISE"] = READ_NOISE
+    header["OBJECT"] = visit["objname"]
+    header["FILTER"] = visit["filter"]
+    header["EXPTIME"] = visit["expTime"]
+    header["CTYPE1"] = "RA---ZPX"
+    header["CTYPE2"] = "DEC--ZPX"
+    header["CRVAL1"] = visit["ra"]
+    header["CRVAL2"] = visit["dec"]
+    header["CRPIX1"] = 2*width - column*width + 0.5
+    header["CRPIX2"] = height - row*height + 0.5
+    header["CD1_1"] = -PIXEL_SCALE
+    header["CD1_2"] = 0.0
+    header["CD2_1"] = 0.0
+    header["CD2_2"] = PIXEL_SCALE
+    wats = {1: 'wtype=zpx axtype=ra projp1=1. projp3=220. '
+               'lngcor = "3. 3. 3. 2. -0.3 0.3 -0.6 0.6 1e-4 2e-5 -3e-5 4e-6 5e-6 7e-6"',
+            2: 'wtype=zpx axtype=dec projp1=1. projp3=220. '
+               'latcor = "3. 3. 3. 2. -0.3 0.3 -0.6 0.6 -1e-4 2e-5 3e-5 4e-6 -5e-6 7e-6"'}
+    for axis, wat in sorted(wats.items()):
+        for i in range(0, len(wat), 68):
+            header["WAT%d_%03d" % (axis, i//68 + 1)] = wat[i:i + 68]
+    return header
+
+
+def makeImage(rng, shape=CCD_SHAPE, sky=SKY_LEVEL, numStars=200, sigma=1.5):
+    """Make a float32 image of sky, Gaussian stars and Poisson-like noise"""
+    image = np.full(shape, sky, dtype=np.float32)
+    half = int(math.ceil(4*sigma))
+    offsets = np.arange(-half, half + 1)
+    yStars = rng.uniform(half, shape[0] - half - 1, numStars)
+    xStars = rng.uniform(half, shape[1] - half - 1, numStars)
+    fluxes = 10**rng.uniform(3, 6, numStars)
+    for x, y, flux in zip(xStars, yStars, fluxes):
+        x0, y0 = int(x), int(y)
+        dx = (x0 + offsets - x)[np.newaxis, :]
+        dy = (y0 + offsets - y)[:, np.newaxis]
+        stamp = flux/(2*math.pi*sigma**2)*np.exp(-0.5*(dx**2 + dy**2)/sigma**2)
+        image[y0 - half:y0 + half + 1, x0 - half:x0 + half + 1] += stamp
+    image += rng.normal(0.0, 1.0, shape).astype(np.float32)*np.sqrt(image/GAIN + (READ_NOISE/GAIN)**2)
+    return image
+
+
+def _makeDirs(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+
+def writePreprocessed(root, visit, rng, ccdnums=CCDNUMS, shape=CCD_SHAPE):
+    """Write a DLS preprocessed MEF with one HDU per CCD, in HDU ccdnum
+
+    @return the path of the file
+    """
+    path = os.path.join(root, PREPROCESSED_TEMPLATE % visit)
+    _makeDirs(path)
+    hdus = [fits.PrimaryHDU(header=makePrimaryHeader(visit))]
+    for ccdnum in CCDNUMS:
+        if ccdnum in ccdnums:
+            image = makeImage(rng, shape) - SKY_LEVEL
+        else:
+            image = np.zeros((1, 1), dtype=np.float32)
+        hdus.append(fits.ImageHDU(image, header=makeCcdHeader(visit, ccdnum, shape)))
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+    return path
+
+
+def writeInstcal(root, visit, rng, ccdnums=CCDNUMS, shape=CCD_SHAPE):
+    """Write community pipeline instcal, dqmask and wtmap files sharing the EXPNUM of the visit
+
+    The files are in the instcal/, dqmask/ and wtmap/ directories expected by MosaicIngestTask.
+
+    @return a dict of file type: path
+    """
+    name = "k4m_%s_%s" % (visit["dateObs"].replace("-", ""), visit["objname"])
+    paths = {}
+    hduLists = dict((fileType, [fits.PrimaryHDU(header=makePrimaryHeader(visit))])
+                    for fileType in ("instcal", "dqmask", "wtmap"))
+    for ccdnum in ccdnums:
+        header = makeCcdHeader(visit, ccdnum, shape)
+        image = makeImage(rng, shape)
+        dqmask = np.zeros(shape, dtype=np.int16)
+        dqmask[:, int(shape[1]*0.3)] = 1  # a bad column
+        dqmask[image > 30000] = 4  # saturated
+        weight = (1.0/(image/GAIN + (READ_NOISE/GAIN)**2)).astype(np.float32)
+        weight[dqmask != 0] = 0.0
+        hduLists["instcal"].append(fits.ImageHDU(image, header=header))
+        hduLists["dqmask"].append(fits.CompImageHDU(dqmask, header=header))
+        hduLists["wtmap"].append(fits.ImageHDU(weight, header=header))
+    suffixes = dict(instcal="ooi", dqmask="ood", wtmap="oow")
+    for fileType, hdus in hduLists.items():
+        path = os.path.join(root, fileType, "%s_%s.fits" % (name, suffixes[fileType]))
+        _makeDirs(path)
+        fits.HDUList(hdus).writeto(path, overwrite=True)
+        paths[fileType] = path
+    return paths
+
+
+def writeRaw(root, visit, rng, ccdnums=CCDNUMS, shape=CCD_SHAPE, biasJumpBackplanes=BIAS_JUMP_BACKPLANES,
+             biasJumpLocation=BIAS_JUMP_LOCATION):
+    """Write a tile-compressed raw MEF, with the data of CCD ccdnum in HDU ccdnum
+
+    Each CCD has RAW_OVERSCAN overscan columns at the right of the data.  The
+    CCDs on the backplanes listed in biasJumpBackplanes have a bias jump of
+    BIAS_JUMP ADU in the rows from biasJumpLocation up, in both the data and
+    the overscan.
+
+    @return the path of the file
+    """
+    path = os.path.join(root, RAW_TEMPLATE % visit)
+    _makeDirs(path)
+    height, width = shape
+    hdus = [fits.PrimaryHDU(header=makePrimaryHeader(visit))]
+    for ccdnum in CCDNUMS:
+        header = makeCcdHeader(visit, ccdnum, shape)
+        if ccdnum not in ccdnums:
+            hdus.append(fits.ImageHDU(np.zeros((1, 1), dtype=np.uint16), header=header))
+            continue
+        raw = np.empty((height, width + RAW_OVERSCAN), dtype=np.float32)
+        raw[:, :width] = makeImage(rng, shape)/(1.0 + 1e-6*np.arange(width))  # a small nonlinearity
+        raw[:, width:] = rng.normal(0.0, READ_NOISE/GAIN, (height, RAW_OVERSCAN))
+        raw += BIAS_LEVEL
+        if header["FPA"] in biasJumpBackplanes:
+            raw[biasJumpLocation:, :] += BIAS_JUMP
+        header["DATASEC"] = "[1:%d,1:%d]" % (width, height)
+        header["BIASSEC"] = "[%d:%d,1:%d]" % (width + 1, width + RAW_OVERSCAN, height)
+        header["SATURATE"] = 38652.0
+        data = np.clip(np.rint(raw), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+        hdus.append(fits.CompImageHDU(data, header=header, compression_type="RICE_1"))
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+    return path
+
+
+def writeBpm(root, ccdnum, year, rng, shape=CCD_SHAPE, observatory="kpno"):
+    """Write a bad pixel mask: 1 for good pixels, 0 for bad columns and hot pixels
+
+    @return the path of the file
+    """
+    path = os.path.join(root, BPM_TEMPLATE % dict(observatory=observatory, year=year, ccdnum=ccdnum))
+    _makeDirs(path)
+    bpm = np.ones(shape, dtype=np.uint16)
+    for column in rng.randint(0, shape[1], 3):
+        bpm[rng.randint(0, shape[0]//2):, column] = 0
+    bpm[rng.randint(0, shape[0], 50), rng.randint(0, shape[1], 50)] = 0
+    fits.writeto(path, bpm, overwrite=True)
+    return path
+
+
+def writeRegionMask(root, visit, ccdnum, rng, bpmPath=None, shape=CCD_SHAPE):
+    """Write a ds9 region file (under root/regions) and the corresponding "masked" image
+
+    @return (region file path, masked image path)
+    """
+    dataId = dict(visit, ccdnum=ccdnum)
+    regionPath = os.path.join(root, "regions", regionMask.REGION_TEMPLATE % dataId)
+    _makeDirs(regionPath)
+    height, width = shape
+    y0, y1 = sorted(rng.uniform(0, height, 2))
+    with open(regionPath, "w") as outfile:
+        outfile.write("# Region file format: DS9 version 4.1\n")
+        outfile.write('global color=green font="helvetica 10 normal roman"\n')
+        outfile.write("image\n")
+        # a satellite trail and a ghost
+        outfile.write("polygon(1,%.1f,%.1f,%.1f,%.1f,%.1f,1,%.1f) # text={trail}\n" %
+                      (y0, width, y1, width, y1 + 20, y0 + 20))
+        outfile.write("circle(%.1f,%.1f,%.1f)\n" %
+                      (rng.uniform(0, width), rng.uniform(0, height), rng.uniform(20, 200)))
+    maskedPath = os.path.join(root, MASKED_TEMPLATE % dataId)
+    regionMask.writeRegionMask((regionPath, bpmPath, shape, maskedPath))
+    return regionPath, maskedPath
+
+
+def writeRegistry(root, rows):
+    """Write registry.sqlite3 with the raw and raw_visit tables, and the _mapper file
+
+    @param[in] root  root of the repository
+    @param[in] rows  list of dicts with the keys of the raw table
+    """
+    columns = [("visit", "int"), ("ccdnum", "int"), ("ccd", "int"), ("hdu", "int"), ("filter", "text"),
+               ("date", "text"), ("taiObs", "text"), ("expTime", "double"), ("field", "text"),
+               ("subfield", "text"), ("dateObs", "text"), ("objname", "text"), ("instcal", "text"),
+               ("dqmask", "text"), ("wtmap", "text")]
+    path = os.path.join(root, "registry.sqlite3")
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("CREATE TABLE raw (id INTEGER PRIMARY KEY AUTOINCREMENT, %s, UNIQUE(visit, ccdnum))" %
+                     (", ".join("%s %s" % column for column in columns),))
+        conn.execute("CREATE TABLE raw_visit (visit INT, filter TEXT, date TEXT, UNIQUE(visit))")
+        names = [name for name, dtype in columns]
+        conn.executemany("INSERT INTO raw (%s) VALUES (%s)" % (", ".join(names), ", ".join("?"*len(names))),
+                         [[row.get(name) for name in names] for row in rows])
+        conn.execute("INSERT INTO raw_visit SELECT DISTINCT visit, filter, date FROM raw")
+        conn.commit()
+    finally:
+        conn.close()
+    with open(os.path.join(root, "_mapper"), "w") as outfile:
+        outfile.write("lsst.obs.mosaic.MosaicMapper\n")
+
+
+def makeSyntheticRepository(root, numVisits=2, ccdnums=CCDNUMS, shape=CCD_SHAPE, datasets=DATASETS, seed=1,
+                            **kwargs):
+    """Write a synthetic Mosaic repository
+
+    @param[in] root  root of the repository; created if needed
+    @param[in] numVisits  number of exposures
+    @param[in] ccdnums  CCDs to write
+    @param[in] shape  (height, width) of the CCDs; smaller than CCD_SHAPE for quick tests
+        (the camera geometry is always that of full-size CCDs)
+    @param[in] datasets  which of DATASETS to write
+    @param[in] seed  random number seed
+    @param[in] kwargs  passed to makeVisits
+    @return the registry rows, one dict per CCD exposure
+    """
+    unknown = set(datasets) - set(DATASETS)
+    if unknown:
+        raise RuntimeError("Unknown synthetic datasets %s; must be in %s" % (sorted(unknown), DATASETS))
+    rng = np.random.RandomState(seed)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    rows = []
+    bpmPaths = {}
+    for visit in makeVisits(numVisits, **kwargs):
+        if "bpm" in datasets:
+            year = visit["dateObs"][0:4]
+            for ccdnum in ccdnums:
+                if (year, ccdnum) not in bpmPaths:
+                    bpmPaths[(year, ccdnum)] = writeBpm(root, ccdnum, year, rng, shape)
+        if "preprocessed" in datasets:
+            writePreprocessed(root, visit, rng, ccdnums, shape)
+        instcalPaths = writeInstcal(root, visit, rng, ccdnums, shape) if "instcal" in datasets else {}
+        if "raw" in datasets:
+            writeRaw(root, visit, rng, ccdnums, shape)
+        for ccdnum in ccdnums:
+            if "masked" in datasets:
+                bpmPath = bpmPaths.get((visit["dateObs"][0:4], ccdnum))
+                writeRegionMask(root, visit, ccdnum, rng, bpmPath, shape)
+            row = dict((key, visit[key]) for key in ("visit", "filter", "date", "expTime", "field",
+                                                     "subfield", "dateObs", "objname"))
+            row.update(ccdnum=ccdnum, ccd=ccdnum, hdu=ccdnum,
+                       taiObs="%sT%s" % (visit["dateObs"], visit["timeObs"]))
+            for fileType, path in instcalPaths.items():
+                row[fileType] = os.path.relpath(path, root)
+            rows.append(row)
+    writeRegistry(root, rows)
+    return rows
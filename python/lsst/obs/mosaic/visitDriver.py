@@ -0,0 +1,566 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Process the CCDs of DLS preprocessed visits in parallel, reading each file once
+
+processCcd.py reads a preprocessed MEF file once per CCD: the butler opens the
+file for the HDU of the CCD, and std_preprocessed opens it again for the
+primary header.  MosaicVisitDriverTask reads the file of a visit once, copies
+the pixels of its CCD HDUs into a buffer in shared memory (a file in
+/dev/shm), removes the crosstalk between its CCDs in the buffer (if
+config.doCrosstalk), and sends one job per CCD to a pool of worker
+processes.  Each worker maps its CCD from the buffer, standardizes it with
+MosaicMapper.standardizePreprocessed, and runs MosaicPreprocessedIsrTask and
+CharacterizeImageTask on it.  The results of the CCDs of a visit are gathered
+when they are all done, and the buffer is removed.
+
+While the workers process a visit, the next visits are read, but no more than
+config.maxVisitsInMemory visits are held in buffers at once: the driver waits
+for the oldest visit before reading another.
+
+With config.doFringe or config.doFocalPlaneBackground, the CCDs of a visit
+are processed in two passes, as the fringe amplitudes (see
+MosaicFringeTask.runVisit) and the background model (see
+MosaicFocalPlaneBackgroundTask) are fitted to all of them at once.  The first
+pass standardizes, ISRs and writes each CCD as postISRCCD, and measures its
+fringes and binned background; the driver then removes the buffer, fits the
+measurements of the visit, and sends a second job per CCD, which reads the
+postISRCCD back, subtracts the fringes (writing it again) and the background
+model, and characterizes it.  The background model is the initial background
+of CharacterizeImageTask, so it is persisted in icExpBackground.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+
+import collections
+import os
+import re
+import tempfile
+import time
+import multiprocessing
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+from lsst.pipe.tasks.characterizeImage import CharacterizeImageTask
+
+from .crosstalk import MosaicCrosstalkTask, getReadoutFlip
+from .focalPlaneBackground import MosaicFocalPlaneBackgroundTask
+from .fringe import MosaicFringeTask
+from .mosaicPreprocessedIsr import MosaicPreprocessedIsrTask, readMasks
+from .quicklook import writeCcdQuicklook
+from .stageTimer import timeStage
+
+__all__ = ["VISIT_KEYS", "VisitBuffer", "groupByVisit", "MosaicVisitDriverConfig",
+           "MosaicVisitDriverTaskRunner", "MosaicVisitDriverTask"]
+
+# Keys of a data ID that identify the preprocessed file of a visit
+VISIT_KEYS = ("field", "subfield", "filter", "dateObs", "objname")
+
+# Header cards that describe the layout of the data, not the image
+_STRUCTURAL_CARDS = re.compile(r"^(SIMPLE|XTENSION|BITPIX|NAXIS\d*|EXTEND|PCOUNT|GCOUNT|BSCALE|BZERO|"
+                               r"CHECKSUM|DATASUM|COMMENT|HISTORY|)$")
+
+
+def _getCards(header):
+    """Return the cards of a FITS header as a list of (keyword, value), without structural cards"""
+    return [(card.keyword, card.value) for card in header.cards
+            if not _STRUCTURAL_CARDS.match(card.keyword)]
+
+
+class VisitBuffer(object):
+    """The pixels and headers of the CCD HDUs of a preprocessed MEF file, in a shared buffer
+
+    The images are stored one after the other as float32 in a file, by
+    default in /dev/shm, which other processes map with getArray.
+
+    @param[in] path  path of the MEF file (without an HDU suffix)
+    @param[in] ccdnums  CCDs to read; the image of CCD n is in HDU n
+    @param[in] directory  directory of the buffer; if None or missing, the default temporary directory
+    """
+
+    def __init__(self, path, ccdnums, directory="/dev/shm"):
+        if directory is not None and not os.path.isdir(directory):
+            directory = None
+        self.path = path
+        self.layout = collections.OrderedDict()
+        with fits.open(path, memmap=False) as hduList:
+            self.primaryHeader = collections.OrderedDict(_getCards(hduList[0].header))
+            self.nbytes = 0
+            for ccdnum in ccdnums:
+                hdu = hduList[ccdnum]
+                self.layout[ccdnum] = (self.nbytes, hdu.data.shape, _getCards(hdu.header))
+                self.nbytes += hdu.data.size*np.dtype(np.float32).itemsize
+            fd, self.bufferPath = tempfile.mkstemp(prefix="mosaicVisit", suffix=".buf", dir=directory)
+            os.close(fd)
+            try:
+                buf = np.memmap(self.bufferPath, dtype=np.float32, mode="w+", shape=(max(self.nbytes//4, 1),))
+                for ccdnum, (offset, shape, cards) in self.layout.items():
+                    start = offset//4
+                    buf[start:start + int(np.prod(shape))] = hduList[ccdnum].data.ravel()
+                buf.flush()
+                del buf
+            except Exception:
+                self.close()
+                raise
+
+    def getArray(self, ccdnum, writable=False):
+        """Return the image of a CCD, mapped from the buffer, read-only unless writable"""
+        offset, shape, cards = self.layout[ccdnum]
+        return _mapArray(self.bufferPath, offset, shape, mode="r+" if writable else "r")
+
+    def getCard(self, ccdnum, keyword, default=None):
+        """Return the value of a header card of the HDU of a CCD, or default if it has none"""
+        offset, shape, cards = self.layout[ccdnum]
+        return dict(cards).get(keyword, default)
+
+    def getJob(self, ccdnum, dataId):
+        """Return the arguments of a worker job for a CCD; see _processCcd"""
+        offset, shape, cards = self.layout[ccdnum]
+        return (self.bufferPath, offset, shape, cards, self.primaryHeader, dict(dataId))
+
+    def close(self):
+        """Remove the buffer"""
+        if os.path.exists(self.bufferPath):
+            os.remove(self.bufferPath)
+
+
+def _mapArray(bufferPath, offset, shape, mode="r"):
+    return np.memmap(bufferPath, dtype=np.float32, mode=mode, offset=offset, shape=tuple(shape))
+
+
+def groupByVisit(dataRefList):
+    """Group data references by the preprocessed file of their visit
+
+    @param[in] dataRefList  list of data references with the keys VISIT_KEYS and ccdnum
+    @return a list of (visit key, list of data references sorted by ccdnum), in the order of the
+        first data reference of each visit
+    """
+    visits = collections.OrderedDict()
+    for dataRef in dataRefList:
+        key = tuple(dataRef.dataId[name] for name in VISIT_KEYS)
+        visits.setdefault(key, []).append(dataRef)
+    return [(key, sorted(dataRefs, key=lambda dataRef: dataRef.dataId["ccdnum"]))
+            for key, dataRefs in visits.items()]
+
+
+# State of a worker process, set by _initWorker
+_worker = None
+
+
+def _initWorker(butler, inputRoot, config):
+    """Create the mapper and tasks of a worker process"""
+    global _worker
+    from .mosaicMapper import MosaicMapper
+    _worker = pipeBase.Struct(
+        butler=butler,
+        mapper=MosaicMapper(root=inputRoot),
+        config=config,
+        isr=config.isr.apply(name="isr"),
+        charImage=config.charImage.apply(name="charImage") if config.doCharacterize else None,
+        fringe=config.fringe.apply(name="fringe") if config.doFringe else None,
+        focalPlaneBackground=(config.focalPlaneBackground.apply(name="focalPlaneBackground")
+                              if config.doFocalPlaneBackground else None),
+    )
+
+
+def _isrCcd(job, result, doQuicklook=True):
+    """Standardize, ISR and write a CCD from a VisitBuffer
+
+    @param[in] job  the result of VisitBuffer.getJob
+    @param[in,out] result  dict of the results of the CCD, to which the wall time of each step is added
+    @param[in] doQuicklook  write the quicklook image if isr.doWriteQuicklook?
+    @return (data reference, exposure)
+    """
+    bufferPath, offset, shape, cards, primaryHeader, dataId = job
+    start = time.time()
+    image = afwImage.makeImageFromArray(np.array(_mapArray(bufferPath, offset, shape)))
+    metadata = dafBase.PropertyList()
+    for keyword, value in cards:
+        metadata.set(keyword, value)
+    item = afwImage.DecoratedImageF(image)
+    item.setMetadata(metadata)
+    exposure = _worker.mapper.standardizePreprocessed(item, dataId, primaryHeader)
+    dataRef = _worker.butler.dataRef("preprocessed", dataId=dataId)
+    result["standardizeTime"] = time.time() - start
+
+    start = time.time()
+    bpm, masked = readMasks(_worker.butler, dataId, exposure)
+    _worker.isr.run(exposure, dataId, bpm=bpm, masked=masked)
+    if _worker.isr.config.doWrite:
+        dataRef.put(exposure, "postISRCCD")
+    if doQuicklook and _worker.isr.config.doWriteQuicklook:
+        writeCcdQuicklook(dataRef, exposure, _worker.isr.config.quicklookBinSize)
+    result["isrTime"] = time.time() - start
+    return dataRef, exposure
+
+
+def _characterizeCcd(dataRef, exposure, result, background=None):
+    """Characterize a CCD, if config.doCharacterize, adding the results to the dict of the CCD
+
+    @param[in] background  lsst.afw.math.BackgroundList already subtracted from the exposure, or None
+    """
+    if _worker.charImage is None:
+        if background is not None:
+            dataRef.put(background, "icExpBackground")
+        return
+    start = time.time()
+    charRes = _worker.charImage.run(dataRef, exposure=exposure, background=background, doUnpersist=False)
+    result["numSources"] = len(charRes.sourceCat)
+    result["psfSigma"] = charRes.exposure.getPsf().computeShape().getDeterminantRadius()
+    result["charImageTime"] = time.time() - start
+
+
+def _readFringes(dataRef):
+    """Return the list of fringe frames of a CCD"""
+    fringes = _worker.fringe.readFringes(dataRef).fringes
+    return fringes if hasattr(fringes, '__iter__') else [fringes]
+
+
+def _processCcd(job):
+    """Standardize, ISR and characterize a CCD from a VisitBuffer
+
+    @param[in] job  the result of VisitBuffer.getJob
+    @return a dict with the data ID, the wall time of each step, the number of
+        sources and the PSF width (-1 if not characterized), and the error
+        message (None on success)
+    """
+    result = dict(dataId=job[-1], numSources=-1, psfSigma=-1.0, error=None)
+    try:
+        dataRef, exposure = _isrCcd(job, result)
+        _characterizeCcd(dataRef, exposure, result)
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    return result
+
+
+def _measureCcd(job):
+    """Standardize, ISR and write a CCD from a VisitBuffer, and measure its fringes and background
+
+    The first pass over the CCDs of a visit, with config.doFringe or config.doFocalPlaneBackground.
+
+    @param[in] job  the result of VisitBuffer.getJob
+    @return the dict of _processCcd, with fringeMeasurement: the science and
+        fluxes arrays of MosaicFringeTask.measure, or None if the filter is not
+        fringe-corrected or not config.doFringe, and backgroundMeasurement:
+        the result of MosaicFocalPlaneBackgroundTask.measureExposure, or None
+        if not config.doFocalPlaneBackground
+    """
+    result = dict(dataId=job[-1], numSources=-1, psfSigma=-1.0, error=None, fringeMeasurement=None,
+                  backgroundMeasurement=None)
+    try:
+        dataRef, exposure = _isrCcd(job, result, doQuicklook=False)
+        if _worker.fringe is not None and _worker.fringe.checkFilter(exposure):
+            start = time.time()
+            measurement = _worker.fringe.measure(exposure, _readFringes(dataRef))
+            result["fringeMeasurement"] = (measurement.science, measurement.fluxes)
+            result["fringeMeasureTime"] = time.time() - start
+        if _worker.focalPlaneBackground is not None:
+            start = time.time()
+            result["backgroundMeasurement"] = \
+                _worker.focalPlaneBackground.measureExposure(result["dataId"]["ccdnum"], exposure)
+            result["backgroundMeasureTime"] = time.time() - start
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    return result
+
+
+def _finishCcd(args):
+    """Subtract the fringes and background from a CCD written by _measureCcd, and characterize it
+
+    The second pass over the CCDs of a visit, with config.doFringe or config.doFocalPlaneBackground.
+
+    @param[in] args  (dict returned by _measureCcd, fringe amplitudes of the visit or None,
+        FocalPlaneBackground of the visit or None)
+    @return the dict of _processCcd
+    """
+    result, fringeSolution, backgroundModel = args
+    result = dict(result)
+    del result["fringeMeasurement"]
+    del result["backgroundMeasurement"]
+    if result["error"] is not None:
+        return result
+    try:
+        dataRef = _worker.butler.dataRef("preprocessed", dataId=result["dataId"])
+        exposure = dataRef.get("postISRCCD", immediate=True)
+        if fringeSolution is not None:
+            start = time.time()
+            _worker.fringe.subtract(exposure, _readFringes(dataRef), fringeSolution)
+            dataRef.put(exposure, "postISRCCD")
+            result["fringeTime"] = time.time() - start
+        if _worker.isr.config.doWriteQuicklook:
+            writeCcdQuicklook(dataRef, exposure, _worker.isr.config.quicklookBinSize)
+        background = None
+        if backgroundModel is not None:
+            start = time.time()
+            background = _worker.focalPlaneBackground.makeBackground(result["dataId"]["ccdnum"],
+                                                                     backgroundModel, exposure.getBBox())
+            image = exposure.getMaskedImage().getImage()
+            image.getArray()[:] -= background.getImage().getArray()
+            result["backgroundTime"] = time.time() - start
+        _characterizeCcd(dataRef, exposure, result, background)
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    return result
+
+
+class MosaicVisitDriverConfig(pexConfig.Config):
+    isr = pexConfig.ConfigurableField(
+        target=MosaicPreprocessedIsrTask,
+        doc="Mask, interpolate and set the variance of the preprocessed CCDs",
+    )
+    charImage = pexConfig.ConfigurableField(
+        target=CharacterizeImageTask,
+        doc="Characterize the CCDs",
+    )
+    doCharacterize = pexConfig.Field(
+        dtype=bool,
+        doc="Run charImage on the CCDs after ISR?",
+        default=True,
+    )
+    crosstalk = pexConfig.ConfigurableField(
+        target=MosaicCrosstalkTask,
+        doc="Remove the crosstalk between the CCDs of a visit",
+    )
+    doCrosstalk = pexConfig.Field(
+        dtype=bool,
+        doc="Remove the crosstalk between the CCDs of each visit, in its buffer, before processing them?",
+        default=False,
+    )
+    fringe = pexConfig.ConfigurableField(
+        target=MosaicFringeTask,
+        doc="Fit fringe amplitudes to the CCDs of a visit and subtract the fringes",
+    )
+    doFringe = pexConfig.Field(
+        dtype=bool,
+        doc="Fit one set of fringe amplitudes to the CCDs of each visit, and subtract the fringes? "
+            "The CCDs are then processed in two passes, and read back from postISRCCD, "
+            "which requires isr.doWrite",
+        default=False,
+    )
+    focalPlaneBackground = pexConfig.ConfigurableField(
+        target=MosaicFocalPlaneBackgroundTask,
+        doc="Fit one background model across the CCDs of a visit",
+    )
+    doFocalPlaneBackground = pexConfig.Field(
+        dtype=bool,
+        doc="Fit one background model across the CCDs of each visit, and subtract it before charImage? "
+            "The CCDs are then processed in two passes, and read back from postISRCCD, "
+            "which requires isr.doWrite",
+        default=False,
+    )
+    numProcesses = pexConfig.Field(
+        dtype=int,
+        doc="Number of worker processes",
+        default=8,
+    )
+    maxVisitsInMemory = pexConfig.Field(
+        dtype=int,
+        doc="Maximum number of visits held in shared buffers at once; "
+            "the driver waits for the oldest visit before reading another",
+        default=2,
+    )
+    bufferDir = pexConfig.Field(
+        dtype=str,
+        doc="Directory of the shared buffers; the default temporary directory is used if it does not exist",
+        default="/dev/shm",
+    )
+
+    def validate(self):
+        pexConfig.Config.validate(self)
+        if self.numProcesses < 1:
+            raise ValueError("numProcesses=%d must be at least 1" % (self.numProcesses,))
+        if self.maxVisitsInMemory < 1:
+            raise ValueError("maxVisitsInMemory=%d must be at least 1" % (self.maxVisitsInMemory,))
+        if self.isTwoPass() and not self.isr.doWrite:
+            raise ValueError("doFringe and doFocalPlaneBackground require isr.doWrite, "
+                             "to read the CCDs back for the second pass")
+
+    def isTwoPass(self):
+        """Are the CCDs of a visit processed in two passes, to fit the visit between them?"""
+        return self.doFringe or self.doFocalPlaneBackground
+
+
+class MosaicVisitDriverTaskRunner(pipeBase.TaskRunner):
+    """Run MosaicVisitDriverTask once on all the visits; it does its own multiprocessing"""
+
+    @staticmethod
+    def getTargetList(parsedCmd, **kwargs):
+        return [(groupByVisit(parsedCmd.id.refList), dict(inputRoot=parsedCmd.input, **kwargs))]
+
+
+class MosaicVisitDriverTask(pipeBase.CmdLineTask):
+    """Run MosaicPreprocessedIsrTask and CharacterizeImageTask on preprocessed visits
+
+    Each preprocessed file is read once into a VisitBuffer, its CCDs are
+    processed by a pool of config.numProcesses workers, and at most
+    config.maxVisitsInMemory visits are buffered at once.  With
+    config.doFringe or config.doFocalPlaneBackground, the fringes or the
+    background are fitted to each visit between two passes over its CCDs; see
+    the documentation of lsst.obs.mosaic.visitDriver.
+    """
+    ConfigClass = MosaicVisitDriverConfig
+    RunnerClass = MosaicVisitDriverTaskRunner
+    _DefaultName = "mosaicVisitDriver"
+    canMultiprocess = False
+
+    def __init__(self, *args, **kwargs):
+        pipeBase.CmdLineTask.__init__(self, *args, **kwargs)
+        self.makeSubtask("isr")
+        # Only for the icSrc schema; the workers make their own
+        self.makeSubtask("charImage")
+        self.makeSubtask("crosstalk")
+        # Fit the fringe amplitudes and backgrounds of the visits; the workers measure and subtract
+        self.makeSubtask("fringe")
+        self.makeSubtask("focalPlaneBackground")
+
+    @classmethod
+    def _makeArgumentParser(cls):
+        parser = pipeBase.ArgumentParser(name=cls._DefaultName)
+        parser.add_id_argument("--id", "preprocessed", help="data ID, e.g. --id objname=obj330 ccdnum=1..8")
+        return parser
+
+    @pipeBase.timeMethod
+    def run(self, visits, inputRoot):
+        """Process visits
+
+        @param[in] visits  list of (visit key, list of data references), as returned by groupByVisit
+        @param[in] inputRoot  root of the input repository, used by the mapper of each worker
+        @return a pipeBase.Struct with field visits: a list of pipeBase.Struct, one per
+            visit, with fields key (the visit key), ccds (a list of the dicts
+            returned by _processCcd), fringeSolution (the fringe amplitudes
+            of the visit, or None) and backgroundModel (the FocalPlaneBackground
+            of the visit, or None)
+        """
+        if not visits:
+            return pipeBase.Struct(visits=[])
+        butler = visits[0][1][0].getButler()
+        pool = multiprocessing.Pool(self.config.numProcesses, _initWorker, (butler, inputRoot, self.config))
+        pending = collections.deque()
+        results = []
+        try:
+            for key, dataRefs in visits:
+                while len(pending) >= self.config.maxVisitsInMemory:
+                    results.append(self._gather(pool, *pending.popleft()))
+                pending.append(self._scatter(pool, key, dataRefs))
+            while pending:
+                results.append(self._gather(pool, *pending.popleft()))
+            pool.close()
+        except Exception:
+            pool.terminate()
+            raise
+        finally:
+            for key, buf, asyncResults in pending:
+                buf.close()
+            pool.join()
+        return pipeBase.Struct(visits=results)
+
+    def _scatter(self, pool, key, dataRefs):
+        """Read the file of a visit and submit one job per CCD
+
+        @return (key, VisitBuffer, list of multiprocessing.pool.AsyncResult)
+        """
+        filename = dataRefs[0].get("preprocessed_filename")[0]
+        path = re.sub(r"\[\d+\]$", "", filename)
+        with timeStage(self.metadata, "readVisit", self.log):
+            buf = VisitBuffer(path, [dataRef.dataId["ccdnum"] for dataRef in dataRefs],
+                              directory=self.config.bufferDir)
+        self.log.info("Read %d CCDs (%.1f MB) of %s" % (len(dataRefs), buf.nbytes/2.0**20, path))
+        if self.config.doCrosstalk:
+            with timeStage(self.metadata, "crosstalk", self.log):
+                try:
+                    self.correctCrosstalk(buf, dataRefs)
+                except Exception:
+                    buf.close()
+                    raise
+        function = _measureCcd if self.config.isTwoPass() else _processCcd
+        asyncResults = [pool.apply_async(function, (buf.getJob(dataRef.dataId["ccdnum"], dataRef.dataId),))
+                        for dataRef in dataRefs]
+        return key, buf, asyncResults
+
+    def correctCrosstalk(self, buf, dataRefs):
+        """Remove the crosstalk between the CCDs of a visit, in place in its buffer
+
+        The backplane of each CCD is the FPA card of its HDU, and its readout
+        corner is that of its detector in the camera.
+        """
+        from .mosaicMapper import MosaicMapper
+        camera = dataRefs[0].getButler().get("camera", immediate=True)
+        arrays = {}
+        backplanes = {}
+        flips = {}
+        for dataRef in dataRefs:
+            ccdnum = dataRef.dataId["ccdnum"]
+            arrays[ccdnum] = buf.getArray(ccdnum, writable=True)
+            backplanes[ccdnum] = buf.getCard(ccdnum, "FPA")
+            flips[ccdnum] = getReadoutFlip(camera[MosaicMapper.detectorNames[ccdnum]])
+        self.crosstalk.correctArrays(arrays, backplanes, flips)
+        for array in arrays.values():
+            array.flush()
+
+    def _gather(self, pool, key, buf, asyncResults):
+        """Wait for the CCDs of a visit and remove its buffer, then fit the visit and run the second pass
+
+        The second pass is run only if config.isTwoPass().
+        """
+        with timeStage(self.metadata, "waitVisit", self.log):
+            try:
+                ccds = [asyncResult.get() for asyncResult in asyncResults]
+            finally:
+                buf.close()
+        fringeSolution = None
+        backgroundModel = None
+        if self.config.isTwoPass():
+            measurements = [pipeBase.Struct(science=ccd["fringeMeasurement"][0],
+                                            fluxes=ccd["fringeMeasurement"][1])
+                            for ccd in ccds if ccd.get("fringeMeasurement") is not None]
+            if measurements:
+                fringeSolution = self.fringe.solveFinite(measurements)
+                self.log.info("Fringe amplitudes of %d CCDs: %s" % (len(measurements), fringeSolution))
+            measurements = dict((ccd["dataId"]["ccdnum"], ccd["backgroundMeasurement"])
+                                for ccd in ccds if ccd.get("backgroundMeasurement") is not None)
+            if measurements:
+                try:
+                    backgroundModel = self.focalPlaneBackground.fitMeasurements(measurements).model
+                except RuntimeError as e:
+                    self.log.warn("Failed to fit the background of visit %s: %s" %
+                                  (dict(zip(VISIT_KEYS, key)), e))
+            with timeStage(self.metadata, "finishVisit", self.log):
+                asyncResults = [pool.apply_async(_finishCcd, ((ccd, fringeSolution, backgroundModel),))
+                                for ccd in ccds]
+                ccds = [asyncResult.get() for asyncResult in asyncResults]
+        for ccd in ccds:
+            if ccd["error"] is not None:
+                self.log.warn("Failed to process %s: %s" % (ccd["dataId"], ccd["error"]))
+        self.log.info("Visit %s: %d of %d CCDs processed, %d sources" %
+                      (dict(zip(VISIT_KEYS, key)), sum(ccd["error"] is None for ccd in ccds), len(ccds),
+                       sum(max(ccd["numSources"], 0) for ccd in ccds)))
+        return pipeBase.Struct(key=key, ccds=ccds, fringeSolution=fringeSolution,
+                               backgroundModel=backgroundModel)
+
+    def _getMetadataName(self):
+        return None
@@ -0,0 +1,395 @@
+#
+# LSST Data Management System
+# Copyright 2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Evaluate the IRAF ZPX/TNX distortion of DLS preprocessed images
+
+The DLS pipeline writes its astrometric solution as an IRAF ZPX (or TNX) WCS:
+a CD matrix followed by polynomial surface corrections ("lngcor", "latcor")
+stored in the WAT1_nnn/WAT2_nnn cards, and, for ZPX, a zenithal polynomial
+projection.  afw cannot read these, so MosaicMapper.std_preprocessed used to
+drop them and keep only the linear TAN part.
+
+ZpxDistortion parses the cards once and evaluates the full solution for whole
+arrays of pixels.  fitSip converts it into TAN-SIP cards, which afw can read,
+using a coarse grid of pixels, so that the exposure gets an accurate initial Wcs.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+from builtins import range
+
+import math
+import re
+
+import numpy as np
+
+__all__ = ["SurfaceFit", "ZpxDistortion", "sipPixelToSky"]
+
+# Length of a WATn_nnn card value as written by IRAF; trailing blanks are
+# significant when the values are concatenated, but FITS readers strip them.
+WAT_CARD_LENGTH = 68
+
+
+def _cardNames(md):
+    """Return the card names of a PropertyList, astropy Header or dict"""
+    if hasattr(md, "paramNames"):
+        return md.paramNames()
+    return list(md.keys())
+
+
+def _parseWat(md, axis):
+    """Concatenate and parse the WATn_nnn cards for one axis
+
+    @param[in] md  FITS metadata
+    @param[in] axis  axis number (1 or 2)
+    @return a dict of attribute name: value (string)
+    """
+    prefix = "WAT%d_" % (axis,)
+    names = sorted(name for name in _cardNames(md) if name.startswith(prefix))
+    text = "".join(str(md.get(name)).ljust(WAT_CARD_LENGTH) for name in names)
+    attributes = {}
+    for match in re.finditer(r'(\w+)\s*=\s*(?:"([^"]*)"|(\S+))', text):
+        key, quoted, bare = match.groups()
+        attributes[key] = quoted if quoted is not None else bare
+    return attributes
+
+
+class SurfaceFit(object):
+    """An IRAF gsurfit polynomial surface, as used for the TNX/ZPX corrections
+
+    The encoded form is a list of numbers:
+        type xorder yorder xterms xmin xmax ymin ymax coeff...
+    where type is 1 (Chebyshev), 2 (Legendre) or 3 (power series) and xterms
+    is 0 (no cross terms), 1 (full cross terms) or 2 (half cross terms).
+    """
+    CHEBYSHEV = 1
+    LEGENDRE = 2
+    POLYNOMIAL = 3
+
+    def __init__(self, values):
+        values = [float(v) for v in values]
+        if len(values) < 8:
+            raise RuntimeError("Surface fit needs at least 8 values; got %d" % (len(values),))
+        self.type = int(values[0])
+        self.xorder = int(values[1])
+        self.yorder = int(values[2])
+        self.xterms = int(values[3])
+        self.xmin, self.xmax, self.ymin, self.ymax = values[4:8]
+        if self.type not in (self.CHEBYSHEV, self.LEGENDRE, self.POLYNOMIAL):
+            raise RuntimeError("Unknown surface fit type %d" % (self.type,))
+        self.terms = self._makeTerms()
+        self.coeffs = np.array(values[8:], dtype=float)
+        if len(self.coeffs) != len(self.terms):
+            raise RuntimeError("Surface fit has %d coefficients; expected %d" %
+                               (len(self.coeffs), len(self.terms)))
+
+    @classmethod
+    def fromString(cls, text):
+        return cls(text.split())
+
+    def _makeTerms(self):
+        """Return the (x power, y power) of each coefficient, in storage order"""
+        if self.xterms == 0:
+            return [(i, 0) for i in range(self.xorder)] + [(0, j) for j in range(1, self.yorder)]
+        maxOrder = max(self.xorder, self.yorder) - 1
+        terms = []
+        for j in range(self.yorder):
+            for i in range(self.xorder):
+                if self.xterms == 2 and i + j > maxOrder:
+                    continue
+                terms.append((i, j))
+        return terms
+
+    def _basis(self, value, order, vmin, vmax):
+        """Return an array of shape (order,) + value.shape of basis functions"""
+        if self.type == self.POLYNOMIAL:
+            norm = value
+        else:
+            norm = (2.0*value - (vmax + vmin))/(vmax - vmin)
+        basis = np.empty((max(order, 2),) + norm.shape)
+        basis[0] = 1.0
+        basis[1] = norm
+        for n in range(2, order):
+            if self.type == self.CHEBYSHEV:
+                basis[n] = 2.0*norm*basis[n - 1] - basis[n - 2]
+            elif self.type == self.LEGENDRE:
+                basis[n] = ((2*n - 1)*norm*basis[n - 1] - (n - 1)*basis[n - 2])/n
+            else:
+                basis[n] = norm*basis[n - 1]
+        return basis[:order]
+
+    def __call__(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        xBasis = self._basis(x, self.xorder, self.xmin, self.xmax)
+        yBasis = self._basis(y, self.yorder, self.ymin, self.ymax)
+        result = np.zeros(np.broadcast(x, y).shape)
+        for coeff, (i, j) in zip(self.coeffs, self.terms):
+            result += coeff*xBasis[i]*yBasis[j]
+        return result
+
+
+class ZpxDistortion(object):
+    """The full ZPX or TNX world coordinate solution of one CCD
+
+    @param[in] crpix  (CRPIX1, CRPIX2), one-based FITS pixels
+    @param[in] crval  (CRVAL1, CRVAL2), degrees
+    @param[in] cd  2x2 CD matrix, degrees/pixel
+    @param[in] lngcor, latcor  SurfaceFit corrections to the intermediate
+                               coordinates, or None
+    @param[in] projp  ZPX projection coefficients (PROJP0, PROJP1, ...), or
+                      None for the TNX (gnomonic) projection
+    """
+
+    def __init__(self, crpix, crval, cd, lngcor=None, latcor=None, projp=None):
+        self.crpix = np.array(crpix, dtype=float)
+        self.crval = np.array(crval, dtype=float)
+        self.cd = np.array(cd, dtype=float).reshape(2, 2)
+        self.lngcor = lngcor
+        self.latcor = latcor
+        self.projp = None if projp is None else np.array(projp, dtype=float)
+
+    @classmethod
+    def fromMetadata(cls, md):
+        """Construct from FITS metadata (a PropertyList, astropy Header or dict)
+
+        @throw RuntimeError if the metadata does not contain a ZPX or TNX Wcs
+        """
+        ctype1 = str(md.get("CTYPE1"))
+        ctype2 = str(md.get("CTYPE2"))
+        projection = ctype1[-3:]
+        if projection not in ("ZPX", "TNX") or ctype2[-3:] != projection:
+            raise RuntimeError("Not a ZPX or TNX Wcs: CTYPE1=%r, CTYPE2=%r" % (ctype1, ctype2))
+        if not ctype1.startswith("RA") or not ctype2.startswith("DEC"):
+            raise RuntimeError("Axes must be RA, DEC; got %r, %r" % (ctype1, ctype2))
+        crpix = (float(md.get("CRPIX1")), float(md.get("CRPIX2")))
+        crval = (float(md.get("CRVAL1")), float(md.get("CRVAL2")))
+        cd = [[float(md.get("CD1_1")), float(md.get("CD1_2"))],
+              [float(md.get("CD2_1")), float(md.get("CD2_2"))]]
+
+        wat1 = _parseWat(md, 1)
+        wat2 = _parseWat(md, 2)
+        lngcor = SurfaceFit.fromString(wat1["lngcor"]) if "lngcor" in wat1 else None
+        latcor = SurfaceFit.fromString(wat2["latcor"]) if "latcor" in wat2 else None
+        projp = None
+        if projection == "ZPX":
+            projp = np.zeros(10)
+            projp[1] = 1.0
+            for wat in (wat1, wat2):
+                for key, value in wat.items():
+                    match = re.match(r"projp(\d)$", key)
+                    if match:
+                        projp[int(match.group(1))] = float(value)
+        return cls(crpix, crval, cd, lngcor=lngcor, latcor=latcor, projp=projp)
+
+    def pixelToIntermediate(self, x, y):
+        """Return the corrected intermediate world coordinates (degrees)
+
+        @param[in] x, y  zero-based (LSST) pixel positions
+        """
+        dx = np.asarray(x, dtype=float) + 1.0 - self.crpix[0]
+        dy = np.asarray(y, dtype=float) + 1.0 - self.crpix[1]
+        xi = self.cd[0, 0]*dx + self.cd[0, 1]*dy
+        eta = self.cd[1, 0]*dx + self.cd[1, 1]*dy
+        xiCorr = xi + self.lngcor(xi, eta) if self.lngcor is not None else xi
+        etaCorr = eta + self.latcor(xi, eta) if self.latcor is not None else eta
+        return xiCorr, etaCorr
+
+    def _nativeTheta(self, radius):
+        """Return native latitude (radians) for intermediate radius (radians)"""
+        if self.projp is None:
+            return np.arctan2(1.0, radius)
+        # ZPN: radius = sum_k projp[k] (pi/2 - theta)^k; invert with Newton
+        # iterations starting from the linear term
+        coeffs = np.trim_zeros(self.projp, "b")
+        derivCoeffs = coeffs[1:]*np.arange(1, len(coeffs))
+        zeta = (radius - coeffs[0])/coeffs[1]
+        for i in range(30):
+            value = np.polynomial.polynomial.polyval(zeta, coeffs) - radius
+            step = value/np.polynomial.polynomial.polyval(zeta, derivCoeffs)
+            zeta -= step
+            if np.all(np.abs(step) < 1e-14):
+                break
+        return 0.5*math.pi - zeta
+
+    def pixelToSky(self, x, y):
+        """Return (ra, dec) in degrees for zero-based pixel positions"""
+        xi, eta = self.pixelToIntermediate(x, y)
+        xi = np.radians(xi)
+        eta = np.radians(eta)
+        phi = np.arctan2(xi, -eta)
+        theta = self._nativeTheta(np.hypot(xi, eta))
+        return _nativeToCelestial(phi, theta, self.crval)
+
+    def fitSip(self, width, height, order=4, spacing=64):
+        """Fit a TAN-SIP Wcs to this solution over a CCD
+
+        The solution is sampled on a grid of pixels.  CRPIX is moved to the
+        pixel that the solution maps to CRVAL, the linear part is refit into
+        CD, and the rest is fit with SIP polynomials, in both the forward
+        (A, B) and reverse (AP, BP) directions.
+
+        @param[in] width, height  dimensions of the CCD in pixels
+        @param[in] order  SIP polynomial order
+        @param[in] spacing  grid spacing in pixels
+        @return a pair (cards, maxResidual): a dict of FITS cards and the
+            largest difference between the SIP Wcs and this solution over the
+            grid, in arcsec
+        """
+        xGrid = np.linspace(0, width - 1, max(int(math.ceil((width - 1)/spacing)), order + 1) + 1)
+        yGrid = np.linspace(0, height - 1, max(int(math.ceil((height - 1)/spacing)), order + 1) + 1)
+        x, y = [a.ravel() for a in np.meshgrid(xGrid, yGrid)]
+        ra, dec = self.pixelToSky(x, y)
+        xi, eta = _celestialToTan(ra, dec, self.crval)
+
+        # The corrections may move the tangent point away from CRPIX; find it
+        cdInverse = np.linalg.inv(self.cd)
+        crpix = self.crpix.copy()
+        for i in range(20):
+            xiRef, etaRef = _celestialToTan(*self.pixelToSky(crpix[0] - 1.0, crpix[1] - 1.0),
+                                            crval=self.crval)
+            step = cdInverse.dot([float(xiRef), float(etaRef)])
+            crpix -= step
+            if np.all(np.abs(step) < 1e-8):
+                break
+        u = x + 1.0 - crpix[0]
+        v = y + 1.0 - crpix[1]
+
+        # Refit CD together with the higher orders so that it absorbs any
+        # linear part of the corrections
+        allTerms = [(p, q) for p in range(order + 1) for q in range(order + 1) if 1 <= p + q <= order]
+        xiCoeffs = _fitPolynomial(u, v, xi, allTerms)
+        etaCoeffs = _fitPolynomial(u, v, eta, allTerms)
+        cd = np.array([[xiCoeffs[allTerms.index((1, 0))], xiCoeffs[allTerms.index((0, 1))]],
+                       [etaCoeffs[allTerms.index((1, 0))], etaCoeffs[allTerms.index((0, 1))]]])
+        cdInverse = np.linalg.inv(cd)
+        uTan = cdInverse[0, 0]*xi + cdInverse[0, 1]*eta
+        vTan = cdInverse[1, 0]*xi + cdInverse[1, 1]*eta
+
+        forwardTerms = [(p, q) for p in range(order + 1) for q in range(order + 1) if 2 <= p + q <= order]
+        reverseTerms = allTerms
+        aCoeffs = _fitPolynomial(u, v, uTan - u, forwardTerms)
+        bCoeffs = _fitPolynomial(u, v, vTan - v, forwardTerms)
+        apCoeffs = _fitPolynomial(uTan, vTan, u - uTan, reverseTerms)
+        bpCoeffs = _fitPolynomial(uTan, vTan, v - vTan, reverseTerms)
+
+        cards = {
+            "CTYPE1": "RA---TAN-SIP",
+            "CTYPE2": "DEC--TAN-SIP",
+            "CRVAL1": float(self.crval[0]),
+            "CRVAL2": float(self.crval[1]),
+            "CRPIX1": float(crpix[0]),
+            "CRPIX2": float(crpix[1]),
+            "CD1_1": float(cd[0, 0]),
+            "CD1_2": float(cd[0, 1]),
+            "CD2_1": float(cd[1, 0]),
+            "CD2_2": float(cd[1, 1]),
+            "A_ORDER": order,
+            "B_ORDER": order,
+            "AP_ORDER": order,
+            "BP_ORDER": order,
+        }
+        for prefix, terms, coeffs in (("A", forwardTerms, aCoeffs), ("B", forwardTerms, bCoeffs),
+                                      ("AP", reverseTerms, apCoeffs), ("BP", reverseTerms, bpCoeffs)):
+            for (p, q), coeff in zip(terms, coeffs):
+                cards["%s_%d_%d" % (prefix, p, q)] = float(coeff)
+
+        sipRa, sipDec = sipPixelToSky(cards, x, y)
+        maxResidual = 3600.0*np.max(_angularSeparation(ra, dec, sipRa, sipDec))
+        return cards, maxResidual
+
+
+def _fitPolynomial(u, v, values, terms):
+    """Least-squares fit of sum_k c_k u^p_k v^q_k to values"""
+    design = np.vstack([u**p*v**q for p, q in terms]).T
+    # scale the columns to keep the normal equations well conditioned
+    scale = np.max(np.abs(design), axis=0)
+    scale[scale == 0] = 1.0
+    return np.linalg.lstsq(design/scale, values, rcond=-1)[0]/scale
+
+
+def sipPixelToSky(cards, x, y):
+    """Evaluate a TAN-SIP Wcs given as a dict of FITS cards
+
+    @param[in] cards  FITS cards, as returned by ZpxDistortion.fitSip
+    @param[in] x, y  zero-based pixel positions
+    @return ra, dec  (degrees)
+    """
+    u = np.asarray(x, dtype=float) + 1.0 - cards["CRPIX1"]
+    v = np.asarray(y, dtype=float) + 1.0 - cards["CRPIX2"]
+    du = np.zeros_like(u)
+    dv = np.zeros_like(v)
+    for name, value in cards.items():
+        match = re.match(r"([AB])_(\d+)_(\d+)$", name)
+        if match:
+            term = value*u**int(match.group(2))*v**int(match.group(3))
+            if match.group(1) == "A":
+                du += term
+            else:
+                dv += term
+    u = u + du
+    v = v + dv
+    xi = cards["CD1_1"]*u + cards["CD1_2"]*v
+    eta = cards["CD2_1"]*u + cards["CD2_2"]*v
+    xi = np.radians(xi)
+    eta = np.radians(eta)
+    phi = np.arctan2(xi, -eta)
+    theta = np.arctan2(1.0, np.hypot(xi, eta))
+    return _nativeToCelestial(phi, theta, (cards["CRVAL1"], cards["CRVAL2"]))
+
+
+def _nativeToCelestial(phi, theta, crval):
+    """Rotate native spherical coordinates of a zenithal projection to (ra, dec)
+
+    The native pole is at crval and LONPOLE is 180 degrees.
+    @param[in] phi, theta  native longitude and latitude (radians)
+    @param[in] crval  (ra, dec) of the reference point (degrees)
+    @return ra, dec (degrees)
+    """
+    ra0 = math.radians(crval[0])
+    dec0 = math.radians(crval[1])
+    dPhi = phi - math.pi
+    sinDec = np.sin(theta)*math.sin(dec0) + np.cos(theta)*math.cos(dec0)*np.cos(dPhi)
+    dec = np.arcsin(np.clip(sinDec, -1.0, 1.0))
+    ra = ra0 + np.arctan2(-np.cos(theta)*np.sin(dPhi),
+                          np.sin(theta)*math.cos(dec0) - np.cos(theta)*math.sin(dec0)*np.cos(dPhi))
+    return np.degrees(ra) % 360.0, np.degrees(dec)
+
+
+def _celestialToTan(ra, dec, crval):
+    """Gnomonic projection of (ra, dec) about crval; returns (xi, eta) in degrees"""
+    ra0 = math.radians(crval[0])
+    dec0 = math.radians(crval[1])
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    dRa = ra - ra0
+    cosC = math.sin(dec0)*np.sin(dec) + math.cos(dec0)*np.cos(dec)*np.cos(dRa)
+    xi = np.cos(dec)*np.sin(dRa)/cosC
+    eta = (math.cos(dec0)*np.sin(dec) - math.sin(dec0)*np.cos(dec)*np.cos(dRa))/cosC
+    return np.degrees(xi), np.degrees(eta)
+
+
+def _angularSeparation(ra1, dec1, ra2, dec2):
+    """Angular separation in degrees (haversine formula)"""
+    ra1, dec1, ra2, dec2 = [np.radians(a) for a in (ra1, dec1, ra2, dec2)]
+    hav = np.sin(0.5*(dec2 - dec1))**2 + np.cos(dec1)*np.cos(dec2)*np.sin(0.5*(ra2 - ra1))**2
+    return np.degrees(2.0*np.arcsin(np.sqrt(hav)))
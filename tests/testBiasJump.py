@@ -0,0 +1,120 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.utils.tests
+from lsst.obs.mosaic import synthetic
+from lsst.obs.mosaic.biasJump import BiasJumpCache, collapseOverscan, findBiasJump, getNight
+
+
+class BiasJumpTestCase(lsst.utils.tests.TestCase):
+    """Test finding the bias jump in the overscan"""
+
+    def setUp(self):
+        self.rng = np.random.RandomState(7)
+        BiasJumpCache.clear()
+
+    def tearDown(self):
+        BiasJumpCache.clear()
+
+    def makeProfile(self, num=4096, location=2098, step=3.0, noise=0.5):
+        profile = 1500.0 + self.rng.normal(0.0, noise, num)
+        profile[location:] += step
+        return profile
+
+    def testFind(self):
+        for location in (2098, 1800, 3000):
+            biasJump = findBiasJump(self.makeProfile(location=location))
+            self.assertEqual(biasJump.location, location)
+            self.assertAlmostEqual(biasJump.step, 3.0, delta=0.1)
+        self.assertIsNone(findBiasJump(self.makeProfile(step=0.0)))
+        self.assertIsNone(findBiasJump(self.makeProfile(step=0.5, noise=0.01), minStep=1.0))
+        self.assertIsNone(findBiasJump(self.makeProfile(num=80, location=40)))
+
+        # An amplifier read out from the top
+        overscan = np.repeat(self.makeProfile()[::-1, np.newaxis], 10, axis=1)
+        self.assertEqual(findBiasJump(collapseOverscan(overscan, flip=True)).location, 2098)
+
+    def testRamp(self):
+        """A ramp of the bias splits the rows into two levels, but is not a jump"""
+        profile = self.makeProfile(step=0.0) + np.linspace(0.0, 2.0, 4096)
+        self.assertIsNone(findBiasJump(profile))
+        # A jump on a ramp
+        profile[2098:] += 3.0
+        self.assertEqual(findBiasJump(profile).location, 2098)
+
+    def testTransient(self):
+        """A decaying transient of the bias at the start of the readout is not a jump"""
+        rows = np.arange(4096)
+        for scale in (10.0, 50.0, 200.0):
+            self.assertIsNone(findBiasJump(self.makeProfile(step=0.0) + 5.0*np.exp(-rows/scale)))
+
+    def testRaw(self):
+        root = tempfile.mkdtemp()
+        try:
+            visit = synthetic.makeVisits(1)[0]
+            height, width = shape = (600, 40)
+            path = synthetic.writeRaw(root, visit, self.rng, ccdnums=(1, 2), shape=shape,
+                                      biasJumpBackplanes=("MOSAIC_BKP1",), biasJumpLocation=350)
+            with fits.open(path) as hduList:
+                jumps = [findBiasJump(collapseOverscan(hduList[ccdnum].data[:, width:])) for ccdnum in (1, 2)]
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        self.assertEqual(jumps[0].location, 350)
+        self.assertAlmostEqual(jumps[0].step, synthetic.BIAS_JUMP, delta=1.0)
+        self.assertIsNone(jumps[1])
+
+    def testCache(self):
+        self.assertEqual(getNight(52643.1), getNight(52642.9))
+        self.assertNotEqual(getNight(52643.1), getNight(52643.9))
+        calls = []
+
+        def detect():
+            calls.append(1)
+            return findBiasJump(self.makeProfile())
+
+        night = getNight(52643.1)
+        biasJump, cached = BiasJumpCache.get(night, "MOSAIC_BKP1", detect)
+        self.assertFalse(cached)
+        self.assertEqual(BiasJumpCache.get(night, "MOSAIC_BKP1", detect), (biasJump, True))
+        BiasJumpCache.get(night, "MOSAIC_BKP2", detect)
+        BiasJumpCache.get(night + 1, "MOSAIC_BKP1", detect)
+        self.assertEqual(len(calls), 3)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
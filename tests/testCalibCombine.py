@@ -0,0 +1,126 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.utils.tests
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.obs.mosaic.calibCombine import STATISTICS, combineArrays, combineStack, getBandRows, streamCombine
+
+
+class CalibCombineTestCase(lsst.utils.tests.TestCase):
+    """Test the streaming combine against the in-memory combine"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.shape = (50, 30)
+        rng = np.random.RandomState(5)
+        self.images = []
+        self.masks = []
+        self.inputs = []
+        for i in range(7):
+            image = rng.normal(1000.0, 10.0, self.shape).astype(np.float32)
+            if i == 3:
+                image[::3, 1::2] = 1e5  # outliers
+            mask = np.zeros(self.shape, dtype=np.int32)
+            mask[:, i] = 1
+            mask[i, :] = 4
+            hdus = [fits.PrimaryHDU()]
+            # Alternate uncompressed and tile-compressed inputs, as written by afw
+            if i % 2:
+                hdus.append(fits.ImageHDU(image))
+            else:
+                hdus.append(fits.CompImageHDU(image, compression_type="GZIP_1"))
+            hdus.append(fits.ImageHDU(mask))
+            path = os.path.join(self.root, "input%d.fits" % (i,))
+            fits.HDUList(hdus).writeto(path)
+            # Tile compression quantizes the pixels
+            self.images.append(fits.getdata(path, 1))
+            self.masks.append(mask)
+            self.inputs.append((path, 1, 2))
+        self.scales = [1.0 + 0.1*i for i in range(len(self.images))]
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def testCombineStack(self):
+        stack = np.array([[[1.0]], [[2.0]], [[3.0]], [[2.5]], [[100.0]]], dtype=np.float32)
+        self.assertEqual(combineStack(stack, "MEDIAN")[0, 0], 2.5)
+        self.assertAlmostEqual(combineStack(stack, "MEAN")[0, 0], 21.7, places=5)
+        self.assertAlmostEqual(combineStack(stack, "MEANCLIP")[0, 0], 2.125, places=5)
+        self.assertTrue(np.isnan(combineStack(np.full((3, 1, 1), np.nan, dtype=np.float32))[0, 0]))
+
+    def testAfw(self):
+        """combineStack matches afwMath.statisticsStack, as used by CalibCombineTask"""
+        rng = np.random.RandomState(7)
+        height, width = 20, 10
+        base = rng.uniform(900.0, 1100.0, (height, width))
+        spread = rng.uniform(0.5, 2.0, (height, width))
+        # Evenly spread frames, so that no pixel is near the clipping threshold, and outliers
+        stack = np.array([base + offset*spread for offset in np.linspace(-1.0, 1.0, 9)], dtype=np.float32)
+        stack[2, ::3, ::2] += 1e4
+        clip, nIter = 3.0, 3
+        statsCtrl = afwMath.StatisticsControl(clip, nIter)
+        for statistic in STATISTICS:
+            images = [afwImage.MaskedImageF(afwImage.ImageF(frame.copy(), True)) for frame in stack]
+            target = afwImage.MaskedImageF(width, height)
+            afwMath.statisticsStack(target, images, afwMath.stringToStatisticsProperty(statistic), statsCtrl)
+            self.assertFloatsAlmostEqual(combineStack(stack.copy(), statistic, clip, nIter),
+                                         target.getImage().getArray(), rtol=1e-5, msg=statistic)
+
+    def testStream(self):
+        height, width = self.shape
+        self.assertEqual(getBandRows(7, width, height, 7*width*40*4, 2), 2)
+        for statistic in ("MEANCLIP", "MEDIAN", "MEAN"):
+            expected = combineArrays(self.images, self.masks, badMask=1, scales=self.scales,
+                                     statistic=statistic)
+            for maxBytes, numThreads in [(1 << 30, 1), (7*width*40*3, 1), (7*width*40*4, 3)]:
+                combined = streamCombine(self.inputs, width, height, badMask=1, scales=self.scales,
+                                         statistic=statistic, maxBytes=maxBytes, numThreads=numThreads)
+                self.assertFloatsEqual(combined, expected)
+        # The outliers are clipped
+        clipped = combineArrays(self.images, self.masks, badMask=1, scales=self.scales)
+        self.assertLess(np.abs(clipped - 1000.0/np.mean(self.scales)).max(), 100.0)
+
+        # A missing input is ignored
+        inputs = self.inputs[:-1] + [None]
+        combined = streamCombine(inputs, width, height, badMask=1, maxBytes=7*width*40*4, numThreads=2)
+        self.assertFloatsEqual(combined, combineArrays(self.images[:-1], self.masks[:-1], badMask=1))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
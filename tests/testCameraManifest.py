@@ -0,0 +1,110 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils
+import lsst.utils.tests
+from lsst.obs.mosaic import MosaicMapper, cameraManifest
+
+
+class CameraManifestTestCase(lsst.utils.tests.TestCase):
+    """Test the content hashes of the camera repository"""
+
+    def setUp(self):
+        self.cameraDir = os.path.join(lsst.utils.getPackageDir("obs_mosaic"), "mosaic", "camGeom")
+
+    def testCommittedManifest(self):
+        """Test that the committed manifest matches the committed camera repository"""
+        differences = cameraManifest.verifyManifest(self.cameraDir)
+        self.assertEqual(differences.added, [])
+        self.assertEqual(differences.removed, [])
+        self.assertEqual(differences.changed, [])
+        manifest = cameraManifest.readManifest(self.cameraDir)
+        self.assertEqual(len(manifest), 9)
+        self.assertIn("camera.py", manifest)
+
+    def testDetectChange(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            copyDir = os.path.join(tempDir, "camGeom")
+            shutil.copytree(self.cameraDir, copyDir)
+            oldHash = cameraManifest.repositoryHash(cameraManifest.makeManifest(copyDir))
+            with open(os.path.join(copyDir, "camera.py"), "a") as outfile:
+                outfile.write("# modified\n")
+            os.remove(os.path.join(copyDir, "W8.fits"))
+            newManifest = cameraManifest.makeManifest(copyDir)
+            self.assertNotEqual(cameraManifest.repositoryHash(newManifest), oldHash)
+            differences = cameraManifest.verifyManifest(copyDir)
+            self.assertEqual(differences.changed, ["camera.py"])
+            self.assertEqual(differences.removed, ["W8.fits"])
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testCurrentManifest(self):
+        """Test that only the files modified after the manifest are hashed"""
+        tempDir = tempfile.mkdtemp()
+        try:
+            copyDir = os.path.join(tempDir, "camGeom")
+            shutil.copytree(self.cameraDir, copyDir)
+            manifest = cameraManifest.makeManifest(copyDir)
+            self.assertEqual(cameraManifest.getCurrentManifest(copyDir), manifest)
+
+            # A manifest newer than the files is trusted without reading them
+            stored = cameraManifest.readManifest(copyDir)
+            stored["E1.fits"] = "0"*40
+            cameraManifest.writeManifest(copyDir, stored)
+            self.assertEqual(cameraManifest.getCurrentManifest(copyDir)["E1.fits"], "0"*40)
+
+            # A file modified after the manifest is hashed
+            cameraPath = os.path.join(copyDir, "camera.py")
+            with open(cameraPath, "a") as outfile:
+                outfile.write("# modified\n")
+            manifestTime = os.stat(os.path.join(copyDir, cameraManifest.MANIFEST_NAME)).st_mtime
+            os.utime(cameraPath, (manifestTime + 10, manifestTime + 10))
+            current = cameraManifest.getCurrentManifest(copyDir)
+            self.assertEqual(current["camera.py"], cameraManifest.hashFile(cameraPath))
+            self.assertNotEqual(current["camera.py"], manifest["camera.py"])
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testMapperCache(self):
+        """Test that mappers share the camera made from an unchanged repository"""
+        camera1 = MosaicMapper(root=".").camera
+        camera2 = MosaicMapper(root=".").camera
+        self.assertIs(camera1, camera2)
+        self.assertEqual(len(camera1), 8)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
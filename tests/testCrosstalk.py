@@ -0,0 +1,113 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.obs.mosaic.crosstalk import correctCrosstalk, parseCoefficients
+
+
+class CrosstalkTestCase(lsst.utils.tests.TestCase):
+    """Test the correction of crosstalk between the CCDs of a backplane"""
+
+    def setUp(self):
+        rng = np.random.RandomState(11)
+        self.shape = (60, 40)
+        self.threshold = 20000.0
+        self.coefficients = parseCoefficients({"1,2": 1e-3, "2,1": 2e-3, "3,1": 5e-4})
+        self.skies = dict((ccdnum, rng.normal(1000.0, 5.0, self.shape).astype(np.float32))
+                          for ccdnum in (1, 2, 3, 4))
+        self.arrays = dict((ccdnum, sky.copy()) for ccdnum, sky in self.skies.items())
+        # Bright pixels on CCDs 1 and 2; one below the threshold
+        self.arrays[1][10:12, 5:8] = 40000.0
+        self.arrays[2][30, 20] = 30000.0
+        self.arrays[2][40, 30] = 15000.0
+        self.backplanes = {1: "MOSAIC_BKP1", 2: "MOSAIC_BKP1", 3: "MOSAIC_BKP1", 4: "MOSAIC_BKP2"}
+
+    def addCrosstalk(self, flips=None):
+        original = dict((ccdnum, array.copy()) for ccdnum, array in self.arrays.items())
+        for (victim, source), coefficient in self.coefficients.items():
+            sourceArray = original[source]
+            if flips:
+                # Both CCDs in readout order
+                sourceArray = sourceArray[::-1] if flips[source][0] != flips[victim][0] else sourceArray
+            self.arrays[victim] += np.where(sourceArray > self.threshold, coefficient*sourceArray, 0.0)
+
+    def testCorrect(self):
+        self.addCrosstalk()
+        expected = dict((ccdnum, array.copy()) for ccdnum, array in self.arrays.items())
+        for ccdnum, sky in self.skies.items():
+            brightOnly = self.arrays[ccdnum] > self.threshold
+            expected[ccdnum][~brightOnly] = sky[~brightOnly]
+        expected[2][40, 30] = 15000.0
+
+        numCorrected = correctCrosstalk(self.arrays, self.backplanes, self.coefficients, self.threshold)
+        for ccdnum in self.arrays:
+            self.assertFloatsAlmostEqual(self.arrays[ccdnum], expected[ccdnum], atol=1e-3)
+        self.assertEqual(numCorrected, {1: 1, 2: 6, 3: 6, 4: 0})
+
+    def testBackplanes(self):
+        self.addCrosstalk()
+        before = dict((ccdnum, array.copy()) for ccdnum, array in self.arrays.items())
+        backplanes = {1: "MOSAIC_BKP1", 2: "MOSAIC_BKP2", 3: "MOSAIC_BKP3", 4: None}
+        numCorrected = correctCrosstalk(self.arrays, backplanes, self.coefficients, self.threshold)
+        self.assertEqual(sum(numCorrected.values()), 0)
+        for ccdnum in self.arrays:
+            self.assertFloatsEqual(self.arrays[ccdnum], before[ccdnum])
+
+    def testInteger(self):
+        """Integer arrays are corrected in floating point, rounded and clipped"""
+        self.addCrosstalk()
+        expected = dict((ccdnum, array.copy()) for ccdnum, array in self.arrays.items())
+        correctCrosstalk(expected, self.backplanes, self.coefficients, self.threshold)
+        arrays = dict((ccdnum, np.rint(array).astype(np.uint16)) for ccdnum, array in self.arrays.items())
+        # A victim pixel that the correction would take below zero
+        arrays[3][10, 5] = 10
+        correctCrosstalk(arrays, self.backplanes, self.coefficients, self.threshold)
+        for ccdnum in (1, 2, 4):
+            self.assertEqual(arrays[ccdnum].dtype, np.uint16)
+            self.assertFloatsAlmostEqual(arrays[ccdnum].astype(np.float64), expected[ccdnum], atol=1.0)
+        self.assertEqual(arrays[3][10, 5], 0)
+
+    def testFlips(self):
+        flips = {1: (False, False), 2: (True, False), 3: (False, False), 4: (False, False)}
+        self.addCrosstalk(flips)
+        correctCrosstalk(self.arrays, self.backplanes, self.coefficients, self.threshold, flips)
+        for ccdnum in (1, 3, 4):
+            faint = self.skies[ccdnum] < self.threshold
+            bright = self.arrays[ccdnum] > self.threshold
+            self.assertFloatsAlmostEqual(self.arrays[ccdnum][faint & ~bright],
+                                         self.skies[ccdnum][faint & ~bright], atol=1e-3)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,133 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.utils.tests
+from lsst.obs.mosaic import defects
+
+
+class DefectsTestCase(lsst.utils.tests.TestCase):
+    """Test bulk export and import of defects, and the defect index"""
+
+    def setUp(self):
+        self.calibRoot = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.calibRoot, "BPM"))
+        conn = sqlite3.connect(os.path.join(self.calibRoot, "calibRegistry.sqlite3"))
+        conn.execute("create table defect (id integer primary key autoincrement, filter text, ccdnum int, "
+                     "path text, calibDate text, validStart text, validEnd text)")
+        self.masks = {}
+        periods = [("2012-01-01", "2012-12-31"), ("2013-01-01", "2013-12-31")]
+        for period, (validStart, validEnd) in enumerate(periods):
+            hdus = [fits.PrimaryHDU()]
+            for ccdnum in range(1, 9):
+                mask = np.zeros((40, 20), dtype=np.uint16)
+                mask[:, 3 + ccdnum] = 1
+                mask[5:9, 10:13] = 4
+                mask[20, period] = 1
+                self.masks[(validStart, ccdnum)] = mask
+                hdus.append(fits.ImageHDU(mask))
+                conn.execute("insert into defect (filter, ccdnum, path, calibDate, validStart, validEnd) "
+                             "values (?, ?, ?, ?, ?, ?)",
+                             ("NONE", ccdnum, "BPM/bpm%d.fits[%d]" % (period, ccdnum), validStart, validStart,
+                              validEnd))
+            fits.HDUList(hdus).writeto(os.path.join(self.calibRoot, "BPM", "bpm%d.fits" % (period,)))
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.calibRoot)
+
+    def checkDefects(self, defectTable):
+        for (validStart, ccdnum), mask in self.masks.items():
+            rows = defectTable[(defectTable["validStart"] == validStart.encode()) &
+                               (defectTable["ccdnum"] == ccdnum)]
+            covered = np.zeros(mask.shape, dtype=int)
+            for row in rows:
+                covered[row["y0"]:row["y0"] + row["height"], row["x0"]:row["x0"] + row["width"]] += 1
+            np.testing.assert_array_equal(covered, mask != 0)
+
+    def testMaskToBoxes(self):
+        mask = np.zeros((10, 8), dtype=np.uint8)
+        mask[:, 2] = 1
+        mask[3:5, 4:7] = 1
+        boxes = defects.maskToBoxes(mask)
+        self.assertEqual(sorted(boxes.tolist()), [(2, 0, 1, 10), (4, 3, 3, 2)])
+        self.assertEqual(len(defects.maskToBoxes(np.zeros((3, 3)))), 0)
+
+    def testExport(self):
+        """Test that one pass exports every period and CCD exactly"""
+        defectTable, index = defects.exportDefects(self.calibRoot)
+        self.assertEqual(len(index), 16)
+        self.checkDefects(defectTable)
+        self.assertEqual(int(index["nrows"].sum()), len(defectTable))
+
+    def testRoundTrip(self):
+        """Test FITS and text output, and importing them as the defect index"""
+        defectTable, index = defects.exportDefects(self.calibRoot)
+        fitsPath = os.path.join(self.calibRoot, "defects.fits")
+        defects.writeDefectFile(fitsPath, defectTable, index)
+        readTable, readIndex = defects.readDefectFile(fitsPath)
+        np.testing.assert_array_equal(readTable, defectTable)
+        np.testing.assert_array_equal(readIndex, index)
+
+        textDir = os.path.join(self.calibRoot, "text")
+        defects.writeDefectText(textDir, defectTable)
+        self.assertEqual(sorted(os.listdir(textDir)), ["2012-01-01", "2013-01-01"])
+        indexPath = defects.importDefects(textDir, self.calibRoot)
+        self.assertEqual(indexPath, os.path.join(self.calibRoot, defects.DEFECT_INDEX_NAME))
+        importedTable, importedIndex = defects.readDefectFile(indexPath)
+        self.checkDefects(importedTable)
+        np.testing.assert_array_equal(importedIndex, index)
+
+    def testDefectIndex(self):
+        defectTable, index = defects.exportDefects(self.calibRoot)
+        indexPath = os.path.join(self.calibRoot, defects.DEFECT_INDEX_NAME)
+        defects.writeDefectFile(indexPath, defectTable, index)
+        defectIndex = defects.DefectIndex.get(indexPath)
+        self.assertIs(defects.DefectIndex.get(indexPath), defectIndex)
+        period = defectIndex.getPeriod(b"2013-01-01")
+        self.assertEqual(sorted(period), list(range(1, 9)))
+        boxes = defectIndex.getDefects("BPM/bpm1.fits[3]", 3)
+        self.assertEqual(sorted(boxes[["x0", "y0", "width", "height"]].tolist()),
+                         [(1, 20, 1, 1), (6, 0, 1, 40), (10, 5, 3, 4)])
+        self.assertIsNone(defectIndex.getDefects("BPM/other.fits", 3))
+        self.assertIsNone(defects.DefectIndex.get(os.path.join(self.calibRoot, "missing.fits")))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,104 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+from lsst.afw.cameraGeom import PIXELS, FOCAL_PLANE, PUPIL
+from lsst.obs.mosaic import MosaicMapper
+
+
+class FocalPlaneTransformTestCase(lsst.utils.tests.TestCase):
+    """Test the vectorized Mosaic focal plane transform"""
+
+    def setUp(self):
+        self.mapper = MosaicMapper(root=".")
+        self.camera = self.mapper.camera
+        self.transform = MosaicMapper.getFocalPlaneTransform()
+        rng = np.random.RandomState(12345)
+        self.ccdnum = rng.randint(1, 9, size=200)
+        self.x = rng.uniform(0, 2047, size=200)
+        self.y = rng.uniform(0, 4095, size=200)
+
+    def tearDown(self):
+        del self.mapper
+        del self.camera
+
+    def testMatchesCameraGeom(self):
+        """Test that focal plane and pupil positions agree with cameraGeom"""
+        xFp, yFp = self.transform.pixelsToFocalPlane(self.ccdnum, self.x, self.y)
+        xPupil, yPupil = self.transform.focalPlaneToPupil(xFp, yFp)
+        for i in range(0, len(self.x), 20):
+            detector = self.camera[MosaicMapper.detectorNames[self.ccdnum[i]]]
+            pixPoint = detector.makeCameraPoint(afwGeom.Point2D(self.x[i], self.y[i]), PIXELS)
+            fpPoint = detector.transform(pixPoint, FOCAL_PLANE).getPoint()
+            self.assertAlmostEqual(xFp[i], fpPoint.getX(), places=9)
+            self.assertAlmostEqual(yFp[i], fpPoint.getY(), places=9)
+            pupilPoint = self.camera.transform(detector.makeCameraPoint(fpPoint, FOCAL_PLANE), PUPIL)
+            self.assertAlmostEqual(xPupil[i], pupilPoint.getPoint().getX(), places=12)
+            self.assertAlmostEqual(yPupil[i], pupilPoint.getPoint().getY(), places=12)
+
+    def testRoundTrip(self):
+        """Test pixels -> sky -> pixels, including finding the detector"""
+        boresight = (139.04807, 30.03947)
+        ra, dec = self.transform.pixelsToSky(self.ccdnum, self.x, self.y, *boresight, rotAngle=30.0)
+        ccdnum, x, y = self.transform.skyToPixels(ra, dec, *boresight, rotAngle=30.0)
+        np.testing.assert_array_equal(ccdnum, self.ccdnum)
+        np.testing.assert_allclose(x, self.x, atol=1e-6)
+        np.testing.assert_allclose(y, self.y, atol=1e-6)
+
+    def testOffDetector(self):
+        """Test that positions in the gaps between detectors map to ccdnum 0"""
+        ccdnum, x, y = self.transform.focalPlaneToPixels(np.array([0.0, -48.81]), np.array([0.0, -30.97]))
+        self.assertEqual(ccdnum[0], 0)
+        self.assertTrue(np.isnan(x[0]))
+        self.assertEqual(ccdnum[1], 1)
+        self.assertAlmostEqual(x[1], 1023.5)
+        self.assertAlmostEqual(y[1], 2047.5)
+
+    def testTransformPixels(self):
+        """Test that the all-in-one transform is consistent with the individual steps"""
+        boresight = (10.0, -5.0)
+        result = self.transform.transformPixels(self.ccdnum, self.x, self.y, boresight=boresight)
+        ra, dec = self.transform.pixelsToSky(self.ccdnum, self.x, self.y, *boresight)
+        np.testing.assert_allclose(result["ra"], ra)
+        np.testing.assert_allclose(result["dec"], dec)
+        self.assertNotIn("ra", self.transform.transformPixels(1, 0.0, 0.0))
+
+    def testBadCcdnum(self):
+        with self.assertRaises(RuntimeError):
+            self.transform.pixelsToFocalPlane(9, 0.0, 0.0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,148 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.obs.mosaic.focalPlane import MosaicFocalPlaneTransform
+from lsst.obs.mosaic.focalPlaneBackground import (binImage, fitFocalPlaneBackground, getBinCenters,
+                                                  MosaicFocalPlaneBackgroundTask)
+
+
+class FocalPlaneBackgroundTestCase(lsst.utils.tests.TestCase):
+    """Test the background model fitted across the CCDs of a visit"""
+
+    def setUp(self):
+        # A small camera laid out as Mosaic: 2 rows of 4 CCDs
+        self.width, self.height = 96, 192
+        self.ccdnums = list(range(1, 9))
+        offsets = [(x, y) for y in (-31.0, 31.0) for x in (-48.0, -16.0, 16.0, 48.0)]
+        num = len(self.ccdnums)
+        self.transform = MosaicFocalPlaneTransform(
+            ccdnums=self.ccdnums, offsets=offsets, refPositions=[(47.5, 95.5)]*num,
+            pixelSizes=[(0.3, 0.3)]*num, yaws=[0.0]*num,
+            bboxes=[(0, 0, self.width - 1, self.height - 1)]*num, radialCoeffs=[0.0, 1.0])
+        rng = np.random.RandomState(5)
+        y, x = np.indices((self.height, self.width))
+        self.truth = {}
+        self.images = {}
+        self.bad = {}
+        for ccdnum in self.ccdnums:
+            xFp, yFp = self.transform.pixelsToFocalPlane(ccdnum, x, y)
+            self.truth[ccdnum] = self.skyModel(xFp, yFp).astype(np.float32)
+            self.images[ccdnum] = self.truth[ccdnum] + rng.normal(0.0, 5.0, x.shape).astype(np.float32)
+            self.bad[ccdnum] = np.zeros(x.shape, dtype=bool)
+        # Masked stars, and an unmasked galaxy covering a bin
+        self.images[2][50:60, 30:42] += 5000.0
+        self.bad[2][50:60, 30:42] = True
+        self.images[7][96:112, 16:32] += 300.0
+
+    @staticmethod
+    def skyModel(xFp, yFp):
+        return 1000.0 + 0.5*xFp - 0.2*yFp + 3e-3*xFp*yFp - 2e-2*xFp**2 + 1e-5*yFp**3
+
+    def testBinImage(self):
+        image = np.arange(5*7, dtype=np.float32).reshape(5, 7)
+        bad = np.zeros(image.shape, dtype=bool)
+        bad[0:2, 0:1] = True
+        bad[4, 6] = True
+        x, y, values = binImage(image, bad, 3, minFraction=0.5)
+        self.assertFloatsEqual(x, np.array([1.0, 4.0, 6.0]))
+        self.assertFloatsEqual(y, np.array([1.0, 3.5]))
+        self.assertFloatsEqual(values[0, :2], np.array([np.median(image[0:3, 0:3][~bad[0:3, 0:3]]),
+                                                        np.median(image[0:3, 3:6])]))
+        # The top right bin has 1 good pixel of 2
+        self.assertFloatsEqual(values[1, 2], image[3, 6])
+        x, y, values = binImage(image, bad, 3, minFraction=0.6)
+        self.assertTrue(np.isnan(values[1, 2]))
+        self.assertEqual(np.isnan(values).sum(), 1)
+
+    def testBinCenters(self):
+        self.assertFloatsEqual(getBinCenters(10, 3), np.array([1.0, 4.5, 8.0]))
+        self.assertFloatsEqual(getBinCenters(7, 1), np.array([3.0]))
+        # A plane given at the bin centers is reproduced exactly by a linearly interpolated afw background
+        width, height = 50, 37
+        x = getBinCenters(width, 4)
+        y = getBinCenters(height, 3)
+        statsImage = afwImage.MaskedImageF(afwGeom.Extent2I(len(x), len(y)))
+        statsImage.getImage().getArray()[:] = 2.0 + 0.5*x[np.newaxis, :] - 0.25*y[:, np.newaxis]
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(width, height))
+        background = afwMath.BackgroundMI(bbox, statsImage)
+        image = background.getImageF(afwMath.Interpolate.LINEAR, afwMath.REDUCE_INTERP_ORDER)
+        yPixels, xPixels = np.indices((height, width))
+        self.assertFloatsAlmostEqual(image.getArray(), 2.0 + 0.5*xPixels - 0.25*yPixels, atol=1e-4)
+
+    def testFit(self):
+        xFpList, yFpList, valueList = [], [], []
+        for ccdnum in self.ccdnums:
+            x, y, values = binImage(self.images[ccdnum], self.bad[ccdnum], 16)
+            xFp, yFp = self.transform.pixelsToFocalPlane(ccdnum, *np.meshgrid(x, y))
+            xFpList.append(xFp.ravel())
+            yFpList.append(yFp.ravel())
+            valueList.append(values.ravel())
+        bounds = (-62.4, -59.8, 62.4, 59.8)
+        fit = fitFocalPlaneBackground(np.concatenate(xFpList), np.concatenate(yFpList),
+                                      np.concatenate(valueList), bounds, order=4)
+        # The galaxy's bin, of 6 by 12 bins per CCD, is rejected
+        self.assertFalse(fit.used[6*72 + 6*6 + 1])
+        self.assertGreater(fit.used.sum(), 0.95*len(fit.used))
+        xFp, yFp = np.meshgrid(np.linspace(-62.0, 62.0, 20), np.linspace(-59.0, 59.0, 20))
+        self.assertFloatsAlmostEqual(fit.model(xFp, yFp), self.skyModel(xFp, yFp), atol=0.5)
+
+    def testTask(self):
+        exposures = {}
+        for ccdnum in self.ccdnums:
+            exposure = afwImage.ExposureF(self.width, self.height)
+            maskedImage = exposure.getMaskedImage()
+            maskedImage.getImage().getArray()[:] = self.images[ccdnum]
+            mask = maskedImage.getMask()
+            mask.getArray()[self.bad[ccdnum]] = mask.getPlaneBitMask("DETECTED")
+            exposures[ccdnum] = exposure
+        config = MosaicFocalPlaneBackgroundTask.ConfigClass()
+        config.binSize = 16
+        config.nodeSpacing = 8
+        task = MosaicFocalPlaneBackgroundTask(transform=self.transform, config=config)
+        result = task.run(exposures)
+        self.assertEqual(set(result.backgrounds), set(self.ccdnums))
+        for ccdnum in self.ccdnums:
+            background = result.backgrounds[ccdnum].getImage().getArray()
+            self.assertFloatsAlmostEqual(background, self.truth[ccdnum], atol=0.5)
+            residuals = exposures[ccdnum].getMaskedImage().getImage().getArray()
+            expected = self.images[ccdnum] - background
+            self.assertFloatsAlmostEqual(residuals, expected, atol=1e-3)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
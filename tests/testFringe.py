@@ -0,0 +1,141 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.afw.image as afwImage
+import lsst.utils.tests
+from lsst.obs.mosaic.fringe import FringeRegions, getFringeRegions, measureRegions, MosaicFringeTask
+
+
+class FakeDataRef(object):
+    """A data reference to a fringe frame, counting the reads"""
+
+    def __init__(self, path, array):
+        self.dataId = dict(ccdnum=1)
+        self.path = path
+        self.array = array
+        self.numReads = 0
+
+    def get(self, datasetType, **kwargs):
+        if datasetType == "fringe_filename":
+            return [self.path]
+        if datasetType == "fringe":
+            self.numReads += 1
+            fringe = afwImage.ExposureF(self.array.shape[1], self.array.shape[0])
+            fringe.getMaskedImage().getImage().getArray()[:] = self.array
+            return fringe
+        raise KeyError(datasetType)
+
+
+class FringeRegionsTestCase(lsst.utils.tests.TestCase):
+    """Test the vectorized measurement of fringe boxes against one box at a time"""
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.height, self.width = 120, 90
+        self.image = rng.normal(0.0, 1.0, (self.height, self.width)).astype(np.float32)
+        self.bad = rng.uniform(size=self.image.shape) < 0.1
+        self.small, self.large = 3, 10
+
+    def measureBox(self, x, y, size, statistic):
+        pixels = self.image[y - size:y + size, x - size:x + size]
+        pixels = pixels[~self.bad[y - size:y + size, x - size:x + size]]
+        return np.median(pixels) if statistic == "MEDIAN" else np.mean(pixels, dtype=np.float64)
+
+    def testMeasure(self):
+        regions = FringeRegions(self.width, self.height, 50, self.small, self.large, seed=2)
+        self.assertEqual(len(regions), 50)
+        self.assertTrue(np.all(regions.positions >= self.large))
+        self.assertTrue(np.all(regions.positions[:, 0] < self.width - self.large))
+        self.assertTrue(np.all(regions.positions[:, 1] < self.height - self.large))
+        for statistic in ("MEDIAN", "MEAN"):
+            for offsets, size in ((regions.smallOffsets, self.small), (regions.largeOffsets, self.large)):
+                values = measureRegions(self.image, self.bad, regions, offsets, statistic=statistic,
+                                        chunkSize=7)
+                expected = [self.measureBox(x, y, size, statistic) for x, y in regions.positions]
+                self.assertFloatsAlmostEqual(values, np.array(expected), rtol=1e-6, atol=1e-6)
+
+        # A box with only bad pixels
+        bad = np.ones_like(self.bad)
+        self.assertTrue(np.all(np.isnan(measureRegions(self.image, bad, regions, regions.smallOffsets))))
+
+    def testCache(self):
+        regions = getFringeRegions("E1", self.width, self.height, 50, self.small, self.large, seed=2)
+        self.assertIs(getFringeRegions("E1", self.width, self.height, 50, self.small, self.large, seed=2),
+                      regions)
+        self.assertIsNot(getFringeRegions("E2", self.width, self.height, 50, self.small, self.large, seed=2),
+                         regions)
+        self.assertIsNot(getFringeRegions("E1", self.width, self.height, 50, self.small, self.large),
+                         regions)
+
+
+class MosaicFringeTaskTestCase(lsst.utils.tests.TestCase):
+    """Test that the pedestal of cached fringe frames is removed once"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        path = os.path.join(self.root, "fringe.fits")
+        with open(path, "w") as fd:
+            fd.write("fringe")
+        rng = np.random.RandomState(5)
+        self.dataRef = FakeDataRef(path, 100.0 + rng.normal(0.0, 1.0, (120, 90)).astype(np.float32))
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def testPedestal(self):
+        config = MosaicFringeTask.ConfigClass()
+        config.pedestal = True
+        config.num = 20
+        config.small = 3
+        config.large = 10
+        task = MosaicFringeTask(config=config)
+        fringe = task.readFringes(self.dataRef).fringes
+        array = fringe.getMaskedImage().getImage().getArray()
+        self.assertLess(abs(np.median(array)), 1e-3)
+        expected = array.copy()
+
+        self.assertIs(task.readFringes(self.dataRef).fringes, fringe)
+        self.assertEqual(self.dataRef.numReads, 1)
+        exposure = afwImage.ExposureF(90, 120)
+        exposure.getMaskedImage().getImage().getArray()[:] = 2.0*self.dataRef.array
+        task.measure(exposure, fringe)
+        task.measure(exposure, [fringe])
+        np.testing.assert_array_equal(fringe.getMaskedImage().getImage().getArray(), expected)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
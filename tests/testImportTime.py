@@ -0,0 +1,123 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Import-time benchmark of the package and of the entry points that load the mapper
+
+Each statement is run in a new interpreter with python -X importtime (Python 3.7+),
+which reports the cumulative import time of every module; the tests check which
+modules are imported.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import subprocess
+import sys
+import unittest
+
+import lsst.utils.tests
+
+# Modules that only some tasks need, and that must not be imported on startup
+HEAVY_MODULES = ["MySQLdb", "pyfits", "lsst.obs.mosaic.defects", "lsst.obs.mosaic.instcal",
+                 "lsst.obs.mosaic.linearize", "lsst.obs.mosaic.selectMosaicImages"]
+# The import chain of bin/ingestImagesDecam.py, which loads the mapper to find the package of the repository
+INGEST_STATEMENT = ("from lsst.obs.decam.ingest import DecamIngestTask; "
+                    "from lsst.obs.mosaic import MosaicMapper")
+
+
+def measureImportTimes(statement):
+    """Run a statement in a new interpreter and return an OrderedDict of module: cumulative import time (us)
+
+    Raise RuntimeError if the statement fails.
+    """
+    process = subprocess.Popen([sys.executable, "-X", "importtime", "-c", statement],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError("Failed to run %r: %s" % (statement, stderr))
+    times = collections.OrderedDict()
+    for line in stderr.splitlines():
+        fields = line.split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+def canImport(statement):
+    """Return True if a statement runs in a new interpreter"""
+    with open(os.devnull, "w") as devnull:
+        return subprocess.call([sys.executable, "-c", statement], stderr=devnull) == 0
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "python -X importtime needs Python 3.7")
+class ImportTimeTestCase(lsst.utils.tests.TestCase):
+    """Test that the package and its entry points import only what they need"""
+
+    def assertNotImported(self, times, modules):
+        for module in modules:
+            self.assertNotIn(module, times)
+
+    def testPackage(self):
+        """Importing the package imports none of its submodules"""
+        times = measureImportTimes("import lsst.obs.mosaic")
+        self.assertIn("lsst.obs.mosaic", times)
+        self.assertEqual([name for name in times if name.startswith("lsst.obs.mosaic.")], [])
+        self.assertNotImported(times, HEAVY_MODULES + ["lsst.afw.image", "lsst.ip.isr"])
+
+    def testLazyAttributes(self):
+        """Submodules and MosaicMapper are imported on first access"""
+        times = measureImportTimes("import lsst.obs.mosaic; lsst.obs.mosaic.biasJump.findBiasJump")
+        self.assertIn("lsst.obs.mosaic.biasJump", times)
+        self.assertNotIn("lsst.obs.mosaic.mosaicMapper", times)
+        self.assertTrue(canImport("import lsst.obs.mosaic; lsst.obs.mosaic.MosaicMapper.packageName"))
+        self.assertFalse(canImport("import lsst.obs.mosaic; lsst.obs.mosaic.noSuchModule"))
+
+    def testMapper(self):
+        """The mapper imports the modules of the datasets it reads when it reads them"""
+        times = measureImportTimes("from lsst.obs.mosaic import MosaicMapper")
+        self.assertIn("lsst.obs.mosaic.mosaicMapper", times)
+        self.assertNotImported(times, HEAVY_MODULES)
+        packageTimes = measureImportTimes("import lsst.obs.mosaic")
+        self.assertLess(packageTimes["lsst.obs.mosaic"], times["lsst.obs.mosaic.mosaicMapper"])
+
+    def testIngest(self):
+        """The import chain of ingestImagesDecam.py imports none of the heavy modules"""
+        if not canImport("import lsst.obs.decam.ingest"):
+            self.skipTest("obs_decam is not set up")
+        times = measureImportTimes(INGEST_STATEMENT)
+        self.assertIn("lsst.obs.mosaic.mosaicMapper", times)
+        self.assertNotImported(times, HEAVY_MODULES)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
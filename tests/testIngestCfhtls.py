@@ -0,0 +1,95 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.meas.algorithms import IndexerRegistry
+from lsst.obs.mosaic.ingestCfhtls import readCfhtlsCatalog, _indexFile, IngestCfhtlsReferenceConfig
+
+
+class IngestCfhtlsTestCase(lsst.utils.tests.TestCase):
+    """Test reading and indexing CFHTLS Wide catalogs"""
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        rng = np.random.RandomState(7)
+        numRows = 1000
+        self.data = np.zeros((numRows, 24))
+        self.data[:, 0] = np.arange(numRows)
+        self.data[:, 3] = rng.uniform(34.0, 35.0, numRows)
+        self.data[:, 4] = rng.uniform(-5.0, -4.0, numRows)
+        self.data[:, 6] = rng.randint(0, 4, numRows)
+        self.data[:, 7:12] = rng.uniform(18.0, 25.0, (numRows, 5))
+        self.data[:, 12:17] = 0.02
+        self.filename = os.path.join(self.tempDir, "CFHTLS_W_test.cat")
+        with open(self.filename, "w") as outfile:
+            outfile.write("# id x y ra dec r2 flag u g r i z ...\n")
+            np.savetxt(outfile, self.data, fmt="%.7f")
+        flags = self.data[:, 6].astype(int)
+        self.selected = ((flags & 1) == 1) & ((flags & 2) == 0) & (self.data[:, 9] < 23.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def testRead(self):
+        """Test that chunked reading applies the star, saturation and magnitude cuts"""
+        stars = np.concatenate(list(readCfhtlsCatalog(self.filename, chunkSize=97)))
+        self.assertEqual(len(stars), self.selected.sum())
+        np.testing.assert_allclose(stars["ra"], self.data[self.selected, 3])
+        np.testing.assert_allclose(stars["z"], self.data[self.selected, 11])
+        np.testing.assert_allclose(stars["g_err"], np.hypot(0.001, 0.02))
+        self.assertTrue(np.all(stars["starnotgal"]))
+        self.assertFalse(np.any(stars["resolved"]))
+
+    def testIndex(self):
+        """Test that the partial shards contain each selected star once, in the right pixel"""
+        indexerConfig = IngestCfhtlsReferenceConfig().dataset_config.indexer
+        indexer = IndexerRegistry[indexerConfig.name](indexerConfig.active)
+        fileIndex, numStars, shards = _indexFile((self.filename, 3, indexerConfig.name, indexerConfig.active,
+                                                 self.tempDir, 100, 23.0, "r"))
+        self.assertEqual(fileIndex, 3)
+        self.assertEqual(numStars, self.selected.sum())
+        indices = []
+        for pixelId, path in shards:
+            with np.load(path) as partial:
+                pixelIds = indexer.index_points(partial["stars"]["ra"], partial["stars"]["dec"])
+                self.assertTrue(np.all(np.asarray(pixelIds) == pixelId))
+                indices.append(partial["index"])
+        self.assertEqual(sorted(np.concatenate(indices)), list(range(numStars)))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,103 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.utils.tests
+import lsst.afw.image as afwImage
+from lsst.obs.mosaic import synthetic
+from lsst.obs.mosaic.instcal import (DQMASK_PLANES, MIN_WEIGHT, makeDqmaskLut, dqmaskToMask,
+                                     weightToVariance, readInstcal, makeInstcalMaskedImage)
+
+
+class InstcalTestCase(lsst.utils.tests.TestCase):
+    """Test reading synthetic instcal, dqmask and wtmap files"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.shape = (40, 20)
+        self.rows = synthetic.makeSyntheticRepository(self.root, numVisits=1, ccdnums=(1, 2),
+                                                      shape=self.shape, datasets=("instcal",))
+        self.paths = [os.path.join(self.root, self.rows[0][fileType]) for fileType in
+                      ("instcal", "dqmask", "wtmap")]
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def testLut(self):
+        planeBits = dict((dqBit, 1 << i) for i, dqBit in enumerate(DQMASK_PLANES))
+        lut = makeDqmaskLut(planeBits)
+        self.assertIs(makeDqmaskLut(dict(planeBits)), lut)
+        dqmask = np.array([0, 1, 2, 3, 16 | 512, 8, -1], dtype=np.int16)
+        expected = [0, planeBits[1], planeBits[2], planeBits[1] | planeBits[2],
+                    planeBits[16] | planeBits[512], 0, sum(planeBits.values())]
+        self.assertEqual(list(dqmaskToMask(dqmask, lut)), expected)
+
+    def testWeightToVariance(self):
+        weight = np.array([4.0, 0.0, -1.0, np.nan, 0.5], dtype=np.float32)
+        variance = weightToVariance(weight)
+        self.assertIs(variance, weight)
+        self.assertFloatsAlmostEqual(variance, np.array([0.25, 1/MIN_WEIGHT, 1/MIN_WEIGHT, 1/MIN_WEIGHT, 2.0],
+                                                        dtype=np.float32), rtol=1e-6)
+
+    def testRead(self):
+        hdu = 2
+        primaryHeader, header, image, mask, variance = readInstcal(*self.paths, hdu=hdu)
+        self.assertEqual(primaryHeader["OBSERVAT"], fits.getheader(self.paths[0], 0)["OBSERVAT"])
+        for array in (image, mask, variance):
+            self.assertEqual(array.shape, self.shape)
+            self.assertTrue(array.dtype.isnative)
+            self.assertTrue(array.flags.writeable)
+        self.assertFloatsEqual(image, fits.getdata(self.paths[0], hdu).astype(np.float32))
+        dqmask = fits.getdata(self.paths[1], hdu)
+        self.assertTrue(np.all((mask != 0) == (dqmask != 0)))
+        self.assertTrue(np.all(mask[dqmask == 1] == afwImage.MaskU.getPlaneBitMask("BAD")))
+        weight = fits.getdata(self.paths[2], hdu)
+        good = weight > 0
+        self.assertFloatsAlmostEqual(variance[good], 1.0/weight[good], rtol=1e-6)
+        self.assertTrue(np.all(variance[~good] >= 1/MIN_WEIGHT))
+
+        serial = readInstcal(*self.paths, hdu=hdu, numThreads=1)
+        for array, serialArray in zip((image, mask, variance), serial[2:]):
+            self.assertTrue(np.all(array == serialArray))
+
+        maskedImage = makeInstcalMaskedImage(image, mask, variance)
+        image[0, 0] = -1.0
+        self.assertEqual(maskedImage.getImage().getArray()[0, 0], -1.0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
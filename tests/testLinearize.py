@@ -0,0 +1,124 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.image as afwImage
+from lsst.ip.isr import LinearizeLookupTable
+from lsst.obs.mosaic import MosaicMapper
+from lsst.obs.mosaic.linearize import (FastLinearizeLookupTable, compactTable, getFastLinearizer,
+                                      _getThreadPool)
+
+
+class FastLinearizeTestCase(lsst.utils.tests.TestCase):
+    """Test that the fast linearizer matches LinearizeLookupTable"""
+
+    def setUp(self):
+        self.camera = MosaicMapper(root=".").camera
+        self.detector = self.camera[3]
+        self.rng = np.random.RandomState(3)
+        self.image = afwImage.ImageF(self.detector.getBBox())
+        # include pixels below and above the range of the table
+        self.image.getArray()[:] = self.rng.uniform(-20, 1100, size=self.image.getArray().shape)
+
+    def tearDown(self):
+        del self.camera
+        del self.detector
+        del self.image
+
+    def checkLinearizer(self, table, numThreads):
+        slowImage = self.image.Factory(self.image, True)
+        fastImage = self.image.Factory(self.image, True)
+        slow = LinearizeLookupTable(table=table, detector=self.detector)
+        fast = FastLinearizeLookupTable(table, self.detector, numThreads=numThreads)
+        slowResult = slow(image=slowImage, detector=self.detector)
+        fastResult = fast(image=fastImage, detector=self.detector)
+        self.assertEqual(fastResult.numAmps, slowResult.numAmps)
+        self.assertEqual(fastResult.numOutOfRange, slowResult.numOutOfRange)
+        self.assertGreater(fastResult.numOutOfRange, 0)
+        self.assertImagesEqual(fastImage, slowImage)
+
+    def testIntegerTable(self):
+        table = np.rint(self.rng.normal(0, 20, size=(2, 1024))).astype(np.float32)
+        self.assertEqual(compactTable(table).dtype, np.int16)
+        for numThreads in (1, 2):
+            self.checkLinearizer(table, numThreads)
+
+    def testHalfIntegers(self):
+        """Pixels halfway between two table entries are rounded away from zero, as std::lround"""
+        halves = np.arange(-20, 1100) + 0.5
+        array = self.image.getArray()
+        array[:] = halves[self.rng.randint(0, len(halves), size=array.shape)]
+        table = np.rint(self.rng.normal(0, 20, size=(2, 1024))).astype(np.float32)
+        for numThreads in (1, 2):
+            self.checkLinearizer(table, numThreads)
+
+    def testFloatTable(self):
+        table = self.rng.normal(0, 20, size=(2, 1024)).astype(np.float32)
+        self.assertEqual(compactTable(table).dtype, np.float32)
+        self.checkLinearizer(table, 2)
+
+    def testCompactTable(self):
+        self.assertEqual(compactTable([[0.5, -1.25], [2.0, 3.0]]).dtype, np.float16)
+        self.assertEqual(compactTable([[1e5, 0.0], [2.0, 3.0]]).dtype, np.float32)
+        self.assertEqual(compactTable([[np.nan, 0.0], [2.0, 3.0]]).dtype, np.float32)
+
+    def testCache(self):
+        table = np.zeros((2, 10), dtype=np.float32)
+        linearizer = LinearizeLookupTable(table=table, detector=self.detector)
+        fast = getFastLinearizer(linearizer, self.detector)
+        self.assertIs(getFastLinearizer(linearizer, self.detector), fast)
+        other = LinearizeLookupTable(table=table, detector=self.detector)
+        self.assertIsNot(getFastLinearizer(other, self.detector), fast)
+        # Another number of threads does not change the cached instance
+        fast = getFastLinearizer(linearizer, self.detector, numThreads=2)
+        single = getFastLinearizer(linearizer, self.detector, numThreads=1)
+        self.assertEqual(single.numThreads, 1)
+        self.assertEqual(fast.numThreads, 2)
+        self.assertIs(getFastLinearizer(linearizer, self.detector, numThreads=2), fast)
+
+    def testThreadPools(self):
+        """A pool stays usable when another thread asks for a pool of another size"""
+        pool = _getThreadPool(2)
+        self.assertIsNot(_getThreadPool(3), pool)
+        self.assertIs(_getThreadPool(2), pool)
+        self.assertEqual(pool.map(abs, [-1, -2, 3]), [1, 2, 3])
+
+    def testCheckDetector(self):
+        fast = FastLinearizeLookupTable(np.zeros((2, 10)), self.detector)
+        with self.assertRaises(RuntimeError):
+            fast(image=self.image, detector=self.camera[4])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
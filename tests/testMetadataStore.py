@@ -0,0 +1,116 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+from lsst.daf.base import PropertySet
+from lsst.obs.mosaic.metadataStore import MetadataStore
+from lsst.obs.mosaic.stageTimer import summarizeStages
+
+
+def makeMetadata(ccdnum, scale=1.0):
+    """Make the metadata of a processCcd run with stage measurements of its isr subtask"""
+    metadata = PropertySet()
+    metadata.set("processCcd:isr.maskEdgesStageWallTime", 0.5*scale*ccdnum)
+    metadata.set("processCcd:isr.maskEdgesStageCpuTime", 0.25*scale*ccdnum)
+    metadata.set("processCcd:isr.maskEdgesStageMaxRssDelta", 1000.0*ccdnum)
+    for value in (1.0, 2.0):
+        metadata.add("processCcd:isr.overscanCorrectionStageWallTime", value*scale)
+    metadata.set("processCcd:charImage.numSources", 100*ccdnum)
+    metadata.set("processCcd:calibrate.photoCalib", "zeropoint")
+    return metadata
+
+
+def putMetadata(args):
+    path, ccdnum = args
+    MetadataStore(path).put("processCcd", dict(visit=1, ccdnum=ccdnum), makeMetadata(ccdnum))
+
+
+class MetadataStoreTestCase(lsst.utils.tests.TestCase):
+    """Test the SQLite store of task metadata"""
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempDir, "run", "metadata.sqlite3")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+
+    def testPutGet(self):
+        store = MetadataStore(self.path)
+        self.assertIsNone(store.get("processCcd", dict(visit=1, ccdnum=1)))
+        self.assertEqual(len(store.summarizeStages()), 0)
+        for ccdnum in (1, 2, 3):
+            store.put("processCcd", dict(visit=1, ccdnum=ccdnum), makeMetadata(ccdnum, scale=10.0))
+        # Processed again: the latest record is used
+        for ccdnum in (1, 2, 3):
+            store.put("processCcd", dict(visit=1, ccdnum=ccdnum), makeMetadata(ccdnum))
+        store.put("processCcd", dict(visit=2, ccdnum=1), makeMetadata(4))
+        store.put("isr", dict(visit=1, ccdnum=1), makeMetadata(5))
+
+        metadata = store.get("processCcd", dict(ccdnum=2, visit=1))
+        self.assertEqual(metadata["processCcd:isr.overscanCorrectionStageWallTime"], [1.0, 2.0])
+        self.assertEqual(metadata["processCcd:charImage.numSources"], [200])
+        self.assertEqual(metadata["processCcd:calibrate.photoCalib"], ["zeropoint"])
+
+        self.assertEqual(store.getDataIds(task="processCcd", dataId=dict(visit=1)),
+                         [dict(visit=1, ccdnum=ccdnum) for ccdnum in (1, 2, 3)])
+        self.assertEqual(len(store.getDataIds()), 5)
+        summary = store.summarizeStages(task="processCcd", dataId=dict(visit=1))
+        expected = summarizeStages(makeMetadata(ccdnum) for ccdnum in (1, 2, 3))
+        self.assertEqual(list(summary), list(expected))
+        for stage in expected:
+            self.assertEqual(set(summary[stage]), set(expected[stage]))
+            for quantity in expected[stage]:
+                self.assertAlmostEqual(summary[stage][quantity], expected[stage][quantity])
+        self.assertEqual(summary["maskEdges"]["runs"], 3)
+        self.assertEqual(summary["overscanCorrection"]["calls"], 6)
+        self.assertEqual(summary["maskEdges"]["MaxRssDelta"], 3000.0)
+
+    def testConcurrentWriters(self):
+        ccdnums = list(range(1, 33))
+        pool = multiprocessing.Pool(4)
+        try:
+            pool.map(putMetadata, [(self.path, ccdnum) for ccdnum in ccdnums], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        store = MetadataStore(self.path)
+        self.assertEqual(sorted(dataId["ccdnum"] for dataId in store.getDataIds()), ccdnums)
+        self.assertEqual(store.summarizeStages()["maskEdges"]["runs"], len(ccdnums))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
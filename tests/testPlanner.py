@@ -0,0 +1,110 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import lsst.utils.tests
+from lsst.obs.mosaic import synthetic
+from lsst.obs.mosaic.planner import planNewData, formatIdArguments, writeIdFile, getTemplateKeys
+
+CALEXP_TEMPLATE = "calexp/%(field)s/%(subfield)s/%(filter)s/%(dateObs)s/%(objname)s_%(ccdnum)d.fits"
+SRC_TEMPLATE = "src/%(field)s/%(subfield)s/%(filter)s/%(dateObs)s/%(objname)s_%(ccdnum)d.fits"
+
+
+class PlannerTestCase(lsst.utils.tests.TestCase):
+    """Test the planning of new data against a synthetic repository"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.output = os.path.join(self.root, "rerun", "nightly")
+        self.rows = synthetic.makeSyntheticRepository(self.root, numVisits=2, ccdnums=(1, 2), shape=(40, 20),
+                                                      datasets=("preprocessed",))
+        self.inputTemplates = [synthetic.PREPROCESSED_TEMPLATE + "[%(ccdnum)d]"]
+        self.outputTemplates = [CALEXP_TEMPLATE, SRC_TEMPLATE]
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def touch(self, template, row, mtime):
+        path = os.path.join(self.output, template % row)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w"):
+            pass
+        os.utime(path, (mtime, mtime))
+
+    def plan(self, **kwargs):
+        return planNewData(self.root, self.output, self.inputTemplates, self.outputTemplates, **kwargs)
+
+    def testPlan(self):
+        plan = self.plan()
+        self.assertEqual(len(plan.dataIds), 4)
+        self.assertEqual(plan.numNew, 4)
+        self.assertEqual(list(plan.dataIds[0]), getTemplateKeys("".join(self.inputTemplates +
+                                                                        self.outputTemplates)))
+
+        future = time.time() + 100
+        past = time.time() - 100
+        for row in self.rows:
+            for template in self.outputTemplates:
+                self.touch(template, row, future)
+        # An output older than the input, and a missing output
+        self.touch(SRC_TEMPLATE, self.rows[1], past)
+        os.remove(os.path.join(self.output, CALEXP_TEMPLATE % self.rows[2]))
+        plan = self.plan()
+        self.assertEqual((plan.numNew, plan.numStale, plan.numUpToDate, plan.numMissingInput), (1, 1, 2, 0))
+        self.assertEqual([(dataId["objname"], dataId["ccdnum"]) for dataId in plan.dataIds],
+                         [(row["objname"], row["ccdnum"]) for row in self.rows[1:3]])
+
+        plan = self.plan(dataId=dict(objname=self.rows[0]["objname"]))
+        self.assertEqual(len(plan.dataIds) + plan.numUpToDate, 2)
+
+        os.remove(os.path.join(self.root, synthetic.PREPROCESSED_TEMPLATE % self.rows[0]))
+        plan = self.plan()
+        self.assertEqual(plan.numMissingInput, 2)
+
+    def testIdArguments(self):
+        plan = self.plan()
+        lines = formatIdArguments(plan.dataIds)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("--id field=F2 "))
+        self.assertTrue(lines[0].endswith(" ccdnum=1^2"))
+        path = os.path.join(self.root, "plan.txt")
+        writeIdFile(path, plan.dataIds)
+        with open(path) as infile:
+            self.assertEqual(infile.read().splitlines(), lines)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
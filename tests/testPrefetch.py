@@ -0,0 +1,100 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import threading
+import time
+import unittest
+
+import lsst.utils.tests
+from lsst.obs.mosaic.prefetch import Prefetcher, getPrefetched
+
+
+class PrefetchTestCase(lsst.utils.tests.TestCase):
+    """Test the read-ahead of Prefetcher"""
+
+    def setUp(self):
+        self.dataIds = [dict(visit=1, ccdnum=ccdnum) for ccdnum in range(1, 9)]
+        self.loaded = []
+        self.lock = threading.Lock()
+
+    def load(self, dataId, delay=0.0, nbytes=100):
+        time.sleep(delay)
+        with self.lock:
+            self.loaded.append(dataId["ccdnum"])
+        return dataId["ccdnum"]*10, nbytes
+
+    def testReadAhead(self):
+        with Prefetcher(self.dataIds, self.load, depth=2, numThreads=2) as prefetcher:
+            for dataId in self.dataIds:
+                # Give the threads time to read ahead while the CCD "computes"
+                time.sleep(0.05)
+                self.assertEqual(getPrefetched(dataId), dataId["ccdnum"]*10)
+                self.assertEqual(getPrefetched(dataId), dataId["ccdnum"]*10)
+            stats = prefetcher.getStats()
+        self.assertIsNone(getPrefetched(self.dataIds[0]))
+        self.assertEqual(sorted(self.loaded), list(range(1, 9)))
+        self.assertEqual(stats["gets"], 8)
+        self.assertEqual(stats["hits"] + stats["misses"], 8)
+        self.assertGreaterEqual(stats["hits"], 7)
+        self.assertEqual(stats["bytes"], 100*stats["hits"])
+
+    def testMemoryBudget(self):
+        prefetcher = Prefetcher(self.dataIds, lambda dataId: self.load(dataId, nbytes=1000), depth=8,
+                                numThreads=4, maxBytes=1500)
+        with prefetcher:
+            time.sleep(0.2)
+            # One load may start while under the budget, and one more may be in flight
+            self.assertLessEqual(len(self.loaded), 2 + 4)
+            self.assertLessEqual(prefetcher._bytes, 1500 + 4*1000)
+            for dataId in self.dataIds:
+                self.assertEqual(prefetcher.get(dataId), dataId["ccdnum"]*10)
+        self.assertEqual(prefetcher.getStats()["gets"], 8)
+
+    def testStall(self):
+        with Prefetcher(self.dataIds[:2], lambda dataId: self.load(dataId, delay=0.2),
+                        depth=1, numThreads=1) as prefetcher:
+            time.sleep(0.05)
+            self.assertEqual(prefetcher.get(self.dataIds[0]), 10)
+            self.assertEqual(prefetcher.get(self.dataIds[1]), 20)
+            stats = prefetcher.getStats()
+        self.assertEqual(stats["hits"] + stats["misses"], 2)
+        self.assertGreaterEqual(stats["stalls"], 1)
+        self.assertGreater(stats["stallTime"], 0.1)
+
+    def testSkip(self):
+        with Prefetcher(self.dataIds, self.load, depth=2, numThreads=1) as prefetcher:
+            self.assertEqual(prefetcher.get(self.dataIds[5]), 60)
+            self.assertEqual(prefetcher.get(self.dataIds[6]), 70)
+            self.assertEqual(prefetcher.get(dict(visit=2, ccdnum=3)), 30)
+        self.assertEqual(prefetcher.getStats()["gets"], 3)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,147 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.afw.image as afwImage
+import lsst.utils.tests
+from lsst.obs.mosaic.focalPlane import MosaicFocalPlaneTransform
+from lsst.obs.mosaic.quicklook import (binArray, readBinnedHdu, placeCcds, makeCcdQuicklook,
+                                       MosaicQuicklookTask)
+
+
+class FakeDataRef(object):
+    """A data reference to a CCD with a quicklookCcd and one HDU of a multi-extension file"""
+
+    def __init__(self, quicklook, path):
+        self.quicklook = quicklook
+        self.path = path
+
+    def datasetExists(self, datasetType):
+        return datasetType == "quicklookCcd"
+
+    def get(self, datasetType):
+        if datasetType == "quicklookCcd":
+            return self.quicklook
+        return [self.path + "[1]"]
+
+
+class QuicklookTestCase(lsst.utils.tests.TestCase):
+    """Test the binning and placement of the CCDs of quicklook images"""
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+
+    def testBinArray(self):
+        array = np.arange(5*7, dtype=np.float32).reshape(5, 7)
+        bad = np.zeros(array.shape, dtype=bool)
+        bad[0, 0] = True
+        bad[3:5, 6] = True
+        binned = binArray(array, 3, bad)
+        self.assertEqual(binned.shape, (2, 3))
+        self.assertFloatsAlmostEqual(binned[0, 0], array[0:3, 0:3][~bad[0:3, 0:3]].mean(), atol=1e-5)
+        self.assertFloatsAlmostEqual(binned[1, 1], array[3:5, 3:6].mean(), atol=1e-5)
+        self.assertTrue(np.isnan(binned[1, 2]))
+
+    def testReadBinnedHdu(self):
+        """Test that reading in bands gives the binned image of the whole HDU"""
+        rng = np.random.RandomState(3)
+        image = rng.normal(100.0, 10.0, (100, 60)).astype(np.float32)
+        mask = np.zeros(image.shape, dtype=np.uint16)
+        mask[10:20, 5:9] = 1 << 3
+        mask[50, :] = 1 << 1
+        maskHeader = fits.Header()
+        maskHeader["MP_BAD"] = 0
+        maskHeader["MP_SAT"] = 1
+        maskHeader["MP_CR"] = 3
+        path = os.path.join(self.tempDir, "exposure.fits")
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(image), fits.ImageHDU(mask, header=maskHeader)]
+                     ).writeto(path)
+
+        binned = readBinnedHdu(path, 1, 8, maskHdu=2, badMaskPlanes=["BAD", "SAT"], bandBins=3)
+        self.assertFloatsAlmostEqual(binned, binArray(image, 8, (mask & 0x3) != 0), atol=1e-4)
+        binned = readBinnedHdu(path, 1, 8, bandBins=5)
+        self.assertFloatsAlmostEqual(binned, binArray(image, 8), atol=1e-4)
+
+    def testReadCcd(self):
+        """Test that the quicklookCcd is used only if binned by binSize from the dataset"""
+        binSize = 4
+        exposure = afwImage.ExposureF(16, 24)
+        exposure.getMaskedImage().getImage().getArray()[:] = 1.0
+        path = os.path.join(self.tempDir, "preprocessed.fits")
+        image = np.full((24, 16), 2.0, dtype=np.float32)
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(image)]).writeto(path)
+        dataRef = FakeDataRef(makeCcdQuicklook(exposure, binSize), path)
+        self.assertEqual(dataRef.quicklook.getMetadata().get("DATASET"), "postISRCCD")
+
+        config = MosaicQuicklookTask.ConfigClass()
+        config.binSize = binSize
+        config.dataset = "postISRCCD"
+        self.assertFloatsEqual(MosaicQuicklookTask(config=config).readCcd(dataRef), np.ones((6, 4)))
+        for dataset, size in (("preprocessed", binSize), ("postISRCCD", 2*binSize)):
+            config.dataset = dataset
+            config.binSize = size
+            binned = MosaicQuicklookTask(config=config).readCcd(dataRef)
+            self.assertFloatsEqual(binned, np.full((24//size, 16//size), 2.0))
+
+    def testPlaceCcds(self):
+        """Test that CCDs are placed by their offsets and yaw"""
+        binSize = 4
+        width, height = 16, 24
+        transform = MosaicFocalPlaneTransform(
+            ccdnums=[1, 2, 3], offsets=[(-5.0, 0.0), (5.0, 0.0), (0.0, 10.0)],
+            refPositions=[(7.5, 11.5)]*3, pixelSizes=[(0.25, 0.25)]*3, yaws=[0.0, 180.0, 90.0],
+            bboxes=[(0, 0, width - 1, height - 1)]*3, radialCoeffs=[0.0, 1.0])
+        binnedImages = dict((ccdnum, np.arange(24, dtype=np.float32).reshape(6, 4) + 100*ccdnum)
+                            for ccdnum in (1, 2, 3))
+        result = placeCcds(binnedImages, transform, binSize)
+        self.assertFloatsAlmostEqual(result.scale, 1.0, atol=1e-12)
+        # CCD 1 spans x = [-7, -3) mm, y = [-3, 3) mm; CCD 2 x = [3, 7); CCD 3 x = [-3, 3), y = [8, 12)
+        self.assertEqual(result.image.shape, (15, 14))
+        self.assertFloatsAlmostEqual(result.xFp0, -6.5, atol=1e-12)
+        self.assertFloatsAlmostEqual(result.yFp0, -2.5, atol=1e-12)
+        self.assertFloatsEqual(result.image[0:6, 0:4], binnedImages[1])
+        self.assertFloatsEqual(result.image[0:6, 10:14], binnedImages[2][::-1, ::-1])
+        self.assertFloatsEqual(result.image[11:15, 4:10], np.rot90(binnedImages[3], -1))
+        self.assertTrue(np.all(np.isnan(result.image[6:11])))
+        self.assertEqual(np.isfinite(result.image).sum(), 3*24)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
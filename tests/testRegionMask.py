@@ -0,0 +1,126 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.utils.tests
+from lsst.obs.mosaic import regionMask
+
+REGION_TEXT = """# Region file format: DS9 version 4.1
+global color=green dashlist=8 3 width=1 font="helvetica 10 normal roman" select=1
+image
+polygon(10.5,5.2,60.3,12.8,45.1,70.4,30,40,12.2,66.6) # text={trail}
+circle(80,30,12.5)
+box(20,90,10,6,30);-circle(20,90,2)
+"""
+
+
+def insidePolygon(x, y, vertices):
+    """Even-odd rule for points (x, y), one edge at a time"""
+    inside = np.zeros(np.broadcast(x, y).shape, dtype=bool)
+    n = len(vertices)
+    for i in range(n):
+        (x0, y0), (x1, y1) = vertices[i], vertices[(i + 1) % n]
+        crosses = (y0 <= y) != (y1 <= y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            xc = x0 + (y - y0)*(x1 - x0)/(y1 - y0)
+        inside ^= crosses & (x < xc)
+    return inside
+
+
+class RegionMaskTestCase(lsst.utils.tests.TestCase):
+    """Test rasterization of ds9 regions and writing of masked images"""
+
+    def setUp(self):
+        self.shape = (110, 100)
+        # 1-based coordinates of the pixel centers
+        self.y, self.x = np.indices(self.shape) + 1.0
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+
+    def testParse(self):
+        regions = regionMask.parseRegions(REGION_TEXT)
+        self.assertEqual([(shape, exclude) for shape, params, exclude in regions],
+                         [("polygon", False), ("circle", False), ("box", False), ("circle", True)])
+        self.assertEqual(regions[1][1], [80.0, 30.0, 12.5])
+        with self.assertRaises(RuntimeError):
+            regionMask.parseRegions("fk5\ncircle(150.1,2.2,3\")\n")
+
+    def testPolygon(self):
+        vertices = [(10.5, 5.2), (60.3, 12.8), (45.1, 70.4), (30, 40), (12.2, 66.6)]
+        mask = np.zeros(self.shape, dtype=bool)
+        regionMask.rasterizePolygon(mask, vertices)
+        np.testing.assert_array_equal(mask, insidePolygon(self.x, self.y, vertices))
+        # partly off the image
+        vertices = [(-20, -20), (50.5, 3.5), (130, 130)]
+        mask = np.zeros(self.shape, dtype=bool)
+        regionMask.rasterizePolygon(mask, vertices)
+        np.testing.assert_array_equal(mask, insidePolygon(self.x, self.y, vertices))
+
+    def testCircle(self):
+        mask = np.zeros(self.shape, dtype=bool)
+        regionMask.rasterizeCircle(mask, 80, 30, 12.5)
+        np.testing.assert_array_equal(mask, (self.x - 80)**2 + (self.y - 30)**2 <= 12.5**2)
+        mask = np.zeros(self.shape, dtype=bool)
+        regionMask.rasterizeCircle(mask, 50, 50, 5)
+        self.assertEqual(mask.sum(), np.sum((self.x - 50)**2 + (self.y - 50)**2 <= 25))
+
+    def testWriteRegionMask(self):
+        regionPath = os.path.join(self.tempDir, "obj330_1.reg")
+        with open(regionPath, "w") as outfile:
+            outfile.write(REGION_TEXT)
+        bpm = np.ones(self.shape, dtype=np.uint16)
+        bpm[:, 3] = 0
+        bpmPath = os.path.join(self.tempDir, "bpm.fits")
+        fits.writeto(bpmPath, bpm)
+        outputPath = os.path.join(self.tempDir, "masks", "obj330_1.bpm.fits.fz")
+
+        jobs = [(regionPath, bpmPath, None, outputPath)]
+        (path, numMasked), = regionMask.buildRegionMasks(jobs)
+        self.assertEqual(path, outputPath)
+        expected = regionMask.makeRegionMask(regionMask.readRegions(regionPath), self.shape)
+        self.assertFalse(expected[90 - 1, 20 - 1])  # excluded from the box
+        self.assertEqual(numMasked, expected.sum())
+        with fits.open(outputPath) as hduList:
+            self.assertIsInstance(hduList[1], fits.CompImageHDU)
+            image = hduList[1].data
+        np.testing.assert_array_equal(image, np.where(expected, 0, bpm))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
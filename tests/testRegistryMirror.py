@@ -0,0 +1,125 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import lsst.utils.tests
+from lsst.obs.mosaic import synthetic
+from lsst.obs.mosaic.registryMirror import RegistryMirror, MirroredLookup, getRegistryPath
+
+
+class FakeMapping(object):
+    """Just enough of an lsst.obs.base.Mapping to wrap its lookup"""
+    columns = None
+    obsTimeName = None
+
+    def __init__(self):
+        self.numCalls = 0
+
+    def lookup(self, properties, dataId):
+        self.numCalls += 1
+        return []
+
+
+class RegistryMirrorTestCase(lsst.utils.tests.TestCase):
+    """Test answering registry lookups from memory"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        rows = []
+        for visit in synthetic.makeVisits(6):
+            for ccdnum in synthetic.CCDNUMS:
+                rows.append(dict(visit, ccdnum=ccdnum, ccd=ccdnum, hdu=ccdnum))
+        synthetic.writeRegistry(self.root, rows)
+        self.path = os.path.join(self.root, "registry.sqlite3")
+        self.conn = sqlite3.connect(self.path)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def query(self, properties, dataId):
+        where = " AND ".join("%s=?" % (key,) for key in dataId)
+        sql = "SELECT DISTINCT %s FROM raw" % (", ".join(properties),)
+        if where:
+            sql += " WHERE " + where
+        return sorted(self.conn.execute(sql, list(dataId.values())).fetchall())
+
+    def testLookup(self):
+        mirror = RegistryMirror.get(self.path)
+        self.assertIs(RegistryMirror.get(self.path), mirror)
+        self.assertEqual(getRegistryPath(self), self.path)  # anything with a sqlite conn
+        self.assertIsNone(getRegistryPath(FakeMapping()))
+        for properties, dataId in [
+            (["field", "subfield", "filter", "dateObs", "objname"], dict(visit=100003, ccdnum=2)),
+            (["visit", "ccdnum"], dict(filter="V")),
+            (["filter"], dict(visit=100004)),
+            (["objname"], dict(visit="100001", ccdnum="8")),
+            (["ccdnum"], dict(visit=1)),
+            (["filter"], {}),
+        ]:
+            self.assertEqual(sorted(mirror.lookup(properties, dataId)),
+                             self.query(properties, dict((k, int(v)) if k in ("visit", "ccdnum") else (k, v)
+                                                         for k, v in dataId.items())))
+        self.assertIsNone(mirror.lookup(["tract"], dict(visit=100001)))
+        self.assertIsNone(mirror.lookup(["filter"], dict(pointing=3)))
+
+    def testReload(self):
+        mirror = RegistryMirror.get(self.path)
+        loads = RegistryMirror.stats[(self.path, "raw")]["loads"]
+        self.conn.execute("DELETE FROM raw WHERE visit=100001")
+        self.conn.commit()
+        mtime = os.stat(self.path).st_mtime + 1
+        os.utime(self.path, (mtime, mtime))
+        reloaded = RegistryMirror.get(self.path)
+        self.assertIsNot(reloaded, mirror)
+        self.assertEqual(RegistryMirror.stats[(self.path, "raw")]["loads"], loads + 1)
+        self.assertEqual(reloaded.lookup(["ccdnum"], dict(visit=100001)), [])
+
+    def testMirroredLookup(self):
+        mapping = FakeMapping()
+        lookup = MirroredLookup(mapping, self.path)
+        stats = RegistryMirror.stats[(self.path, "raw")]
+        lookups, fallbacks = stats["lookups"], stats["fallbacks"]
+        self.assertEqual(lookup(("objname",), dict(visit=100002, ccdnum=1)), [("obj101",)])
+        self.assertEqual(lookup("filter", dict(visit=100002, tract=3)), [("V",)])
+        self.assertEqual(lookup(["tract"], dict(visit=100002, tract=3)), [])
+        self.assertEqual(mapping.numCalls, 1)
+        self.assertEqual(stats["lookups"], lookups + 2)
+        self.assertEqual(stats["fallbacks"], fallbacks + 1)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
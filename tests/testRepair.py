@@ -0,0 +1,132 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.afw.image as afwImage
+import lsst.meas.algorithms as measAlg
+import lsst.utils.tests
+from lsst.pipe.tasks.repair import RepairConfig, RepairTask
+from lsst.obs.mosaic.repair import makeTiles, mergeTile, MosaicRepairConfig, MosaicRepairTask
+
+
+class TileTestCase(lsst.utils.tests.TestCase):
+    """Test the tiling and stitching of cosmic ray detection"""
+
+    def testTiles(self):
+        width, height, tileSize, overlap = 250, 130, 64, 10
+        tiles = makeTiles(width, height, tileSize, overlap)
+        self.assertEqual(len(tiles), 4*3)
+        count = np.zeros((height, width), dtype=int)
+        for core, tile in tiles:
+            x0, y0, x1, y1 = core
+            count[y0:y1, x0:x1] += 1
+            self.assertLessEqual(tile[0], x0)
+            self.assertLessEqual(tile[1], y0)
+            self.assertGreaterEqual(tile[2], x1)
+            self.assertGreaterEqual(tile[3], y1)
+            # Grown by the overlap, within the image
+            self.assertEqual(tile, (max(x0 - overlap, 0), max(y0 - overlap, 0), min(x1 + overlap, width),
+                                    min(y1 + overlap, height)))
+        # The cores partition the image
+        self.assertTrue(np.all(count == 1))
+
+    def testMerge(self):
+        width, height = 100, 80
+        image = np.zeros((height, width), dtype=np.float32)
+        mask = np.zeros((height, width), dtype=np.uint16)
+        # A cosmic ray across the seam at x=50, seen whole by both tiles
+        track = [(40, x) for x in range(45, 56)]
+        for core, tile in makeTiles(width, height, 50, 8):
+            x0, y0, x1, y1 = core
+            crMask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+            for y, x in track:
+                if x0 <= x < x1 and y0 <= y < y1:
+                    crMask[y - y0, x - x0] = True
+            mergeTile(image, mask, core, crMask, np.full(crMask.sum(), 7.0, dtype=np.float32), 8)
+        crPixels = list(zip(*np.nonzero(mask)))
+        self.assertEqual(sorted(crPixels), sorted(track))
+        self.assertTrue(np.all(mask[mask != 0] == 8))
+        self.assertTrue(np.all(image[mask != 0] == 7.0))
+        self.assertEqual(image.sum(), 7.0*len(track))
+
+
+class CosmicRayTestCase(lsst.utils.tests.TestCase):
+    """Test that tiled cosmic ray detection matches RepairTask.cosmicRay"""
+
+    def setUp(self):
+        width, height, sky = 300, 260, 1000.0
+        rng = np.random.RandomState(12345)
+        self.exposure = afwImage.ExposureF(width, height)
+        maskedImage = self.exposure.getMaskedImage()
+        image = maskedImage.getImage().getArray()
+        image[:] = sky + rng.normal(0.0, np.sqrt(sky), size=(height, width))
+        maskedImage.getVariance().getArray()[:] = sky
+        # Cosmic rays across the seams at x=128 and y=128 of 128-pixel tiles, and one inside a tile
+        tracks = [[(60, x) for x in range(118, 139)],
+                  [(y, 200) for y in range(120, 136)],
+                  [(y, y - 3) for y in range(120, 137)],
+                  [(30, x) for x in range(20, 30)]]
+        for track in tracks:
+            for y, x in track:
+                image[y, x] += 3000.0
+        self.exposure.setPsf(measAlg.SingleGaussianPsf(21, 21, 2.0))
+
+    def tearDown(self):
+        del self.exposure
+
+    def testTiledMatchesWhole(self):
+        """Tiled and whole-image detection find the same CR pixels and repair them alike"""
+        expected = self.exposure.clone()
+        RepairTask(config=RepairConfig()).cosmicRay(expected)
+        expectedMask = expected.getMaskedImage().getMask()
+        crBit = expectedMask.getPlaneBitMask("CR")
+        expectedCrs = (expectedMask.getArray() & crBit) != 0
+        self.assertGreater(expectedCrs.sum(), 0)
+
+        for numProcesses in (1, 2):
+            config = MosaicRepairConfig()
+            config.doTile = True
+            config.tileSize = 128
+            config.tileOverlap = 32
+            config.numProcesses = numProcesses
+            exposure = self.exposure.clone()
+            MosaicRepairTask(config=config).cosmicRay(exposure)
+            mask = exposure.getMaskedImage().getMask()
+            crs = (mask.getArray() & mask.getPlaneBitMask("CR")) != 0
+            self.assertTrue(np.all(crs == expectedCrs))
+            self.assertFloatsAlmostEqual(exposure.getMaskedImage().getImage().getArray(),
+                                         expected.getMaskedImage().getImage().getArray(), atol=1e-3)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
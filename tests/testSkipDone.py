@@ -0,0 +1,150 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import lsst.utils.tests
+from lsst.obs.mosaic.processCcd import MosaicProcessCcdConfig, computeConfigHash, getFingerprintInputs, \
+    writeFingerprint, isUpToDate
+
+
+class FakeDataRef(object):
+    """A data reference to files named <datasetType>.fits in a directory"""
+
+    def __init__(self, root):
+        self.root = root
+        # Datasets whose lookup fails, as for a data ID without the keys they need
+        self.badLookups = set()
+
+    def _path(self, datasetType):
+        return os.path.join(self.root, datasetType + ".fits")
+
+    def datasetExists(self, datasetType):
+        if datasetType in self.badLookups:
+            raise Exception("no such column: %s" % (datasetType,))
+        return os.path.exists(self._path(datasetType))
+
+    def get(self, datasetType):
+        assert datasetType.endswith("_filename")
+        return [self._path(datasetType[:-len("_filename")]) + "[1]"]
+
+
+class SkipDoneTestCase(lsst.utils.tests.TestCase):
+    """Test the fingerprints of MosaicProcessCcdTask"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.dataRef = FakeDataRef(self.root)
+        self.config = MosaicProcessCcdConfig()
+        for datasetType in ["raw", "flat", "calexp", "src", "icSrc"]:
+            self.write(datasetType, datasetType)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, datasetType, text):
+        with open(self.dataRef._path(datasetType), "w") as outfile:
+            outfile.write(text)
+
+    def testFingerprint(self):
+        self.assertFalse(isUpToDate(self.dataRef, self.config))
+        path = writeFingerprint(self.dataRef, self.config)
+        self.assertEqual(path, os.path.join(self.root, "calexp.fingerprint.json"))
+        self.assertTrue(isUpToDate(self.dataRef, self.config))
+
+        # Same contents with a new modification time: checksum matches
+        rawPath = self.dataRef._path("raw")
+        os.utime(rawPath, (time.time() + 10, time.time() + 10))
+        self.assertTrue(isUpToDate(self.dataRef, self.config))
+        self.write("raw", "RAW")
+        self.assertFalse(isUpToDate(self.dataRef, self.config))
+        writeFingerprint(self.dataRef, self.config)
+        self.assertTrue(isUpToDate(self.dataRef, self.config))
+
+        # Skip-mode fields are not in the config hash; other fields are
+        self.config.doSkipDone = True
+        self.assertTrue(isUpToDate(self.dataRef, self.config))
+        hashBefore = computeConfigHash(self.config)
+        self.config.doCalibrate = not self.config.doCalibrate
+        self.assertNotEqual(computeConfigHash(self.config), hashBefore)
+        self.assertFalse(isUpToDate(self.dataRef, self.config))
+        self.config.doCalibrate = not self.config.doCalibrate
+
+        os.remove(self.dataRef._path("src"))
+        self.assertFalse(isUpToDate(self.dataRef, self.config))
+
+    def testCalibrations(self):
+        """A new or changed calibration makes the outputs stale"""
+        writeFingerprint(self.dataRef, self.config)
+        self.assertTrue(isUpToDate(self.dataRef, self.config))
+        self.write("flat", "FLAT")
+        self.assertFalse(isUpToDate(self.dataRef, self.config))
+        writeFingerprint(self.dataRef, self.config)
+        self.write("bias", "bias")
+        self.assertFalse(isUpToDate(self.dataRef, self.config))
+
+    def testDefaultInputs(self):
+        """By default, the inputs are raw and the calibrations the ISR applies"""
+        self.assertEqual(getFingerprintInputs(self.config),
+                         ["raw", "bias", "dark", "flat", "fringe", "defects"])
+        self.config.isr.doDark = False
+        self.config.isr.doFringe = False
+        self.assertEqual(getFingerprintInputs(self.config), ["raw", "bias", "flat", "defects"])
+        writeFingerprint(self.dataRef, self.config)
+        self.write("dark", "dark")
+        self.assertTrue(isUpToDate(self.dataRef, self.config))
+        self.config.fingerprintInputs = ["raw"]
+        self.assertEqual(getFingerprintInputs(self.config), ["raw"])
+
+    def testBadLookup(self):
+        """An input that cannot be looked up for the data ID is missing"""
+        self.config.fingerprintInputs = ["raw", "flat", "bpm"]
+        self.dataRef.badLookups.add("bpm")
+        writeFingerprint(self.dataRef, self.config)
+        self.assertTrue(isUpToDate(self.dataRef, self.config))
+
+    def testNoInputs(self):
+        """Outputs whose inputs are not found are never up to date"""
+        self.config.fingerprintInputs = ["preprocessed"]
+        writeFingerprint(self.dataRef, self.config)
+        self.assertFalse(isUpToDate(self.dataRef, self.config))
+        # The input appears after the fingerprint was written without it
+        self.write("preprocessed", "preprocessed")
+        self.assertFalse(isUpToDate(self.dataRef, self.config))
+        writeFingerprint(self.dataRef, self.config)
+        self.assertTrue(isUpToDate(self.dataRef, self.config))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
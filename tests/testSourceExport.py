@@ -0,0 +1,164 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.table as afwTable
+from lsst.obs.mosaic.sourceExport import (catalogToColumns, writeColumns, getColumnNames, readColumns,
+                                          mergeColumnFiles, MosaicSourceExportTask)
+
+
+def makeRowGroup(ccdExposureId, numRows):
+    return (ccdExposureId, dict(id=np.arange(numRows, dtype=np.int64) + 1000*ccdExposureId,
+                                flux=np.linspace(0.0, 1.0, numRows),
+                                flag=np.arange(numRows) % 2 == 0))
+
+
+class FakeDataRef(object):
+    """A data reference to the catalog of a CCD"""
+
+    def __init__(self, dataset, catalog, path, ccdExposureId):
+        self.dataId = dict(objname="obj1", ccdnum=1)
+        self.dataset = dataset
+        self.catalog = catalog
+        self.path = path
+        self.ccdExposureId = ccdExposureId
+
+    def datasetExists(self, datasetType):
+        return datasetType == self.dataset
+
+    def get(self, datasetType, **kwargs):
+        if datasetType == self.dataset + "_filename":
+            return [self.path]
+        if datasetType == self.dataset:
+            return self.catalog
+        if datasetType == "ccdExposureId":
+            return self.ccdExposureId
+        raise KeyError(datasetType)
+
+
+class SourceExportTestCase(lsst.utils.tests.TestCase):
+    """Test the columnar export of source catalogs"""
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+
+    def testCatalogToColumns(self):
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        fluxKey = schema.addField("base_PsfFlux_flux", type="D", doc="flux")
+        flagKey = schema.addField("calib_psfUsed", type="Flag", doc="used for the PSF")
+        catalog = afwTable.SourceCatalog(schema)
+        for i in range(5):
+            record = catalog.addNew()
+            record.set(fluxKey, 1.5*i)
+            record.set(flagKey, i % 2 == 0)
+        columns = catalogToColumns(catalog, ["id", "base_PsfFlux_flux", "calib_psfUsed"])
+        self.assertEqual(sorted(columns), ["base_PsfFlux_flux", "calib_psfUsed", "id"])
+        self.assertFloatsEqual(columns["base_PsfFlux_flux"], 1.5*np.arange(5))
+        self.assertEqual(list(columns["calib_psfUsed"]), [True, False, True, False, True])
+        self.assertEqual(list(columns["id"]), [record.getId() for record in catalog])
+        columns = catalogToColumns(catalog)
+        self.assertEqual(sorted(columns), ["base_PsfFlux_flux", "calib_psfUsed", "coord_dec", "coord_ra",
+                                           "id", "parent"])
+
+    def testMatch(self):
+        """Test that a packed match catalog is exported with the match columns"""
+        schema = afwTable.Schema()
+        firstKey = schema.addField("first", type="L", doc="reference ID")
+        secondKey = schema.addField("second", type="L", doc="source ID")
+        distanceKey = schema.addField("distance", type="D", doc="distance")
+        catalog = afwTable.BaseCatalog(schema)
+        for i in range(3):
+            record = catalog.addNew()
+            record.set(firstKey, 100 + i)
+            record.set(secondKey, 200 + i)
+            record.set(distanceKey, 0.1*i)
+        config = MosaicSourceExportTask.ConfigClass()
+        config.dataset = "srcMatch"
+        task = MosaicSourceExportTask(config=config)
+        self.assertEqual(task.getColumns(), ["first", "second", "distance"])
+        dataRef = FakeDataRef("srcMatch", catalog, os.path.join(self.tempDir, "obj1", "srcMatch.fits"), 11)
+        result = task.run([dataRef])
+        self.assertEqual(result.path, os.path.join(self.tempDir, "obj1", "obj1_srcMatch.npz"))
+        self.assertEqual(result.numRows, 3)
+        columns = readColumns(result.path)
+        self.assertEqual(sorted(columns), ["ccdExposureId", "distance", "first", "second"])
+        self.assertEqual(list(columns["first"]), [100, 101, 102])
+        self.assertEqual(list(columns["ccdExposureId"]), [11]*3)
+
+        config.dataset = "src"
+        self.assertEqual(MosaicSourceExportTask(config=config).getColumns(), list(config.columns))
+
+    def testWriteRead(self):
+        path = os.path.join(self.tempDir, "visit", "obj1_src.npz")
+        rowGroups = [makeRowGroup(11, 5), makeRowGroup(12, 0), makeRowGroup(13, 3)]
+        self.assertEqual(writeColumns(path, rowGroups), 8)
+        self.assertEqual(sorted(getColumnNames(path)), ["ccdExposureId", "flag", "flux", "id"])
+
+        columns = readColumns(path, ["flux", "ccdExposureId"])
+        self.assertEqual(sorted(columns), ["ccdExposureId", "flux"])
+        self.assertFloatsEqual(columns["flux"], np.concatenate([rowGroups[0][1]["flux"],
+                                                                rowGroups[2][1]["flux"]]))
+        self.assertEqual(list(columns["ccdExposureId"]), [11]*5 + [13]*3)
+
+        columns = readColumns(path, ["id"], ccdExposureIds=[13, 12])
+        self.assertEqual(list(columns["id"]), [13000, 13001, 13002])
+        columns = readColumns(path, ["id"], ccdExposureIds=[99])
+        self.assertEqual(len(columns["id"]), 0)
+        with self.assertRaises(RuntimeError):
+            readColumns(path, ["nonexistent"])
+        with self.assertRaises(RuntimeError):
+            writeColumns(path, [makeRowGroup(1, 2), (2, dict(id=np.arange(2)))])
+
+    def testMerge(self):
+        paths = [os.path.join(self.tempDir, "obj%d_src.npz" % (i,)) for i in (1, 2)]
+        writeColumns(paths[0], [makeRowGroup(11, 2), makeRowGroup(12, 3)])
+        writeColumns(paths[1], [makeRowGroup(21, 4)])
+        outputPath = os.path.join(self.tempDir, "field_src.npz")
+        self.assertEqual(mergeColumnFiles(paths, outputPath), 9)
+        columns = readColumns(outputPath)
+        self.assertEqual(list(columns["ccdExposureId"]), [11]*2 + [12]*3 + [21]*4)
+        self.assertEqual(list(readColumns(outputPath, ["id"], ccdExposureIds=[12])["id"]),
+                         [12000, 12001, 12002])
+        self.assertEqual(list(readColumns(outputPath, ["id"], ccdExposureIds=[21])["id"]),
+                         [21000, 21001, 21002, 21003])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,98 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import time
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.daf.base import PropertySet
+from lsst.obs.mosaic.stageTimer import timeStage, timeStageMethod, getStageValues, summarizeStages
+
+
+class Stepper(object):
+    """A minimal task with metadata"""
+
+    def __init__(self):
+        self.metadata = PropertySet()
+
+    @timeStageMethod()
+    def allocate(self, size):
+        return np.ones(size, dtype=np.uint8)
+
+    @timeStageMethod("pause")
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class StageTimerTestCase(lsst.utils.tests.TestCase):
+    """Test recording and summarizing of stage timing"""
+
+    def testTimeStage(self):
+        stepper = Stepper()
+        stepper.sleep(0.05)
+        stepper.sleep(0.01)
+        self.assertEqual(len(stepper.allocate(1 << 20)), 1 << 20)
+        with timeStage(stepper.metadata, "busy"):
+            sum(range(100000))
+        metadata = stepper.metadata
+        wallTimes = metadata.getArray("pauseStageWallTime")
+        self.assertEqual(len(wallTimes), 2)
+        self.assertGreaterEqual(wallTimes[0], 0.05)
+        self.assertLess(metadata.getArray("pauseStageCpuTime")[0], wallTimes[0])
+        self.assertGreaterEqual(metadata.get("allocateStageMaxRssDelta"), 0)
+        self.assertGreater(metadata.get("busyStageCpuTime"), 0.0)
+
+        values = getStageValues(metadata)
+        self.assertEqual(set(stage for stage, quantity in values), set(["pause", "allocate", "busy"]))
+
+    def testSummarizeStages(self):
+        runs = []
+        for i in range(3):
+            task = PropertySet()
+            task.add("setMaskStageWallTime", 1.0)
+            task.add("setMaskStageMaxRssDelta", 100*i)
+            task.add("overscanCorrectionStageWallTime", 0.4)
+            task.add("overscanCorrectionStageWallTime", 0.4)
+            task.add("runDataRefStartCpuTime", 3.0)  # recorded by timeMethod; not a stage
+            metadata = PropertySet()
+            metadata.set("processCcd:isr", task)
+            runs.append(metadata)
+        summary = summarizeStages(runs)
+        self.assertEqual(list(summary), ["setMask", "overscanCorrection"])
+        self.assertEqual(summary["setMask"]["runs"], 3)
+        self.assertEqual(summary["setMask"]["WallTime"], 3.0)
+        self.assertEqual(summary["setMask"]["MaxRssDelta"], 200)
+        self.assertEqual(summary["overscanCorrection"]["calls"], 6)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
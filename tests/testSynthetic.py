@@ -0,0 +1,109 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.utils.tests
+from lsst.obs.mosaic import synthetic
+from lsst.obs.mosaic.benchmark import MosaicBenchmarkConfig, runBenchmarks, formatBenchmarkResults
+from lsst.obs.mosaic.zpxWcs import ZpxDistortion
+
+
+class SyntheticTestCase(lsst.utils.tests.TestCase):
+    """Test the synthetic repository generator and the benchmarks"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def testRepository(self):
+        shape = (synthetic.BIAS_JUMP_LOCATION + 100, 64)
+        rows = synthetic.makeSyntheticRepository(self.root, numVisits=2, ccdnums=(1, 2), shape=shape)
+        self.assertEqual(len(rows), 4)
+        conn = sqlite3.connect(os.path.join(self.root, "registry.sqlite3"))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM raw").fetchone()[0], 4)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM raw_visit").fetchone()[0], 2)
+        conn.close()
+
+        with fits.open(os.path.join(self.root, synthetic.PREPROCESSED_TEMPLATE % rows[0])) as hduList:
+            self.assertEqual(len(hduList), 1 + len(synthetic.CCDNUMS))
+            self.assertEqual(hduList[1].data.shape, shape)
+            distortion = ZpxDistortion.fromMetadata(hduList[1].header)
+            self.assertEqual(len(distortion.lngcor.coeffs), 6)
+
+        with fits.open(os.path.join(self.root, synthetic.RAW_TEMPLATE % rows[0])) as hduList:
+            for ccdnum in (1, 2):
+                header, data = hduList[ccdnum].header, hduList[ccdnum].data.astype(float)
+                overscan = data[:, shape[1]:]
+                jump = overscan[synthetic.BIAS_JUMP_LOCATION:].mean() - \
+                    overscan[:synthetic.BIAS_JUMP_LOCATION].mean()
+                if header["FPA"] in synthetic.BIAS_JUMP_BACKPLANES:
+                    self.assertAlmostEqual(jump, synthetic.BIAS_JUMP, delta=1.0)
+                else:
+                    self.assertAlmostEqual(jump, 0.0, delta=1.0)
+
+        for row in rows:
+            with fits.open(os.path.join(self.root, synthetic.MASKED_TEMPLATE % row)) as hduList:
+                masked = hduList[1].data
+            self.assertEqual(masked.shape, shape)
+            self.assertTrue(np.any(masked == 0))
+            for fileType in ("instcal", "dqmask", "wtmap"):
+                self.assertTrue(os.path.exists(os.path.join(self.root, row[fileType])))
+
+    def testBenchmarks(self):
+        config = MosaicBenchmarkConfig()
+        config.numVisits = 1
+        config.ccdnums = [1, 3]
+        config.repeat = 1
+        config.benchmarks = ["mapperGet", "ccdExposureId"]
+        results = runBenchmarks(config, root=self.root)
+        self.assertEqual([result.name for result in results], ["mapperGet", "ccdExposureId"])
+        # Only the structure of the results: the time limits are checked by bin/benchmarkMosaic.py
+        for result in results:
+            self.assertGreater(result.units, 0)
+            self.assertGreaterEqual(result.seconds, 0.0)
+            self.assertAlmostEqual(result.perUnit, result.seconds/result.units)
+            self.assertEqual(result.maxSeconds, config.maxSeconds.get(result.name))
+            self.assertIn(result.passed, (True, False))
+        lines = formatBenchmarkResults(results).splitlines()
+        self.assertEqual(len(lines), 1 + len(results))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
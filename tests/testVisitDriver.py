@@ -0,0 +1,104 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import astropy.io.fits as fits
+
+import lsst.utils.tests
+from lsst.obs.mosaic import synthetic
+from lsst.obs.mosaic.visitDriver import VISIT_KEYS, VisitBuffer, groupByVisit
+
+
+class FakeDataRef(object):
+
+    def __init__(self, dataId):
+        self.dataId = dataId
+
+
+class VisitDriverTestCase(lsst.utils.tests.TestCase):
+    """Test the shared visit buffer and the grouping of data references by visit"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def testVisitBuffer(self):
+        shape = (40, 20)
+        visit = synthetic.makeVisits(1)[0]
+        path = synthetic.writePreprocessed(self.root, visit, np.random.RandomState(1), ccdnums=(2, 5),
+                                           shape=shape)
+        buf = VisitBuffer(path, [2, 5], directory=self.root)
+        try:
+            self.assertEqual(buf.nbytes, 2*shape[0]*shape[1]*4)
+            self.assertEqual(buf.primaryHeader["OBSERVAT"], fits.getheader(path, 0)["OBSERVAT"])
+            for ccdnum in (2, 5):
+                with fits.open(path) as hduList:
+                    expected = hduList[ccdnum].data
+                    header = hduList[ccdnum].header
+                np.testing.assert_array_equal(buf.getArray(ccdnum), expected)
+                bufferPath, offset, jobShape, cards, primaryHeader, dataId = \
+                    buf.getJob(ccdnum, dict(ccdnum=ccdnum))
+                self.assertEqual(tuple(jobShape), shape)
+                self.assertEqual(dict(cards)["CRPIX1"], header["CRPIX1"])
+                self.assertNotIn("NAXIS1", dict(cards))
+                self.assertEqual(buf.getCard(ccdnum, "FPA"), header["FPA"])
+            self.assertIsNone(buf.getCard(2, "NOSUCHKEY"))
+
+            # Corrections written to the buffer are seen by the next reader
+            array = buf.getArray(5, writable=True)
+            array[3, 4] = -1.0
+            array.flush()
+            self.assertEqual(buf.getArray(5)[3, 4], -1.0)
+            with self.assertRaises(ValueError):
+                buf.getArray(2)[0, 0] = 0.0
+        finally:
+            buf.close()
+        self.assertFalse(os.path.exists(buf.bufferPath))
+
+    def testGroupByVisit(self):
+        visits = synthetic.makeVisits(2)
+        dataRefs = [FakeDataRef(dict(ccdnum=ccdnum, **dict((key, visit[key]) for key in VISIT_KEYS)))
+                    for ccdnum in (3, 1, 2) for visit in visits]
+        groups = groupByVisit(dataRefs)
+        self.assertEqual(len(groups), 2)
+        for (key, refs), visit in zip(groups, visits):
+            self.assertEqual(key, tuple(visit[name] for name in VISIT_KEYS))
+            self.assertEqual([ref.dataId["ccdnum"] for ref in refs], [1, 2, 3])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,123 @@
+#
+# LSST Data Management System
+# Copyright 2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+from lsst.obs.mosaic.zpxWcs import SurfaceFit, ZpxDistortion, sipPixelToSky
+
+PIXEL_SCALE = 0.258/3600.0
+
+
+def makeZpxMetadata(withCorrections=True):
+    """Make a dict of FITS cards with a DLS-like ZPX Wcs, split into 68-character WAT cards"""
+    md = {"CTYPE1": "RA---ZPX", "CTYPE2": "DEC--ZPX",
+          "CRPIX1": -44.0659, "CRPIX2": 4107.8164,
+          "CRVAL1": 139.04807, "CRVAL2": 30.03947,
+          "CD1_1": -PIXEL_SCALE, "CD1_2": 1e-7, "CD2_1": 2e-7, "CD2_2": PIXEL_SCALE}
+    wat1 = "wtype=zpx axtype=ra projp1=1. projp3=220."
+    wat2 = "wtype=zpx axtype=dec projp1=1. projp3=220."
+    if withCorrections:
+        wat1 += ' lngcor = "3. 4. 4. 2. -0.3 0.3 -0.6 0.6 1e-4 2e-5 -3e-5 4e-6 5e-6 7e-6 1e-5 -2e-6 3e-6 4e-7"'
+        wat2 += ' latcor = "1. 3. 3. 1. -0.3 0.3 -0.6 0.6 -1e-4 2e-5 3e-5 4e-6 -5e-6 7e-6 1e-5 -2e-6 3e-6"'
+    for axis, wat in ((1, wat1), (2, wat2)):
+        for i in range(0, len(wat), 68):
+            # FITS readers strip trailing blanks, which must be restored when parsing
+            md["WAT%d_%03d" % (axis, i//68 + 1)] = wat[i:i + 68].rstrip()
+    return md
+
+
+class ZpxWcsTestCase(lsst.utils.tests.TestCase):
+    """Test parsing and fitting the ZPX Wcs of DLS preprocessed images"""
+
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        self.x = rng.uniform(0, 2047, 1000)
+        self.y = rng.uniform(0, 4095, 1000)
+
+    def testSurfaceTerms(self):
+        """Test the coefficient ordering for each kind of cross terms"""
+        none = SurfaceFit([3, 3, 3, 0, -1, 1, -1, 1] + [0]*5)
+        self.assertEqual(none.terms, [(0, 0), (1, 0), (2, 0), (0, 1), (0, 2)])
+        half = SurfaceFit([3, 3, 3, 2, -1, 1, -1, 1] + [0]*6)
+        self.assertEqual(half.terms, [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (0, 2)])
+        full = SurfaceFit([3, 2, 2, 1, -1, 1, -1, 1] + [0]*4)
+        self.assertEqual(full.terms, [(0, 0), (1, 0), (0, 1), (1, 1)])
+        with self.assertRaises(RuntimeError):
+            SurfaceFit([3, 2, 2, 1, -1, 1, -1, 1] + [0]*3)
+
+    def testChebyshev(self):
+        """Test a Chebyshev surface against a direct evaluation"""
+        surface = SurfaceFit([1, 3, 2, 1, 0, 2, -1, 1, 1, 2, 3, 4, 5, 6])
+        x, y = 1.5, 0.25
+        xn = (2*x - 2)/2
+        xBasis = [1, xn, 2*xn**2 - 1]
+        yBasis = [1, y]
+        expected = sum(c*xBasis[i]*yBasis[j] for c, (i, j) in zip(range(1, 7), surface.terms))
+        self.assertAlmostEqual(float(surface(x, y)), expected)
+
+    def testParseMetadata(self):
+        distortion = ZpxDistortion.fromMetadata(makeZpxMetadata())
+        self.assertEqual(distortion.projp[1], 1.0)
+        self.assertEqual(distortion.projp[3], 220.0)
+        self.assertEqual(len(distortion.lngcor.coeffs), 10)
+        self.assertEqual(len(distortion.latcor.coeffs), 9)
+        with self.assertRaises(RuntimeError):
+            ZpxDistortion.fromMetadata(dict(makeZpxMetadata(), CTYPE1="RA---TAN", CTYPE2="DEC--TAN"))
+
+    def testLinearPart(self):
+        """Without corrections a ZPX with projp1=1 is the ARC projection"""
+        md = dict((k, v) for k, v in makeZpxMetadata(withCorrections=False).items() if "WAT" not in k)
+        distortion = ZpxDistortion.fromMetadata(md)
+        ra, dec = distortion.pixelToSky(1000.0, 200.0)
+        dx = 1001.0 - md["CRPIX1"]
+        dy = 201.0 - md["CRPIX2"]
+        radius = np.hypot(md["CD1_1"]*dx + md["CD1_2"]*dy, md["CD2_1"]*dx + md["CD2_2"]*dy)
+        ra0, dec0 = np.radians(md["CRVAL1"]), np.radians(md["CRVAL2"])
+        sep = np.arccos(np.sin(dec0)*np.sin(np.radians(dec)) +
+                        np.cos(dec0)*np.cos(np.radians(dec))*np.cos(np.radians(ra) - ra0))
+        self.assertAlmostEqual(float(np.degrees(sep)), radius, places=9)
+
+    def testFitSip(self):
+        """Test that the TAN-SIP approximation matches the full solution to a few mas"""
+        distortion = ZpxDistortion.fromMetadata(makeZpxMetadata())
+        cards, maxResidual = distortion.fitSip(2048, 4096, order=4)
+        self.assertLess(maxResidual, 0.005)
+        self.assertEqual(cards["CTYPE1"], "RA---TAN-SIP")
+        ra, dec = distortion.pixelToSky(self.x, self.y)
+        sipRa, sipDec = sipPixelToSky(cards, self.x, self.y)
+        np.testing.assert_allclose(sipRa, ra, atol=0.005/3600)
+        np.testing.assert_allclose(sipDec, dec, atol=0.005/3600)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()